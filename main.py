@@ -11,6 +11,7 @@ MiniCPM-V 视频聊天 Demo - Intel GPU版本
   python main.py --batch            # 批量处理模式
   python main.py --web              # Web界面模式 (Gradio)
   python main.py --test             # 运行测试
+  python main.py --snapshot DIR     # 写入模型快照，之后用 --model DIR 快速启动
 """
 
 # 修复Triton DLL加载问题 - 必须在任何其他导入之前设置
@@ -50,14 +51,25 @@ def print_banner():
     print(banner)
 
 
-def run_interactive_mode(video_path: Optional[str] = None):
+def _model_kwargs(model_path: Optional[str], device: Optional[str] = None) -> dict:
+    """未指定模型路径/设备时使用各组件的默认值"""
+    kwargs = {}
+    if model_path:
+        kwargs['model_path'] = model_path
+    if device:
+        kwargs['device'] = device
+    return kwargs
+
+
+def run_interactive_mode(video_path: Optional[str] = None, model_path: Optional[str] = None,
+                         device: Optional[str] = None):
     """运行交互式模式"""
     try:
         print("\n🚀 正在初始化视频聊天系统...")
         
         # 延迟导入以避免早期加载问题
         from src.chat_with_video.video_chat_interface import VideoChatInterface
-        chat_interface = VideoChatInterface()
+        chat_interface = VideoChatInterface(**_model_kwargs(model_path, device))
         
         if video_path:
             # 单个视频模式
@@ -80,12 +92,7 @@ def run_interactive_mode(video_path: Optional[str] = None):
                 if not question:
                     continue
                 
-                answer = chat_interface.chat_with_video(video_path, question)
-                
-                print("\n🤖 回答:")
-                print("-" * 40)
-                print(answer)
-                print("-" * 40)
+                chat_interface.print_stream_answer(video_path, question)
         else:
             # 完全交互式模式
             chat_interface.interactive_chat()
@@ -99,14 +106,15 @@ def run_interactive_mode(video_path: Optional[str] = None):
     return 0
 
 
-def run_web_mode(host: str = "0.0.0.0", port: int = 7860, share: bool = False):
+def run_web_mode(host: str = "0.0.0.0", port: int = 7860, share: bool = False,
+                 model_path: Optional[str] = None, device: Optional[str] = None):
     """运行Web界面模式"""
     try:
         print("\n🌐 正在启动Web界面模式...")
         print(f"   地址: http://{host}:{port}")
         
         # 创建Gradio应用
-        app = VideoChatGradioApp()
+        app = VideoChatGradioApp(**_model_kwargs(model_path, device))
         
         # 启动应用
         app.launch(
@@ -125,14 +133,14 @@ def run_web_mode(host: str = "0.0.0.0", port: int = 7860, share: bool = False):
     return 0
 
 
-def run_batch_mode():
+def run_batch_mode(model_path: Optional[str] = None, device: Optional[str] = None):
     """运行批量处理模式"""
     try:
         print("\n🚀 正在初始化批量处理系统...")
         
         # 延迟导入
         from src.chat_with_video.video_chat_interface import VideoChatInterface
-        chat_interface = VideoChatInterface()
+        chat_interface = VideoChatInterface(**_model_kwargs(model_path, device))
         
         # 获取视频文件
         video_path = input("\n📁 请输入视频文件路径: ").strip()
@@ -199,6 +207,26 @@ def run_batch_mode():
     return 0
 
 
+def run_snapshot_mode(output_dir: str, model_path: Optional[str] = None, device: Optional[str] = None):
+    """加载模型并写入本地快照"""
+    try:
+        print(f"\n📦 正在创建模型快照: {output_dir}")
+        
+        from src.chat_with_video.model_loader import MiniCPMVInference
+        inference_engine = MiniCPMVInference(**_model_kwargs(model_path, device))
+        
+        start_time = time.time()
+        inference_engine.save_snapshot(output_dir)
+        print(f"\n✅ 快照创建完成，耗时 {time.time() - start_time:.1f}秒")
+        print(f"   使用快照启动: python main.py --model {output_dir}")
+        
+    except Exception as e:
+        print(f"\n❌ 快照创建失败: {str(e)}")
+        return 1
+    
+    return 0
+
+
 def run_test_mode():
     """运行测试模式"""
     try:
@@ -313,6 +341,9 @@ def main():
   python main.py --web                    # Web界面模式 (Gradio)
   python main.py --web --port 8080        # 指定端口的Web模式
   python main.py --test                   # 运行系统测试
+  python main.py --snapshot ./snapshot    # 写入模型快照
+  python main.py --web --model ./snapshot # 从快照快速启动
+  python main.py --web --device cpu       # 使用CPU推理
 
 支持的视频格式: MP4, AVI, MOV, MKV, FLV, WMV, WEBM
         """
@@ -362,6 +393,26 @@ def main():
         help='运行系统测试'
     )
     
+    parser.add_argument(
+        '--model', '-m',
+        type=str,
+        help='模型路径或HuggingFace模型ID（可以是 --snapshot 写入的快照目录）'
+    )
+    
+    parser.add_argument(
+        '--device', '-d',
+        type=str,
+        choices=['xpu', 'cpu'],
+        help='推理设备 (默认: xpu，不可用时自动使用CPU)'
+    )
+    
+    parser.add_argument(
+        '--snapshot',
+        type=str,
+        metavar='DIR',
+        help='加载模型后写入本地快照目录，之后用 --model DIR 快速启动'
+    )
+    
     parser.add_argument(
         '--no-banner',
         action='store_true',
@@ -377,16 +428,20 @@ def main():
     # 根据参数选择运行模式
     if args.test:
         return run_test_mode()
+    elif args.snapshot:
+        return run_snapshot_mode(args.snapshot, args.model, args.device)
     elif args.batch:
-        return run_batch_mode()
+        return run_batch_mode(args.model, args.device)
     elif args.web:
         return run_web_mode(
             host=args.host,
             port=args.port,
-            share=args.share
+            share=args.share,
+            model_path=args.model,
+            device=args.device
         )
     else:
-        return run_interactive_mode(args.video)
+        return run_interactive_mode(args.video, args.model, args.device)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,124 @@
+"""
+生成取消与截止时间 - 取消令牌、墙钟截止时间和对应的停止条件
+前端（Gradio停止按钮、命令行Ctrl+C）或服务层调用cancel()，或者超过截止时间后，
+正在进行的生成在下一个解码步停止并释放模型，已生成的部分作为被截断的回答返回
+"""
+
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import torch
+from transformers import StoppingCriteria
+
+
+class CancellationToken:
+    """一次（或一组）生成请求的取消令牌，可带墙钟截止时间"""
+    
+    def __init__(self, timeout: Optional[float] = None, deadline: Optional[float] = None,
+                 parent: Optional['CancellationToken'] = None):
+        """
+        Args:
+            timeout: 从现在开始的超时秒数
+            deadline: 截止时间（time.time()时间戳），与timeout同时给出时取较早者
+            parent: 父令牌，父令牌取消或超时时本令牌同样停止
+        """
+        if timeout is not None:
+            timeout_deadline = time.time() + timeout
+            deadline = timeout_deadline if deadline is None else min(deadline, timeout_deadline)
+        self.deadline = deadline
+        self.parent = parent
+        
+        self._cancel_reason: Optional[str] = None
+        self._stop_reason: Optional[str] = None
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def for_request(cls, token: Optional['CancellationToken'],
+                    timeout: Optional[float]) -> Optional['CancellationToken']:
+        """调用方令牌加上本次请求的超时；都没有时返回None"""
+        if timeout is None:
+            return token
+        return cls(timeout=timeout, parent=token)
+    
+    def cancel(self, reason: str = '已取消'):
+        """请求停止生成"""
+        with self._lock:
+            if self._cancel_reason is None:
+                self._cancel_reason = reason
+    
+    @property
+    def cancelled(self) -> bool:
+        """是否已被取消（不含超时）"""
+        return self._cancel_reason is not None or (self.parent is not None and self.parent.cancelled)
+    
+    def remaining(self) -> Optional[float]:
+        """距离截止时间的秒数，没有截止时间时为None"""
+        deadlines = [t.deadline for t in self._chain() if t.deadline is not None]
+        if not deadlines:
+            return None
+        return min(deadlines) - time.time()
+    
+    def check(self) -> Optional[str]:
+        """
+        检查是否应当停止；第一次返回停止原因后记录在stop_reason中
+        
+        Returns:
+            停止原因（'已取消'等取消原因或'超时'），不需要停止时为None
+        """
+        if self._stop_reason is not None:
+            return self._stop_reason
+        
+        reason = None
+        for token in self._chain():
+            if token._cancel_reason is not None:
+                reason = token._cancel_reason
+                break
+        if reason is None:
+            remaining = self.remaining()
+            if remaining is not None and remaining <= 0:
+                reason = '超时'
+        
+        if reason is not None:
+            with self._lock:
+                if self._stop_reason is None:
+                    self._stop_reason = reason
+        return self._stop_reason
+    
+    @property
+    def stop_reason(self) -> Optional[str]:
+        """生成过程中观察到的停止原因；生成在此之前已正常结束时为None"""
+        return self._stop_reason
+    
+    def _chain(self):
+        token = self
+        while token is not None:
+            yield token
+            token = token.parent
+
+
+class ChatResult(str):
+    """模型回答文本，附带是否因取消或超时被截断，以及内存不足时使用的降级设置"""
+    
+    def __new__(cls, text: str, stop_reason: Optional[str] = None,
+                degradation: Optional[Dict[str, Any]] = None):
+        result = super().__new__(cls, text)
+        result.stop_reason = stop_reason
+        result.degradation = degradation
+        return result
+    
+    @property
+    def truncated(self) -> bool:
+        """回答是否不完整"""
+        return self.stop_reason is not None
+
+
+class StopOnCancel(StoppingCriteria):
+    """令牌取消或超时时停止HuggingFace generate（每个解码步检查一次）"""
+    
+    def __init__(self, token: CancellationToken):
+        self.token = token
+    
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        stop = self.token.check() is not None
+        return torch.full((input_ids.shape[0],), stop, dtype=torch.bool, device=input_ids.device)
@@ -0,0 +1,236 @@
+"""
+编译执行模式 - 用torch.compile编译视觉编码器和语言模型的前向，并按形状分桶
+视觉编码器的每批图像数、语言模型预填充的token数补齐到少数几个固定大小，
+每个桶只编译一次；解码步（每次1个token、KV长度递增）和复用前缀KV的预填充（前缀长度不固定）
+使用动态形状编译，重新编译次数有上限
+"""
+
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import torch
+import torch.nn as nn
+
+
+# 预填充token数的默认分桶（超过最大桶时补齐到最大桶的整数倍）
+DEFAULT_PROMPT_BUCKETS = (64, 256, 1024, 2048, 3072, 4096, 5120, 6144, 8192)
+
+
+def bucket_size(length: int, buckets: Sequence[int]) -> int:
+    """不小于length的最小桶大小"""
+    for bucket in buckets:
+        if length <= bucket:
+            return bucket
+    largest = buckets[-1]
+    return -(-length // largest) * largest
+
+
+def _map_batch(value: Any, fn: Callable[[torch.Tensor], torch.Tensor], batch_size: int) -> Any:
+    """对第0维等于batch_size的张量（包括嵌套在列表、元组和ModelOutput中的）应用fn"""
+    if isinstance(value, torch.Tensor):
+        return fn(value) if value.dim() > 0 and value.shape[0] == batch_size else value
+    if isinstance(value, dict):
+        # ModelOutput也是dict，逐项替换以保留其类型
+        for key in list(value.keys()):
+            value[key] = _map_batch(value[key], fn, batch_size)
+        return value
+    if type(value) in (list, tuple):
+        return type(value)(_map_batch(v, fn, batch_size) for v in value)
+    return value
+
+
+def _extend_positions(positions: torch.Tensor, pad: int) -> torch.Tensor:
+    """在最后一维之后接着递增补pad个位置"""
+    step = torch.arange(1, pad + 1, device=positions.device, dtype=positions.dtype)
+    return torch.cat([positions, positions[..., -1:] + step], dim=-1)
+
+
+class CompiledExecution:
+    """为MiniCPM-V的视觉编码器和语言模型安装分桶的编译前向"""
+    
+    def __init__(self, model: nn.Module, prompt_buckets: Optional[Sequence[int]] = None,
+                 vision_batch_size: Optional[int] = None, backend: str = 'inductor',
+                 mode: Optional[str] = None):
+        """
+        Args:
+            model: MiniCPM-V模型（包含vpm和llm）
+            prompt_buckets: 预填充token数的分桶，默认DEFAULT_PROMPT_BUCKETS
+            vision_batch_size: 视觉编码器的最大批大小，默认取模型配置的vision_batch_size；
+                               不足一批时补齐到不小于它的2的幂
+            backend: torch.compile后端
+            mode: torch.compile模式（如XPU/CUDA上的'reduce-overhead'）
+        """
+        self.model = model
+        self.prompt_buckets = tuple(sorted(prompt_buckets or DEFAULT_PROMPT_BUCKETS))
+        config = getattr(model, 'config', None)
+        vision_batch_size = vision_batch_size or getattr(config, 'vision_batch_size', 16)
+        self.vision_buckets = tuple(sorted({min(2 ** i, vision_batch_size)
+                                            for i in range(vision_batch_size.bit_length() + 1)}))
+        self.backend = backend
+        self.mode = mode
+        
+        self._originals: List[tuple] = []
+        self.stats: Dict[str, Any] = {'prefill_bucket_calls': {}, 'vision_bucket_calls': {}, 'decode_calls': 0,
+                                      'prefix_prefill_calls': 0}
+    
+    @property
+    def applied(self) -> bool:
+        return bool(self._originals)
+    
+    def _compile(self, fn: Callable, dynamic: bool) -> Callable:
+        return torch.compile(fn, backend=self.backend, mode=self.mode, dynamic=dynamic)
+    
+    def _install(self, module: nn.Module, forward: Callable):
+        self._originals.append((module, 'forward' in vars(module), vars(module).get('forward')))
+        module.forward = forward
+    
+    def apply(self) -> 'CompiledExecution':
+        """替换视觉编码器和语言模型解码器的forward"""
+        if self.applied:
+            return self
+        
+        # 每个桶一个静态图，另外解码步和前缀预填充的动态图，视觉编码器各批大小一个图
+        limit = len(self.prompt_buckets) + len(self.vision_buckets) + 4
+        for name in ('recompile_limit', 'cache_size_limit'):
+            if hasattr(torch._dynamo.config, name):
+                setattr(torch._dynamo.config, name, max(getattr(torch._dynamo.config, name), limit))
+        
+        vpm = getattr(self.model, 'vpm', None)
+        if vpm is not None:
+            self._install(vpm, self._bucketed_vision(vpm.forward))
+        
+        llm = getattr(self.model, 'llm', self.model)
+        decoder = llm.get_decoder() if hasattr(llm, 'get_decoder') else llm.model
+        self._install(decoder, self._bucketed_decoder(decoder))
+        return self
+    
+    def remove(self):
+        """恢复原始的forward（回到eager执行）"""
+        for module, had_instance_attr, previous in reversed(self._originals):
+            if had_instance_attr:
+                module.forward = previous
+            else:
+                del module.forward
+        self._originals = []
+    
+    def _bucketed_vision(self, forward: Callable) -> Callable:
+        """视觉编码器：批大小补齐到桶大小（重复最后一张图像），输出只保留真实图像"""
+        compiled = self._compile(forward, dynamic=False)
+        
+        def bucketed(*args, **kwargs):
+            tensors = [v for v in list(args) + list(kwargs.values()) if isinstance(v, torch.Tensor)]
+            if not tensors:
+                return compiled(*args, **kwargs)
+            
+            batch_size = tensors[0].shape[0]
+            target = bucket_size(batch_size, self.vision_buckets)
+            self.stats['vision_bucket_calls'][target] = self.stats['vision_bucket_calls'].get(target, 0) + 1
+            if target != batch_size:
+                pad = target - batch_size
+                
+                def repeat_last(t):
+                    return torch.cat([t, t[-1:].expand(pad, *t.shape[1:])], dim=0)
+                
+                args = _map_batch(args, repeat_last, batch_size)
+                kwargs = _map_batch(kwargs, repeat_last, batch_size)
+            
+            output = compiled(*args, **kwargs)
+            if target != batch_size:
+                output = _map_batch(output, lambda t: t[:batch_size], target)
+            return output
+        
+        return bucketed
+    
+    def _bucketed_decoder(self, decoder: nn.Module) -> Callable:
+        """
+        语言模型解码器：预填充在序列末尾补零到桶长度（因果注意力下不影响真实token），
+        之后裁掉补齐部分的隐藏状态和KV；单token解码步和接在复用的前缀KV之后的预填充
+        使用动态形状编译，前缀长度变化时不重新编译
+        """
+        forward = decoder.forward
+        prefill = self._compile(forward, dynamic=False)
+        dynamic = self._compile(forward, dynamic=True)
+        
+        def bucketed(*args, **kwargs):
+            if args:
+                return forward(*args, **kwargs)
+            
+            inputs_embeds = kwargs.get('inputs_embeds')
+            if inputs_embeds is None:
+                inputs_embeds = decoder.embed_tokens(kwargs.pop('input_ids'))
+                kwargs['inputs_embeds'] = inputs_embeds
+            
+            length = inputs_embeds.shape[1]
+            if length == 1:
+                self.stats['decode_calls'] += 1
+                return dynamic(**kwargs)
+            
+            cache = kwargs.get('past_key_values')
+            if hasattr(cache, 'get_seq_length') and cache.get_seq_length() > 0:
+                # 复用的前缀KV长度随视频和问题变化，静态图会为每个长度重新编译
+                self.stats['prefix_prefill_calls'] += 1
+                return dynamic(**kwargs)
+            
+            target = bucket_size(length, self.prompt_buckets)
+            self.stats['prefill_bucket_calls'][target] = self.stats['prefill_bucket_calls'].get(target, 0) + 1
+            pad = target - length
+            if pad:
+                kwargs['inputs_embeds'] = torch.nn.functional.pad(inputs_embeds, (0, 0, 0, pad))
+                for key in ('cache_position', 'position_ids'):
+                    if kwargs.get(key) is not None:
+                        kwargs[key] = _extend_positions(kwargs[key], pad)
+                if kwargs.get('attention_mask') is not None and kwargs['attention_mask'].dim() == 2:
+                    kwargs['attention_mask'] = torch.nn.functional.pad(kwargs['attention_mask'], (0, pad), value=1)
+            
+            output = prefill(**kwargs)
+            if pad:
+                cache = getattr(output, 'past_key_values', None)
+                if cache is not None:
+                    cache.crop(cache.get_seq_length() - pad)
+                output.last_hidden_state = output.last_hidden_state[:, :length]
+                if getattr(output, 'hidden_states', None) is not None:
+                    output.hidden_states = tuple(h[:, :length] for h in output.hidden_states)
+            return output
+        
+        return bucketed
+    
+    @torch.no_grad()
+    def warm_up(self, buckets: Optional[Sequence[int]] = None, decode_steps: int = 2) -> Dict[int, float]:
+        """
+        按桶预编译语言模型的预填充图，并编译解码步和复用前缀KV的预填充的动态图
+        
+        Args:
+            buckets: 要预热的预填充桶，默认全部
+            decode_steps: 每个桶之后的解码步数（至少2步，动态图在第二个KV长度时生成）
+        
+        Returns:
+            每个桶的预热耗时（秒）
+        """
+        from transformers import DynamicCache
+        
+        llm = getattr(self.model, 'llm', self.model)
+        embed = llm.get_input_embeddings()
+        device, dtype = embed.weight.device, embed.weight.dtype
+        hidden = embed.weight.shape[1]
+        
+        def decode(cache):
+            for _ in range(decode_steps):
+                llm(input_ids=torch.zeros(1, 1, dtype=torch.long, device=device),
+                    past_key_values=cache, use_cache=True)
+        
+        timings = {}
+        for i, bucket in enumerate(buckets or self.prompt_buckets):
+            start = time.time()
+            cache = DynamicCache()
+            # 比桶少一个token，和实际请求一样走补齐和裁剪KV的路径（裁剪后的KV布局不同，解码步需要单独的图）
+            llm(inputs_embeds=torch.zeros(1, max(bucket - 1, 1), hidden, device=device, dtype=dtype),
+                past_key_values=cache, use_cache=True)
+            decode(cache)
+            if i == 0:
+                # 接在已有KV之后的预填充（复用前缀KV的请求）和其后的解码步，各长度共用动态图
+                llm(inputs_embeds=torch.zeros(1, 2, hidden, device=device, dtype=dtype),
+                    past_key_values=cache, use_cache=True)
+                decode(cache)
+            timings[bucket] = time.time() - start
+            print(f"  预填充桶 {bucket}: {timings[bucket]:.1f}s")
+        return timings
@@ -0,0 +1,116 @@
+"""
+CPU推理后端 - 线程数配置、计算精度选择和LLM线性层动态int8量化
+没有Intel XPU的节点使用CPU推理时，按物理核数设置线程数，
+优先使用CPU原生支持的bf16，可选torch.ao动态int8量化语言模型的线性层
+"""
+
+import os
+from typing import Dict, Optional
+
+import torch
+import torch.nn as nn
+
+
+_DTYPE_ALIASES = {
+    'bfloat16': torch.bfloat16,
+    'bf16': torch.bfloat16,
+    'float32': torch.float32,
+    'fp32': torch.float32,
+}
+
+
+def available_cpu_count() -> int:
+    """当前进程可用的逻辑CPU数（考虑CPU亲和性）"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def physical_core_count() -> int:
+    """
+    当前进程可用的物理核数
+    
+    超线程的两个逻辑核共享计算单元，矩阵乘法线程数超过物理核数通常反而变慢
+    """
+    logical = available_cpu_count()
+    try:
+        import psutil
+        physical_total = psutil.cpu_count(logical=False)
+    except ImportError:
+        physical_total = None
+    
+    total = os.cpu_count() or logical
+    threads_per_core = max(total // physical_total, 1) if physical_total else 1
+    return max(logical // threads_per_core, 1)
+
+
+def configure_cpu_threads(num_threads: Optional[int] = None,
+                          interop_threads: Optional[int] = None) -> Dict[str, int]:
+    """
+    设置PyTorch的算子内/算子间线程数
+    
+    Args:
+        num_threads: 算子内线程数，默认为可用物理核数
+        interop_threads: 算子间线程数，默认为算子内线程数的1/4（1~4）
+    
+    Returns:
+        实际生效的线程配置
+    """
+    num_threads = num_threads or physical_core_count()
+    torch.set_num_threads(num_threads)
+    
+    interop_threads = interop_threads or min(max(num_threads // 4, 1), 4)
+    try:
+        torch.set_num_interop_threads(interop_threads)
+    except RuntimeError:
+        # 算子间线程池只能在第一次并行计算前设置
+        pass
+    
+    return {
+        'num_threads': torch.get_num_threads(),
+        'interop_threads': torch.get_num_interop_threads(),
+    }
+
+
+def cpu_supports_bf16() -> bool:
+    """CPU是否原生支持bf16计算（AVX512-BF16/AMX）"""
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except Exception:
+        return False
+
+
+def select_cpu_dtype(preference: str = 'auto') -> torch.dtype:
+    """
+    选择CPU推理的计算精度
+    
+    Args:
+        preference: 'auto'（支持bf16时用bf16，否则fp32）、'bfloat16'/'bf16' 或 'float32'/'fp32'
+    
+    Returns:
+        torch dtype
+    """
+    if preference == 'auto':
+        return torch.bfloat16 if cpu_supports_bf16() else torch.float32
+    if preference not in _DTYPE_ALIASES:
+        raise ValueError(f"不支持的CPU精度: {preference}，可选: auto, {', '.join(_DTYPE_ALIASES)}")
+    return _DTYPE_ALIASES[preference]
+
+
+def quantize_linear_dynamic(module: nn.Module) -> int:
+    """
+    使用torch.ao动态int8量化模块中的nn.Linear层（原地替换）
+    
+    权重预先量化为int8，激活在运行时按批量化，要求模块为fp32；
+    只替换类型恰好为nn.Linear的层，bitsandbytes等已量化的层保持不变
+    
+    Args:
+        module: 待量化的模块（如语言模型）
+    
+    Returns:
+        被量化的线性层数
+    """
+    count = sum(1 for m in module.modules() if type(m) is nn.Linear)
+    if count:
+        torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return count
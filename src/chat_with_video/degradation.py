@@ -0,0 +1,173 @@
+"""
+内存不足降级阶梯 - 视频编码或模型推理内存不足时逐级降低负载后重试
+默认阶梯依次为：降低分辨率 -> 减少帧数 -> 提高打包数 -> CPU卸载，
+每一级在前一级的基础上累加，对当前输入不产生变化的级（如已达到最大打包数时的提高打包数）跳过，
+重试前释放设备缓存、视觉特征缓存和解码帧缓存
+"""
+
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Sequence, Tuple
+
+import torch
+from PIL import Image
+
+from .feature_cache import EncodedFrames, derive_fingerprint
+
+
+# 各后端内存不足时的错误信息片段（CUDA/XPU/Level Zero/CPU分配器）
+_OOM_MESSAGES = (
+    'out of memory',
+    'out_of_memory',
+    'out of device memory',
+    'out_of_device_memory',
+    "can't allocate memory",
+    'cannot allocate memory',
+    'not enough memory',
+)
+
+
+def is_out_of_memory(error: BaseException) -> bool:
+    """判断异常（包括其原因链）是否为设备或主机内存不足"""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, MemoryError):
+            return True
+        oom_type = getattr(torch, 'OutOfMemoryError', None)
+        if oom_type is not None and isinstance(error, oom_type):
+            return True
+        message = str(error).lower()
+        if any(fragment in message for fragment in _OOM_MESSAGES):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+@dataclass(frozen=True)
+class DegradationStep:
+    """降级阶梯中的一级"""
+    
+    name: str
+    resolution_scale: float = 1.0  # 帧分辨率缩放比例，小于1时同时取消关键帧高分辨率切片
+    frame_fraction: float = 1.0    # 按时序组均匀保留的比例
+    packing_factor: int = 1        # 打包数量放大倍数（不超过最大打包数）
+    cpu_offload: bool = False      # 把模型临时移到CPU执行
+    
+    @property
+    def degraded(self) -> bool:
+        """是否偏离原始设置"""
+        return (self.resolution_scale < 1.0 or self.frame_fraction < 1.0
+                or self.packing_factor > 1 or self.cpu_offload)
+    
+    def settings(self) -> Dict[str, Any]:
+        """降级设置（用于记录在回答和服务信息中）"""
+        return asdict(self)
+
+
+DEFAULT_OOM_LADDER = (
+    DegradationStep('原始设置'),
+    DegradationStep('降低分辨率', resolution_scale=0.5),
+    DegradationStep('减少帧数', resolution_scale=0.5, frame_fraction=0.5),
+    DegradationStep('提高打包数', resolution_scale=0.5, frame_fraction=0.5, packing_factor=2),
+    DegradationStep('CPU卸载', resolution_scale=0.5, frame_fraction=0.5, packing_factor=2, cpu_offload=True),
+)
+
+
+def scaled_size(width: int, height: int, scale: float) -> Tuple[int, int]:
+    """按比例缩放后的分辨率（至少1像素）"""
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def effective_settings(step: DegradationStep, num_groups: int, packing: int,
+                       max_packing: int) -> Tuple[float, int, int, bool]:
+    """
+    降级设置对给定形状的输入实际产生的效果，与degrade_frames的处理一致
+    
+    Args:
+        step: 降级设置
+        num_groups: 时序组数
+        packing: 每组帧数（打包数）
+        max_packing: 最大打包数量
+    
+    Returns:
+        (分辨率缩放比例, 保留的时序组数, 打包数, 是否CPU卸载)
+    """
+    groups = num_groups
+    if step.frame_fraction < 1.0 and num_groups > 1:
+        groups = max(1, round(num_groups * step.frame_fraction))
+    # 只剩一个时序组时没有可合并的相邻组
+    target = packing
+    if groups > 1:
+        target = max(packing, min(max_packing, packing * step.packing_factor))
+    return step.resolution_scale, groups, target, step.cpu_offload
+
+
+def applicable_steps(steps: Sequence[DegradationStep], num_groups: int, packing: int,
+                     max_packing: int) -> List[DegradationStep]:
+    """
+    去掉阶梯中对给定形状的输入不产生变化的级
+    
+    例如只有一个时序组时的减少帧数和提高打包数、已达到最大打包数时的提高打包数，
+    这些级与前一级的输入相同，重试只会再次内存不足
+    
+    Returns:
+        实际需要尝试的降级设置
+    """
+    kept, previous = [], None
+    for step in steps:
+        settings = effective_settings(step, num_groups, packing, max_packing)
+        if settings != previous:
+            kept.append(step)
+            previous = settings
+    return kept
+
+
+def degrade_frames(frames: List[Image.Image], temporal_ids: List[List[int]], step: DegradationStep,
+                   max_packing: int, resize: bool = True) -> Tuple[List[Image.Image], List[List[int]]]:
+    """
+    按降级设置处理已解码的帧
+    
+    Args:
+        frames: PIL图像帧列表（按时序组顺序排列）
+        temporal_ids: 时序ID分组列表
+        step: 降级设置
+        max_packing: 最大打包数量
+        resize: 是否按resolution_scale缩小帧（解码时已按缩小的分辨率解码则为False）
+    
+    Returns:
+        (帧列表, 时序ID分组列表)；输入为EncodedFrames时输出也附带由降级设置派生的指纹
+    """
+    if not step.degraded:
+        return frames, temporal_ids
+    
+    source = frames
+    if sum(len(ids) for ids in temporal_ids) == len(frames) and temporal_ids:
+        groups, start = [], 0
+        for ids in temporal_ids:
+            groups.append((frames[start:start + len(ids)], list(ids)))
+            start += len(ids)
+        
+        # 均匀保留部分时序组（每组对应固定数量的视觉token）
+        if step.frame_fraction < 1.0 and len(groups) > 1:
+            keep = max(1, round(len(groups) * step.frame_fraction))
+            gap = len(groups) / keep
+            groups = [groups[int(i * gap + gap / 2)] for i in range(keep)]
+        
+        frames = [frame for group_frames, _ in groups for frame in group_frames]
+        temporal_ids = [ids for _, ids in groups]
+        
+        # 合并相邻时序组，提高打包数量
+        packing = max(len(ids) for ids in temporal_ids)
+        target = min(max_packing, packing * step.packing_factor)
+        if target > packing:
+            flat = [t for ids in temporal_ids for t in ids]
+            temporal_ids = [flat[i:i + target] for i in range(0, len(flat), target)]
+    
+    if resize and step.resolution_scale < 1.0:
+        frames = [frame.resize(scaled_size(*frame.size, step.resolution_scale), Image.BILINEAR)
+                  for frame in frames]
+    
+    fingerprint = getattr(source, 'fingerprint', None)
+    if fingerprint is not None:
+        frames = EncodedFrames(frames, derive_fingerprint(fingerprint, step.settings(), max_packing, resize))
+    return frames, temporal_ids
@@ -0,0 +1,307 @@
+"""
+快速模型加载 - 并行读取safetensors分片并直接放到目标设备
+在meta设备上构建模型结构，多线程读取各分片，张量逐个转换dtype后直接写到目标设备，
+避免先在CPU上完整加载再逐层移动，主机内存峰值接近一份权重，并输出分阶段耗时报告
+"""
+
+import json
+import os
+import re
+import struct
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import torch
+
+from .loading_scope import inherit_loading_scope, scoped_env
+
+
+class LoadTimer:
+    """分阶段计时"""
+    
+    def __init__(self):
+        self.phases: "OrderedDict[str, float]" = OrderedDict()
+    
+    @contextmanager
+    def phase(self, name: str):
+        """记录一个阶段的耗时"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.time() - start
+    
+    @property
+    def total(self) -> float:
+        return sum(self.phases.values())
+    
+    def report(self, title: str = "模型加载耗时"):
+        """打印分阶段耗时报告"""
+        total = self.total
+        print(f"⏱️ {title}: {total:.2f}秒")
+        for name, seconds in self.phases.items():
+            percentage = seconds / total * 100 if total > 0 else 0
+            print(f"  {name}: {seconds:.2f}秒 ({percentage:.1f}%)")
+
+
+def resolve_checkpoint_dir(model_path: str) -> str:
+    """
+    获取模型文件所在的本地目录
+    
+    Args:
+        model_path: 本地目录或HuggingFace模型ID
+    
+    Returns:
+        本地目录路径（模型ID会下载或使用本地缓存）
+    """
+    if os.path.isdir(model_path):
+        return model_path
+    
+    from huggingface_hub import snapshot_download
+    return snapshot_download(model_path)
+
+
+def checkpoint_shards(checkpoint_dir: str) -> List[str]:
+    """
+    列出safetensors权重分片
+    
+    Returns:
+        分片文件路径列表，没有safetensors权重时为空
+    """
+    index_file = os.path.join(checkpoint_dir, 'model.safetensors.index.json')
+    if os.path.exists(index_file):
+        with open(index_file, 'r', encoding='utf-8') as f:
+            weight_map = json.load(f)['weight_map']
+        return [os.path.join(checkpoint_dir, name) for name in sorted(set(weight_map.values()))]
+    
+    single_file = os.path.join(checkpoint_dir, 'model.safetensors')
+    return [single_file] if os.path.exists(single_file) else []
+
+
+def _load_shard(path: str, device: str, dtype: torch.dtype) -> Dict[str, torch.Tensor]:
+    """读取一个分片，浮点张量转换为目标dtype后放到目标设备"""
+    from safetensors import safe_open
+    
+    def convert(tensor: torch.Tensor) -> torch.Tensor:
+        if tensor.is_floating_point():
+            return tensor.to(device=device, dtype=dtype)
+        return tensor.to(device=device)
+    
+    try:
+        # safetensors直接在目标设备上创建张量
+        handle = safe_open(path, framework='pt', device=device)
+    except Exception:
+        handle = safe_open(path, framework='pt', device='cpu')
+    
+    tensors = {}
+    with handle as f:
+        for name in f.keys():
+            # 逐个张量转换，CPU上的临时副本随即释放
+            tensors[name] = convert(f.get_tensor(name))
+    return tensors
+
+
+def load_shards_parallel(paths: List[str], device: str, dtype: torch.dtype,
+                         num_workers: Optional[int] = None) -> Dict[str, torch.Tensor]:
+    """
+    多线程并行读取权重分片
+    
+    Args:
+        paths: 分片文件路径
+        device: 目标设备
+        dtype: 浮点权重的目标dtype
+        num_workers: 读取线程数，默认为 min(分片数, 8)
+    
+    Returns:
+        合并后的state_dict
+    """
+    num_workers = num_workers or min(len(paths), 8)
+    state_dict: Dict[str, torch.Tensor] = {}
+    # 读取线程与调用线程处于同一加载作用域，看到相同的显存查询替换
+    load = inherit_loading_scope(lambda p: _load_shard(p, device, dtype))
+    with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as executor:
+        for tensors in executor.map(load, paths):
+            state_dict.update(tensors)
+    return state_dict
+
+
+_SAFETENSORS_DTYPES = {
+    'F64': torch.float64, 'F32': torch.float32, 'F16': torch.float16, 'BF16': torch.bfloat16,
+    'I64': torch.int64, 'I32': torch.int32, 'I16': torch.int16, 'I8': torch.int8,
+    'U8': torch.uint8, 'BOOL': torch.bool,
+}
+
+
+def map_safetensors(path: str) -> Dict[str, torch.Tensor]:
+    """
+    把safetensors文件映射为CPU张量，不读取数据
+    
+    张量共享文件的私有内存映射（写时复制），页面在首次访问时才从磁盘读入
+    
+    Args:
+        path: safetensors文件路径
+    
+    Returns:
+        名称到张量的映射
+    """
+    with open(path, 'rb') as f:
+        header_len = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_len))
+    header.pop('__metadata__', None)
+    
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=os.path.getsize(path))
+    data = torch.empty(0, dtype=torch.uint8).set_(storage)
+    base = 8 + header_len
+    
+    tensors = {}
+    for name, info in header.items():
+        start, end = info['data_offsets']
+        raw = data[base + start:base + end]
+        dtype = _SAFETENSORS_DTYPES[info['dtype']]
+        try:
+            tensor = raw.view(dtype)
+        except RuntimeError:
+            # 偏移未按元素大小对齐时只能复制
+            tensor = raw.clone().view(dtype)
+        tensors[name] = tensor.reshape(info['shape'])
+    return tensors
+
+
+def load_shards_mapped(paths: List[str], device: str, dtype: torch.dtype) -> Dict[str, torch.Tensor]:
+    """
+    以内存映射方式加载权重分片
+    
+    目标为CPU且dtype一致时直接使用映射的张量（按需读入），否则逐个张量转换/复制到目标设备
+    
+    Args:
+        paths: 分片文件路径
+        device: 目标设备
+        dtype: 浮点权重的目标dtype
+    
+    Returns:
+        合并后的state_dict
+    """
+    state_dict: Dict[str, torch.Tensor] = {}
+    for path in paths:
+        for name, tensor in map_safetensors(path).items():
+            if tensor.is_floating_point():
+                state_dict[name] = tensor.to(device=device, dtype=dtype)
+            else:
+                state_dict[name] = tensor.to(device=device)
+    return state_dict
+
+
+def fast_load_model(checkpoint_dir: str, device: str, dtype: torch.dtype = torch.float16,
+                    timer: Optional[LoadTimer] = None, num_workers: Optional[int] = None,
+                    mmap: bool = False):
+    """
+    在meta设备上构建模型并并行加载权重到目标设备
+    
+    量化模型（config中有quantization_config）需要transformers的量化器替换层，
+    不走此路径，返回None由调用方使用load_pretrained_to_device
+    
+    Args:
+        checkpoint_dir: 模型本地目录
+        device: 目标设备
+        dtype: 浮点权重dtype
+        timer: 分阶段计时器
+        num_workers: 读取分片的线程数
+        mmap: 以内存映射方式按需读入权重（用于本地快照）
+    
+    Returns:
+        加载完成的模型，不适用时返回None
+    """
+    from accelerate import init_empty_weights
+    from transformers import AutoConfig, AutoModel
+    
+    timer = timer or LoadTimer()
+    
+    with timer.phase("解析配置"):
+        config = AutoConfig.from_pretrained(checkpoint_dir, trust_remote_code=True)
+        config.torch_dtype = dtype
+        shards = checkpoint_shards(checkpoint_dir)
+    
+    if getattr(config, 'quantization_config', None) is not None or not shards:
+        return None
+    
+    with timer.phase("构建模型结构"):
+        # 参数放在meta设备上不分配内存，缓冲区（如rotary的inv_freq）正常创建
+        with init_empty_weights(include_buffers=False):
+            model = AutoModel.from_config(config, trust_remote_code=True, torch_dtype=dtype)
+    
+    if mmap:
+        with timer.phase(f"映射权重 ({len(shards)} 个分片)"):
+            state_dict = load_shards_mapped(shards, device, dtype)
+    else:
+        with timer.phase(f"并行读取权重 ({len(shards)} 个分片)"):
+            state_dict = load_shards_parallel(shards, device, dtype, num_workers)
+    
+    with timer.phase("装配权重"):
+        result = model.load_state_dict(state_dict, strict=False, assign=True)
+        del state_dict
+        
+        # 权重名与模型结构对不上时（如配置与检查点不匹配）不能静默忽略，
+        # 模型自己声明可忽略的多余权重除外
+        ignored = getattr(model, '_keys_to_ignore_on_load_unexpected', None) or []
+        unexpected = [name for name in result.unexpected_keys
+                      if not any(re.search(pattern, name) for pattern in ignored)]
+        if unexpected:
+            raise RuntimeError(f"检查点包含模型中不存在的 {len(unexpected)} 个参数，例如: {unexpected[:3]}")
+        
+        if hasattr(model, 'tie_weights'):
+            model.tie_weights()
+        
+        missing = [name for name, param in model.named_parameters() if param.device.type == 'meta']
+        if missing:
+            raise RuntimeError(f"检查点缺少 {len(missing)} 个参数，例如: {missing[:3]}")
+        
+        # 构建时创建的缓冲区仍在CPU上，移动到目标设备
+        for module in model.modules():
+            for name, buffer in module.named_buffers(recurse=False):
+                if buffer is not None and buffer.device != torch.device(device):
+                    module._buffers[name] = buffer.to(device)
+    
+    return model.eval()
+
+
+def load_pretrained_to_device(checkpoint_dir: str, device: str, dtype: torch.dtype = torch.float16,
+                              timer: Optional[LoadTimer] = None, num_workers: Optional[int] = None):
+    """
+    使用from_pretrained直接把权重加载到目标设备（量化模型）
+    
+    通过device_map让transformers在读取分片时直接放到目标设备，
+    并开启transformers的多线程分片加载
+    
+    Args:
+        checkpoint_dir: 模型本地目录
+        device: 目标设备
+        dtype: 浮点权重dtype
+        timer: 分阶段计时器
+        num_workers: 读取分片的线程数
+    
+    Returns:
+        加载完成的模型
+    """
+    from transformers import AutoModel
+    
+    timer = timer or LoadTimer()
+    shards = checkpoint_shards(checkpoint_dir)
+    
+    parallel_env = {
+        'HF_ENABLE_PARALLEL_LOADING': 'true',
+        'HF_PARALLEL_LOADING_WORKERS': str(num_workers or max(min(len(shards), 8), 1)),
+    }
+    # 环境变量是进程级的，和并行加载的其他副本共享并按引用计数恢复
+    with scoped_env(parallel_env), timer.phase(f"加载并放置权重 ({len(shards)} 个分片)"):
+        model = AutoModel.from_pretrained(
+            checkpoint_dir,
+            trust_remote_code=True,
+            torch_dtype=dtype,
+            low_cpu_mem_usage=True,
+            device_map={'': device},
+        )
+    
+    return model.eval()
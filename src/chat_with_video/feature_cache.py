@@ -0,0 +1,186 @@
+"""
+视觉特征缓存 - 同一视频的后续提问复用视觉编码结果
+缓存视觉编码器 + 3D重采样器的输出（vision_hidden_states），
+键为帧集合指纹和时序ID，第二次及以后的提问只需要LLM预填充和解码；
+视频编码得到的帧（EncodedFrames）携带编码时计算的指纹，提问时不再哈希像素
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Hashable, List, Optional, Sequence
+
+from PIL import Image
+
+
+def _frame_digest(frame: Image.Image) -> bytes:
+    """单帧完整像素数据（含模式和分辨率）的哈希"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((frame.mode, frame.size)).encode())
+    digest.update(frame.tobytes())
+    return digest.digest()
+
+
+class EncodedFrames(list):
+    """
+    视频编码得到的帧列表，附带编码时由视频文件指纹和采样参数计算的指纹
+    
+    帧集合指纹直接使用该指纹而不再哈希像素；修改列表中的帧后应使用普通列表（按像素计算指纹）
+    """
+    
+    def __init__(self, frames: Sequence[Image.Image] = (), fingerprint: Optional[str] = None):
+        super().__init__(frames)
+        self.fingerprint = fingerprint
+
+
+def derive_fingerprint(*parts: Any) -> str:
+    """由已有指纹和参数（可repr的值）派生新的指纹"""
+    return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+
+def frame_set_fingerprint(frames: Sequence[Image.Image], temporal_ids: Optional[List[List[int]]],
+                          extra: Sequence[Any] = ()) -> str:
+    """
+    计算帧集合指纹
+    
+    EncodedFrames使用编码时的指纹；其他帧列表对每帧的完整像素数据哈希，任何像素不同的帧集合
+    都得到不同的指纹（视觉特征、前缀KV和像素缓存共用此键，采样哈希可能让不同的视频命中彼此的缓存）。
+    hashlib哈希大块数据时释放GIL，多帧时用线程池并行计算
+    
+    Args:
+        frames: PIL图像帧列表
+        temporal_ids: 时序ID分组
+        extra: 其他影响视觉特征的参数（如切片数）
+    
+    Returns:
+        指纹字符串
+    """
+    fingerprint = getattr(frames, 'fingerprint', None)
+    if fingerprint is not None:
+        return derive_fingerprint(fingerprint, len(frames), temporal_ids, tuple(extra))
+    
+    workers = min(os.cpu_count() or 1, 8, len(frames))
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            frame_digests = list(pool.map(_frame_digest, frames))
+    else:
+        frame_digests = [_frame_digest(frame) for frame in frames]
+    
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((len(frames), temporal_ids, tuple(extra))).encode())
+    for frame_digest in frame_digests:
+        digest.update(frame_digest)
+    return digest.hexdigest()
+
+
+def _nbytes(value: Any) -> int:
+    """递归计算张量（或张量列表、字典、numpy数组）占用的字节数"""
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(v) for v in value)
+    if isinstance(value, Mapping):
+        return sum(_nbytes(v) for v in value.values())
+    if hasattr(value, 'element_size') and hasattr(value, 'numel'):
+        return value.element_size() * value.numel()
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    return 0
+
+
+class VisionFeatureCache:
+    """视觉特征LRU缓存，按占用字节数淘汰"""
+    
+    def __init__(self, max_bytes: int = 1024**3):
+        """
+        初始化视觉特征缓存
+        
+        Args:
+            max_bytes: 缓存占用的最大字节数，0表示禁用
+        """
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._sizes: Dict[Hashable, int] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    @property
+    def enabled(self) -> bool:
+        """缓存是否启用"""
+        return self.max_bytes > 0
+    
+    def __contains__(self, key: Hashable) -> bool:
+        """是否已缓存（不计入命中统计）"""
+        with self._lock:
+            return key in self._entries
+    
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        查询缓存
+        
+        Args:
+            key: 缓存键
+        
+        Returns:
+            缓存的视觉特征，未命中返回None
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+    
+    def put(self, key: Hashable, value: Any):
+        """
+        写入缓存
+        
+        Args:
+            key: 缓存键
+            value: 视觉特征（张量列表）
+        """
+        size = _nbytes(value)
+        if not self.enabled or size > self.max_bytes:
+            return
+        
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._sizes.pop(key)
+                del self._entries[key]
+            
+            self._entries[key] = value
+            self._sizes[key] = size
+            self._bytes += size
+            
+            while self._bytes > self.max_bytes and self._entries:
+                old_key, _ = self._entries.popitem(last=False)
+                self._bytes -= self._sizes.pop(old_key)
+                self.evictions += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        """获取缓存统计信息"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'size_mb': self._bytes / 1024**2,
+                'max_size_mb': self.max_bytes / 1024**2,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / total if total else 0.0,
+            }
+    
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._bytes = 0
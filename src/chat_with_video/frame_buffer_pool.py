@@ -0,0 +1,171 @@
+"""
+帧缓冲池 - 复用解码帧缓冲区
+避免每次视频编码都重新分配数百MB的numpy数组，降低长时间运行服务的堆碎片和RSS增长。
+缓冲区按实际编码的帧数和分辨率分配，只在更大的请求到来时增长，池保留的内存
+不超过 num_buffers x 最近的峰值请求，而不是按最坏情况预留；
+decord的get_batch仍会为每个解码块分配临时数组，缓冲池只限制整段视频的峰值占用
+"""
+
+import threading
+from typing import Dict, List, Optional, Tuple, Any
+
+import numpy as np
+
+
+class FrameBuffer:
+    """从缓冲池借出的帧缓冲区"""
+    
+    def __init__(self, pool: Optional["FrameBufferPool"], storage: np.ndarray,
+                 num_frames: int, height: int, width: int):
+        """
+        初始化帧缓冲区
+        
+        Args:
+            pool: 所属缓冲池，None表示不归还到任何缓冲池
+            storage: 底层一维uint8存储
+            num_frames: 帧数
+            height: 帧高度
+            width: 帧宽度
+        """
+        self._pool = pool
+        self._storage = storage
+        self.array = storage[:num_frames * height * width * 3].reshape(num_frames, height, width, 3)
+    
+    def release(self):
+        """归还缓冲区，之后不能再访问array"""
+        if self._storage is None:
+            return
+        if self._pool is not None:
+            self._pool._return(self._storage)
+        self._storage = None
+        self.array = None
+    
+    def __enter__(self) -> "FrameBuffer":
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class FrameBufferPool:
+    """预分配的帧缓冲池"""
+    
+    def __init__(self, max_frames: int = 0, resolution: Tuple[int, int] = (1280, 720),
+                 num_buffers: int = 2, preallocate: bool = False):
+        """
+        初始化帧缓冲池
+        
+        Args:
+            max_frames: 预分配时每个缓冲区容纳的帧数
+            resolution: 预分配时的帧分辨率 (width, height)
+            num_buffers: 池中保留的缓冲区数量，即可同时进行的编码数
+            preallocate: 是否在初始化时按 max_frames x resolution 分配全部缓冲区（默认按需分配）
+        """
+        width, height = resolution
+        self.num_buffers = num_buffers
+        
+        self._free: List[np.ndarray] = []
+        self._owned = 0
+        self._owned_bytes = 0
+        self._lock = threading.Lock()
+        
+        # 监控计数器
+        self.counters: Dict[str, int] = {
+            'acquires': 0,
+            'reuses': 0,
+            'allocations': 0,
+            'grows': 0,
+            'overflow_allocations': 0,
+            'in_use': 0,
+            'peak_in_use': 0,
+        }
+        
+        if preallocate:
+            for _ in range(num_buffers):
+                self._free.append(self._allocate(max_frames * width * height * 3))
+                self._owned += 1
+    
+    def _allocate(self, nbytes: int) -> np.ndarray:
+        """分配新的池内存储"""
+        self.counters['allocations'] += 1
+        self._owned_bytes += nbytes
+        return np.empty(nbytes, dtype=np.uint8)
+    
+    def acquire(self, num_frames: int, height: int, width: int) -> FrameBuffer:
+        """
+        借出一个能容纳指定帧数和分辨率的缓冲区
+        
+        Args:
+            num_frames: 帧数
+            height: 帧高度
+            width: 帧宽度
+        
+        Returns:
+            帧缓冲区，使用完毕后需调用release()归还
+        """
+        needed = num_frames * height * width * 3
+        
+        with self._lock:
+            self.counters['acquires'] += 1
+            self.counters['in_use'] += 1
+            self.counters['peak_in_use'] = max(self.counters['peak_in_use'], self.counters['in_use'])
+            
+            # 优先复用足够大的空闲缓冲区
+            for i, storage in enumerate(self._free):
+                if storage.nbytes >= needed:
+                    self.counters['reuses'] += 1
+                    return FrameBuffer(self, self._free.pop(i), num_frames, height, width)
+            
+            # 空闲缓冲区都太小，用按本次大小分配的缓冲区替换其中最小的一个
+            if self._free:
+                smallest = min(range(len(self._free)), key=lambda i: self._free[i].nbytes)
+                self._owned_bytes -= self._free.pop(smallest).nbytes
+                self.counters['grows'] += 1
+                return FrameBuffer(self, self._allocate(needed), num_frames, height, width)
+            
+            # 池未满，新建缓冲区
+            if self._owned < self.num_buffers:
+                self._owned += 1
+                return FrameBuffer(self, self._allocate(needed), num_frames, height, width)
+            
+            # 池已满且全部借出，临时分配，用完后直接释放
+            self.counters['overflow_allocations'] += 1
+            self.counters['allocations'] += 1
+            storage = np.empty(needed, dtype=np.uint8)
+            return _OverflowFrameBuffer(self, storage, num_frames, height, width)
+    
+    def _return(self, storage: np.ndarray):
+        """归还缓冲区（由FrameBuffer.release调用）"""
+        with self._lock:
+            self.counters['in_use'] -= 1
+            self._free.append(storage)
+    
+    def _return_overflow(self):
+        """归还临时缓冲区（只更新计数）"""
+        with self._lock:
+            self.counters['in_use'] -= 1
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        获取缓冲池统计信息
+        
+        Returns:
+            统计信息字典
+        """
+        with self._lock:
+            stats = dict(self.counters)
+            stats['pooled_buffers'] = self._owned
+            stats['free_buffers'] = len(self._free)
+            stats['pooled_size_mb'] = self._owned_bytes / 1024**2
+            return stats
+
+
+class _OverflowFrameBuffer(FrameBuffer):
+    """池已满时临时分配的缓冲区，归还时不回到池中"""
+    
+    def release(self):
+        if self._storage is None:
+            return
+        self._pool._return_overflow()
+        self._storage = None
+        self.array = None
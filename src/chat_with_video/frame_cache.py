@@ -0,0 +1,164 @@
+"""
+解码帧缓存 - 按帧缓存已解码的视频帧
+缓存键为 (视频指纹, 帧索引, 解码分辨率)，调整采样帧率或打包数量后
+重新规划的帧索引中已解码过的帧可以直接复用，只需解码缺失的帧
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Tuple, Any
+
+import numpy as np
+
+
+# 解码分辨率 (width, height)，(-1, -1) 表示原始分辨率，与decord的默认值保持一致
+NATIVE_RESOLUTION = (-1, -1)
+
+
+def video_fingerprint(video_path: str) -> str:
+    """
+    计算视频文件指纹
+    
+    使用绝对路径、文件大小和修改时间组合，无需读取文件内容
+    
+    Args:
+        video_path: 视频文件路径
+    
+    Returns:
+        视频指纹字符串
+    """
+    stat = os.stat(video_path)
+    return f"{os.path.abspath(video_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class FrameCache:
+    """按帧缓存的解码帧LRU缓存"""
+    
+    def __init__(self, max_bytes: int = 2 * 1024**3):
+        """
+        初始化解码帧缓存
+        
+        Args:
+            max_bytes: 缓存占用的最大字节数，超过后按LRU顺序淘汰，0表示禁用缓存
+        """
+        self.max_bytes = max_bytes
+        self._frames: "OrderedDict[Tuple[str, int, Tuple[int, int]], np.ndarray]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        
+        # 累计统计
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    @property
+    def enabled(self) -> bool:
+        """缓存是否启用"""
+        return self.max_bytes > 0
+    
+    def lookup(self, fingerprint: str, frame_indices: List[int],
+               resolution: Tuple[int, int] = NATIVE_RESOLUTION) -> Tuple[Dict[int, np.ndarray], List[int]]:
+        """
+        查询缓存中的帧
+        
+        Args:
+            fingerprint: 视频指纹
+            frame_indices: 需要的帧索引列表
+            resolution: 解码分辨率
+        
+        Returns:
+            Tuple[cached, missing]:
+                - cached: 命中的 {帧索引: 帧数据}
+                - missing: 未命中、需要解码的帧索引列表（保持原顺序）
+        """
+        cached: Dict[int, np.ndarray] = {}
+        missing: List[int] = []
+        
+        with self._lock:
+            for idx in frame_indices:
+                key = (fingerprint, int(idx), tuple(resolution))
+                frame = self._frames.get(key)
+                if frame is None:
+                    missing.append(int(idx))
+                else:
+                    self._frames.move_to_end(key)
+                    cached[int(idx)] = frame
+            
+            self.hits += len(cached)
+            self.misses += len(missing)
+        
+        return cached, missing
+    
+    def missing_indices(self, fingerprint: str, frame_indices: List[int],
+                        resolution: Tuple[int, int] = NATIVE_RESOLUTION) -> List[int]:
+        """
+        返回不在缓存中的帧索引（不计入命中统计，也不改变LRU顺序）
+        
+        Args:
+            fingerprint: 视频指纹
+            frame_indices: 帧索引列表
+            resolution: 解码分辨率
+            
+        Returns:
+            未缓存的帧索引列表
+        """
+        with self._lock:
+            return [int(idx) for idx in frame_indices
+                    if (fingerprint, int(idx), tuple(resolution)) not in self._frames]
+    
+    def store(self, fingerprint: str, frame_indices: List[int], frames: np.ndarray,
+              resolution: Tuple[int, int] = NATIVE_RESOLUTION):
+        """
+        写入解码后的帧
+        
+        Args:
+            fingerprint: 视频指纹
+            frame_indices: 帧索引列表
+            frames: 对应的帧数据，形状为 (N, H, W, 3)
+            resolution: 解码分辨率
+        """
+        if not self.enabled:
+            return
+        
+        with self._lock:
+            for idx, frame in zip(frame_indices, frames):
+                key = (fingerprint, int(idx), tuple(resolution))
+                if key in self._frames:
+                    self._frames.move_to_end(key)
+                    continue
+                
+                # 复制一份，避免持有整批解码结果的引用
+                frame = np.array(frame, copy=True)
+                self._frames[key] = frame
+                self._bytes += frame.nbytes
+            
+            while self._bytes > self.max_bytes and self._frames:
+                _, evicted = self._frames.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self.evictions += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        获取缓存统计信息
+        
+        Returns:
+            统计信息字典
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._frames),
+                'size_mb': self._bytes / 1024**2,
+                'max_size_mb': self.max_bytes / 1024**2,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / total if total else 0.0,
+            }
+    
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._frames.clear()
+            self._bytes = 0
@@ -7,7 +7,7 @@ Gradio Web界面 - MiniCPM-V视频聊天
 import os
 import gradio as gr
 import time
-from typing import Optional, List, Tuple, Any
+from typing import Optional, List, Tuple, Any, Iterator, Dict
 
 # 延迟导入以避免在应用启动时就开始加载模型
 # from .video_chat_service import VideoChatService
@@ -126,6 +126,10 @@ class VideoChatGradioApp:
             
             process_time = time.time() - start_time
             
+            # 解码帧缓存命中情况
+            cache_stats = self.service.video_encoder.last_cache_stats
+            total_cache_stats = self.service.video_encoder.frame_cache.stats()
+            
             status_text = f"""
 ✅ 视频处理完成！
 
@@ -134,6 +138,11 @@ class VideoChatGradioApp:
 - 时序组数: {len(temporal_ids)}
 - 处理耗时: {process_time:.2f}秒
 
+🗂️ 解码帧缓存:
+- 本次命中: {cache_stats.get('hits', 0)}/{cache_stats.get('requested', 0)} ({cache_stats.get('hit_ratio', 0.0):.1%})
+- 新解码帧数: {cache_stats.get('decoded', 0)}
+- 累计命中率: {total_cache_stats['hit_ratio']:.1%} (缓存 {total_cache_stats['entries']} 帧, {total_cache_stats['size_mb']:.0f} MB)
+
 🎯 3D重采样器统计:
 - 采样帧率: {fps} FPS
 - 打包模式: {"强制 " + str(force_packing) if force_packing and force_packing > 0 else "自动"}
@@ -150,56 +159,89 @@ class VideoChatGradioApp:
                        question: str, 
                        max_tokens: int, 
                        temperature: float, 
-                       top_p: float) -> str:
+                       top_p: float,
+                       keyframe_detail: bool = False,
+                       timeout: float = 0,
+                       session: Optional[Dict[str, Any]] = None) -> Iterator[str]:
         """
-        与视频进行聊天
+        与视频进行聊天（流式输出）
+        
+        同一会话中新的问题会先停止该会话上一个尚未完成的回答，不必等它生成完；
+        其他会话的回答不受影响
         
         Args:
             question: 用户问题
             max_tokens: 最大生成token数
             temperature: 温度参数
             top_p: Top-p参数
+            keyframe_detail: 是否为关键帧分配高分辨率
+            timeout: 生成时限（秒），0表示不限制
+            session: 会话状态（gr.State），保存该会话正在生成的回答的取消令牌
             
-        Returns:
-            模型回答
+        Yields:
+            截至当前生成的回答文本
         """
         if not self.service:
-            return "❌ 服务未初始化，请先点击'初始化服务'按钮"
+            yield "❌ 服务未初始化，请先点击'初始化服务'按钮"
+            return
         
         if not self.current_video_data:
-            return "❌ 请先上传并处理视频"
+            yield "❌ 请先上传并处理视频"
+            return
         
         if not question.strip():
-            return "❌ 请输入您的问题"
+            yield "❌ 请输入您的问题"
+            return
         
         try:
+            from .cancellation import CancellationToken
+            
+            session = session if session is not None else {}
+            if session.get('token') is not None:
+                session['token'].cancel('新的问题')
+            token = CancellationToken(timeout=timeout or None)
+            session['token'] = token
+            
             frames, temporal_ids = self.current_video_data
             
-            start_time = time.time()
+            answer = ""
+            timings: Dict[str, Any] = {}
             
-            # 使用缓存的视频数据进行聊天
-            answer = self.service.chat_with_frames(
+            # 使用缓存的视频数据进行流式聊天
+            for text in self.service.stream_chat(
                 frames=frames,
                 temporal_ids=temporal_ids,
                 question=question,
                 max_new_tokens=max_tokens,
                 temperature=temperature,
-                top_p=top_p
-            )
-            
-            inference_time = time.time() - start_time
+                top_p=top_p,
+                keyframe_detail=keyframe_detail,
+                cancel_token=token,
+                timings=timings
+            ):
+                answer += text
+                yield f"🤖 AI回答:\n{answer}"
             
             result_text = f"""
 🤖 AI回答:
 {answer}
 
-⏱️ 推理耗时: {inference_time:.2f}秒
+⏱️ 首token延迟: {timings.get('first_token', 0.0):.2f}秒
+⏱️ 推理耗时: {timings.get('inference', 0.0):.2f}秒
             """
+            if timings.get('stop_reason'):
+                result_text += f"\n⚠️ 回答已截断（{timings['stop_reason']}）"
             
-            return result_text.strip()
+            yield result_text.strip()
             
         except Exception as e:
-            return f"❌ 聊天失败: {str(e)}"
+            yield f"❌ 聊天失败: {str(e)}"
+    
+    def stop_generation(self, session: Optional[Dict[str, Any]] = None):
+        """停止该会话正在生成的回答，已生成的部分保留"""
+        token = (session or {}).get('token')
+        if token is not None:
+            token.cancel('用户停止')
     
     def get_video_info(self, video_file) -> str:
         """
@@ -320,6 +362,9 @@ class VideoChatGradioApp:
             
             gr.Markdown("## 💬 视频聊天")
             
+            # 每个浏览器会话一份状态（初始值按会话复制），保存该会话正在生成的回答的取消令牌
+            session = gr.State({})
+            
             with gr.Row():
                 with gr.Column(scale=2):
                     # 聊天输入
@@ -343,9 +388,21 @@ class VideoChatGradioApp:
                             minimum=0.1, maximum=1.0, value=0.8, step=0.1,
                             label="多样性 (Top-p)", info="控制回答的多样性"
                         )
+                        timeout = gr.Slider(
+                            minimum=0, maximum=600, value=0, step=10,
+                            label="生成时限 (秒)", info="超时后停止并保留已生成的部分，0表示不限制"
+                        )
                     
-                    # 聊天按钮
-                    chat_btn = gr.Button("🗣️ 开始聊天", variant="primary")
+                    keyframe_detail = gr.Checkbox(
+                        value=False,
+                        label="关键帧高分辨率",
+                        info="在视觉token预算内为场景关键帧保留高分辨率细节"
+                    )
+                    
+                    # 聊天和停止按钮
+                    with gr.Row():
+                        chat_btn = gr.Button("🗣️ 开始聊天", variant="primary")
+                        stop_btn = gr.Button("⏹️ 停止生成", variant="stop")
                 
                 with gr.Column(scale=3):
                     # 聊天结果
@@ -391,25 +448,33 @@ class VideoChatGradioApp:
                 outputs=process_status
             )
             
-            chat_btn.click(
+            chat_event = chat_btn.click(
                 self.chat_with_video,
-                inputs=[question, max_tokens, temperature, top_p],
+                inputs=[question, max_tokens, temperature, top_p, keyframe_detail, timeout, session],
                 outputs=chat_result
             )
             
             # 回车键提交
-            question.submit(
+            submit_event = question.submit(
                 self.chat_with_video,
-                inputs=[question, max_tokens, temperature, top_p],
+                inputs=[question, max_tokens, temperature, top_p, keyframe_detail, timeout, session],
                 outputs=chat_result
             )
+            
+            # 停止生成：只取消本会话的令牌让模型立即空闲，并结束前端的流式事件
+            stop_btn.click(
+                self.stop_generation,
+                inputs=session,
+                cancels=[chat_event, submit_event]
+            )
         
         return interface
     
     def launch(self, 
               server_name: str = "0.0.0.0", 
               server_port: int = 7860, 
-              share: bool = False):
+              share: bool = False,
+              concurrency_limit: int = 4):
         """
         启动Gradio应用
         
@@ -417,8 +482,10 @@ class VideoChatGradioApp:
             server_name: 服务器地址
             server_port: 端口号
             share: 是否创建公共链接
+            concurrency_limit: 同时处理的事件数，每个会话的回答可以单独停止
         """
         interface = self.create_interface()
+        interface.queue(default_concurrency_limit=concurrency_limit)
         
         print(f"🚀 启动Gradio应用...")
         print(f"   地址: http://{server_name}:{server_port}")
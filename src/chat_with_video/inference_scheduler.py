@@ -0,0 +1,519 @@
+"""
+连续批处理推理调度器 - 多用户并发推理
+推理工作线程独占模型，从队列接收请求；新请求预填充后在token粒度上加入正在解码的批次，
+已完成的序列随时退出批次，调用方通过Future或流式迭代器获取结果
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Optional, Sequence, Tuple
+
+import torch
+
+from .cancellation import CancellationToken, ChatResult
+from .prefix_cache import layer_tensors
+
+
+class PreparedPrompt:
+    """已准备好的提示：输入嵌入和生成参数"""
+    
+    def __init__(self, inputs_embeds: torch.Tensor, eos_token_ids: Sequence[int],
+                 max_new_tokens: int = 2048, do_sample: bool = True,
+                 temperature: float = 0.7, top_p: float = 0.8, top_k: int = 100,
+                 repetition_penalty: float = 1.05, cache_key: Optional[Hashable] = None):
+        """
+        Args:
+            inputs_embeds: 提示的输入嵌入 [1, seq_len, hidden]
+            eos_token_ids: 结束token ID列表
+            max_new_tokens: 最大生成token数
+            do_sample: 是否采样，False为贪心解码
+            temperature: 温度参数
+            top_p: Top-p采样参数
+            top_k: Top-k采样参数，0表示不限制
+            repetition_penalty: 对已生成token的重复惩罚
+            cache_key: 前缀KV缓存键（可选）
+        """
+        self.inputs_embeds = inputs_embeds
+        self.eos_token_ids = set(int(i) for i in eos_token_ids)
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.repetition_penalty = repetition_penalty
+        self.cache_key = cache_key
+
+
+def adjust_logits(logits: torch.Tensor, generated: List[int], prompt: PreparedPrompt) -> torch.Tensor:
+    """
+    按请求的采样参数处理单个位置的logits
+    
+    应用重复惩罚；采样时再应用温度、top-k和top-p，被过滤的token置为-inf
+    
+    Args:
+        logits: 词表上的logits [vocab]
+        generated: 该位置之前已生成的token
+        prompt: 生成参数
+    
+    Returns:
+        处理后的float32 logits，softmax即为采样分布
+    """
+    logits = logits.float()
+    
+    if prompt.repetition_penalty != 1.0 and generated:
+        ids = torch.tensor(sorted(set(generated)), device=logits.device)
+        scores = logits[ids]
+        scores = torch.where(scores > 0, scores / prompt.repetition_penalty,
+                             scores * prompt.repetition_penalty)
+        logits = logits.index_put((ids,), scores)
+    
+    if not prompt.do_sample:
+        return logits
+    
+    logits = logits / max(prompt.temperature, 1e-5)
+    if prompt.top_k > 0:
+        kth = torch.topk(logits, min(prompt.top_k, logits.shape[-1])).values[-1]
+        logits = logits.masked_fill(logits < kth, float('-inf'))
+    
+    if prompt.top_p < 1.0:
+        sorted_logits, sorted_ids = torch.sort(logits, descending=True)
+        sorted_probs = torch.softmax(sorted_logits, dim=-1)
+        cumulative = torch.cumsum(sorted_probs, dim=-1)
+        # 保留累计概率首次超过top_p之前（含）的token
+        remove = cumulative - sorted_probs > prompt.top_p
+        logits = logits.index_put((sorted_ids[remove],), torch.tensor(float('-inf'), device=logits.device))
+    
+    return logits
+
+
+class GenerationRequest:
+    """一次生成请求，可以等待完整结果或流式读取"""
+    
+    _END = object()
+    
+    def __init__(self, prepare: Callable[[], PreparedPrompt],
+                 cancel_token: Optional[CancellationToken] = None):
+        """
+        Args:
+            prepare: 在推理工作线程中执行，返回PreparedPrompt（如运行处理器和视觉编码器）
+            cancel_token: 取消令牌（可选），取消或超时后在下一个解码步退出批次
+        """
+        self.prepare = prepare
+        self.cancel_token = cancel_token
+        self.stop_reason: Optional[str] = None
+        self.future: Future = Future()
+        self._chunks: "queue.Queue[Any]" = queue.Queue()
+        
+        self.submitted_at = time.time()
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.num_tokens = 0
+    
+    def result(self, timeout: Optional[float] = None) -> str:
+        """等待并返回完整的生成文本（被取消时为截断的ChatResult）"""
+        return self.future.result(timeout)
+    
+    def stream(self) -> Iterator[str]:
+        """逐段返回新生成的文本"""
+        while True:
+            item = self._chunks.get()
+            if item is self._END:
+                break
+            yield item
+        # 生成失败时抛出异常
+        self.future.result()
+    
+    def timings(self) -> Dict[str, Optional[float]]:
+        """请求的排队/首token/总耗时"""
+        def since_submit(t):
+            return t - self.submitted_at if t is not None else None
+        return {
+            'first_token': since_submit(self.first_token_at),
+            'total': since_submit(self.finished_at),
+            'tokens': self.num_tokens,
+        }
+    
+    def _emit(self, text: str):
+        if self.first_token_at is None:
+            self.first_token_at = time.time()
+        if text:
+            self._chunks.put(text)
+    
+    def _finish(self, text: str):
+        self.finished_at = time.time()
+        self._chunks.put(self._END)
+        self.future.set_result(ChatResult(text, self.stop_reason))
+    
+    def _check_cancelled(self) -> bool:
+        if self.cancel_token is None:
+            return False
+        self.stop_reason = self.cancel_token.check()
+        return self.stop_reason is not None
+    
+    def _fail(self, error: BaseException):
+        self.finished_at = time.time()
+        self._chunks.put(self._END)
+        if not self.future.done():
+            self.future.set_exception(error)
+
+
+class _Sequence:
+    """运行批次中的一条序列"""
+    
+    def __init__(self, request: GenerationRequest, prompt: PreparedPrompt, prompt_len: int):
+        self.request = request
+        self.prompt = prompt
+        self.position = prompt_len
+        self.generated: List[int] = []
+        self.text = ""
+        self.done = False
+
+
+def _pad_kv_left(layers: List[Tuple[torch.Tensor, torch.Tensor]], pad: int) -> List[tuple]:
+    """在序列维度左侧补零"""
+    if pad == 0:
+        return layers
+    return [
+        tuple(torch.cat([t.new_zeros(t.shape[:-2] + (pad, t.shape[-1])), t], dim=-2) for t in layer)
+        for layer in layers
+    ]
+
+
+def _build_cache(layers: List[Tuple[torch.Tensor, torch.Tensor]]) -> Any:
+    """由每层的 (keys, values) 构建运行批次使用的DynamicCache"""
+    from transformers import DynamicCache
+    
+    cache = DynamicCache()
+    for layer_idx, (keys, values) in enumerate(layers):
+        cache.update(keys, values, layer_idx)
+    return cache
+
+
+class ContinuousBatchScheduler:
+    """token粒度的连续批处理调度器"""
+    
+    def __init__(self, llm: Any, tokenizer: Any, max_batch_size: int = 8,
+                 lock: Optional[threading.RLock] = None, prefix_cache: Optional[Any] = None):
+        """
+        初始化调度器
+        
+        Args:
+            llm: HuggingFace因果语言模型（支持inputs_embeds/position_ids/past_key_values）
+            tokenizer: 分词器，用于增量解码文本
+            max_batch_size: 同时解码的最大序列数
+            lock: 模型锁，每一步推理都在锁内执行，与其他直接使用模型的调用互斥
+            prefix_cache: 前缀KV缓存（PrefixKVCache），预填充时复用视频前缀
+        """
+        self.llm = llm
+        self.tokenizer = tokenizer
+        self.max_batch_size = max(int(max_batch_size), 1)
+        self.lock = lock or threading.RLock()
+        self.prefix_cache = prefix_cache
+        
+        self._queue: "queue.Queue[GenerationRequest]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+        # 未设置时暂停推理（模型临时卸载到CPU期间）
+        self._resumed = threading.Event()
+        self._resumed.set()
+        
+        # 运行批次：KV在解码步骤之间保持为同一个DynamicCache，只在序列加入或离开时重建
+        self._sequences: List[_Sequence] = []
+        self._past_key_values: Optional[Any] = None
+        self._attention_mask: Optional[torch.Tensor] = None
+        
+        self._stats: Dict[str, Any] = {
+            'requests': 0,
+            'completed': 0,
+            'failed': 0,
+            'cancelled': 0,
+            'prefills': 0,
+            'decode_steps': 0,
+            'generated_tokens': 0,
+            'batch_size_sum': 0,
+            'max_batch_size_seen': 0,
+        }
+    
+    @property
+    def running(self) -> bool:
+        """工作线程是否在运行"""
+        return self._thread is not None and self._thread.is_alive()
+    
+    def start(self) -> "ContinuousBatchScheduler":
+        """启动推理工作线程"""
+        if self.running:
+            return self
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, name="inference-scheduler", daemon=True)
+        self._thread.start()
+        print(f"连续批处理调度器已启动 (最大批大小: {self.max_batch_size})")
+        return self
+    
+    def stop(self):
+        """停止工作线程，未完成的请求以异常结束"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        
+        error = RuntimeError("推理调度器已停止")
+        self._fail_batch(error)
+        while True:
+            try:
+                self._queue.get_nowait()._fail(error)
+            except queue.Empty:
+                break
+    
+    def pause(self):
+        """暂停推理（如模型临时卸载到CPU期间），已接纳的序列留在批次中，恢复后继续解码"""
+        self._resumed.clear()
+    
+    def resume(self):
+        """恢复推理"""
+        self._resumed.set()
+    
+    @contextmanager
+    def _model_access(self):
+        """获取模型锁执行一步推理；暂停期间释放锁等待恢复"""
+        while True:
+            self.lock.acquire()
+            if self._resumed.is_set():
+                break
+            self.lock.release()
+            if self._stop_event.is_set():
+                raise RuntimeError("推理调度器已停止")
+            self._resumed.wait(0.1)
+        try:
+            yield
+        finally:
+            self.lock.release()
+    
+    def submit(self, request: GenerationRequest) -> GenerationRequest:
+        """提交请求（非阻塞）"""
+        if not self.running:
+            raise RuntimeError("推理调度器未启动")
+        self._stats['requests'] += 1
+        self._queue.put(request)
+        return request
+    
+    def stats(self) -> Dict[str, Any]:
+        """获取调度统计信息"""
+        stats = dict(self._stats)
+        steps = stats.pop('batch_size_sum')
+        stats['avg_batch_size'] = steps / stats['decode_steps'] if stats['decode_steps'] else 0.0
+        stats['running'] = len(self._sequences)
+        stats['queued'] = self._queue.qsize()
+        return stats
+    
+    def _loop(self):
+        """工作线程主循环：接纳新请求 -> 解码一步 -> 移除完成的序列"""
+        while not self._stop_event.is_set():
+            # 批次为空时阻塞等待新请求
+            if not self._sequences:
+                try:
+                    request = self._queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                self._admit(request)
+            
+            # 批次未满时接纳排队的请求
+            while len(self._sequences) < self.max_batch_size:
+                try:
+                    request = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                self._admit(request)
+            
+            # 被取消或超时的序列在解码前退出批次
+            self._drop_cancelled()
+            
+            if self._sequences:
+                try:
+                    self._decode_step()
+                except Exception as e:
+                    print(f"批量解码失败: {e}")
+                    self._fail_batch(e)
+    
+    def _admit(self, request: GenerationRequest):
+        """准备提示、预填充并加入运行批次"""
+        if request._check_cancelled():
+            # 排队期间已取消或超时，不再占用模型
+            self._stats['cancelled'] += 1
+            request._finish("")
+            return
+        
+        try:
+            with self._model_access(), torch.inference_mode():
+                prompt = request.prepare()
+                past_key_values, logits = self._prefill(prompt)
+            seq = _Sequence(request, prompt, prompt.inputs_embeds.shape[1])
+            self._accept_token(seq, logits[0])
+        except Exception as e:
+            print(f"请求预填充失败: {e}")
+            self._stats['failed'] += 1
+            request._fail(e)
+            return
+        
+        self._merge(seq, past_key_values)
+        self._stats['prefills'] += 1
+        self._retire()
+    
+    def _prefill(self, prompt: PreparedPrompt):
+        """单条序列预填充，命中前缀缓存时只预填充剩余部分"""
+        from transformers import DynamicCache
+        
+        inputs_embeds = prompt.inputs_embeds
+        past_key_values, reused = None, 0
+        use_prefix_cache = (self.prefix_cache is not None and self.prefix_cache.enabled
+                            and prompt.cache_key is not None)
+        if use_prefix_cache:
+            past_key_values, reused = self.prefix_cache.fork(prompt.cache_key, inputs_embeds)
+        if past_key_values is None:
+            past_key_values = DynamicCache()
+        
+        # 只需要最后一个位置的logits，不为整个提示（包括视觉token）计算词表大小的logits
+        outputs = self.llm(
+            inputs_embeds=inputs_embeds[:, reused:],
+            past_key_values=past_key_values,
+            use_cache=True,
+            logits_to_keep=1
+        )
+        past_key_values = outputs.past_key_values
+        
+        if use_prefix_cache:
+            self.prefix_cache.store(prompt.cache_key, inputs_embeds, past_key_values, reused or None)
+        
+        return past_key_values, outputs.logits[:, -1, :]
+    
+    def _merge(self, seq: _Sequence, past_key_values: Any):
+        """把新序列的KV左对齐填充后拼接到运行批次"""
+        new_layers = layer_tensors(past_key_values)
+        new_len = new_layers[0][0].shape[-2]
+        device = new_layers[0][0].device
+        new_mask = torch.ones(1, new_len, dtype=torch.long, device=device)
+        
+        if not self._sequences:
+            self._past_key_values = past_key_values
+            self._attention_mask = new_mask
+        else:
+            batch_len = self._attention_mask.shape[1]
+            total = max(batch_len, new_len)
+            batch_kv = _pad_kv_left(layer_tensors(self._past_key_values), total - batch_len)
+            new_kv = _pad_kv_left(new_layers, total - new_len)
+            self._past_key_values = _build_cache([
+                tuple(torch.cat([a, b], dim=0) for a, b in zip(batch_layer, new_layer))
+                for batch_layer, new_layer in zip(batch_kv, new_kv)
+            ])
+            batch_mask = torch.nn.functional.pad(self._attention_mask, (total - batch_len, 0))
+            new_mask = torch.nn.functional.pad(new_mask, (total - new_len, 0))
+            self._attention_mask = torch.cat([batch_mask, new_mask], dim=0)
+        
+        self._sequences.append(seq)
+        self._stats['max_batch_size_seen'] = max(self._stats['max_batch_size_seen'], len(self._sequences))
+    
+    def _decode_step(self):
+        """对运行批次中的所有序列解码一个token（模型原地追加运行批次的KV）"""
+        seqs = self._sequences
+        device = self._attention_mask.device
+        input_ids = torch.tensor([[seq.generated[-1]] for seq in seqs], device=device)
+        position_ids = torch.tensor([[seq.position] for seq in seqs], device=device)
+        attention_mask = torch.nn.functional.pad(self._attention_mask, (0, 1), value=1)
+        
+        with self._model_access(), torch.inference_mode():
+            outputs = self.llm(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=self._past_key_values,
+                use_cache=True
+            )
+        
+        self._past_key_values = outputs.past_key_values
+        self._attention_mask = attention_mask
+        self._stats['decode_steps'] += 1
+        self._stats['batch_size_sum'] += len(seqs)
+        
+        logits = outputs.logits[:, -1, :]
+        for i, seq in enumerate(seqs):
+            seq.position += 1
+            self._accept_token(seq, logits[i])
+        
+        self._retire()
+    
+    def _accept_token(self, seq: _Sequence, logits: torch.Tensor):
+        """采样下一个token，更新文本并判断是否结束"""
+        prompt = seq.prompt
+        token = self._sample(logits, seq.generated, prompt)
+        seq.generated.append(token)
+        seq.request.num_tokens += 1
+        self._stats['generated_tokens'] += 1
+        
+        if token in prompt.eos_token_ids:
+            seq.done = True
+        else:
+            text = self.tokenizer.decode(
+                [t for t in seq.generated if t not in prompt.eos_token_ids],
+                skip_special_tokens=True
+            )
+            # 不完整的多字节字符等到下一个token再输出
+            if not text.endswith('�'):
+                seq.request._emit(text[len(seq.text):])
+                seq.text = text
+        
+        if len(seq.generated) >= prompt.max_new_tokens:
+            seq.done = True
+    
+    @staticmethod
+    def _sample(logits: torch.Tensor, generated: List[int], prompt: PreparedPrompt) -> int:
+        """按请求的采样参数从logits中选出下一个token"""
+        logits = adjust_logits(logits, generated, prompt)
+        if not prompt.do_sample:
+            return int(torch.argmax(logits))
+        return int(torch.multinomial(torch.softmax(logits, dim=-1), 1))
+    
+    def _retire(self):
+        """移除已完成的序列，并裁掉所有序列都不再需要的左侧填充"""
+        finished = [seq for seq in self._sequences if seq.done]
+        if not finished:
+            return
+        
+        for seq in finished:
+            self._stats['completed'] += 1
+            seq.request._finish(seq.text)
+        
+        keep = [i for i, seq in enumerate(self._sequences) if not seq.done]
+        self._sequences = [self._sequences[i] for i in keep]
+        if not keep:
+            self._reset_batch()
+            return
+        
+        index = torch.tensor(keep, device=self._attention_mask.device)
+        mask = self._attention_mask[index]
+        start = int(torch.nonzero(mask.any(dim=0))[0, 0])
+        self._attention_mask = mask[:, start:]
+        self._past_key_values = _build_cache([
+            tuple(t[index, ..., start:, :] for t in layer) for layer in layer_tensors(self._past_key_values)
+        ])
+    
+    def _drop_cancelled(self):
+        """结束被取消或超时的序列，已生成的文本作为截断结果返回"""
+        for seq in self._sequences:
+            if not seq.done and seq.request._check_cancelled():
+                self._stats['cancelled'] += 1
+                seq.done = True
+        self._retire()
+    
+    def _fail_batch(self, error: BaseException):
+        """运行批次中的所有请求以异常结束"""
+        for seq in self._sequences:
+            self._stats['failed'] += 1
+            seq.request._fail(error)
+        self._reset_batch()
+    
+    def _reset_batch(self):
+        self._sequences = []
+        self._past_key_values = None
+        self._attention_mask = None
@@ -0,0 +1,201 @@
+"""
+隔离的模型加载作用域 - 多个引擎可以在不同线程中并行加载
+加载XPU模型时需要屏蔽torch/transformers/accelerate的显存查询并设置若干环境变量，
+这些都是进程级的全局状态。这里用锁和引用计数管理：第一个进入作用域的加载线程安装替换，
+最后一个离开时恢复；替换后的函数只对处于加载作用域内的线程生效，
+推理线程和其他线程仍调用原始函数。加载线程启动的工作线程（如并行读取分片）
+通过inherit_loading_scope继承其作用域
+"""
+
+import functools
+import os
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import torch
+
+
+# 加载XPU模型时强制设置的环境变量
+FORCE_XPU_ENV = {
+    'PYTORCH_CUDA_ALLOC_CONF': 'max_split_size_mb:128',
+    'CUDA_LAUNCH_BLOCKING': '0',
+    'PYTORCH_NO_CUDA_MEMORY_CACHING': '0',
+    'INTEL_XPU_FORCE_LOAD': '1',
+    'XPU_FORCE_DEVICE_ALLOC': '1',
+    'SYCL_DISABLE_MEM_QUERY': '1',
+}
+
+_lock = threading.RLock()
+_local = threading.local()
+
+# 已安装的替换: (对象, 属性名) -> 原始函数
+_patched: Dict[Tuple[Any, str], Callable] = {}
+_patch_users = 0
+
+# 环境变量的引用计数和原始值
+_env_users: Dict[str, int] = {}
+_env_originals: Dict[str, Optional[str]] = {}
+
+
+def in_loading_scope() -> bool:
+    """当前线程是否处于模型加载作用域内"""
+    return getattr(_local, 'depth', 0) > 0
+
+
+def inherit_loading_scope(fn: Callable) -> Callable:
+    """
+    让在工作线程中执行的函数继承当前线程的加载作用域
+    
+    在加载作用域内调用时，返回的函数执行期间把执行线程标记为处于作用域内；
+    全局替换和环境变量仍由调用线程的作用域持有，调用线程需要等待工作线程完成后再退出作用域。
+    不在加载作用域内调用时原样返回fn
+    
+    Args:
+        fn: 提交给线程池或工作线程的函数
+    
+    Returns:
+        包装后的函数
+    """
+    if not in_loading_scope():
+        return fn
+    
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        _local.depth = getattr(_local, 'depth', 0) + 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.depth -= 1
+    return run
+
+
+def _no_memory_info(device=None):
+    return 0, 0
+
+
+def _no_available_memory():
+    return {}
+
+
+def _no_warmup(*args, **kwargs):
+    pass
+
+
+def _memory_query_patches() -> List[Tuple[Any, str, Callable]]:
+    """需要在加载期间屏蔽的显存查询函数（对象, 属性名, 替换函数）"""
+    patches = []
+    if hasattr(torch.cuda, 'mem_get_info'):
+        patches.append((torch.cuda, 'mem_get_info', _no_memory_info))
+    xpu = getattr(torch, 'xpu', None)
+    if xpu is not None and hasattr(xpu, 'mem_get_info'):
+        patches.append((xpu, 'mem_get_info', _no_memory_info))
+    
+    import transformers.utils
+    import transformers.modeling_utils
+    
+    if hasattr(transformers.utils, 'get_available_memory'):
+        patches.append((transformers.utils, 'get_available_memory', _no_available_memory))
+    if hasattr(transformers.modeling_utils, 'caching_allocator_warmup'):
+        patches.append((transformers.modeling_utils, 'caching_allocator_warmup', _no_warmup))
+    
+    try:
+        import accelerate.utils
+        if hasattr(accelerate.utils, 'get_available_memory'):
+            patches.append((accelerate.utils, 'get_available_memory', _no_available_memory))
+    except ImportError:
+        pass  # accelerate 可能未安装
+    return patches
+
+
+def _scoped(original: Callable, replacement: Callable) -> Callable:
+    """只在加载作用域内的线程调用replacement，其他线程调用原函数"""
+    @functools.wraps(original)
+    def dispatch(*args, **kwargs):
+        if in_loading_scope():
+            return replacement(*args, **kwargs)
+        return original(*args, **kwargs)
+    return dispatch
+
+
+def _install_patches():
+    try:
+        for owner, name, replacement in _memory_query_patches():
+            original = getattr(owner, name)
+            _patched[(owner, name)] = original
+            setattr(owner, name, _scoped(original, replacement))
+        print(f"    ✅ 已在加载作用域内屏蔽 {len(_patched)} 个显存查询函数")
+    except Exception as e:
+        print(f"    ❌ 修补函数失败: {e}")
+
+
+def _restore_patches():
+    for (owner, name), original in _patched.items():
+        setattr(owner, name, original)
+    _patched.clear()
+
+
+@contextmanager
+def scoped_env(values: Dict[str, str]) -> Iterator[None]:
+    """
+    引用计数地设置环境变量：第一个使用者设置并保存原值，最后一个使用者退出时恢复
+    
+    多个加载同时要求同一变量取不同值时保留先设置的值
+    
+    Args:
+        values: 环境变量名到值的映射
+    """
+    with _lock:
+        for key, value in values.items():
+            if _env_users.get(key, 0) == 0:
+                _env_originals[key] = os.environ.get(key)
+                os.environ[key] = value
+            elif os.environ.get(key) != value:
+                print(f"    ⚠️ 环境变量 {key} 已被并行的加载设置为 {os.environ.get(key)}，保持不变")
+            _env_users[key] = _env_users.get(key, 0) + 1
+    try:
+        yield
+    finally:
+        with _lock:
+            for key in values:
+                _env_users[key] -= 1
+                if _env_users[key] == 0:
+                    del _env_users[key]
+                    original = _env_originals.pop(key)
+                    if original is None:
+                        os.environ.pop(key, None)
+                    else:
+                        os.environ[key] = original
+
+
+@contextmanager
+def model_loading_scope(env: Optional[Dict[str, str]] = None,
+                        patch_memory_queries: bool = True) -> Iterator[None]:
+    """
+    模型加载作用域：屏蔽当前线程的显存查询并设置环境变量，退出时恢复
+    
+    可以在多个线程中同时进入（以及在同一线程中嵌套），全局替换只安装和恢复一次
+    
+    Args:
+        env: 加载期间设置的环境变量
+        patch_memory_queries: 是否屏蔽torch/transformers/accelerate的显存查询
+    """
+    global _patch_users
+    
+    if patch_memory_queries:
+        with _lock:
+            if _patch_users == 0:
+                _install_patches()
+            _patch_users += 1
+    
+    _local.depth = getattr(_local, 'depth', 0) + 1
+    try:
+        with scoped_env(env or {}):
+            yield
+    finally:
+        _local.depth -= 1
+        if patch_memory_queries:
+            with _lock:
+                _patch_users -= 1
+                if _patch_users == 0:
+                    _restore_patches()
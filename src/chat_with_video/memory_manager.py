@@ -0,0 +1,239 @@
+"""
+自适应内存管理 - 只在超过高水位或空闲时释放缓存
+每次请求结束后记录设备已分配/已保留内存和进程常驻内存，只有保留内存超过设备高水位、
+进程内存超过主机高水位、请求失败或空闲一段时间后才释放分配器缓存和执行完整垃圾回收，
+避免每个问题之后丢弃马上又要重新分配的缓存
+"""
+
+import ctypes
+import gc
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Optional, Tuple
+
+import torch
+
+
+def _host_memory() -> Tuple[int, int]:
+    """进程常驻内存和系统总内存（字节）"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss, psutil.virtual_memory().total
+    except ImportError:
+        pass
+    
+    rss = 0
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        total = 0
+    return rss, total
+
+
+def _malloc_trim():
+    """把glibc堆上的空闲内存归还给系统（仅Linux）"""
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class DeviceMemoryManager:
+    """按水位线和空闲时间决定何时释放设备和主机内存"""
+    
+    def __init__(self, device: str = 'xpu', high_water: float = 0.85, host_high_water: float = 0.85,
+                 idle_seconds: Optional[float] = 30.0, history: int = 50):
+        """
+        初始化内存管理器
+        
+        Args:
+            device: 设备类型（'xpu'/'cuda'/'cpu'）
+            high_water: 设备保留内存超过总显存的该比例时释放分配器缓存
+            host_high_water: 进程常驻内存超过系统内存的该比例时执行完整垃圾回收
+            idle_seconds: 没有请求超过该秒数后释放缓存，None表示不做空闲释放
+            history: 保留最近决策记录的条数
+        """
+        self.device = device
+        self.high_water = high_water
+        self.host_high_water = host_high_water
+        self.idle_seconds = idle_seconds
+        
+        self._lock = threading.Lock()
+        self._active = 0
+        self._idle_timer: Optional[threading.Timer] = None
+        self.decisions: "deque[Dict[str, Any]]" = deque(maxlen=history)
+        self.counters = {'requests': 0, 'kept': 0, 'trims': 0, 'host_collections': 0}
+        self.peak_reserved = 0
+    
+    def _backend(self):
+        device_type = self.device.split(':')[0]
+        backend = getattr(torch, device_type, None) if device_type != 'cpu' else None
+        if backend is None or not hasattr(backend, 'is_available') or not backend.is_available():
+            return None
+        return backend
+    
+    def device_stats(self) -> Tuple[int, int, int]:
+        """
+        设备内存统计（字节）
+        
+        Returns:
+            (已分配, 已保留, 总显存)，CPU或不可用时均为0
+        """
+        backend = self._backend()
+        if backend is None:
+            return 0, 0, 0
+        try:
+            allocated = backend.memory_allocated()
+            reserved = backend.memory_reserved()
+            total = backend.get_device_properties(backend.current_device()).total_memory
+            return allocated, reserved, total
+        except Exception:
+            return 0, 0, 0
+    
+    def _empty_device_cache(self):
+        backend = self._backend()
+        if backend is not None and hasattr(backend, 'empty_cache'):
+            backend.empty_cache()
+    
+    def snapshot(self) -> Dict[str, float]:
+        """当前设备和主机内存占用（MB）"""
+        allocated, reserved, total = self.device_stats()
+        rss, host_total = _host_memory()
+        return {
+            'allocated_mb': allocated / 1024**2,
+            'reserved_mb': reserved / 1024**2,
+            'device_total_mb': total / 1024**2,
+            'host_rss_mb': rss / 1024**2,
+            'host_total_mb': host_total / 1024**2,
+        }
+    
+    def begin_request(self):
+        """请求开始：取消待执行的空闲释放"""
+        with self._lock:
+            self._active += 1
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+                self._idle_timer = None
+    
+    def end_request(self, failed: bool = False) -> Dict[str, Any]:
+        """
+        请求结束：根据水位决定是否释放缓存
+        
+        Args:
+            failed: 请求是否失败（可能是内存不足），失败时总是释放
+        
+        Returns:
+            本次决策记录
+        """
+        with self._lock:
+            self._active = max(self._active - 1, 0)
+            self.counters['requests'] += 1
+            idle = self._active == 0
+        
+        allocated, reserved, total = self.device_stats()
+        rss, host_total = _host_memory()
+        self.peak_reserved = max(self.peak_reserved, reserved)
+        
+        reason = None
+        if failed:
+            reason = '请求失败'
+        elif total and reserved > self.high_water * total:
+            reason = f'保留显存超过高水位 ({reserved / total:.0%})'
+        elif host_total and rss > self.host_high_water * host_total:
+            reason = f'进程内存超过高水位 ({rss / host_total:.0%})'
+        
+        if reason is not None:
+            decision = self.trim(reason, full_gc=True)
+        else:
+            decision = self._record('保留缓存', '低于高水位', allocated, reserved, rss)
+            with self._lock:
+                self.counters['kept'] += 1
+        
+        if idle and self.idle_seconds is not None:
+            self._schedule_idle_trim()
+        return decision
+    
+    def _schedule_idle_trim(self):
+        with self._lock:
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+            timer = threading.Timer(self.idle_seconds, self._idle_trim)
+            timer.daemon = True
+            self._idle_timer = timer
+        timer.start()
+    
+    def _idle_trim(self):
+        with self._lock:
+            if self._active or self._idle_timer is None:
+                return
+            self._idle_timer = None
+        self.trim(f'空闲超过 {self.idle_seconds:.0f}s', full_gc=True)
+    
+    def trim(self, reason: str, full_gc: bool = True) -> Dict[str, Any]:
+        """
+        释放设备分配器缓存，可选执行完整垃圾回收并把堆内存归还系统
+        
+        Args:
+            reason: 释放原因（记录在决策中）
+            full_gc: 是否执行gc.collect
+        
+        Returns:
+            本次决策记录（包含释放前后的保留显存）
+        """
+        _, reserved_before, _ = self.device_stats()
+        if full_gc:
+            gc.collect()
+            _malloc_trim()
+        self._empty_device_cache()
+        
+        allocated, reserved, _ = self.device_stats()
+        rss, _ = _host_memory()
+        with self._lock:
+            self.counters['trims'] += 1
+            if full_gc:
+                self.counters['host_collections'] += 1
+        decision = self._record('释放缓存', reason, allocated, reserved, rss)
+        decision['freed_mb'] = (reserved_before - reserved) / 1024**2
+        print(f"内存管理: 释放缓存（{reason}），释放 {decision['freed_mb']:.0f} MB")
+        return decision
+    
+    def _record(self, action: str, reason: str, allocated: int, reserved: int, rss: int) -> Dict[str, Any]:
+        decision = {
+            'time': time.time(),
+            'action': action,
+            'reason': reason,
+            'allocated_mb': allocated / 1024**2,
+            'reserved_mb': reserved / 1024**2,
+            'host_rss_mb': rss / 1024**2,
+        }
+        with self._lock:
+            self.decisions.append(decision)
+        return decision
+    
+    def stats(self) -> Dict[str, Any]:
+        """当前占用、计数器和最近的决策"""
+        with self._lock:
+            counters = dict(self.counters)
+            recent = list(self.decisions)[-5:]
+        return {
+            **self.snapshot(),
+            **counters,
+            'peak_reserved_mb': self.peak_reserved / 1024**2,
+            'high_water': self.high_water,
+            'idle_seconds': self.idle_seconds,
+            'recent_decisions': recent,
+        }
+    
+    def shutdown(self):
+        """取消待执行的空闲释放"""
+        with self._lock:
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+                self._idle_timer = None
@@ -4,51 +4,195 @@ MiniCPM-V模型加载器 - Intel XPU优化版本
 """
 
 import os
+import queue
+import threading
+import time
 import torch
-from transformers import AutoModel, AutoTokenizer
-from typing import Optional, List, Dict, Any
+from contextlib import contextmanager
+from transformers import AutoTokenizer, StoppingCriteriaList
+from typing import Optional, List, Dict, Any, Callable, Iterator
 import warnings
 
+from .feature_cache import VisionFeatureCache
+from .prefix_cache import PrefixKVCache, align_shared_prefix
+from .inference_scheduler import ContinuousBatchScheduler, GenerationRequest, PreparedPrompt
+from .fast_loader import LoadTimer, resolve_checkpoint_dir, fast_load_model, load_pretrained_to_device
+from .model_snapshot import is_snapshot, write_snapshot, restore_snapshot
+from .cpu_backend import configure_cpu_threads, quantize_linear_dynamic
+from .placement_planner import PlacementPlan, estimate_units, plan_placement, apply_placement
+from .speculative_decoding import SpeculativeDecoder
+from .compiled_execution import CompiledExecution, DEFAULT_PROMPT_BUCKETS
+from .memory_manager import DeviceMemoryManager
+from .cancellation import CancellationToken, ChatResult, StopOnCancel
+from .loading_scope import FORCE_XPU_ENV, model_loading_scope
+from .pixel_preprocessing import BatchImagePreprocessor, as_samples
+from .precision import PRECISION_MODES, PrecisionMode, resolve_precision, is_quantized_checkpoint
+
+
+# 流式生成线程结束的标记
+_STREAM_END = object()
+
+
+@contextmanager
+def _override_method(obj: Any, name: str, replacement: Callable):
+    """
+    临时用replacement覆盖对象上的方法（设置为实例属性），退出时恢复
+    
+    Args:
+        obj: 目标对象（如模型）
+        name: 方法名
+        replacement: 替换的可调用对象
+    """
+    instance_attrs = vars(obj)
+    had_instance_attr = name in instance_attrs
+    previous = instance_attrs.get(name)
+    setattr(obj, name, replacement)
+    try:
+        yield
+    finally:
+        if had_instance_attr:
+            setattr(obj, name, previous)
+        else:
+            delattr(obj, name)
+
+
+class _PromptCaptured(Exception):
+    """已捕获语言模型的输入，中止model.chat后续的生成"""
+
 
 class MiniCPMVInference:
     """MiniCPM-V模型推理引擎 - Intel XPU版本 (INT4量化)"""
     
-    def __init__(self, model_path: str = 'openbmb/MiniCPM-V-4_5-int4', device: str = 'xpu'):
+    def __init__(self, model_path: str = 'openbmb/MiniCPM-V-4_5-int4', device: str = 'xpu',
+                 vision_cache_bytes: int = 1024**3, prefix_cache_bytes: int = 2 * 1024**3,
+                 load_workers: Optional[int] = None, cpu_dtype: str = 'auto',
+                 cpu_int8: bool = False, num_threads: Optional[int] = None,
+                 device_budgets: Optional[Dict[str, Optional[float]]] = None,
+                 max_context_tokens: int = 8192,
+                 draft_model_path: Optional[str] = None, speculative_lookahead: int = 4,
+                 compile_model: bool = False, compile_buckets: Optional[List[int]] = None,
+                 compile_mode: Optional[str] = None, memory_high_water: float = 0.85,
+                 memory_idle_seconds: Optional[float] = 30.0,
+                 pixel_cache_bytes: int = 512 * 1024**2, preprocess_workers: Optional[int] = None,
+                 precision: str = 'auto'):
         """
         初始化MiniCPM-V推理引擎
         
         Args:
             model_path: 模型路径，默认为MiniCPM-V-4.5-int4量化版本
-            device: 设备类型，默认为'xpu'（Intel GPU）
+            device: 设备类型，默认为'xpu'（Intel GPU）；XPU不可用时自动使用CPU
+            vision_cache_bytes: 视觉特征缓存的最大字节数，0表示禁用
+            prefix_cache_bytes: 前缀KV缓存的最大字节数，0表示禁用
+            load_workers: 并行读取权重分片的线程数，默认为 min(分片数, 8)
+            cpu_dtype: precision为'auto'/'int4'时的CPU浮点精度，'auto'（支持bf16时用bf16）、'bfloat16' 或 'float32'
+            cpu_int8: 等同于 precision='int8-dynamic'（保留的旧参数）
+            num_threads: CPU推理的线程数，默认为可用物理核数
+            device_budgets: 各设备可用内存（GB，None表示不限）的有序映射，如 {'xpu': 6, 'cpu': None}；
+                            设置后按预算把视觉编码器、重采样器和LLM各层依次放到各设备上
+            max_context_tokens: 设备放置时估算KV缓存和激活使用的最大上下文长度
+            draft_model_path: 推测解码的草稿语言模型路径（需与主模型共用分词器），None表示不启用
+            speculative_lookahead: 推测解码每轮草稿模型提议的token数
+            compile_model: 使用torch.compile编译视觉编码器和语言模型前向（启动时按桶预热）
+            compile_buckets: 预填充token数的分桶，默认为不超过max_context_tokens的默认桶
+            compile_mode: torch.compile模式，如XPU上的'reduce-overhead'
+            memory_high_water: 请求结束后设备保留显存超过总显存的该比例时才释放分配器缓存
+            memory_idle_seconds: 空闲超过该秒数后释放缓存，None表示不做空闲释放
+            pixel_cache_bytes: 预处理后像素值缓存的最大字节数，0表示禁用
+            preprocess_workers: 批量图像预处理中并行缩放帧的线程数，默认为 min(CPU核数, 8)
+            precision: 推理精度，'auto'（XPU用fp16，CPU支持bf16时用bf16）、'fp32'、'bf16'、'fp16'、
+                       'int8-dynamic'（CPU动态int8量化LLM线性层）或 'int4'（需要int4量化的检查点）；
+                       initialize时检查设备是否支持
         """
         self.model_path = model_path
         self.device = device
         self.model = None
         self.tokenizer = None
         self._initialized = False
+        self.load_workers = load_workers
+        
+        # 计算精度：initialize时按precision和实际设备解析
+        if cpu_int8 and precision == 'auto':
+            precision = 'int8-dynamic'
+        if precision != 'auto' and precision not in PRECISION_MODES:
+            raise ValueError(f"不支持的精度: {precision}，可选: auto, {', '.join(PRECISION_MODES)}")
+        self.precision_name = precision
+        self.precision: Optional[PrecisionMode] = None
+        self.torch_dtype = torch.float16
+        self.cpu_dtype = cpu_dtype
+        self.cpu_int8 = precision == 'int8-dynamic'
+        # 检查点是否已量化（如int4），加载后确定
+        self.quantized_checkpoint = False
+        self.num_threads = num_threads
+        self.cpu_threads: Dict[str, int] = {}
+        
+        # 按内存预算的跨设备放置
+        self.device_budgets = device_budgets
+        self.max_context_tokens = max_context_tokens
+        self.placement: Optional[PlacementPlan] = None
+        
+        # 推测解码：草稿模型在initialize时加载
+        self.draft_model_path = draft_model_path
+        self.speculative_lookahead = speculative_lookahead
+        self.speculative: Optional[SpeculativeDecoder] = None
+        
+        # 编译执行模式
+        self.compile_model = compile_model
+        self.compile_buckets = compile_buckets
+        self.compile_mode = compile_mode
+        self.compiled: Optional[CompiledExecution] = None
+        
+        # 视觉特征缓存：同一视频的后续提问跳过视觉编码器和3D重采样器
+        self.vision_cache = VisionFeatureCache(max_bytes=vision_cache_bytes)
+        # 前缀KV缓存：同一视频的后续提问只预填充问题部分的token
+        self.prefix_cache = PrefixKVCache(max_bytes=prefix_cache_bytes)
+        # 像素值缓存：同一视频的后续提问和批量推理跳过图像预处理
+        self.pixel_cache = VisionFeatureCache(max_bytes=pixel_cache_bytes)
+        self.preprocess_workers = preprocess_workers
+        self.batch_preprocessor: Optional[BatchImagePreprocessor] = None
+        
+        # 内存管理：按水位和空闲时间释放缓存，而不是每次请求后都清理
+        self.memory = DeviceMemoryManager(device, high_water=memory_high_water,
+                                          idle_seconds=memory_idle_seconds)
+        
+        # 模型锁：直接推理与连续批处理调度器互斥地使用模型
+        self._model_lock = threading.RLock()
+        # 内存不足降级时模型临时卸载到CPU（_offload_users为仍在卸载作用域内的调用方数）
+        self.offloaded = False
+        self._offload_users = 0
+        self.scheduler: Optional[ContinuousBatchScheduler] = None
         
         # Intel GPU环境变量设置
         self._setup_intel_gpu_env()
         
-        print(f"MiniCPM-V推理引擎已配置 (INT4量化版本)")
+        print(f"MiniCPM-V推理引擎已配置")
         print(f"模型路径: {model_path}")
         print(f"目标设备: {device}")
+        print(f"推理精度: {precision}")
     
     def initialize(self):
         """初始化模型（延迟加载）"""
         if self._initialized:
             return
             
-        # 验证XPU可用性
-        if not self._check_xpu_availability():
-            raise RuntimeError("Intel XPU不可用，请检查驱动和环境配置")
+        # 验证XPU可用性，不可用时_check_xpu_availability会回退到CPU
+        if self.device == 'xpu' and not self._check_xpu_availability():
+            print("Intel XPU不可用，使用CPU推理后端")
         
         print(f"正在初始化MiniCPM-V推理引擎...")
-        print(f"XPU设备数量: {torch.xpu.device_count()}")
+        self.memory.device = self.device
+        self._resolve_precision()
+        if self.device == 'cpu':
+            self._setup_cpu_backend()
+        else:
+            print(f"XPU设备数量: {torch.xpu.device_count()}")
         
         # 加载模型和分词器
         self._load_model()
         self._load_tokenizer()
+        if self.draft_model_path:
+            self._load_draft_model()
+        if self.compile_model:
+            self._setup_compiled_execution()
         
         self._initialized = True
         print("模型初始化完成!")
@@ -66,6 +210,22 @@ class MiniCPMVInference:
                 os.environ[key] = value
                 print(f"设置环境变量: {key}={value}")
     
+    def _resolve_precision(self):
+        """按实际设备（XPU不可用时已回退到CPU）解析推理精度，设备不支持时抛出ValueError"""
+        self.precision = resolve_precision(self.precision_name, self.device, self.cpu_dtype)
+        self.torch_dtype = self.precision.dtype
+        self.cpu_int8 = self.precision.quantization == 'int8-dynamic'
+        print(f"推理精度: {self.precision.describe()}")
+    
+    def _setup_cpu_backend(self):
+        """配置CPU推理线程数"""
+        self.cpu_threads = configure_cpu_threads(self.num_threads)
+        
+        print(f"CPU推理后端: 线程数 {self.cpu_threads['num_threads']}, "
+              f"算子间线程数 {self.cpu_threads['interop_threads']}, "
+              f"精度 {str(self.torch_dtype).replace('torch.', '')}"
+              f"{', LLM动态int8量化' if self.cpu_int8 else ''}")
+    
     def _check_xpu_availability(self) -> bool:
         """检查Intel XPU设备可用性 - 带DLL依赖绕过"""
         try:
@@ -110,98 +270,159 @@ class MiniCPMVInference:
             return False
     
     def _load_model(self):
-        """加载MiniCPM-V模型 - INT4量化版本强制XPU加载策略 (终极版本)"""
+        """加载MiniCPM-V模型 - 直接加载到目标设备（XPU或CPU）"""
         try:
-            print("正在加载INT4量化模型到XPU...")
+            print(f"正在加载模型到{self.device.upper()}...")
             
             # 清理XPU缓存
             self._clear_xpu_cache()
             
-            # 强制XPU加载 - 绕过Transformers的显存查询机制
-            if self.device != 'xpu':
-                print(f"⚠️ 设备不是XPU ({self.device})，强制设置为XPU")
-                self.device = 'xpu'
-            
-            print("🚀 使用终极策略彻底绕过Intel XPU显存查询问题...")
-            
-            # 策略1: 全面禁用PyTorch的显存查询功能
-            print("Step 1: 彻底禁用PyTorch显存查询机制...")
-            
-            # 保存原始函数的引用
-            self._patch_pytorch_memory_functions()
-            
-            try:
-                # 策略2: 强制设置环境变量
-                print("Step 2: 设置强制XPU环境变量...")
-                original_env = self._setup_force_xpu_env()
+            # 在隔离的加载作用域内屏蔽显存查询并设置强制XPU环境变量：
+            # 替换只对当前加载线程生效，多个引擎可以在不同线程中并行加载
+            print("🚀 绕过Intel XPU显存查询问题...")
+            with model_loading_scope(env=FORCE_XPU_ENV):
+                # 并行读取权重分片，直接放到目标设备
+                print("并行加载模型权重到目标设备...")
+                timer = LoadTimer()
                 
-                # 策略3: 分阶段加载模型
-                print("Step 3: 分阶段加载模型...")
+                with timer.phase("定位模型文件"):
+                    checkpoint_dir = resolve_checkpoint_dir(self.model_path)
                 
-                # 3.1 先加载配置
-                print("  3.1 加载模型配置...")
-                from transformers import AutoConfig
-                config = AutoConfig.from_pretrained(
-                    self.model_path,
-                    trust_remote_code=True
-                )
+                # 按预算放置时先加载到CPU，规划后再把各部分移动到对应设备
+                load_device = 'cpu' if self.device_budgets else self.device
                 
-                # 3.2 强制配置torch_dtype
-                config.torch_dtype = torch.float16
-                
-                # 3.3 加载模型到CPU
-                print("  3.2 在CPU上加载模型...")
-                with torch.device('cpu'):
-                    self.model = AutoModel.from_pretrained(
-                        self.model_path,
-                        config=config,
-                        trust_remote_code=True,
-                        torch_dtype=torch.float16,
-                        low_cpu_mem_usage=True,
-                        device_map=None,  # 完全禁用自动设备分配
-                        max_memory=None,  # 禁用内存管理
-                    )
-                
-                # 3.4 逐层移动到XPU
-                print("  3.3 逐层移动模型到XPU...")
-                self._move_model_to_xpu_safely()
-                
-                print("✅ 成功！INT4模型已彻底加载到Intel XPU")
-                
-                # 恢复环境变量
-                self._restore_env(original_env)
+                if is_snapshot(checkpoint_dir):
+                    # 本地快照: 权重已是最终dtype/量化格式，精度须与快照一致；非量化权重按需映射
+                    print("  从模型快照恢复...")
+                    self.model = restore_snapshot(checkpoint_dir, load_device, timer=timer,
+                                                  num_workers=self.load_workers, precision=self.precision)
+                else:
+                    # 非量化模型: meta设备构建结构 + 多线程读取分片直接写到目标设备
+                    self.model = fast_load_model(checkpoint_dir, load_device, self.torch_dtype,
+                                                 timer=timer, num_workers=self.load_workers)
+                if self.model is None:
+                    # 量化模型需要transformers替换量化层，通过device_map直接加载到目标设备
+                    print("  量化模型: 使用device_map直接加载到目标设备")
+                    self.model = load_pretrained_to_device(checkpoint_dir, load_device, self.torch_dtype,
+                                                           timer=timer, num_workers=self.load_workers)
                 
-            finally:
-                # 恢复所有被修改的函数
-                self._restore_pytorch_memory_functions()
+                print(f"✅ 模型权重已加载到 {load_device.upper()}")
+            
+            self._check_checkpoint_precision()
             
             # 设置为评估模式
             self.model = self.model.eval()
             
+            # CPU: 可选的LLM线性层动态int8量化
+            if self.device == 'cpu' and self.cpu_int8:
+                with timer.phase("LLM动态int8量化"):
+                    if self.model.dtype != torch.float32:
+                        # 量化检查点的非量化部分可能以其他精度加载，视觉特征与LLM嵌入需保持同一dtype
+                        self.model = self.model.float()
+                    quantized = quantize_linear_dynamic(self.model.llm)
+                print(f"  已量化 {quantized} 个LLM线性层为int8")
+            
+            # 按设备预算放置视觉编码器、重采样器和LLM各层
+            if self.device_budgets:
+                self._apply_device_budgets(timer)
+            
             # 验证模型设备
-            self._verify_model_device()
+            with timer.phase("验证设备"):
+                self._verify_model_device()
             
             # 显示模型设备分布
             self._print_device_distribution()
             
             # 显示XPU使用情况（如果可能）
             try:
-                if hasattr(torch.xpu, 'memory_allocated'):
+                if self.device == 'xpu' and hasattr(torch.xpu, 'memory_allocated'):
                     allocated = torch.xpu.memory_allocated() / 1024**3
                     print(f"XPU显存使用: {allocated:.2f} GB")
             except Exception as mem_e:
                 print(f"无法查询XPU显存使用: {mem_e}")
             
-            print(f"✅ INT4量化模型强制加载完成 - 运行在: {self.device.upper()}")
-            print("🎉 已彻底绕过Intel XPU显存查询限制！")
+            # 分阶段耗时报告
+            timer.report()
+            
+            print(f"✅ 模型加载完成 - 运行在: {self.device.upper()}")
             
         except Exception as e:
-            print(f"XPU强制加载失败: {str(e)}")
+            print(f"模型加载失败: {str(e)}")
             import traceback
             print("\n详细错误信息:")
             traceback.print_exc()
             raise
     
+    def _check_checkpoint_precision(self):
+        """检查加载的检查点与精度模式是否匹配"""
+        self.quantized_checkpoint = is_quantized_checkpoint(self.model)
+        quantization = self.precision.quantization if self.precision is not None else None
+        
+        if quantization == 'int4' and not self.quantized_checkpoint:
+            raise ValueError(f"int4精度需要int4量化的检查点（如 openbmb/MiniCPM-V-4_5-int4），"
+                             f"{self.model_path} 未量化")
+        if self.quantized_checkpoint and quantization != 'int4':
+            print(f"⚠️ 检查点已量化，{self.precision_name} 只作用于非量化部分（视觉编码器、嵌入等）和计算精度")
+    
+    def _apply_device_budgets(self, timer: LoadTimer):
+        """根据设备内存预算规划并应用模型各部分的设备放置"""
+        budgets = {device: None if gb is None else int(gb * 1024**3)
+                   for device, gb in self.device_budgets.items()}
+        
+        with timer.phase("规划设备放置"):
+            units = estimate_units(self.model, max_context_tokens=self.max_context_tokens)
+            self.placement = plan_placement(units, budgets)
+        
+        # 没有XPU时以CPU模拟预算中的其他设备，方案不变
+        alias = {device: 'cpu' for device in budgets if self.device == 'cpu' and device != 'cpu'}
+        if alias:
+            print(f"⚠️ 当前运行在CPU上，预算中的设备 {', '.join(alias)} 以CPU模拟")
+        
+        with timer.phase("应用设备放置"):
+            apply_placement(self.model, self.placement, device_alias=alias)
+        
+        self.placement.print_report()
+    
+    def _load_draft_model(self):
+        """加载推测解码的草稿语言模型"""
+        from transformers import AutoModelForCausalLM
+        
+        print(f"正在加载草稿模型: {self.draft_model_path}")
+        timer = LoadTimer()
+        with timer.phase("加载草稿模型"):
+            checkpoint_dir = resolve_checkpoint_dir(self.draft_model_path)
+            draft_model = AutoModelForCausalLM.from_pretrained(
+                checkpoint_dir,
+                torch_dtype=self.torch_dtype,
+                low_cpu_mem_usage=True
+            )
+            draft_model = draft_model.to(self.device).eval()
+        
+        target_vocab = self.model.llm.config.vocab_size
+        if draft_model.config.vocab_size != target_vocab:
+            print(f"⚠️ 草稿模型词表大小 ({draft_model.config.vocab_size}) 与主模型 ({target_vocab}) 不同，"
+                  f"请确认两者使用相同的分词器")
+        
+        self.speculative = SpeculativeDecoder(draft_model, lookahead=self.speculative_lookahead)
+        timer.report("草稿模型加载耗时")
+    
+    def _setup_compiled_execution(self):
+        """安装分桶的编译前向，并在启动时预热各个预填充桶"""
+        buckets = self.compile_buckets or [b for b in DEFAULT_PROMPT_BUCKETS if b <= self.max_context_tokens]
+        self.compiled = CompiledExecution(self.model, prompt_buckets=buckets, mode=self.compile_mode).apply()
+        print(f"已启用编译执行模式 (后端: {self.compiled.backend}, 预填充分桶: {list(self.compiled.prompt_buckets)}, "
+              f"视觉批大小分桶: {list(self.compiled.vision_buckets)})")
+        
+        print("正在按形状分桶预热编译...")
+        try:
+            timings = self.compiled.warm_up()
+        except Exception as e:
+            print(f"⚠️ 模型编译失败，使用eager执行: {e}")
+            self.compiled.remove()
+            self.compiled = None
+            return
+        print(f"✅ 编译预热完成，耗时 {sum(timings.values()):.1f}s")
+    
     def _load_tokenizer(self):
         """加载分词器"""
         try:
@@ -237,6 +458,9 @@ class MiniCPMVInference:
         """获取设备信息"""
         info = {
             'device': self.device,
+            'dtype': str(self.torch_dtype).replace('torch.', ''),
+            'precision': self.precision.name if self.precision is not None else self.precision_name,
+            'quantized_checkpoint': self.quantized_checkpoint,
             'xpu_available': torch.xpu.is_available(),
             'device_count': torch.xpu.device_count() if torch.xpu.is_available() else 0,
         }
@@ -253,12 +477,39 @@ class MiniCPMVInference:
             except:
                 pass
         
+        if self.device == 'cpu':
+            info.update(self.cpu_threads)
+            info['cpu_int8'] = self.cpu_int8
+        
+        if self.placement is not None:
+            info['placement'] = self.placement.summary()
+        
+        if self.speculative is not None:
+            info['speculative'] = self.speculative.stats()
+        
+        info['memory'] = self.memory.stats()
+        
+        if self.batch_preprocessor is not None:
+            info['preprocessing'] = {
+                'vectorized': self.batch_preprocessor.validated,
+                **self.batch_preprocessor.stats,
+            }
+        
+        if self.compiled is not None:
+            info['compiled'] = {
+                'prompt_buckets': list(self.compiled.prompt_buckets),
+                'vision_buckets': list(self.compiled.vision_buckets),
+                **self.compiled.stats,
+            }
+        
         return info
     
     def chat(self, msgs: List[Dict], use_image_id: bool = False, 
              max_slice_nums: int = 1, temporal_ids: Optional[List[List[int]]] = None,
              max_new_tokens: int = 2048, do_sample: bool = True, 
-             temperature: float = 0.7, top_p: float = 0.8) -> str:
+             temperature: float = 0.7, top_p: float = 0.8,
+             cache_key: Optional[str] = None, speculative: bool = True,
+             cancel_token: Optional[CancellationToken] = None, timeout: Optional[float] = None) -> str:
         """
         与模型进行对话
         
@@ -271,9 +522,13 @@ class MiniCPMVInference:
             do_sample: 是否采样
             temperature: 温度参数
             top_p: Top-p采样参数
+            cache_key: 帧集合指纹（可选），提供时缓存并复用视觉特征和视频前缀的KV
+            speculative: 配置了草稿模型时使用推测解码（直接在当前线程生成，不经过调度器）
+            cancel_token: 取消令牌（可选），取消后在下一个解码步停止并释放模型
+            timeout: 本次请求的墙钟超时秒数（可选），超时后同样停止
             
         Returns:
-            模型的回答文本
+            模型的回答文本（ChatResult），被取消或超时时为已生成的部分，truncated为True
         """
         # 确保模型已初始化
         if not self._initialized:
@@ -283,49 +538,701 @@ class MiniCPMVInference:
             if self.model is None or self.tokenizer is None:
                 raise RuntimeError("模型或分词器未正确加载")
             
+            token = CancellationToken.for_request(cancel_token, timeout)
+            if self.offloaded:
+                # 模型在CPU上时不使用设备上的特征缓存、草稿模型和调度器
+                cache_key = None
+            use_speculative = speculative and self.speculative is not None and not self.offloaded
+            if (self.scheduler is not None and self.scheduler.running and not use_speculative
+                    and not self.offloaded):
+                return self.submit_chat(
+                    msgs, use_image_id, max_slice_nums, temporal_ids,
+                    max_new_tokens, do_sample, temperature, top_p, cache_key, token
+                ).result()
+            
+            if token is not None and token.check():
+                print(f"推理未开始即停止: {token.stop_reason}")
+                return ChatResult("", token.stop_reason)
+            
             print("开始推理...")
             
             # 禁用梯度计算以节省内存
-            with torch.no_grad():
-                # 生成参数
-                generation_config = {
-                    'max_new_tokens': max_new_tokens,
-                    'do_sample': do_sample,
-                    'temperature': temperature,
-                    'top_p': top_p,
-                    'use_cache': True,
-                }
+            with torch.no_grad(), self._model_lock, self._track_memory():
+                generation_config = self._build_generation_config(
+                    max_new_tokens, do_sample, temperature, top_p, temporal_ids
+                )
+                vision_key = self._apply_cached_vision_features(
+                    generation_config, cache_key, max_slice_nums, use_image_id
+                )
                 
-                # 如果有时序ID，添加到参数中
-                if temporal_ids is not None:
-                    generation_config['temporal_ids'] = temporal_ids
+                with self._batched_preprocessing(cache_key, max_slice_nums), \
+                        self._capture_vision_hidden_states() as captured, \
+                        self._speculative_generate(use_speculative, token), \
+                        self._reuse_prefix_kv(vision_key), \
+                        self._stop_on_cancel(token):
+                    # 调用模型的chat方法
+                    answer = self.model.chat(
+                        msgs=msgs,
+                        tokenizer=self.tokenizer,
+                        use_image_id=use_image_id,
+                        max_slice_nums=max_slice_nums,
+                        **generation_config
+                    )
                 
-                # 调用模型的chat方法
-                answer = self.model.chat(
-                    msgs=msgs,
-                    tokenizer=self.tokenizer,
-                    use_image_id=use_image_id,
-                    max_slice_nums=max_slice_nums,
-                    **generation_config
-                )
+                self._store_vision_features(vision_key, generation_config, captured)
                 
-                print("推理完成")
-                return answer
+                stop_reason = token.stop_reason if token is not None else None
+                if stop_reason is not None:
+                    print(f"推理提前停止（{stop_reason}），返回已生成的部分")
+                else:
+                    print("推理完成")
+                return ChatResult(answer, stop_reason)
                 
         except Exception as e:
             print(f"推理失败: {str(e)}")
             raise
     
-    def warm_up(self):
-        """模型预热，预加载CUDA kernel"""
+    def stream_chat(self, msgs: List[Dict], use_image_id: bool = False,
+                    max_slice_nums: int = 1, temporal_ids: Optional[List[List[int]]] = None,
+                    max_new_tokens: int = 2048, do_sample: bool = True,
+                    temperature: float = 0.7, top_p: float = 0.8,
+                    cache_key: Optional[str] = None,
+                    cancel_token: Optional[CancellationToken] = None,
+                    timeout: Optional[float] = None) -> Iterator[str]:
+        """
+        与模型进行流式对话，逐段返回生成的文本
+        
+        参数与chat相同，使用模型自带的stream模式（内部为TextIteratorStreamer），
+        生成在后台线程中进行；调用方提前关闭迭代器（如客户端断开）时取消生成，
+        是否被截断可在传入的cancel_token.stop_reason中查看
+        
+        Yields:
+            新生成的文本片段
+        """
+        # 确保模型已初始化
+        if not self._initialized:
+            self.initialize()
+        
+        if self.model is None or self.tokenizer is None:
+            raise RuntimeError("模型或分词器未正确加载")
+        
+        token = CancellationToken.for_request(cancel_token, timeout) or CancellationToken()
+        finished = False
+        try:
+            yield from self._stream_chat(msgs, use_image_id, max_slice_nums, temporal_ids, max_new_tokens,
+                                         do_sample, temperature, top_p, cache_key, token)
+            finished = True
+        finally:
+            if not finished:
+                # 调用方不再读取（断开或中断），立即让生成线程停止
+                token.cancel('客户端断开')
+    
+    def _stream_chat(self, msgs: List[Dict], use_image_id: bool, max_slice_nums: int,
+                     temporal_ids: Optional[List[List[int]]], max_new_tokens: int, do_sample: bool,
+                     temperature: float, top_p: float, cache_key: Optional[str],
+                     token: CancellationToken) -> Iterator[str]:
+        if self.offloaded:
+            # 模型在CPU上时不使用设备上的特征缓存和调度器
+            cache_key = None
+        elif self.scheduler is not None and self.scheduler.running:
+            yield from self.submit_chat(
+                msgs, use_image_id, max_slice_nums, temporal_ids,
+                max_new_tokens, do_sample, temperature, top_p, cache_key, token
+            ).stream()
+            return
+        
+        if token.check():
+            print(f"流式推理未开始即停止: {token.stop_reason}")
+            return
+        
+        print("开始流式推理...")
+        
+        # model.chat(stream=True)返回时生成线程刚启动，模型锁需要一直持有到生成结束；
+        # 调用方可能在不同线程中逐段读取（如gradio的线程池），因此由专门的线程获取和释放锁，
+        # 生成结束或被取消（stream_chat关闭时取消token）后才释放
+        chunks: "queue.Queue[Any]" = queue.Queue()
+        
+        def produce():
+            try:
+                with torch.no_grad(), self._model_lock:
+                    generation_config = self._build_generation_config(
+                        max_new_tokens, do_sample, temperature, top_p, temporal_ids
+                    )
+                    vision_key = self._apply_cached_vision_features(
+                        generation_config, cache_key, max_slice_nums, use_image_id
+                    )
+                    
+                    # 视觉编码在chat()返回前同步完成，生成线程此时已经启动
+                    with self._batched_preprocessing(cache_key, max_slice_nums), \
+                            self._capture_vision_hidden_states() as captured, \
+                            self._reuse_prefix_kv(vision_key), \
+                            self._stop_on_cancel(token):
+                        stream = self.model.chat(
+                            msgs=msgs,
+                            tokenizer=self.tokenizer,
+                            use_image_id=use_image_id,
+                            max_slice_nums=max_slice_nums,
+                            stream=True,
+                            **generation_config
+                        )
+                    
+                    self._store_vision_features(vision_key, generation_config, captured)
+                    for text in stream:
+                        if text:
+                            chunks.put(text)
+            except BaseException as e:
+                chunks.put(e)
+            finally:
+                chunks.put(_STREAM_END)
+        
+        with self._track_memory():
+            threading.Thread(target=produce, name="stream-chat", daemon=True).start()
+            while True:
+                item = chunks.get()
+                if item is _STREAM_END:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        
+        if token.stop_reason is not None:
+            print(f"流式推理提前停止（{token.stop_reason}）")
+        else:
+            print("流式推理完成")
+    
+    def batch_chat(self, msgs_list: List[List[Dict]], use_image_id: bool = False,
+                   max_slice_nums: int = 1, temporal_ids: Optional[List[List[int]]] = None,
+                   max_new_tokens: int = 2048, do_sample: bool = True,
+                   temperature: float = 0.7, top_p: float = 0.8,
+                   cache_key: Optional[str] = None, max_batch_size: int = 4,
+                   cancel_token: Optional[CancellationToken] = None,
+                   timeout: Optional[float] = None) -> List[str]:
+        """
+        批量对话：同一组视频帧上的多个问题按微批次一起生成
+        
+        提供cache_key时要求所有消息使用相同的帧，视觉特征只编码一次，
+        每个微批次共享视频前缀的KV；视觉特征未缓存时先单独推理第一个问题来填充缓存
+        
+        Args:
+            msgs_list: 消息列表的列表，每个元素对应一个问题
+            max_batch_size: 每个微批次的最大问题数
+            cancel_token: 取消令牌（可选），对整批问题生效
+            timeout: 整批问题的墙钟超时秒数（可选）
+            其余参数与chat相同
+            
+        Returns:
+            按输入顺序排列的回答列表（ChatResult），停止后剩余的问题为空的截断回答
+        """
+        # 确保模型已初始化
+        if not self._initialized:
+            self.initialize()
+        
+        if self.model is None or self.tokenizer is None:
+            raise RuntimeError("模型或分词器未正确加载")
+        
+        chat_kwargs = dict(
+            use_image_id=use_image_id,
+            max_slice_nums=max_slice_nums,
+            temporal_ids=temporal_ids,
+            max_new_tokens=max_new_tokens,
+            do_sample=do_sample,
+            temperature=temperature,
+            top_p=top_p,
+            cache_key=cache_key,
+            cancel_token=CancellationToken.for_request(cancel_token, timeout)
+        )
+        token = chat_kwargs['cancel_token']
+        
+        answers: List[str] = []
+        start = 0
+        vision_key = (cache_key, max_slice_nums, use_image_id)
+        if cache_key is not None and self.vision_cache.enabled and vision_key not in self.vision_cache:
+            answers.append(self.chat(msgs_list[0], **chat_kwargs))
+            start = 1
+        
+        max_batch_size = max(int(max_batch_size), 1)
+        for i in range(start, len(msgs_list), max_batch_size):
+            batch = msgs_list[i:i + max_batch_size]
+            if len(batch) == 1:
+                answers.append(self.chat(batch[0], **chat_kwargs))
+                continue
+            
+            if token is not None and token.check():
+                answers.extend(ChatResult("", token.stop_reason) for _ in batch)
+                continue
+            
+            print(f"开始批量推理: {len(batch)} 个问题")
+            with torch.no_grad(), self._model_lock, self._track_memory():
+                generation_config = self._build_generation_config(
+                    max_new_tokens, do_sample, temperature, top_p, temporal_ids
+                )
+                batch_vision_key = self._apply_cached_vision_features(
+                    generation_config, cache_key, max_slice_nums, use_image_id, batch_size=len(batch)
+                )
+                
+                with self._batched_preprocessing(cache_key, max_slice_nums), \
+                        self._reuse_prefix_kv(batch_vision_key), self._stop_on_cancel(token):
+                    batch_answers = self.model.chat(
+                        msgs=batch,
+                        tokenizer=self.tokenizer,
+                        use_image_id=use_image_id,
+                        max_slice_nums=max_slice_nums,
+                        **generation_config
+                    )
+            
+            stop_reason = token.stop_reason if token is not None else None
+            answers.extend(ChatResult(answer, stop_reason) for answer in batch_answers)
+        
+        print("批量推理完成")
+        return answers
+    
+    def start_scheduler(self, max_batch_size: int = 8) -> ContinuousBatchScheduler:
+        """
+        启动连续批处理调度器，之后chat/stream_chat的请求都交给调度器的工作线程
+        
+        Args:
+            max_batch_size: 同时解码的最大序列数
+        """
+        if not self._initialized:
+            self.initialize()
+        
+        if self.scheduler is None or not self.scheduler.running:
+            self.scheduler = ContinuousBatchScheduler(
+                self.model.llm,
+                self.tokenizer,
+                max_batch_size=max_batch_size,
+                lock=self._model_lock,
+                prefix_cache=self.prefix_cache
+            ).start()
+        return self.scheduler
+    
+    def stop_scheduler(self):
+        """停止连续批处理调度器，恢复直接推理"""
+        if self.scheduler is not None:
+            self.scheduler.stop()
+            self.scheduler = None
+    
+    def submit_chat(self, msgs: List[Dict], use_image_id: bool = False,
+                    max_slice_nums: int = 1, temporal_ids: Optional[List[List[int]]] = None,
+                    max_new_tokens: int = 2048, do_sample: bool = True,
+                    temperature: float = 0.7, top_p: float = 0.8,
+                    cache_key: Optional[str] = None,
+                    cancel_token: Optional[CancellationToken] = None) -> GenerationRequest:
+        """
+        向连续批处理调度器提交一次对话（非阻塞）
+        
+        参数与chat相同；处理器和视觉编码器在调度器的工作线程中运行，
+        cancel_token取消或超时后请求在下一个解码步退出批次
+        
+        Returns:
+            GenerationRequest，可通过result()等待结果或stream()流式读取
+        """
+        if self.scheduler is None or not self.scheduler.running:
+            raise RuntimeError("推理调度器未启动，请先调用start_scheduler()")
+        
+        def prepare() -> PreparedPrompt:
+            generation_config = self._build_generation_config(
+                max_new_tokens, do_sample, temperature, top_p, temporal_ids
+            )
+            return self._prepare_prompt(msgs, use_image_id, max_slice_nums, generation_config, cache_key)
+        
+        request = GenerationRequest(prepare, cancel_token)
+        self.memory.begin_request()
+        request.future.add_done_callback(
+            lambda future: self.memory.end_request(failed=future.exception() is not None)
+        )
+        return self.scheduler.submit(request)
+    
+    @contextmanager
+    def _track_memory(self):
+        """请求期间登记为活跃请求，结束后由内存管理器根据水位决定是否释放缓存"""
+        self.memory.begin_request()
+        failed = True
         try:
-            print("正在预热模型...")
+            yield
+            failed = False
+        except GeneratorExit:
+            # 流式输出被调用方提前关闭，不算失败
+            failed = False
+            raise
+        finally:
+            self.memory.end_request(failed=failed)
+    
+    def _prepare_prompt(self, msgs: List[Dict], use_image_id: bool, max_slice_nums: int,
+                        generation_config: Dict[str, Any], cache_key: Optional[str]) -> PreparedPrompt:
+        """
+        运行model.chat直到语言模型生成之前，取出输入嵌入和生成参数
+        
+        Returns:
+            交给调度器预填充和解码的PreparedPrompt
+        """
+        vision_key = self._apply_cached_vision_features(
+            generation_config, cache_key, max_slice_nums, use_image_id
+        )
+        
+        llm_kwargs: Dict[str, Any] = {}
+        
+        def generate(*args, **kwargs):
+            llm_kwargs.update(kwargs)
+            raise _PromptCaptured()
+        
+        with self._batched_preprocessing(cache_key, max_slice_nums), \
+                self._capture_vision_hidden_states() as captured, \
+                _override_method(self.model.llm, 'generate', generate):
+            try:
+                self.model.chat(
+                    msgs=msgs,
+                    tokenizer=self.tokenizer,
+                    use_image_id=use_image_id,
+                    max_slice_nums=max_slice_nums,
+                    **generation_config
+                )
+            except _PromptCaptured:
+                pass
+        
+        if llm_kwargs.get('inputs_embeds') is None:
+            raise RuntimeError("未能获取语言模型的输入嵌入")
+        
+        self._store_vision_features(vision_key, generation_config, captured)
+        
+        eos_token_ids = llm_kwargs.get('eos_token_id', self.tokenizer.eos_token_id)
+        if isinstance(eos_token_ids, int):
+            eos_token_ids = [eos_token_ids]
+        
+        return PreparedPrompt(
+            inputs_embeds=llm_kwargs['inputs_embeds'],
+            eos_token_ids=eos_token_ids,
+            max_new_tokens=llm_kwargs.get('max_new_tokens', generation_config['max_new_tokens']),
+            do_sample=llm_kwargs.get('do_sample', generation_config['do_sample']),
+            temperature=llm_kwargs.get('temperature', generation_config['temperature']),
+            top_p=llm_kwargs.get('top_p', generation_config['top_p']),
+            top_k=llm_kwargs.get('top_k', 0),
+            repetition_penalty=llm_kwargs.get('repetition_penalty', 1.0),
+            cache_key=vision_key
+        )
+    
+    def _build_generation_config(self, max_new_tokens: int, do_sample: bool,
+                                 temperature: float, top_p: float,
+                                 temporal_ids: Optional[List[List[int]]]) -> Dict[str, Any]:
+        """构建传给model.chat的生成参数"""
+        generation_config = {
+            'max_new_tokens': max_new_tokens,
+            'do_sample': do_sample,
+            'temperature': temperature,
+            'top_p': top_p,
+            'use_cache': True,
+        }
+        
+        # 如果有时序ID，添加到参数中
+        if temporal_ids is not None:
+            generation_config['temporal_ids'] = temporal_ids
+        
+        return generation_config
+    
+    def _apply_cached_vision_features(self, generation_config: Dict[str, Any],
+                                      cache_key: Optional[str], max_slice_nums: int,
+                                      use_image_id: bool, batch_size: int = 1) -> Optional[tuple]:
+        """
+        查询视觉特征缓存，命中时把特征写入生成参数
+        
+        Args:
+            batch_size: 批量推理时每条样本复用同一份视觉特征
+        
+        Returns:
+            视觉特征缓存键（包含影响视觉编码的参数），未提供cache_key时为None
+        """
+        if cache_key is None or not self.vision_cache.enabled:
+            return None
+        
+        vision_key = (cache_key, max_slice_nums, use_image_id)
+        cached_states = self.vision_cache.get(vision_key)
+        if cached_states is not None:
+            print("命中视觉特征缓存，跳过视觉编码")
+            generation_config['vision_hidden_states'] = (
+                cached_states if batch_size == 1 else list(cached_states) * batch_size
+            )
+        return vision_key
+    
+    def _store_vision_features(self, vision_key: Optional[tuple],
+                               generation_config: Dict[str, Any], captured: List[Any]):
+        """缓存本次推理新计算出的视觉特征"""
+        if vision_key is not None and 'vision_hidden_states' not in generation_config and captured:
+            self.vision_cache.put(vision_key, captured[0])
+    
+    def _image_processor(self) -> Optional[Any]:
+        """模型处理器的image_processor（与model.chat一样在首次使用时加载处理器），没有时为None"""
+        if self.model is None or not hasattr(self.model, 'processor'):
+            return None
+        if self.model.processor is None:
+            try:
+                from transformers import AutoProcessor
+                self.model.processor = AutoProcessor.from_pretrained(
+                    self.model.config._name_or_path, trust_remote_code=True
+                )
+            except Exception as e:
+                print(f"处理器加载失败，使用模型默认的预处理: {e}")
+                return None
+        return getattr(self.model.processor, 'image_processor', None)
+    
+    @contextmanager
+    def _batched_preprocessing(self, cache_key: Optional[str], max_slice_nums: int):
+        """
+        临时包装处理器的图像预处理：同一帧集合的像素值与视觉特征一起按帧集合指纹缓存，
+        命中时直接返回；未命中时用向量化的批量预处理代替逐帧处理
+        
+        Args:
+            cache_key: 帧集合指纹，None时只做批量预处理、不缓存
+            max_slice_nums: 最大切片数量（影响像素值，作为缓存键的一部分）
+        """
+        image_processor = self._image_processor()
+        if image_processor is None:
+            yield
+            return
+        
+        if self.batch_preprocessor is None or self.batch_preprocessor.image_processor is not image_processor:
+            self.batch_preprocessor = BatchImagePreprocessor(image_processor, self.preprocess_workers)
+        batch = self.batch_preprocessor
+        original = image_processor.preprocess
+        pixel_key = (cache_key, max_slice_nums) if cache_key is not None and self.pixel_cache.enabled else None
+        
+        def preprocess(images, *args, **kwargs):
+            samples = as_samples(images)
+            # 批量推理时各样本使用同一组帧才能复用单个样本的结果
+            if args or not samples or any(
+                    len(sample) != len(samples[0]) or any(a is not b for a, b in zip(sample, samples[0]))
+                    for sample in samples[1:]):
+                return original(images, *args, **kwargs)
+            
+            data = self.pixel_cache.get(pixel_key) if pixel_key is not None else None
+            if data is not None:
+                print("命中像素缓存，跳过图像预处理")
+            elif len(samples) > 1:
+                return original(images, **kwargs)
+            else:
+                data = batch.preprocess_sample(original, samples[0], kwargs)
+                if pixel_key is not None:
+                    self.pixel_cache.put(pixel_key, data)
+            
+            output = batch.build_output(data, len(samples), kwargs.get('return_tensors'))
+            return output if output is not None else original(images, **kwargs)
+        
+        with _override_method(image_processor, 'preprocess', preprocess):
+            yield
+    
+    @contextmanager
+    def _capture_vision_hidden_states(self):
+        """
+        临时包装模型的get_vllm_embedding，记录本次推理计算出的视觉特征
+        
+        Yields:
+            列表，推理结束后包含每次调用返回的vision_hidden_states
+        """
+        captured = []
+        original = self.model.get_vllm_embedding
+        
+        def get_vllm_embedding(data):
+            embedding, vision_hidden_states = original(data)
+            captured.append(vision_hidden_states)
+            return embedding, vision_hidden_states
+        
+        with _override_method(self.model, 'get_vllm_embedding', get_vllm_embedding):
+            yield captured
+    
+    @contextmanager
+    def _speculative_generate(self, enabled: bool, cancel_token: Optional[CancellationToken] = None):
+        """
+        临时把语言模型的generate替换为推测解码
+        
+        草稿模型看不到视觉特征，从get_vllm_embedding的输入中取出去掉图像占位token后的
+        文本提示作为草稿模型的提示；由_reuse_prefix_kv传入的前缀KV直接交给主模型使用
+        
+        Args:
+            enabled: False时不做任何替换
+            cancel_token: 取消令牌（可选），每轮验证前检查
+        """
+        llm = getattr(self.model, 'llm', None)
+        if not enabled or llm is None:
+            yield
+            return
+        
+        draft_prompts: List[torch.Tensor] = []
+        original_embedding = self.model.get_vllm_embedding
+        original_generate = llm.generate
+        
+        def get_vllm_embedding(data):
+            input_ids = data['input_ids']
+            if input_ids.shape[0] == 1:
+                keep = torch.ones(input_ids.shape[1], dtype=torch.bool, device=input_ids.device)
+                for start, end in data.get('image_bound', [[]])[0]:
+                    keep[int(start):int(end)] = False
+                draft_prompts.append(input_ids[:, keep])
+            return original_embedding(data)
+        
+        def generate(*args, **kwargs):
+            inputs_embeds = kwargs.get('inputs_embeds')
+            if (args or inputs_embeds is None or inputs_embeds.shape[0] != 1 or not draft_prompts
+                    or kwargs.get('num_beams', 1) != 1 or kwargs.get('streamer') is not None):
+                return original_generate(*args, **kwargs)
+            
+            eos_token_ids = kwargs.get('eos_token_id', self.tokenizer.eos_token_id)
+            if isinstance(eos_token_ids, int):
+                eos_token_ids = [eos_token_ids]
+            prompt = PreparedPrompt(
+                inputs_embeds=inputs_embeds,
+                eos_token_ids=eos_token_ids,
+                max_new_tokens=kwargs.get('max_new_tokens', 2048),
+                do_sample=kwargs.get('do_sample', True),
+                temperature=kwargs.get('temperature', 0.7),
+                top_p=kwargs.get('top_p', 0.8),
+                top_k=kwargs.get('top_k', 0),
+                repetition_penalty=kwargs.get('repetition_penalty', 1.0)
+            )
+            tokens = self.speculative.generate(
+                llm, inputs_embeds, draft_prompts[-1], prompt,
+                past_key_values=kwargs.get('past_key_values'),
+                should_stop=cancel_token.check if cancel_token is not None else None
+            )
+            return torch.tensor([tokens], device=inputs_embeds.device)
+        
+        with _override_method(self.model, 'get_vllm_embedding', get_vllm_embedding), \
+                _override_method(llm, 'generate', generate):
+            yield
+    
+    @contextmanager
+    def _stop_on_cancel(self, token: Optional[CancellationToken]):
+        """
+        临时包装语言模型的generate，加入检查取消令牌的停止条件
+        
+        Args:
+            token: 取消令牌，None时不做任何替换
+        """
+        llm = getattr(self.model, 'llm', None)
+        if token is None or llm is None:
+            yield
+            return
+        
+        original = llm.generate
+        
+        def generate(*args, **kwargs):
+            criteria = StoppingCriteriaList(kwargs.get('stopping_criteria') or [])
+            criteria.append(StopOnCancel(token))
+            kwargs['stopping_criteria'] = criteria
+            return original(*args, **kwargs)
+        
+        with _override_method(llm, 'generate', generate):
+            yield
+    
+    @contextmanager
+    def _reuse_prefix_kv(self, key: Optional[Any]):
+        """
+        临时包装语言模型的generate，复用缓存的前缀KV
+        
+        与缓存前缀相同的部分（视频帧）直接使用复制出的past_key_values，
+        generate只对剩余的问题token做预填充；生成结束后保存本次的前缀KV
+        
+        Args:
+            key: 前缀缓存键，None表示不复用
+        """
+        llm = getattr(self.model, 'llm', None)
+        if key is None or llm is None or not self.prefix_cache.enabled:
+            yield
+            return
+        
+        from transformers import DynamicCache
+        original = llm.generate
+        
+        def generate(*args, **kwargs):
+            inputs_embeds = kwargs.get('inputs_embeds')
+            # 只处理非beam search、未自带KV的生成
+            if (args or inputs_embeds is None
+                    or kwargs.get('num_beams', 1) != 1 or 'past_key_values' in kwargs):
+                return original(*args, **kwargs)
+            
+            if inputs_embeds.shape[0] > 1:
+                return self._generate_shared_prefix(original, key, kwargs)
+            
+            past_key_values, prefix_len = self.prefix_cache.fork(key, inputs_embeds)
+            if past_key_values is None:
+                past_key_values = DynamicCache()
+            else:
+                print(f"命中前缀KV缓存，复用 {prefix_len}/{inputs_embeds.shape[1]} 个token")
+            
+            output = original(*args, past_key_values=past_key_values, **kwargs)
+            self.prefix_cache.store(key, inputs_embeds, past_key_values, prefix_len or None)
+            return output
+        
+        with _override_method(llm, 'generate', generate):
+            yield
+    
+    def _generate_shared_prefix(self, original: Callable, key: Any, kwargs: Dict[str, Any]):
+        """
+        批量生成：所有样本共享同一份视频前缀KV，只预填充各自的问题部分
+        
+        Args:
+            original: 语言模型原始的generate
+            key: 前缀缓存键
+            kwargs: 传给generate的参数（inputs_embeds为左填充的批量输入）
+        """
+        attention_mask = kwargs.get('attention_mask')
+        aligned = None
+        if attention_mask is not None:
+            aligned = align_shared_prefix(kwargs['inputs_embeds'], attention_mask)
+        if aligned is None or aligned[2] < self.prefix_cache.min_prefix_tokens:
+            return original(**kwargs)
+        
+        inputs_embeds, attention_mask, prefix_len = aligned
+        prefix = inputs_embeds[:1, :prefix_len]
+        
+        past_key_values, reused = self.prefix_cache.fork(key, prefix, max_prefix=prefix_len)
+        if past_key_values is None:
+            from transformers import DynamicCache
+            past_key_values = DynamicCache()
+        
+        # 缓存未覆盖的前缀部分只对一条样本预填充一次
+        if reused < prefix_len:
+            self.model.llm.get_decoder()(
+                inputs_embeds=prefix[:, reused:],
+                past_key_values=past_key_values,
+                use_cache=True
+            )
+            self.prefix_cache.store(key, prefix, past_key_values)
+        
+        batch_size = inputs_embeds.shape[0]
+        print(f"批量生成共享前缀KV: {prefix_len} 个token × {batch_size} 条")
+        past_key_values.batch_repeat_interleave(batch_size)
+        
+        kwargs.update(
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            past_key_values=past_key_values
+        )
+        return original(**kwargs)
+    
+    def warm_up(self, videos: Optional[List[tuple]] = None, max_new_tokens: int = 8) -> Dict[str, float]:
+        """
+        模型预热
+        
+        先用纯文本提示预热语言模型；再对videos中的每个视频形状走完整的视频推理路径
+        （处理器、视觉编码器、带temporal_ids的3D重采样器和长提示预填充），
+        使这些一次性开销（kernel编译、内存池增长、编译图）不落在第一个真实请求上
+        
+        Args:
+            videos: [(标签, 帧列表, temporal_ids)]，如VideoEncoder.synthetic_video生成的合成视频
+            max_new_tokens: 每个视频预热步骤的生成token数
             
+        Returns:
+            每个预热步骤的耗时（秒）
+        """
+        timings: Dict[str, float] = {}
+        print("正在预热模型...")
+        
+        try:
             # 创建虚拟输入进行预热
             dummy_msgs = [
                 {'role': 'user', 'content': ['Hello, this is a warm-up message.']}
             ]
             
+            start = time.time()
             with torch.no_grad():
                 _ = self.model.chat(
                     msgs=dummy_msgs,
@@ -333,11 +1240,30 @@ class MiniCPMVInference:
                     max_new_tokens=10,
                     do_sample=False
                 )
-            
-            print("模型预热完成")
+            timings['文本'] = time.time() - start
+            print(f"  文本: {timings['文本']:.1f}s")
             
         except Exception as e:
             print(f"模型预热失败: {str(e)}")
+            return timings
+        
+        for label, frames, temporal_ids in videos or []:
+            try:
+                start = time.time()
+                # 不提供cache_key，合成视频不进入视觉特征和前缀KV缓存
+                self.chat(
+                    msgs=[{'role': 'user', 'content': list(frames) + ['Describe the video.']}],
+                    temporal_ids=temporal_ids,
+                    max_new_tokens=max_new_tokens,
+                    do_sample=False
+                )
+                timings[label] = time.time() - start
+                print(f"  {label}: {timings[label]:.1f}s")
+            except Exception as e:
+                print(f"视频预热失败 ({label}): {str(e)}")
+        
+        print(f"模型预热完成，共 {sum(timings.values()):.1f}s")
+        return timings
     
     def _clear_xpu_cache(self):
         """清理XPU缓存"""
@@ -393,177 +1319,93 @@ class MiniCPMVInference:
         except Exception as e:
             print(f"设备分布显示失败: {str(e)}")
     
-    def _patch_pytorch_memory_functions(self):
-        """修补PyTorch的内存查询函数以避免XPU显存查询错误"""
-        try:
-            print("    正在修补PyTorch内存查询函数...")
-            
-            # 保存原始函数引用
-            self._original_functions = {}
-            
-            # 1. 修补 torch.cuda.mem_get_info (如果存在)
-            if hasattr(torch.cuda, 'mem_get_info'):
-                self._original_functions['cuda_mem_get_info'] = torch.cuda.mem_get_info
-                torch.cuda.mem_get_info = lambda device=None: (0, 0)
-            
-            # 2. 修补 torch.xpu.mem_get_info (如果存在)
-            try:
-                if hasattr(torch.xpu, 'mem_get_info'):
-                    self._original_functions['xpu_mem_get_info'] = torch.xpu.mem_get_info
-                    torch.xpu.mem_get_info = lambda device=None: (0, 0)
-            except:
-                pass
-            
-            # 3. 修补 transformers 中的相关函数
-            import transformers.utils
-            import transformers.modeling_utils
-            
-            # 修补 get_available_memory 相关函数
-            if hasattr(transformers.utils, 'get_available_memory'):
-                self._original_functions['get_available_memory'] = transformers.utils.get_available_memory
-                transformers.utils.get_available_memory = lambda: {}
-            
-            # 修补 caching_allocator_warmup
-            if hasattr(transformers.modeling_utils, 'caching_allocator_warmup'):
-                self._original_functions['caching_allocator_warmup'] = transformers.modeling_utils.caching_allocator_warmup
-                def dummy_warmup(*args, **kwargs):
-                    pass
-                transformers.modeling_utils.caching_allocator_warmup = dummy_warmup
-            
-            # 4. 修补 accelerate 库的内存函数
-            try:
-                import accelerate.utils
-                if hasattr(accelerate.utils, 'get_available_memory'):
-                    self._original_functions['accelerate_get_available_memory'] = accelerate.utils.get_available_memory
-                    accelerate.utils.get_available_memory = lambda: {}
-            except ImportError:
-                pass  # accelerate 可能未安装
-            
-            print(f"    ✅ 已修补 {len(self._original_functions)} 个内存查询函数")
-            
-        except Exception as e:
-            print(f"    ❌ 修补函数失败: {e}")
-            self._original_functions = {}
-    
-    def _restore_pytorch_memory_functions(self):
-        """恢复被修补的PyTorch内存查询函数"""
-        try:
-            if not hasattr(self, '_original_functions'):
-                return
-            
-            print("    正在恢复PyTorch内存查询函数...")
-            
-            # 恢复 torch.cuda.mem_get_info
-            if 'cuda_mem_get_info' in self._original_functions:
-                torch.cuda.mem_get_info = self._original_functions['cuda_mem_get_info']
-            
-            # 恢复 torch.xpu.mem_get_info
-            if 'xpu_mem_get_info' in self._original_functions:
-                torch.xpu.mem_get_info = self._original_functions['xpu_mem_get_info']
-            
-            # 恢复 transformers 函数
-            import transformers.utils
-            import transformers.modeling_utils
-            
-            if 'get_available_memory' in self._original_functions:
-                transformers.utils.get_available_memory = self._original_functions['get_available_memory']
-            
-            if 'caching_allocator_warmup' in self._original_functions:
-                transformers.modeling_utils.caching_allocator_warmup = self._original_functions['caching_allocator_warmup']
-            
-            # 恢复 accelerate 函数
-            if 'accelerate_get_available_memory' in self._original_functions:
-                try:
-                    import accelerate.utils
-                    accelerate.utils.get_available_memory = self._original_functions['accelerate_get_available_memory']
-                except ImportError:
-                    pass
-            
-            print(f"    ✅ 已恢复 {len(self._original_functions)} 个函数")
-            self._original_functions = {}
+    def save_snapshot(self, output_dir: str) -> Dict[str, Any]:
+        """
+        把加载完成的模型写入本地快照目录
+        
+        之后以该目录作为model_path创建引擎即可跳过配置解析、dtype转换和量化，
+        权重以内存映射方式恢复
+        
+        Args:
+            output_dir: 快照目录
             
-        except Exception as e:
-            print(f"    ❌ 恢复函数失败: {e}")
-    
-    def _setup_force_xpu_env(self):
-        """设置强制XPU环境变量"""
-        original_env = {}
-        
-        force_env = {
-            'PYTORCH_CUDA_ALLOC_CONF': 'max_split_size_mb:128',
-            'CUDA_LAUNCH_BLOCKING': '0',
-            'PYTORCH_NO_CUDA_MEMORY_CACHING': '0',
-            'INTEL_XPU_FORCE_LOAD': '1',
-            'XPU_FORCE_DEVICE_ALLOC': '1',
-            'SYCL_DISABLE_MEM_QUERY': '1',
-        }
+        Returns:
+            快照描述信息
+        """
+        self.initialize()
         
-        for key, value in force_env.items():
-            original_env[key] = os.environ.get(key)
-            os.environ[key] = value
-            print(f"    设置环境变量: {key}={value}")
+        if self.device == 'cpu' and self.cpu_int8:
+            # 动态量化层无法按safetensors保存，恢复时会重新量化
+            raise ValueError("启用cpu_int8时无法写入快照，请在不启用动态int8量化的情况下创建快照")
         
-        return original_env
-    
-    def _restore_env(self, original_env):
-        """恢复环境变量"""
-        for key, value in original_env.items():
-            if value is None:
-                if key in os.environ:
-                    del os.environ[key]
-            else:
-                os.environ[key] = value
+        print(f"正在写入模型快照: {output_dir}")
+        manifest = write_snapshot(
+            self.model,
+            self.tokenizer,
+            source_dir=resolve_checkpoint_dir(self.model_path),
+            output_dir=output_dir,
+            device=self.device,
+            source=self.model_path,
+        )
+        print(f"✅ 模型快照已写入: {output_dir}")
+        return manifest
     
-    def _move_model_to_xpu_safely(self):
-        """安全地将模型逐层移动到XPU"""
+    @contextmanager
+    def cpu_offload(self):
+        """
+        临时把整个模型移到CPU执行（内存不足降级的最后一级），最后一个调用方退出时移回原设备
+        
+        只在移动模型时持有模型锁，卸载期间不持有：推理（包括流式推理的生成线程）照常获取锁，
+        在CPU上执行且不使用视觉特征缓存、前缀KV缓存、草稿模型和调度器；
+        调度器在卸载期间暂停，批次中的序列在模型移回后继续解码
+        """
+        if not self._initialized:
+            self.initialize()
+        
+        if self.device == 'cpu':
+            yield
+            return
+        if self.placement is not None:
+            raise RuntimeError("模型已按设备预算放置，不支持临时卸载到CPU")
+        
+        with self._model_lock:
+            if self._offload_users == 0:
+                print("⚠️ 将模型临时卸载到CPU执行")
+                self.clear_feature_cache()
+                if self.scheduler is not None:
+                    self.scheduler.pause()
+                self.model.to('cpu')
+                self.memory.trim('CPU卸载')
+                self.offloaded = True
+            self._offload_users += 1
         try:
-            print("    开始逐层移动模型到XPU...")
-            
-            # 统计层数
-            layer_count = 0
-            for name, module in self.model.named_modules():
-                if len(list(module.children())) == 0:  # 叶子模块
-                    layer_count += 1
-            
-            print(f"    总共需要移动 {layer_count} 个模块")
-            
-            # 逐层移动
-            moved_count = 0
-            for name, module in self.model.named_modules():
-                if len(list(module.children())) == 0:  # 叶子模块
-                    try:
-                        # 检查模块是否有参数
-                        has_params = any(p.numel() > 0 for p in module.parameters())
-                        if has_params:
-                            # 使用 torch.device 上下文确保正确移动
-                            with torch.device('xpu'):
-                                module.to('xpu')
-                            moved_count += 1
-                            
-                            if moved_count % 50 == 0:  # 每50层显示一次进度
-                                print(f"    已移动 {moved_count}/{layer_count} 个模块")
-                    except Exception as e:
-                        print(f"    ⚠️ 模块 {name} 移动失败: {e}，继续处理其他模块...")
-                        continue
-            
-            # 最终确保整个模型在XPU上
-            self.model = self.model.to('xpu')
-            print(f"    ✅ 成功移动 {moved_count} 个模块到XPU")
-            
-        except Exception as e:
-            print(f"    ❌ 模型移动失败: {e}")
-            # 如果逐层移动失败，尝试整体移动
-            print("    尝试整体移动模型...")
-            self.model = self.model.to('xpu')
+            yield
+        finally:
+            with self._model_lock:
+                self._offload_users -= 1
+                if self._offload_users == 0:
+                    self.offloaded = False
+                    self.model.to(self.device)
+                    if self.scheduler is not None:
+                        self.scheduler.resume()
+                    print(f"模型已移回 {self.device.upper()}")
     
     def clear_cache(self):
-        """清理XPU缓存"""
-        self._clear_xpu_cache()
+        """立即释放设备分配器缓存并执行垃圾回收（一般不需要手动调用，由内存管理器按水位释放）"""
+        self.memory.trim('手动清理')
+    
+    def clear_feature_cache(self):
+        """清空视觉特征缓存、前缀KV缓存和像素值缓存（释放缓存的设备张量）"""
+        self.vision_cache.clear()
+        self.prefix_cache.clear()
+        self.pixel_cache.clear()
     
     def __del__(self):
         """析构函数，清理资源"""
         try:
-            self.clear_cache()
+            self.stop_scheduler()
+            self.memory.shutdown()
+            self._clear_xpu_cache()
         except:
             pass
 
@@ -0,0 +1,143 @@
+"""
+模型变体路由 - 按请求代价在多个模型变体之间选择
+同时部署完整模型、int4量化模型或更小的模型时，按帧数、问题长度和请求的最大生成token数估算请求代价：
+短视频上的简短问题交给便宜的变体，长视频或复杂问题交给大模型，并按变体统计延迟
+"""
+
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+
+@dataclass(frozen=True)
+class ModelVariant:
+    """模型变体配置"""
+    
+    name: str
+    model_path: str
+    max_cost: Optional[float] = None  # 能处理的最大请求代价，None表示不限（兜底的大模型）
+    precision: str = 'auto'
+
+
+@dataclass(frozen=True)
+class CostWeights:
+    """请求代价的权重：代价 = 帧数 * per_frame + 问题字符数 * per_question_char + 最大生成token数 * per_output_token"""
+    
+    per_frame: float = 1 / 64
+    per_question_char: float = 1 / 200
+    per_output_token: float = 1 / 2048
+    
+    def score(self, num_frames: int, question: str, max_new_tokens: int) -> float:
+        """估算一次请求的代价"""
+        return (num_frames * self.per_frame
+                + len(question or '') * self.per_question_char
+                + max_new_tokens * self.per_output_token)
+
+
+class LatencyStats:
+    """一个变体的请求数、失败数和最近请求的延迟分布"""
+    
+    def __init__(self, window: int = 256):
+        self.requests = 0
+        self.failures = 0
+        self.total_seconds = 0.0
+        self.last_seconds: Optional[float] = None
+        self.recent: "deque[float]" = deque(maxlen=window)
+    
+    def record(self, seconds: float, failed: bool = False):
+        self.requests += 1
+        self.total_seconds += seconds
+        self.last_seconds = seconds
+        self.recent.append(seconds)
+        if failed:
+            self.failures += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        recent = sorted(self.recent)
+        
+        def percentile(q: float) -> Optional[float]:
+            if not recent:
+                return None
+            return recent[min(len(recent) - 1, int(q * len(recent)))] * 1000
+        
+        return {
+            'requests': self.requests,
+            'failures': self.failures,
+            'mean_ms': self.total_seconds * 1000 / self.requests if self.requests else None,
+            'p50_ms': percentile(0.5),
+            'p95_ms': percentile(0.95),
+            'last_ms': self.last_seconds * 1000 if self.last_seconds is not None else None,
+        }
+
+
+class VariantRouter:
+    """按请求代价把请求路由到能处理它的最便宜的模型变体"""
+    
+    def __init__(self, variants: Sequence[ModelVariant], weights: Optional[CostWeights] = None,
+                 window: int = 256):
+        """
+        初始化路由器
+        
+        Args:
+            variants: 模型变体列表，按max_cost从小到大尝试；代价超过所有上限的请求交给max_cost最大
+                      （或为None）的变体
+            weights: 请求代价的权重，默认CostWeights()
+            window: 统计延迟分位数使用的最近请求数
+        
+        Raises:
+            ValueError: 变体列表为空或名称重复
+        """
+        if not variants:
+            raise ValueError("至少需要一个模型变体")
+        names = [variant.name for variant in variants]
+        if len(set(names)) != len(names):
+            raise ValueError(f"模型变体名称重复: {names}")
+        
+        # 从便宜到昂贵排序，最后一个是兜底的大模型
+        self.variants: List[ModelVariant] = sorted(
+            variants, key=lambda v: (v.max_cost is None, v.max_cost or 0.0)
+        )
+        self.weights = weights or CostWeights()
+        self._lock = threading.Lock()
+        self._latency = {variant.name: LatencyStats(window) for variant in self.variants}
+    
+    @property
+    def default(self) -> ModelVariant:
+        """兜底的（最大的）变体"""
+        return self.variants[-1]
+    
+    def route(self, num_frames: int, question: str, max_new_tokens: int) -> Tuple[ModelVariant, float]:
+        """
+        为一次请求选择模型变体
+        
+        Args:
+            num_frames: 请求的视频帧数
+            question: 用户问题
+            max_new_tokens: 请求的最大生成token数
+        
+        Returns:
+            (选中的变体, 请求代价)
+        """
+        cost = self.weights.score(num_frames, question, max_new_tokens)
+        for variant in self.variants:
+            if variant.max_cost is None or cost <= variant.max_cost:
+                return variant, cost
+        return self.default, cost
+    
+    def record(self, name: str, seconds: float, failed: bool = False):
+        """记录一次请求在该变体上的耗时"""
+        with self._lock:
+            self._latency[name].record(seconds, failed)
+    
+    def stats(self) -> Dict[str, Any]:
+        """各变体的代价上限和延迟统计"""
+        with self._lock:
+            return {
+                variant.name: {
+                    'model_path': variant.model_path,
+                    'max_cost': variant.max_cost,
+                    **self._latency[variant.name].stats(),
+                }
+                for variant in self.variants
+            }
@@ -0,0 +1,150 @@
+"""
+模型快照 - 把加载完成的模型写入本地目录，重启时直接映射恢复
+快照包含已确定dtype（或已量化）的权重、分词器、处理器配置和远程代码，
+恢复时不再访问模型仓库、不做dtype转换；非量化权重以内存映射方式按需读入，
+量化（int4）快照仍通过from_pretrained加载，权重会复制到新分配的内存中，不做内存映射
+"""
+
+import json
+import os
+import shutil
+import time
+from typing import Any, Dict, Optional
+
+import torch
+
+from .fast_loader import LoadTimer, fast_load_model, load_pretrained_to_device
+from .precision import PrecisionMode
+
+
+SNAPSHOT_MANIFEST = 'snapshot.json'
+SNAPSHOT_FORMAT_VERSION = 1
+
+# 源模型目录中不复制到快照的权重文件（快照中的权重由save_pretrained重新写入）
+_WEIGHT_SUFFIXES = ('.safetensors', '.bin', '.pt', '.pth', '.ckpt', '.index.json')
+
+
+def is_snapshot(path: str) -> bool:
+    """判断路径是否为模型快照目录"""
+    return os.path.isfile(os.path.join(path, SNAPSHOT_MANIFEST))
+
+
+def read_manifest(snapshot_dir: str) -> Dict[str, Any]:
+    """读取快照描述信息"""
+    with open(os.path.join(snapshot_dir, SNAPSHOT_MANIFEST), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_snapshot(model, tokenizer, source_dir: str, output_dir: str, device: str,
+                   source: Optional[str] = None, max_shard_size: str = '2GB') -> Dict[str, Any]:
+    """
+    把加载完成的模型写入快照目录
+    
+    Args:
+        model: 已加载（已量化、dtype已确定）的模型
+        tokenizer: 分词器
+        source_dir: 源模型本地目录（复制处理器配置和远程代码）
+        output_dir: 快照目录
+        device: 模型所在设备
+        source: 源模型路径或ID，记录在快照描述中
+        max_shard_size: 权重分片的最大大小
+    
+    Returns:
+        快照描述信息
+    """
+    timer = LoadTimer()
+    os.makedirs(output_dir, exist_ok=True)
+    
+    with timer.phase("复制配置和代码"):
+        # 处理器配置、分词器文件和远程代码，model.chat会从快照目录加载处理器
+        for name in os.listdir(source_dir):
+            path = os.path.join(source_dir, name)
+            if os.path.isfile(path) and not name.endswith(_WEIGHT_SUFFIXES):
+                shutil.copy2(path, os.path.join(output_dir, name))
+    
+    with timer.phase("写入权重"):
+        model.save_pretrained(output_dir, safe_serialization=True, max_shard_size=max_shard_size)
+    
+    if tokenizer is not None:
+        with timer.phase("写入分词器"):
+            tokenizer.save_pretrained(output_dir)
+    
+    first_param = next(model.parameters())
+    manifest = {
+        'format_version': SNAPSHOT_FORMAT_VERSION,
+        'source': source or source_dir,
+        'dtype': str(model.dtype).replace('torch.', ''),
+        'device': device,
+        'quantized': getattr(model.config, 'quantization_config', None) is not None,
+        'num_parameters': sum(p.numel() for p in model.parameters()),
+        'parameter_device': str(first_param.device),
+        'created_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    with open(os.path.join(output_dir, SNAPSHOT_MANIFEST), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    
+    timer.report("快照写入耗时")
+    return manifest
+
+
+def check_snapshot_precision(manifest: Dict[str, Any], precision: PrecisionMode):
+    """
+    检查请求的精度模式与快照是否一致
+    
+    快照中的权重已是最终dtype（或已量化），恢复时不做转换，因此请求的浮点精度必须与快照dtype相同，
+    int4精度需要量化快照，非int4精度不能使用量化快照
+    
+    Raises:
+        ValueError: 精度与快照不一致
+    """
+    snapshot_dtype = manifest['dtype']
+    requested_dtype = str(precision.dtype).replace('torch.', '')
+    quantized = bool(manifest.get('quantized'))
+    
+    if (precision.quantization == 'int4') != quantized:
+        raise ValueError(f"快照{'已' if quantized else '未'}量化，与请求的精度 {precision.name} 不一致，"
+                         f"请使用对应精度重新创建快照")
+    if snapshot_dtype != requested_dtype:
+        raise ValueError(f"快照以 {snapshot_dtype} 保存，请求的精度 {precision.describe()} 需要 {requested_dtype}，"
+                         f"请使用对应精度重新创建快照")
+
+
+def restore_snapshot(snapshot_dir: str, device: str, timer: Optional[LoadTimer] = None,
+                     num_workers: Optional[int] = None, precision: Optional[PrecisionMode] = None):
+    """
+    从快照目录恢复模型
+    
+    非量化快照在meta设备上构建结构后以内存映射方式挂载权重（CPU上不复制，按需读入）；
+    量化快照需要transformers的量化层，通过from_pretrained和device_map直接加载到目标设备，
+    权重会复制到新分配的内存中，不做内存映射，省去的只是量化和模型仓库访问
+    
+    Args:
+        snapshot_dir: 快照目录
+        device: 目标设备
+        timer: 分阶段计时器
+        num_workers: 读取分片的线程数（量化快照）
+        precision: 请求的精度模式，设置后与快照的dtype和量化状态比对
+    
+    Returns:
+        恢复的模型
+    
+    Raises:
+        ValueError: 快照版本不支持，或与请求的精度不一致
+    """
+    timer = timer or LoadTimer()
+    manifest = read_manifest(snapshot_dir)
+    if manifest.get('format_version') != SNAPSHOT_FORMAT_VERSION:
+        raise ValueError(f"不支持的快照版本: {manifest.get('format_version')}")
+    if precision is not None:
+        check_snapshot_precision(manifest, precision)
+    
+    dtype = getattr(torch, manifest['dtype'])
+    if manifest.get('device') != device:
+        print(f"⚠️ 快照在 {manifest.get('device')} 上创建，当前设备为 {device}")
+    
+    model = None
+    if not manifest.get('quantized'):
+        model = fast_load_model(snapshot_dir, device, dtype, timer=timer, mmap=True)
+    if model is None:
+        model = load_pretrained_to_device(snapshot_dir, device, dtype, timer=timer, num_workers=num_workers)
+    return model
@@ -0,0 +1,262 @@
+"""
+批量图像预处理 - 一次向量化处理整组视频帧，替代处理器的逐帧预处理
+MiniCPM-V的图像处理器在model.chat内对每帧依次缩放、转float、归一化、按patch重排；
+这里用线程池并行缩放帧并写入堆叠的uint8数组，再用torch一次完成归一化和patch重排。
+只替换像素计算：处理器的其余逻辑（占位符尺寸、时序ID等）仍由原始preprocess完成，
+首次使用时与原始实现的输出逐项校验，不一致时回退到原始实现
+"""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+# 向量化路径依赖的图像处理器属性和方法
+_REQUIRED_ATTRIBUTES = ('patch_size', 'scale_resolution', 'mean', 'std',
+                        'get_sliced_images', 'get_sliced_grid', 'find_best_resize')
+
+
+@contextmanager
+def _override_attribute(obj: Any, name: str, replacement: Any):
+    """临时在实例上覆盖属性，退出时恢复"""
+    had_own = name in vars(obj)
+    original = vars(obj).get(name)
+    setattr(obj, name, replacement)
+    try:
+        yield
+    finally:
+        if had_own:
+            setattr(obj, name, original)
+        else:
+            delattr(obj, name)
+
+
+def _to_numpy(value: Any) -> Any:
+    """把（嵌套的）张量转换为numpy数组，便于缓存和比较"""
+    if isinstance(value, torch.Tensor):
+        return value.cpu().numpy()
+    if isinstance(value, list):
+        return [_to_numpy(v) for v in value]
+    if isinstance(value, tuple):
+        return tuple(_to_numpy(v) for v in value)
+    return value
+
+
+def _same(a: Any, b: Any, atol: float = 1e-4) -> bool:
+    """递归比较两个预处理输出项"""
+    a, b = _to_numpy(a), _to_numpy(b)
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        a, b = np.asarray(a), np.asarray(b)
+        return a.shape == b.shape and np.allclose(a, b, atol=atol)
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return len(a) == len(b) and all(_same(x, y, atol) for x, y in zip(a, b))
+    return a == b
+
+
+def as_samples(images: Any) -> List[List[Any]]:
+    """把preprocess的images参数（单张图像、一个样本的图像列表或多个样本）统一为样本列表"""
+    if isinstance(images, Image.Image):
+        return [[images]]
+    if images and isinstance(images[0], Image.Image):
+        return [list(images)]
+    return [list(sample) for sample in images]
+
+
+class BatchImagePreprocessor:
+    """MiniCPM-V图像处理器的向量化批量预处理（只处理不需要切片的帧）"""
+    
+    def __init__(self, image_processor: Any, num_threads: Optional[int] = None):
+        """
+        初始化批量预处理器
+        
+        Args:
+            image_processor: 模型处理器的image_processor
+            num_threads: 并行缩放帧的线程数，默认为 min(CPU核数, 8)
+        """
+        self.image_processor = image_processor
+        self.num_threads = num_threads or min(os.cpu_count() or 1, 8)
+        self.supported = all(hasattr(image_processor, name) for name in _REQUIRED_ATTRIBUTES)
+        
+        # None: 尚未与原始实现校验；False: 校验不一致，始终使用原始实现
+        self.validated: Optional[bool] = None
+        # 处理器输出的类型（MiniCPMVBatchFeature），由缓存的输出项重建输出时使用
+        self.output_type: Optional[type] = None
+        
+        self.stats = {
+            'batches': 0,         # 向量化处理的批次数
+            'frames': 0,          # 向量化处理的帧数
+            'fallbacks': 0,       # 使用原始逐帧实现的次数
+            'preprocess_ms': 0.0,
+        }
+    
+    def applicable(self, images: Sequence[Any], max_slice_nums: Optional[int]) -> bool:
+        """这组帧是否可以走向量化路径：全部为RGB图像且都不需要切片"""
+        if not self.supported or self.validated is False or not images:
+            return False
+        if not getattr(self.image_processor, 'slice_mode', True):
+            return False
+        if not all(isinstance(image, Image.Image) and image.mode == 'RGB' for image in images):
+            return False
+        
+        max_slice_nums = max_slice_nums or getattr(self.image_processor, 'max_slice_nums', 9)
+        sizes = {image.size for image in images}
+        return all(self.image_processor.get_sliced_grid(size, max_slice_nums) is None for size in sizes)
+    
+    def target_size(self, size: Tuple[int, int]) -> Tuple[int, int]:
+        """不切片时帧缩放到的分辨率（与处理器一致，允许放大）"""
+        processor = self.image_processor
+        return tuple(processor.find_best_resize(size, processor.scale_resolution,
+                                                processor.patch_size, allow_upscale=True))
+    
+    def stack_resized(self, frames: Sequence[Image.Image], size: Tuple[int, int]) -> np.ndarray:
+        """
+        多线程缩放帧并写入堆叠的uint8数组
+        
+        Args:
+            frames: 同一分辨率的PIL图像帧
+            size: 目标分辨率 (width, height)
+        
+        Returns:
+            (帧数, 高, 宽, 3) 的uint8数组
+        """
+        stacked = np.empty((len(frames), size[1], size[0], 3), dtype=np.uint8)
+        
+        def resize(i: int):
+            # PIL缩放时释放GIL，多个帧可以真正并行
+            stacked[i] = np.asarray(frames[i].resize(size, resample=Image.Resampling.BICUBIC))
+        
+        if self.num_threads > 1 and len(frames) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.num_threads, len(frames))) as pool:
+                list(pool.map(resize, range(len(frames))))
+        else:
+            for i in range(len(frames)):
+                resize(i)
+        return stacked
+    
+    def normalize_patches(self, stacked: np.ndarray) -> torch.Tensor:
+        """
+        一次完成整批帧的归一化和按patch重排（等价于处理器逐帧的normalize + reshape_by_patch）
+        
+        Args:
+            stacked: (帧数, 高, 宽, 3) 的uint8数组
+        
+        Returns:
+            (帧数, 3, patch_size, 高*宽/patch_size) 的float32张量
+        """
+        patch = self.image_processor.patch_size
+        num, height, width, channels = stacked.shape
+        mean = np.asarray(self.image_processor.mean, dtype=np.float32)
+        std = np.asarray(self.image_processor.std, dtype=np.float32)
+        # (x / 255 - mean) / std 合并为一次乘加
+        scale = torch.from_numpy(1.0 / (255.0 * std)).view(1, channels, 1, 1)
+        bias = torch.from_numpy(-mean / std).view(1, channels, 1, 1)
+        
+        # 先在uint8上完成patch重排（每个元素只占1字节），输出布局与reshape_by_patch相同：
+        # [帧, 通道, patch内行, (patch行, patch列, patch内列)]
+        pixels = torch.from_numpy(stacked).view(num, height // patch, patch, width // patch, patch, channels)
+        pixels = pixels.permute(0, 5, 2, 1, 3, 4).reshape(num, channels, patch, -1)
+        return torch.addcmul(bias, pixels.to(torch.float32), scale)
+    
+    def pixel_values(self, frames: Sequence[Image.Image]) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+        """
+        计算一组帧的像素值和patch网格尺寸，不同分辨率的帧分组处理
+        
+        Returns:
+            (每帧的像素数组列表, 每帧的 [高patch数, 宽patch数] 列表)
+        """
+        patch = self.image_processor.patch_size
+        pixel_values: List[Optional[np.ndarray]] = [None] * len(frames)
+        tgt_sizes: List[Optional[np.ndarray]] = [None] * len(frames)
+        
+        groups: Dict[Tuple[int, int], List[int]] = {}
+        for i, frame in enumerate(frames):
+            groups.setdefault(frame.size, []).append(i)
+        
+        for size, indices in groups.items():
+            target = self.target_size(size)
+            patches = self.normalize_patches(self.stack_resized([frames[i] for i in indices], target))
+            grid = np.array((target[1] // patch, target[0] // patch))
+            for row, values in enumerate(patches.numpy()):
+                pixel_values[indices[row]] = values
+                tgt_sizes[indices[row]] = grid.copy()
+        return pixel_values, tgt_sizes
+    
+    def preprocess_sample(self, original: Callable, images: List[Any], kwargs: Dict[str, Any]) -> Dict[str, list]:
+        """
+        预处理一个样本（一条消息中的所有帧）
+        
+        Args:
+            original: 图像处理器原始的preprocess
+            images: 该样本的帧列表
+            kwargs: 传给preprocess的参数
+        
+        Returns:
+            未转换为张量的输出项字典，每项为长度1的批次列表
+        """
+        start = time.perf_counter()
+        kwargs = {**kwargs, 'return_tensors': None}
+        
+        if not self.applicable(images, kwargs.get('max_slice_nums')):
+            self.stats['fallbacks'] += 1
+            output = original([images], **kwargs)
+            self.output_type = type(output)
+            data = dict(output)
+        else:
+            pixel_values, tgt_sizes = self.pixel_values(images)
+            
+            # 原始preprocess只处理占位的最小图像，用来得到像素以外的输出项
+            placeholder = Image.new('RGB', (self.image_processor.patch_size,) * 2)
+            with _override_attribute(self.image_processor, 'get_sliced_images',
+                                     lambda image, *args, **kw: [placeholder]):
+                output = original([images], **kwargs)
+            self.output_type = type(output)
+            data = dict(output)
+            data['pixel_values'] = [pixel_values]
+            data['tgt_sizes'] = [tgt_sizes]
+            
+            if self.validated is None:
+                self.validated = self._validate(data, dict(original([images], **kwargs)))
+                if not self.validated:
+                    data = dict(original([images], **kwargs))
+            
+            if self.validated:
+                self.stats['batches'] += 1
+                self.stats['frames'] += len(images)
+            else:
+                self.stats['fallbacks'] += 1
+        
+        self.stats['preprocess_ms'] += (time.perf_counter() - start) * 1000
+        return {key: _to_numpy(value) for key, value in data.items()}
+    
+    def build_output(self, data: Dict[str, list], batch_size: int, return_tensors: Any) -> Optional[Any]:
+        """
+        由单样本的输出项构造处理器输出，批量推理时每条样本复用同一份
+        
+        Returns:
+            处理器输出；输出项不是按样本排列的列表而无法复制时为None
+        """
+        if self.output_type is None:
+            return None
+        if batch_size > 1 and not all(isinstance(v, list) and len(v) == 1 for v in data.values()):
+            return None
+        batched = {key: list(value) * batch_size for key, value in data.items()}
+        return self.output_type(data=batched, tensor_type=return_tensors)
+    
+    def _validate(self, fast: Dict[str, Any], reference: Dict[str, Any]) -> bool:
+        """与原始实现的输出逐项比较"""
+        if set(fast) != set(reference):
+            print(f"⚠️ 批量图像预处理的输出项与处理器不一致，使用原始预处理: "
+                  f"{sorted(fast)} != {sorted(reference)}")
+            return False
+        for key in reference:
+            if not _same(fast[key], reference[key]):
+                print(f"⚠️ 批量图像预处理的 {key} 与处理器不一致，使用原始预处理")
+                return False
+        print("✅ 批量图像预处理与处理器输出一致，启用向量化预处理")
+        return True
@@ -0,0 +1,263 @@
+"""
+按显存预算规划模型各部分的设备放置
+根据参数大小和激活（KV缓存、前向临时张量）估算，把视觉编码器、重采样器和LLM各层
+按执行顺序依次放到预算允许的设备上（如先放满XPU，其余放CPU），并通过前向钩子
+在设备边界处自动搬运输入
+"""
+
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Any, Dict, List, Optional
+
+import torch
+import torch.nn as nn
+
+
+@dataclass
+class PlacementUnit:
+    """放置的最小单位 - 必须整体放在同一设备上的一组模块"""
+    
+    name: str
+    modules: List[str]
+    param_bytes: int
+    persistent_bytes: int = 0   # 常驻激活，如该层的KV缓存
+    transient_bytes: int = 0    # 前向时的临时激活峰值（同一设备上的单元不会同时执行，取最大值）
+
+
+@dataclass
+class PlacementPlan:
+    """设备放置方案"""
+    
+    assignments: "OrderedDict[str, str]"
+    device_map: Dict[str, str]
+    budgets: Dict[str, Optional[int]]
+    usage: Dict[str, int] = field(default_factory=dict)
+    
+    def summary(self) -> Dict[str, Any]:
+        """各设备的单元列表和预计占用"""
+        devices: Dict[str, Any] = OrderedDict()
+        for unit, device in self.assignments.items():
+            info = devices.setdefault(device, {'units': [], 'estimated_gb': self.usage.get(device, 0) / 1024**3,
+                                               'budget_gb': _gb(self.budgets.get(device))})
+            info['units'].append(unit)
+        return devices
+    
+    def print_report(self):
+        """打印放置方案"""
+        print("模型设备放置方案:")
+        for device, info in self.summary().items():
+            budget = '不限' if info['budget_gb'] is None else f"{info['budget_gb']:.2f} GB"
+            print(f"  {device}: 预计 {info['estimated_gb']:.2f} GB / 预算 {budget}")
+            print(f"    {', '.join(_compress_unit_names(info['units']))}")
+
+
+def _gb(value: Optional[int]) -> Optional[float]:
+    return None if value is None else value / 1024**3
+
+
+def _compress_unit_names(names: List[str]) -> List[str]:
+    """把连续的 'LLM层 i' 合并为 'LLM层 a-b'"""
+    compressed, run = [], []
+    for name in names + [None]:
+        if name is not None and name.startswith('LLM层 '):
+            run.append(int(name.split(' ')[1]))
+            continue
+        if run:
+            compressed.append(f"LLM层 {run[0]}-{run[-1]}" if len(run) > 1 else f"LLM层 {run[0]}")
+            run = []
+        if name is not None:
+            compressed.append(name)
+    return compressed
+
+
+def _module_bytes(module: nn.Module) -> int:
+    """模块参数和缓冲区占用的字节数"""
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def _activation_bytes(model: nn.Module) -> int:
+    """激活的元素字节数（取第一个浮点参数的dtype）"""
+    for param in model.parameters():
+        if param.is_floating_point():
+            return param.element_size()
+    return 2
+
+
+def estimate_units(model: nn.Module, max_context_tokens: int = 8192, batch_size: int = 1) -> List[PlacementUnit]:
+    """
+    按执行顺序把模型划分为放置单元并估算各单元的内存需求
+    
+    视觉特征会被写入文本嵌入（scatter），因此重采样器与文本嵌入放在同一单元
+    
+    Args:
+        model: MiniCPM-V模型（包含vpm、resampler、llm）
+        max_context_tokens: 估算KV缓存和预填充激活使用的最大上下文长度
+        batch_size: 同时解码的序列数
+    
+    Returns:
+        放置单元列表（按执行顺序）
+    """
+    names = {id(module): name for name, module in model.named_modules()}
+    act = _activation_bytes(model)
+    config = getattr(model, 'config', None)
+    llm = getattr(model, 'llm', model)
+    decoder = llm.get_decoder() if hasattr(llm, 'get_decoder') else llm.model
+    text_config = llm.config
+    
+    hidden = text_config.hidden_size
+    intermediate = getattr(text_config, 'intermediate_size', 4 * hidden)
+    num_heads = text_config.num_attention_heads
+    kv_heads = getattr(text_config, 'num_key_value_heads', None) or num_heads
+    head_dim = getattr(text_config, 'head_dim', None) or hidden // num_heads
+    tokens = max_context_tokens * batch_size
+    
+    units: List[PlacementUnit] = []
+    covered: List[str] = []
+    
+    def add(name: str, modules: List[nn.Module], persistent: int = 0, transient: int = 0):
+        module_names = [names[id(m)] for m in modules if m is not None]
+        units.append(PlacementUnit(name, module_names, sum(_module_bytes(m) for m in modules if m is not None),
+                                   persistent, transient))
+        covered.extend(module_names)
+    
+    vpm = getattr(model, 'vpm', None)
+    if vpm is not None:
+        vision_config = getattr(config, 'vision_config', None)
+        v_hidden = getattr(vision_config, 'hidden_size', hidden)
+        v_intermediate = getattr(vision_config, 'intermediate_size', 4 * v_hidden)
+        v_heads = getattr(vision_config, 'num_attention_heads', 1)
+        patches = (getattr(vision_config, 'image_size', 448) // getattr(vision_config, 'patch_size', 14)) ** 2
+        images = getattr(config, 'vision_batch_size', 16)
+        # 隐藏状态/MLP中间结果 + 注意力分数
+        transient = images * patches * (4 * v_hidden + v_intermediate) * act + images * v_heads * patches ** 2 * act
+        add('视觉编码器', [vpm], transient=transient)
+    
+    resampler = getattr(model, 'resampler', None)
+    embed_name = '重采样器+文本嵌入' if resampler is not None else '文本嵌入'
+    add(embed_name, [resampler, decoder.embed_tokens, getattr(decoder, 'rotary_emb', None)],
+        transient=tokens * hidden * act)
+    
+    for i, layer in enumerate(decoder.layers):
+        # KV缓存常驻；预填充时的qkv/MLP中间结果是临时的（按SDPA估算，不含完整注意力矩阵）
+        kv_cache = 2 * kv_heads * head_dim * tokens * act
+        transient = tokens * (4 * hidden + 2 * intermediate) * act
+        add(f'LLM层 {i}', [layer], persistent=kv_cache, transient=transient)
+    
+    # 输出层：最后的归一化和lm_head，生成时只计算最后一个token的logits（fp32）
+    add('输出层', [decoder.norm, getattr(llm, 'lm_head', None)],
+        transient=batch_size * text_config.vocab_size * 4)
+    
+    # 其余带参数的模块放到第一个单元所在设备
+    for name, module in model.named_modules():
+        if not name or any(name == c or name.startswith(c + '.') for c in covered):
+            continue
+        has_tensors = (next(module.parameters(recurse=False), None) is not None
+                       or next(module.buffers(recurse=False), None) is not None)
+        if has_tensors and not any(c.startswith(name + '.') for c in covered):
+            units.insert(0, PlacementUnit(f'其他: {name}', [name], _module_bytes(module)))
+            covered.append(name)
+    
+    return units
+
+
+def plan_placement(units: List[PlacementUnit], budgets: Dict[str, Optional[int]]) -> PlacementPlan:
+    """
+    按执行顺序把放置单元依次分配到设备上
+    
+    设备按budgets的顺序使用，当前设备放不下下一个单元时换到下一个设备，
+    这样前向过程只在设备边界处搬运一次激活
+    
+    Args:
+        units: 放置单元（按执行顺序）
+        budgets: 设备到可用字节数的有序映射，None表示不限
+    
+    Returns:
+        放置方案
+    
+    Raises:
+        ValueError: 所有设备的预算都放不下模型
+    """
+    devices = list(budgets)
+    if not devices:
+        raise ValueError("至少需要一个设备预算")
+    
+    persistent = {device: 0 for device in devices}
+    transient = {device: 0 for device in devices}
+    assignments: "OrderedDict[str, str]" = OrderedDict()
+    device_map: Dict[str, str] = {}
+    
+    index = 0
+    for unit in units:
+        while True:
+            device = devices[index]
+            need = (persistent[device] + unit.param_bytes + unit.persistent_bytes
+                    + max(transient[device], unit.transient_bytes))
+            if budgets[device] is None or need <= budgets[device]:
+                break
+            index += 1
+            if index == len(devices):
+                required = unit.param_bytes + unit.persistent_bytes + unit.transient_bytes
+                raise ValueError(f"设备预算不足，无法放置 {unit.name}（需要约 {required / 1024**3:.2f} GB）")
+        
+        persistent[device] += unit.param_bytes + unit.persistent_bytes
+        transient[device] = max(transient[device], unit.transient_bytes)
+        assignments[unit.name] = device
+        for module_name in unit.modules:
+            device_map[module_name] = device
+    
+    usage = {device: persistent[device] + transient[device] for device in devices if persistent[device]}
+    return PlacementPlan(assignments, device_map, dict(budgets), usage)
+
+
+def _to_device(value: Any, device: torch.device) -> Any:
+    """把（嵌套的）张量参数移动到指定设备"""
+    if isinstance(value, torch.Tensor):
+        return value if value.device == device else value.to(device)
+    if type(value) in (list, tuple):
+        return type(value)(_to_device(v, device) for v in value)
+    if type(value) is dict:
+        return {k: _to_device(v, device) for k, v in value.items()}
+    return value
+
+
+def _move_inputs(device: torch.device, module: nn.Module, args, kwargs):
+    return _to_device(args, device), _to_device(kwargs, device)
+
+
+def _move_outputs(device: torch.device, module: nn.Module, args, output):
+    return _to_device(output, device)
+
+
+def apply_placement(model: nn.Module, plan: PlacementPlan,
+                    device_alias: Optional[Dict[str, str]] = None) -> nn.Module:
+    """
+    按方案移动模块并注册前向钩子
+    
+    每个放置的模块在前向前把输入搬到自己所在设备；最后一个单元的输出搬回第一个LLM单元
+    （文本嵌入）所在设备，使生成循环中的token拼接与输入在同一设备
+    
+    Args:
+        model: 模型
+        plan: 放置方案
+        device_alias: 设备别名，如 {'xpu': 'cpu'} 在没有XPU的环境中用CPU模拟
+    
+    Returns:
+        放置后的模型
+    """
+    alias = device_alias or {}
+    modules = dict(model.named_modules())
+    
+    for name, device in plan.device_map.items():
+        target = torch.device(alias.get(device, device))
+        module = modules[name]
+        module.to(target)
+        module.register_forward_pre_hook(partial(_move_inputs, target), with_kwargs=True)
+    
+    llm = getattr(model, 'llm', model)
+    decoder = llm.get_decoder() if hasattr(llm, 'get_decoder') else llm.model
+    main_device = decoder.embed_tokens.weight.device
+    output_module = getattr(llm, 'lm_head', None) or decoder.norm
+    output_module.register_forward_hook(partial(_move_outputs, main_device))
+    return model
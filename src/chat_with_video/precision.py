@@ -0,0 +1,122 @@
+"""
+推理精度模式 - fp32 / bf16 / fp16 / int8-dynamic / int4
+把精度名称解析为权重加载的dtype和量化方式，并检查当前设备是否支持：
+int8-dynamic为torch.ao动态int8量化（只支持CPU），int4需要int4量化的检查点（如MiniCPM-V-4_5-int4），
+非量化部分（视觉编码器、嵌入等）和计算使用该设备上的默认浮点精度
+"""
+
+from dataclasses import dataclass
+from typing import Any, Optional
+
+import torch
+
+from .cpu_backend import cpu_supports_bf16, select_cpu_dtype
+
+
+PRECISION_MODES = ('fp32', 'bf16', 'fp16', 'int8-dynamic', 'int4')
+
+_FLOAT_DTYPES = {
+    'fp32': torch.float32,
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
+
+
+@dataclass(frozen=True)
+class PrecisionMode:
+    """解析后的精度模式"""
+    
+    name: str
+    dtype: torch.dtype               # 加载权重和计算使用的浮点dtype
+    quantization: Optional[str] = None  # 'int8-dynamic' / 'int4'，None表示不量化
+    
+    def describe(self) -> str:
+        """精度说明（用于日志和设备信息）"""
+        dtype = str(self.dtype).replace('torch.', '')
+        return dtype if self.quantization is None else f"{self.quantization} (计算精度 {dtype})"
+
+
+def cpu_supports_fp16() -> bool:
+    """CPU是否原生支持fp16计算（AVX512-FP16/AMX-FP16）"""
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_fp16_supported())
+    except Exception:
+        return False
+
+
+def xpu_supports_bf16() -> bool:
+    """Intel XPU是否支持bf16"""
+    try:
+        return torch.xpu.is_available() and bool(getattr(torch.xpu, 'is_bf16_supported', lambda: True)())
+    except Exception:
+        return False
+
+
+def _default_dtype(device: str, cpu_dtype: str = 'auto') -> torch.dtype:
+    """设备上的默认浮点精度：XPU使用fp16，CPU支持bf16时用bf16，否则fp32"""
+    if device == 'cpu':
+        return select_cpu_dtype(cpu_dtype)
+    return torch.float16
+
+
+def resolve_precision(precision: str, device: str, cpu_dtype: str = 'auto') -> PrecisionMode:
+    """
+    解析精度模式并检查设备是否支持
+    
+    Args:
+        precision: 'auto' 或 PRECISION_MODES 之一
+        device: 推理设备（'cpu' / 'xpu'）
+        cpu_dtype: precision为'auto'或'int4'时CPU上的浮点精度偏好
+    
+    Returns:
+        精度模式
+    
+    Raises:
+        ValueError: 精度名称未知或当前设备不支持
+    """
+    if precision == 'auto':
+        dtype = _default_dtype(device, cpu_dtype)
+        return PrecisionMode(str(dtype).replace('torch.', ''), dtype)
+    if precision not in PRECISION_MODES:
+        raise ValueError(f"不支持的精度: {precision}，可选: auto, {', '.join(PRECISION_MODES)}")
+    
+    if precision == 'int8-dynamic':
+        if device != 'cpu':
+            raise ValueError("int8-dynamic（torch.ao动态int8量化）只支持CPU推理")
+        # 动态int8量化的线性层只接受fp32激活
+        return PrecisionMode(precision, torch.float32, 'int8-dynamic')
+    
+    if precision == 'int4':
+        return PrecisionMode(precision, _default_dtype(device, cpu_dtype), 'int4')
+    
+    if device == 'cpu':
+        if precision == 'bf16' and not cpu_supports_bf16():
+            raise ValueError("当前CPU不支持原生bf16计算（需要AVX512-BF16/AMX），请使用fp32或int8-dynamic")
+        if precision == 'fp16' and not cpu_supports_fp16():
+            raise ValueError("当前CPU不支持原生fp16计算（需要AVX512-FP16/AMX-FP16），请使用fp32或bf16")
+    elif device == 'xpu' and precision == 'bf16' and not xpu_supports_bf16():
+        raise ValueError("当前XPU设备不支持bf16，请使用fp16或fp32")
+    
+    return PrecisionMode(precision, _FLOAT_DTYPES[precision])
+
+
+def is_quantized_checkpoint(model: Any) -> bool:
+    """模型是否由量化检查点加载（config中有quantization_config）"""
+    config = getattr(model, 'config', None)
+    return getattr(config, 'quantization_config', None) is not None
+
+
+def module_nbytes(module: torch.nn.Module) -> int:
+    """
+    模块权重和缓冲区占用的字节数
+    
+    按state_dict统计，包括动态量化层打包的int8权重和4bit打包参数
+    """
+    def nbytes(value: Any) -> int:
+        if isinstance(value, (list, tuple)):
+            return sum(nbytes(v) for v in value)
+        if isinstance(value, torch.Tensor):
+            return value.element_size() * value.numel()
+        return 0
+    
+    return sum(nbytes(value) for value in module.state_dict().values())
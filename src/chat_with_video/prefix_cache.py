@@ -0,0 +1,266 @@
+"""
+前缀KV缓存 - 同一视频的多次提问复用视觉前缀的预填充结果
+保存上一次推理的输入嵌入和对应的past_key_values，新问题与其最长公共前缀
+（视频帧部分）的KV直接复用，只对问题部分的token做预填充。
+保存时只复制一次前缀部分得到紧凑的KV，复用时也只复制需要的前缀，不复制整个缓存
+"""
+
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+import torch
+
+
+def layer_tensors(past_key_values: Any) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    """past_key_values（DynamicCache或legacy元组）每层的 (keys, values)"""
+    if hasattr(past_key_values, 'layers'):
+        return [(layer.keys, layer.values) for layer in past_key_values.layers
+                if isinstance(getattr(layer, 'keys', None), torch.Tensor)]
+    if hasattr(past_key_values, 'key_cache'):
+        return list(zip(past_key_values.key_cache, past_key_values.value_cache))
+    return [(layer[0], layer[1]) for layer in past_key_values]
+
+
+def cache_nbytes(past_key_values: Any) -> int:
+    """计算past_key_values（DynamicCache）占用的字节数"""
+    return sum(t.element_size() * t.numel() for layer in layer_tensors(past_key_values) for t in layer)
+
+
+@lru_cache(maxsize=None)
+def _update_copies() -> bool:
+    """DynamicCache.update写入空层时是否复制传入的张量（新版本拼接到空张量，旧版本直接保存）"""
+    from transformers import DynamicCache
+    
+    probe = torch.zeros(1, 1, 1, 1)
+    keys, _ = DynamicCache().update(probe, probe, 0)
+    return keys.data_ptr() != probe.data_ptr()
+
+
+def copy_prefix(past_key_values: Any, length: int) -> Any:
+    """
+    把past_key_values的前length个token复制为一个新的紧凑DynamicCache
+    
+    只复制前缀部分，新缓存不引用原缓存的存储，原缓存不被修改
+    
+    Args:
+        past_key_values: 源KV（DynamicCache或legacy元组）
+        length: 复制的token数
+    
+    Returns:
+        新的DynamicCache
+    """
+    from transformers import DynamicCache
+    
+    copies = _update_copies()
+    cache = DynamicCache()
+    for layer_idx, (keys, values) in enumerate(layer_tensors(past_key_values)):
+        keys, values = keys[..., :length, :], values[..., :length, :]
+        if not copies:
+            keys, values = keys.clone(), values.clone()
+        cache.update(keys, values, layer_idx)
+    return cache
+
+
+def _seq_length(past_key_values: Any) -> int:
+    """past_key_values中已缓存的token数"""
+    layers = layer_tensors(past_key_values)
+    return layers[0][0].shape[-2] if layers else 0
+
+
+def common_prefix_length(a: torch.Tensor, b: torch.Tensor) -> int:
+    """
+    计算两个输入嵌入序列的最长公共前缀长度
+    
+    Args:
+        a: 形如 [1, seq_len, hidden] 的嵌入
+        b: 形如 [1, seq_len, hidden] 的嵌入
+    
+    Returns:
+        公共前缀的token数
+    """
+    n = min(a.shape[1], b.shape[1])
+    if n == 0:
+        return 0
+    same = (a[:, :n] == b[:, :n]).all(dim=-1).all(dim=0)
+    mismatch = torch.nonzero(~same)
+    return int(mismatch[0, 0]) if mismatch.numel() else n
+
+
+def align_shared_prefix(inputs_embeds: torch.Tensor,
+                        attention_mask: torch.Tensor) -> Optional[Tuple[torch.Tensor, torch.Tensor, int]]:
+    """
+    把左填充的批量输入重排为“公共前缀 + 填充 + 各自问题”的布局
+    
+    左填充时每条样本的公共前缀（视频帧部分）起始位置不同，无法共享同一份KV；
+    把填充挪到公共前缀之后，所有样本的前缀都位于 [0, prefix_len)，
+    位置编码由attention_mask的累加和得到，与单条推理一致
+    
+    Args:
+        inputs_embeds: 左填充的输入嵌入 [batch, seq_len, hidden]
+        attention_mask: 对应的注意力掩码 [batch, seq_len]
+    
+    Returns:
+        (重排后的嵌入, 重排后的掩码, 公共前缀长度)，输入不是左填充时返回None
+    """
+    batch, total = attention_mask.shape
+    lengths = [int(n) for n in attention_mask.sum(dim=1).tolist()]
+    for b, n in enumerate(lengths):
+        if n == 0 or not bool(attention_mask[b, total - n:].all()):
+            return None
+    
+    rows = [inputs_embeds[b:b + 1, total - n:] for b, n in enumerate(lengths)]
+    prefix_len = min(lengths) - 1
+    for row in rows[1:]:
+        prefix_len = min(prefix_len, common_prefix_length(rows[0], row))
+    
+    aligned = torch.empty_like(inputs_embeds)
+    mask = torch.zeros_like(attention_mask)
+    for b, (row, n) in enumerate(zip(rows, lengths)):
+        pad = total - n
+        aligned[b, :prefix_len] = row[0, :prefix_len]
+        aligned[b, prefix_len:prefix_len + pad] = inputs_embeds[b, :pad]
+        aligned[b, prefix_len + pad:] = row[0, prefix_len:]
+        mask[b, :prefix_len] = 1
+        mask[b, prefix_len + pad:] = 1
+    return aligned, mask, prefix_len
+
+
+class _PrefixEntry:
+    """一条缓存的前缀：输入嵌入和对应的KV"""
+    
+    def __init__(self, inputs_embeds: torch.Tensor, past_key_values: Any):
+        self.inputs_embeds = inputs_embeds
+        self.past_key_values = past_key_values
+        self.nbytes = (inputs_embeds.element_size() * inputs_embeds.numel()
+                       + cache_nbytes(past_key_values))
+
+
+class PrefixKVCache:
+    """前缀KV的LRU缓存，按占用字节数淘汰"""
+    
+    def __init__(self, max_bytes: int = 2 * 1024**3, min_prefix_tokens: int = 16):
+        """
+        初始化前缀KV缓存
+        
+        Args:
+            max_bytes: 缓存占用的最大字节数，0表示禁用
+            min_prefix_tokens: 公共前缀少于该token数时不复用
+        """
+        self.max_bytes = max_bytes
+        self.min_prefix_tokens = min_prefix_tokens
+        self._entries: "OrderedDict[Hashable, _PrefixEntry]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reused_tokens = 0
+        self.prefilled_tokens = 0
+    
+    @property
+    def enabled(self) -> bool:
+        """缓存是否启用"""
+        return self.max_bytes > 0
+    
+    def fork(self, key: Hashable, inputs_embeds: torch.Tensor,
+             max_prefix: Optional[int] = None) -> Tuple[Optional[Any], int]:
+        """
+        查找可复用的前缀并复制出一份KV供本次生成使用
+        
+        缓存中的KV不会被本次生成修改
+        
+        Args:
+            key: 缓存键
+            inputs_embeds: 本次的输入嵌入 [1, seq_len, hidden]
+            max_prefix: 复用的最大长度，默认为 seq_len - 1
+        
+        Returns:
+            (只含复用前缀的past_key_values副本, 复用的前缀长度)，未命中返回 (None, 0)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        
+        prefix_len = 0
+        if entry is not None:
+            # 默认至少保留最后一个token做预填充，以得到第一个生成token的logits
+            limit = inputs_embeds.shape[1] - 1 if max_prefix is None else max_prefix
+            prefix_len = min(common_prefix_length(entry.inputs_embeds, inputs_embeds), limit)
+        
+        total = inputs_embeds.shape[1]
+        if prefix_len < self.min_prefix_tokens:
+            with self._lock:
+                self.misses += 1
+                self.prefilled_tokens += total
+            return None, 0
+        
+        forked = copy_prefix(entry.past_key_values, prefix_len)
+        
+        with self._lock:
+            self.hits += 1
+            self.reused_tokens += prefix_len
+            self.prefilled_tokens += total - prefix_len
+        return forked, prefix_len
+    
+    def store(self, key: Hashable, inputs_embeds: torch.Tensor, past_key_values: Any,
+              prefix_len: Optional[int] = None):
+        """
+        保存本次生成的前缀KV
+        
+        生成结束后past_key_values还包含回答部分，这里只复制提示长度的前缀；
+        若已知与上次提问的公共前缀，则只保留公共前缀（即视频部分）
+        
+        Args:
+            key: 缓存键
+            inputs_embeds: 本次的输入嵌入
+            past_key_values: 本次生成使用的KV（不会被修改，调用方可以继续使用）
+            prefix_len: 与缓存前缀的公共长度，None表示保留整个提示
+        """
+        if not self.enabled:
+            return
+        
+        length = inputs_embeds.shape[1] if not prefix_len else prefix_len
+        if cache_nbytes(past_key_values) * length / max(_seq_length(past_key_values), 1) > self.max_bytes:
+            return
+        entry = _PrefixEntry(inputs_embeds[:, :length].clone(), copy_prefix(past_key_values, length))
+        if entry.nbytes > self.max_bytes:
+            return
+        
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            
+            self._entries[key] = entry
+            self._bytes += entry.nbytes
+            
+            while self._bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self.evictions += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        """获取缓存统计信息"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'size_mb': self._bytes / 1024**2,
+                'max_size_mb': self.max_bytes / 1024**2,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / total if total else 0.0,
+                'reused_tokens': self.reused_tokens,
+                'prefilled_tokens': self.prefilled_tokens,
+            }
+    
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
@@ -0,0 +1,313 @@
+"""
+预fork工作进程池 - 父进程加载一次模型，fork出的工作进程以写时复制方式共享权重
+每个工作进程绑定一组CPU核，独立处理请求；权重页面只读不被复制，
+每增加一个工作进程只增加该进程的激活、KV缓存等私有内存（仅支持CPU推理）
+"""
+
+import gc
+import itertools
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional
+
+import torch
+
+
+def split_cores(cores: List[int], num_workers: int) -> List[List[int]]:
+    """
+    把CPU核平均分成连续的若干组
+    
+    Args:
+        cores: 可用的CPU核编号
+        num_workers: 组数
+    
+    Returns:
+        每个工作进程的核列表（核数少于进程数时多个进程共享核）
+    """
+    if len(cores) < num_workers:
+        return [[cores[i % len(cores)]] for i in range(num_workers)]
+    size, extra = divmod(len(cores), num_workers)
+    groups, start = [], 0
+    for i in range(num_workers):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(cores[start:end])
+        start = end
+    return groups
+
+
+def process_memory(pid: int) -> Dict[str, float]:
+    """
+    读取进程的内存占用（MB，仅Linux）
+    
+    Returns:
+        rss: 常驻内存；pss: 按共享进程数分摊后的内存；
+        private: 进程独占的内存；shared: 与其他进程共享的内存
+    """
+    fields = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup', 'r') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0].endswith(':') and parts[1].isdigit():
+                    fields[parts[0][:-1]] = int(parts[1]) / 1024
+    except OSError:
+        return {}
+    
+    return {
+        'rss': fields.get('Rss', 0.0),
+        'pss': fields.get('Pss', 0.0),
+        'private': fields.get('Private_Clean', 0.0) + fields.get('Private_Dirty', 0.0),
+        'shared': fields.get('Shared_Clean', 0.0) + fields.get('Shared_Dirty', 0.0),
+    }
+
+
+def _worker_main(index: int, service: Any, cores: List[int], num_threads: int,
+                 scheduler_batch_size: int, requests, results):
+    """工作进程主循环：按请求调用服务方法并返回结果"""
+    gc.enable()
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(num_threads)
+    
+    # 线程不会被fork继承，调度器在工作进程中重新启动
+    engine = getattr(service, 'inference_engine', None)
+    if engine is not None and scheduler_batch_size > 0:
+        engine.start_scheduler(scheduler_batch_size)
+    
+    while True:
+        item = requests.get()
+        if item is None:
+            break
+        
+        request_id, method, args, kwargs = item
+        results.put(('started', request_id, index, None))
+        try:
+            value = getattr(service, method)(*args, **kwargs)
+            results.put(('done', request_id, index, value))
+        except Exception as e:
+            results.put(('error', request_id, index, f"{type(e).__name__}: {e}"))
+    
+    if engine is not None and scheduler_batch_size > 0:
+        engine.stop_scheduler()
+
+
+class PreforkWorkerPool:
+    """预fork的多进程推理池"""
+    
+    # 允许在工作进程中调用的服务方法（参数需可pickle）
+    WORKER_METHODS = ('chat_with_video', 'chat_with_frames')
+    
+    def __init__(self, service: Any, num_workers: int = 2, threads_per_worker: Optional[int] = None):
+        """
+        初始化工作进程池
+        
+        Args:
+            service: VideoChatService（使用CPU推理），在start时于父进程中初始化
+            num_workers: 工作进程数
+            threads_per_worker: 每个工作进程的推理线程数，默认为分到的核数
+        """
+        self.service = service
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker
+        
+        self._processes: List[Any] = []
+        self._cores: List[List[int]] = []
+        self._requests = None
+        self._results = None
+        self._collector: Optional[threading.Thread] = None
+        self._running = False
+        
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._pending: Dict[int, Future] = {}
+        self._assigned: Dict[int, int] = {}
+        self._completed = [0] * num_workers
+        self._failed = [0] * num_workers
+    
+    def start(self) -> 'PreforkWorkerPool':
+        """在父进程中加载模型，然后fork工作进程"""
+        if self._running:
+            return self
+        
+        engine = getattr(self.service, 'inference_engine', None)
+        if not getattr(self.service, '_initialized', False):
+            # GNU OpenMP在父进程使用过多线程并行区后，fork出的子进程再使用多线程会死锁，
+            # 因此父进程以单线程加载模型，工作进程fork后再设置各自的线程数
+            if hasattr(self.service, 'num_threads'):
+                self.service.num_threads = 1
+            torch.set_num_threads(1)
+            if not self.service.initialize():
+                raise RuntimeError("服务初始化失败")
+            engine = getattr(self.service, 'inference_engine', None)
+        
+        if engine is not None and getattr(engine, 'device', 'cpu') != 'cpu':
+            raise RuntimeError(f"预fork工作进程池只支持CPU推理，当前设备: {engine.device}")
+        
+        threads_per_worker = self.threads_per_worker
+        if torch.get_num_threads() > 1:
+            print("⚠️ 父进程已使用多线程推理，工作进程以单线程运行以避免OpenMP在fork后死锁")
+            threads_per_worker = 1
+        
+        # 调度器线程不能跨fork，父进程停止后在工作进程中重新启动
+        scheduler_batch_size = 0
+        if engine is not None and getattr(engine, 'scheduler', None) is not None:
+            scheduler_batch_size = engine.scheduler.max_batch_size
+            engine.stop_scheduler()
+        
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+        self._cores = split_cores(cores, self.num_workers)
+        
+        context = mp.get_context('fork')
+        self._requests = context.Queue()
+        self._results = context.Queue()
+        
+        # 把现有对象移入永久代，子进程的垃圾回收不再改写它们的对象头，减少写时复制
+        gc.collect()
+        gc.freeze()
+        try:
+            for index, worker_cores in enumerate(self._cores):
+                process = context.Process(
+                    target=_worker_main,
+                    args=(index, self.service, worker_cores, threads_per_worker or len(worker_cores),
+                          scheduler_batch_size, self._requests, self._results),
+                    daemon=True,
+                )
+                process.start()
+                self._processes.append(process)
+        finally:
+            gc.unfreeze()
+        
+        self._running = True
+        self._collector = threading.Thread(target=self._collect, name="prefork-collector", daemon=True)
+        self._collector.start()
+        
+        print(f"预fork工作进程池已启动: {self.num_workers} 个工作进程, "
+              f"核分配 {[f'{c[0]}-{c[-1]}' if len(c) > 1 else str(c[0]) for c in self._cores]}")
+        return self
+    
+    def submit(self, method: str, *args, **kwargs) -> Future:
+        """
+        提交请求，由空闲的工作进程处理
+        
+        Args:
+            method: 服务方法名（见WORKER_METHODS）
+            *args, **kwargs: 方法参数
+        
+        Returns:
+            结果的Future
+        """
+        if method not in self.WORKER_METHODS:
+            raise ValueError(f"不支持的方法: {method}")
+        if not self._running:
+            raise RuntimeError("工作进程池未启动")
+        
+        future: Future = Future()
+        request_id = next(self._ids)
+        with self._lock:
+            self._pending[request_id] = future
+        self._requests.put((request_id, method, args, kwargs))
+        return future
+    
+    def chat_with_video(self, *args, **kwargs) -> str:
+        """与VideoChatService.chat_with_video相同，在工作进程中执行"""
+        return self.submit('chat_with_video', *args, **kwargs).result()
+    
+    def chat_with_frames(self, *args, **kwargs) -> str:
+        """与VideoChatService.chat_with_frames相同，在工作进程中执行"""
+        return self.submit('chat_with_frames', *args, **kwargs).result()
+    
+    def _collect(self):
+        """收集工作进程的结果，并检测退出的工作进程"""
+        while self._running or self._pending:
+            try:
+                kind, request_id, index, value = self._results.get(timeout=0.5)
+            except queue.Empty:
+                self._check_workers()
+                if not self._running and not any(p.is_alive() for p in self._processes):
+                    break
+                continue
+            
+            with self._lock:
+                if kind == 'started':
+                    self._assigned[request_id] = index
+                    continue
+                future = self._pending.pop(request_id, None)
+                self._assigned.pop(request_id, None)
+                if kind == 'done':
+                    self._completed[index] += 1
+                else:
+                    self._failed[index] += 1
+            
+            if future is None:
+                continue
+            if kind == 'done':
+                future.set_result(value)
+            else:
+                future.set_exception(RuntimeError(value))
+    
+    def _check_workers(self):
+        """异常退出的工作进程上正在处理的请求标记为失败"""
+        dead = {i for i, p in enumerate(self._processes) if not p.is_alive() and p.exitcode not in (0, None)}
+        if not dead:
+            return
+        
+        with self._lock:
+            lost = [rid for rid, index in self._assigned.items() if index in dead]
+            futures = [(self._pending.pop(rid, None), self._assigned.pop(rid)) for rid in lost]
+        for future, index in futures:
+            if future is not None:
+                self._failed[index] += 1
+                future.set_exception(RuntimeError(f"工作进程 {index} 异常退出 "
+                                                  f"(exitcode={self._processes[index].exitcode})"))
+    
+    def stats(self) -> Dict[str, Any]:
+        """各工作进程的状态、处理数和内存占用"""
+        workers = []
+        for index, process in enumerate(self._processes):
+            workers.append({
+                'pid': process.pid,
+                'alive': process.is_alive(),
+                'cores': self._cores[index],
+                'completed': self._completed[index],
+                'failed': self._failed[index],
+                'memory_mb': process_memory(process.pid) if process.is_alive() else {},
+            })
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            'num_workers': self.num_workers,
+            'pending': pending,
+            'parent_memory_mb': process_memory(os.getpid()),
+            'workers': workers,
+        }
+    
+    def stop(self, timeout: float = 10.0):
+        """通知工作进程退出并等待"""
+        if not self._running:
+            return
+        
+        for _ in self._processes:
+            self._requests.put(None)
+        deadline = time.time() + timeout
+        for process in self._processes:
+            process.join(max(deadline - time.time(), 0.1))
+            if process.is_alive():
+                process.terminate()
+        
+        self._running = False
+        if self._collector is not None:
+            self._collector.join(timeout=2.0)
+        
+        with self._lock:
+            futures = list(self._pending.values())
+            self._pending.clear()
+            self._assigned.clear()
+        for future in futures:
+            future.set_exception(RuntimeError("工作进程池已停止"))
+        
+        self._processes = []
+        print("预fork工作进程池已停止")
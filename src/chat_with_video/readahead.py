@@ -0,0 +1,184 @@
+"""
+视频文件预读 - 按帧采样计划提前预热页缓存
+网络存储上decord每次seek都会等待I/O，根据FramePlan估算即将解码的字节范围，
+通过posix_fadvise(WILLNEED)或后台线程的大块顺序读取提前把数据读入页缓存
+"""
+
+import os
+import threading
+import time
+from typing import Callable, List, Optional, Sequence, Tuple, Dict, Any, BinaryIO
+
+
+# 预读策略
+READAHEAD_STRATEGIES = ('auto', 'fadvise', 'thread')
+
+
+def _default_opener(path: str) -> BinaryIO:
+    return open(path, 'rb', buffering=0)
+
+
+class FrameReadahead:
+    """根据帧采样计划预读视频文件"""
+    
+    # 文件头尾（容器元数据，如mp4的moov box）固定预读的字节数
+    HEADER_BYTES = 1024 * 1024
+    # 后台线程单次读取的块大小
+    CHUNK_BYTES = 4 * 1024 * 1024
+    
+    def __init__(self, video_path: str, frame_indices: Sequence[int], total_frames: int,
+                 fps: float, strategy: str = 'auto', gop_seconds: float = 2.0,
+                 opener: Optional[Callable[[str], BinaryIO]] = None):
+        """
+        初始化预读器
+        
+        Args:
+            video_path: 视频文件路径
+            frame_indices: 即将解码的帧索引（按解码顺序）
+            total_frames: 视频总帧数
+            fps: 视频帧率
+            strategy: 预读策略，'fadvise' 只向内核发出WILLNEED提示，
+                      'thread' 使用后台线程读取，'auto' 两者同时使用
+            gop_seconds: 估计的关键帧间隔（秒），解码一帧需要从前一个关键帧开始读取
+            opener: 打开文件的函数，默认为无缓冲的二进制读取
+        """
+        if strategy not in READAHEAD_STRATEGIES:
+            raise ValueError(f"不支持的预读策略: {strategy}，可选: {READAHEAD_STRATEGIES}")
+        
+        self.video_path = video_path
+        self.frame_indices = [int(i) for i in frame_indices]
+        self.total_frames = max(int(total_frames), 1)
+        self.fps = fps
+        self.strategy = strategy
+        self.gop_seconds = gop_seconds
+        self.opener = opener or _default_opener
+        
+        self.file_size = os.path.getsize(video_path)
+        
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+        self._stats: Dict[str, Any] = {
+            'ranges': 0,
+            'bytes_planned': 0,
+            'bytes_advised': 0,
+            'bytes_prefetched': 0,
+            'prefetch_seconds': 0.0,
+        }
+    
+    @classmethod
+    def container(cls, video_path: str, strategy: str = 'auto', **kwargs) -> "FrameReadahead":
+        """
+        只预读文件头尾（容器元数据和索引）的预读器
+        
+        在打开VideoReader之前启动，覆盖其同步读取文件头和索引时的I/O等待；
+        此时帧数和帧率未知，不预读帧数据
+        """
+        return cls(video_path, [], 1, 1.0, strategy=strategy, **kwargs)
+    
+    def byte_ranges(self) -> List[Tuple[int, int]]:
+        """
+        估算需要读取的字节范围
+        
+        假设码率均匀，帧索引按比例映射到文件偏移，每帧向前扩展一个GOP的数据量，
+        并合并相邻或重叠的范围
+        
+        Returns:
+            按解码顺序排列的 (offset, length) 列表
+        """
+        bytes_per_frame = self.file_size / self.total_frames
+        gop_bytes = int(bytes_per_frame * max(self.fps * self.gop_seconds, 1))
+        
+        ranges: List[Tuple[int, int]] = [(0, min(self.HEADER_BYTES, self.file_size))]
+        for idx in self.frame_indices:
+            end = min(int((idx + 1) * bytes_per_frame), self.file_size)
+            start = max(end - gop_bytes - int(bytes_per_frame), 0)
+            ranges.append((start, end))
+        tail_start = max(self.file_size - self.HEADER_BYTES, 0)
+        ranges.append((tail_start, self.file_size))
+        
+        # 合并重叠范围（头尾之外的范围已经按帧顺序递增）
+        merged: List[Tuple[int, int]] = []
+        for start, end in ranges:
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        
+        return [(start, end - start) for start, end in merged if end > start]
+    
+    def start(self) -> "FrameReadahead":
+        """开始预读（非阻塞）"""
+        ranges = self.byte_ranges()
+        self._stats['ranges'] = len(ranges)
+        self._stats['bytes_planned'] = sum(length for _, length in ranges)
+        
+        if self.strategy in ('auto', 'fadvise'):
+            self._advise(ranges)
+        
+        if self.strategy in ('auto', 'thread'):
+            self._thread = threading.Thread(
+                target=self._prefetch, args=(ranges,), name="video-readahead", daemon=True
+            )
+            self._thread.start()
+        
+        return self
+    
+    def stop(self):
+        """停止预读并等待后台线程退出"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+    
+    def stats(self) -> Dict[str, Any]:
+        """获取预读统计信息"""
+        return dict(self._stats)
+    
+    def _advise(self, ranges: List[Tuple[int, int]]):
+        """通过posix_fadvise通知内核即将读取的范围"""
+        if not hasattr(os, 'posix_fadvise'):
+            return
+        
+        try:
+            fd = os.open(self.video_path, os.O_RDONLY)
+        except OSError:
+            return
+        
+        try:
+            for offset, length in ranges:
+                os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+                self._stats['bytes_advised'] += length
+        except OSError as e:
+            print(f"posix_fadvise失败，跳过内核预读提示: {e}")
+        finally:
+            os.close(fd)
+    
+    def _prefetch(self, ranges: List[Tuple[int, int]]):
+        """后台线程：按顺序大块读取各范围，预热页缓存"""
+        start_time = time.time()
+        buffer = bytearray(self.CHUNK_BYTES)
+        view = memoryview(buffer)
+        
+        try:
+            with self.opener(self.video_path) as f:
+                for offset, length in ranges:
+                    f.seek(offset)
+                    remaining = length
+                    while remaining > 0:
+                        if self._stop_event.is_set():
+                            return
+                        n = f.readinto(view[:min(remaining, self.CHUNK_BYTES)])
+                        if not n:
+                            break
+                        remaining -= n
+                        self._stats['bytes_prefetched'] += n
+        except Exception as e:
+            print(f"视频预读失败: {e}")
+        finally:
+            self._stats['prefetch_seconds'] = time.time() - start_time
+    
+    def __enter__(self) -> "FrameReadahead":
+        return self.start()
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -0,0 +1,248 @@
+"""
+多副本模型池 - 按负载把请求路由到多个推理副本
+每个副本是一个独立的VideoChatService（各自的MiniCPMVInference），绑定到一组CPU核或一个设备，
+由专属工作线程顺序处理请求；新请求路由到在途token最少、队列最短的副本
+"""
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+
+from .prefork_pool import split_cores
+
+
+@dataclass
+class ReplicaSpec:
+    """副本配置：设备和绑定的CPU核"""
+    
+    device: str = 'cpu'
+    cores: Optional[List[int]] = None
+
+
+def cpu_replica_specs(num_replicas: int) -> List[ReplicaSpec]:
+    """把当前进程可用的CPU核平均分给num_replicas个CPU副本"""
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    return [ReplicaSpec('cpu', group) for group in split_cores(cores, num_replicas)]
+
+
+class _Replica:
+    """一个推理副本：服务实例、请求队列、工作线程和指标"""
+    
+    def __init__(self, index: int, spec: ReplicaSpec, service: Any):
+        self.index = index
+        self.spec = spec
+        self.service = service
+        self.queue: "queue.Queue" = queue.Queue()
+        self.thread: Optional[threading.Thread] = None
+        self.ready = threading.Event()
+        self.init_error: Optional[BaseException] = None
+        
+        # 负载：排队+处理中的请求数，以及这些请求预留的生成token数
+        self.queue_depth = 0
+        self.in_flight_tokens = 0
+        
+        self.completed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self.total_latency = 0.0
+        self.started_at = time.time()
+
+
+class ReplicaPool:
+    """多副本推理池，按负载路由请求"""
+    
+    # 可路由到副本的服务方法
+    REPLICA_METHODS = ('chat_with_video', 'chat_with_frames')
+    
+    def __init__(self, specs: List[ReplicaSpec],
+                 service_factory: Optional[Callable[[ReplicaSpec], Any]] = None,
+                 model_path: str = 'openbmb/MiniCPM-V-4_5-int4'):
+        """
+        初始化副本池
+        
+        Args:
+            specs: 各副本的设备和CPU核配置（如 cpu_replica_specs(4) 或 [ReplicaSpec('xpu:0'), ReplicaSpec('xpu:1')]）
+            service_factory: 根据副本配置创建服务实例的函数，默认创建VideoChatService
+            model_path: 默认服务使用的模型路径（可以是模型快照目录，CPU副本可共享映射的权重页面）
+        """
+        self.model_path = model_path
+        self.service_factory = service_factory or self._default_service
+        self._lock = threading.Lock()
+        self._replicas = [_Replica(i, spec, None) for i, spec in enumerate(specs)]
+        self._running = False
+    
+    def _default_service(self, spec: ReplicaSpec):
+        from .video_chat_service import VideoChatService
+        
+        return VideoChatService(
+            model_path=self.model_path,
+            device=spec.device,
+            num_threads=len(spec.cores) if spec.cores else None,
+            # 每个副本只有一个工作线程，不需要连续批处理调度器
+            scheduler_batch_size=0,
+        )
+    
+    def start(self) -> 'ReplicaPool':
+        """在各副本的工作线程中初始化服务并开始处理请求"""
+        if self._running:
+            return self
+        
+        self._running = True
+        for replica in self._replicas:
+            replica.thread = threading.Thread(target=self._run, args=(replica,),
+                                              name=f"replica-{replica.index}", daemon=True)
+            replica.thread.start()
+        
+        for replica in self._replicas:
+            replica.ready.wait()
+        errors = [r for r in self._replicas if r.init_error is not None]
+        if errors:
+            self.stop()
+            raise RuntimeError(f"副本 {errors[0].index} 初始化失败: {errors[0].init_error}")
+        
+        print(f"副本池已启动: {len(self._replicas)} 个副本 "
+              f"({', '.join(self._describe(r) for r in self._replicas)})")
+        return self
+    
+    @staticmethod
+    def _describe(replica: _Replica) -> str:
+        cores = replica.spec.cores
+        if not cores:
+            return replica.spec.device
+        return f"{replica.spec.device}[{cores[0]}-{cores[-1]}]" if len(cores) > 1 else f"{replica.spec.device}[{cores[0]}]"
+    
+    def _run(self, replica: _Replica):
+        """副本工作线程：绑定CPU核、初始化服务，然后依次处理请求"""
+        try:
+            if replica.spec.cores:
+                # Linux上对当前线程生效，之后创建的OpenMP线程继承该亲和性
+                if hasattr(os, 'sched_setaffinity'):
+                    os.sched_setaffinity(0, replica.spec.cores)
+                torch.set_num_threads(len(replica.spec.cores))
+            
+            # 加载期间的全局替换由loading_scope按线程隔离，各副本并行加载
+            replica.service = self.service_factory(replica.spec)
+            if not getattr(replica.service, '_initialized', False) and hasattr(replica.service, 'initialize'):
+                if replica.service.initialize() is False:
+                    raise RuntimeError("服务初始化失败")
+        except Exception as e:
+            replica.init_error = e
+            replica.ready.set()
+            return
+        replica.ready.set()
+        
+        while True:
+            item = replica.queue.get()
+            if item is None:
+                break
+            
+            future, method, args, kwargs, tokens, submitted_at = item
+            if not future.set_running_or_notify_cancel():
+                self._finish(replica, tokens, ok=False)
+                continue
+            
+            start = time.time()
+            try:
+                value = getattr(replica.service, method)(*args, **kwargs)
+            except Exception as e:
+                self._finish(replica, tokens, ok=False, busy=time.time() - start)
+                future.set_exception(e)
+            else:
+                self._finish(replica, tokens, ok=True, busy=time.time() - start, latency=time.time() - submitted_at)
+                future.set_result(value)
+    
+    def _finish(self, replica: _Replica, tokens: int, ok: bool, busy: float = 0.0, latency: float = 0.0):
+        with self._lock:
+            replica.queue_depth -= 1
+            replica.in_flight_tokens -= tokens
+            replica.busy_seconds += busy
+            if ok:
+                replica.completed += 1
+                replica.total_latency += latency
+            else:
+                replica.failed += 1
+    
+    def _select(self) -> _Replica:
+        """选择在途token最少的副本，相同时选择队列最短的"""
+        return min(self._replicas, key=lambda r: (r.in_flight_tokens, r.queue_depth, r.index))
+    
+    def submit(self, method: str, *args, **kwargs) -> Future:
+        """
+        提交请求到负载最低的副本
+        
+        请求的token预留量取max_new_tokens（默认2048），请求完成后释放
+        
+        Args:
+            method: 服务方法名（见REPLICA_METHODS）
+            *args, **kwargs: 方法参数
+        
+        Returns:
+            结果的Future
+        """
+        if method not in self.REPLICA_METHODS:
+            raise ValueError(f"不支持的方法: {method}")
+        if not self._running:
+            raise RuntimeError("副本池未启动")
+        
+        tokens = int(kwargs.get('max_new_tokens', 2048))
+        future: Future = Future()
+        with self._lock:
+            replica = self._select()
+            replica.queue_depth += 1
+            replica.in_flight_tokens += tokens
+        replica.queue.put((future, method, args, kwargs, tokens, time.time()))
+        return future
+    
+    def chat_with_video(self, *args, **kwargs) -> str:
+        """与VideoChatService.chat_with_video相同，由负载最低的副本执行"""
+        return self.submit('chat_with_video', *args, **kwargs).result()
+    
+    def chat_with_frames(self, *args, **kwargs) -> str:
+        """与VideoChatService.chat_with_frames相同，由负载最低的副本执行"""
+        return self.submit('chat_with_frames', *args, **kwargs).result()
+    
+    def stats(self) -> Dict[str, Any]:
+        """各副本的负载和处理指标"""
+        now = time.time()
+        replicas = []
+        with self._lock:
+            for replica in self._replicas:
+                elapsed = max(now - replica.started_at, 1e-6)
+                replicas.append({
+                    'index': replica.index,
+                    'device': replica.spec.device,
+                    'cores': replica.spec.cores,
+                    'queue_depth': replica.queue_depth,
+                    'in_flight_tokens': replica.in_flight_tokens,
+                    'completed': replica.completed,
+                    'failed': replica.failed,
+                    'avg_latency': replica.total_latency / replica.completed if replica.completed else 0.0,
+                    'utilization': min(replica.busy_seconds / elapsed, 1.0),
+                })
+        return {
+            'num_replicas': len(replicas),
+            'queue_depth': sum(r['queue_depth'] for r in replicas),
+            'completed': sum(r['completed'] for r in replicas),
+            'replicas': replicas,
+        }
+    
+    def stop(self, timeout: float = 10.0):
+        """停止所有副本（处理完已排队的请求）"""
+        if not self._running:
+            return
+        
+        for replica in self._replicas:
+            replica.queue.put(None)
+        for replica in self._replicas:
+            if replica.thread is not None:
+                replica.thread.join(timeout)
+            if replica.service is not None and hasattr(replica.service, 'shutdown'):
+                replica.service.shutdown()
+        self._running = False
+        print("副本池已停止")
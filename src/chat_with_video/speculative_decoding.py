@@ -0,0 +1,206 @@
+"""
+推测解码 - 小型草稿模型提议token，主模型一次前向验证
+草稿语言模型（与主模型共用分词器，如Qwen3-0.6B之于MiniCPM-V 4.5的Qwen3-8B）只看文本部分的提示，
+每轮连续提议lookahead个token；主模型对这些token做一次前向，按推测采样规则接受一个前缀并补一个token，
+贪心解码时输出与主模型逐token解码完全一致，采样时输出分布不变
+"""
+
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+
+from .inference_scheduler import PreparedPrompt, adjust_logits
+
+
+class SpeculativeDecoder:
+    """基于草稿模型的推测解码器（单条序列）"""
+    
+    def __init__(self, draft_model: Any, lookahead: int = 4):
+        """
+        Args:
+            draft_model: 草稿因果语言模型（与主模型共用分词器）
+            lookahead: 每轮草稿模型提议的token数
+        """
+        if lookahead < 1:
+            raise ValueError(f"lookahead必须大于0: {lookahead}")
+        
+        self.draft_model = draft_model
+        self.lookahead = lookahead
+        
+        self._lock = threading.Lock()
+        self._stats = {
+            'calls': 0,
+            'generated_tokens': 0,
+            'proposed_tokens': 0,
+            'accepted_tokens': 0,
+            'target_forwards': 0,
+        }
+    
+    @property
+    def draft_device(self) -> torch.device:
+        return next(self.draft_model.parameters()).device
+    
+    def _distribution(self, logits: torch.Tensor, generated: List[int], prompt: PreparedPrompt,
+                      vocab_size: int) -> torch.Tensor:
+        """处理后的采样分布，词表对齐到主模型大小"""
+        logits = logits[:vocab_size]
+        if logits.shape[0] < vocab_size:
+            logits = torch.nn.functional.pad(logits, (0, vocab_size - logits.shape[0]), value=float('-inf'))
+        logits = adjust_logits(logits, generated, prompt)
+        if not prompt.do_sample:
+            # 贪心解码：argmax上的one-hot分布
+            return torch.nn.functional.one_hot(torch.argmax(logits), vocab_size).float()
+        return torch.softmax(logits, dim=-1)
+    
+    def _draft(self, tokens: List[int], past_key_values: Any, generated: List[int],
+               prompt: PreparedPrompt, count: int, vocab_size: int):
+        """
+        草稿模型自回归提议count个token
+        
+        Args:
+            tokens: 草稿KV缓存之后尚未输入的token
+        
+        Returns:
+            (提议的token, 每个token的草稿分布)
+        """
+        proposals, distributions = [], []
+        device = self.draft_device
+        for _ in range(count):
+            outputs = self.draft_model(
+                input_ids=torch.tensor([tokens], device=device),
+                past_key_values=past_key_values,
+                use_cache=True
+            )
+            q = self._distribution(outputs.logits[0, -1].to(torch.float32), generated + proposals,
+                                   prompt, vocab_size)
+            token = int(torch.multinomial(q, 1)) if prompt.do_sample else int(torch.argmax(q))
+            proposals.append(token)
+            distributions.append(q)
+            tokens = [token]
+        return proposals, distributions
+    
+    @torch.no_grad()
+    def generate(self, target_model: Any, inputs_embeds: torch.Tensor, draft_input_ids: torch.Tensor,
+                 prompt: PreparedPrompt, past_key_values: Optional[Any] = None,
+                 should_stop: Optional[Callable[[], Any]] = None) -> List[int]:
+        """
+        推测解码生成
+        
+        Args:
+            target_model: 主语言模型（接受inputs_embeds）
+            inputs_embeds: 主模型的提示嵌入 [1, seq_len, hidden]
+            draft_input_ids: 草稿模型的提示token [1, draft_len]（提示的文本部分）
+            prompt: 生成参数（结束token、最大长度和采样参数）
+            past_key_values: 主模型已预填充的前缀KV（如前缀缓存），生成结束后包含提示和回答
+            should_stop: 每轮之前调用，返回真值时停止生成（如取消令牌的check）
+        
+        Returns:
+            生成的token（包含结束token）
+        """
+        from transformers import DynamicCache
+        
+        if inputs_embeds.shape[0] != 1:
+            raise ValueError("推测解码只支持单条序列")
+        
+        vocab_size = target_model.config.vocab_size
+        target_cache = past_key_values if past_key_values is not None else DynamicCache()
+        reused = target_cache.get_seq_length()
+        # 提示预填充只需要最后一个位置的logits
+        outputs = target_model(inputs_embeds=inputs_embeds[:, reused:], past_key_values=target_cache,
+                               use_cache=True, logits_to_keep=1)
+        forwards = 1
+        prompt_len = inputs_embeds.shape[1]
+        
+        p = self._distribution(outputs.logits[0, -1], [], prompt, vocab_size)
+        generated = [int(torch.multinomial(p, 1)) if prompt.do_sample else int(torch.argmax(p))]
+        
+        draft_cache = DynamicCache()
+        self.draft_model(input_ids=draft_input_ids.to(self.draft_device), past_key_values=draft_cache,
+                         use_cache=True, logits_to_keep=1)
+        draft_prompt_len = draft_input_ids.shape[1]
+        # 草稿KV覆盖的已生成token数；主模型KV始终覆盖除最后一个token外的所有已生成token
+        draft_consumed = 0
+        proposed = accepted = 0
+        
+        while generated[-1] not in prompt.eos_token_ids and len(generated) < prompt.max_new_tokens:
+            if should_stop is not None and should_stop():
+                break
+            count = min(self.lookahead, prompt.max_new_tokens - len(generated))
+            proposals, q = self._draft(generated[draft_consumed:], draft_cache, generated, prompt, count, vocab_size)
+            
+            # 主模型一次前向验证：输入最后一个已确定token和全部提议token
+            device = inputs_embeds.device
+            outputs = target_model(
+                input_ids=torch.tensor([[generated[-1]] + proposals], device=device),
+                past_key_values=target_cache,
+                use_cache=True
+            )
+            forwards += 1
+            logits = outputs.logits[0]
+            
+            num_generated = len(generated)
+            context = list(generated)
+            num_accepted = 0
+            next_token = None
+            for j, token in enumerate(proposals):
+                p = self._distribution(logits[j], context, prompt, vocab_size)
+                if prompt.do_sample:
+                    # 推测采样：以 min(1, p/q) 的概率接受，拒绝时从 max(0, p-q) 重新采样
+                    if float(torch.rand(())) * float(q[j][token]) <= float(p[token]):
+                        context.append(token)
+                        num_accepted += 1
+                        continue
+                    residual = torch.clamp(p - q[j].to(p.device), min=0)
+                    residual = residual if residual.sum() > 0 else p
+                    next_token = int(torch.multinomial(residual / residual.sum(), 1))
+                else:
+                    if int(torch.argmax(p)) == token:
+                        context.append(token)
+                        num_accepted += 1
+                        continue
+                    next_token = int(torch.argmax(p))
+                break
+            
+            if next_token is None:
+                # 全部接受，由主模型最后一个位置再补一个token
+                p = self._distribution(logits[len(proposals)], context, prompt, vocab_size)
+                next_token = int(torch.multinomial(p, 1)) if prompt.do_sample else int(torch.argmax(p))
+            
+            proposed += len(proposals)
+            accepted += num_accepted
+            generated = context + [next_token]
+            
+            # 丢弃被拒绝token的KV
+            target_cache.crop(prompt_len + num_generated + num_accepted)
+            draft_consumed = num_generated + min(num_accepted, len(proposals) - 1)
+            draft_cache.crop(draft_prompt_len + draft_consumed)
+            
+            for i, token in enumerate(generated[num_generated:], start=num_generated):
+                if token in prompt.eos_token_ids:
+                    generated = generated[:i + 1]
+                    break
+            generated = generated[:prompt.max_new_tokens]
+        
+        with self._lock:
+            self._stats['calls'] += 1
+            self._stats['generated_tokens'] += len(generated)
+            self._stats['proposed_tokens'] += proposed
+            self._stats['accepted_tokens'] += accepted
+            self._stats['target_forwards'] += forwards
+        
+        if proposed:
+            print(f"推测解码: 接受 {accepted}/{proposed} 个草稿token ({accepted / proposed:.1%})，"
+                  f"主模型前向 {forwards} 次生成 {len(generated)} 个token")
+        return generated
+    
+    def stats(self) -> Dict[str, Any]:
+        """接受率和每次主模型前向生成的token数"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['lookahead'] = self.lookahead
+        stats['acceptance_rate'] = (stats['accepted_tokens'] / stats['proposed_tokens']
+                                    if stats['proposed_tokens'] else 0.0)
+        stats['tokens_per_forward'] = (stats['generated_tokens'] / stats['target_forwards']
+                                       if stats['target_forwards'] else 0.0)
+        return stats
@@ -0,0 +1,159 @@
+"""
+视觉token分配器 - 多分辨率逐帧token分配
+检测关键帧/场景起始帧，在全局视觉token预算内为这些帧保留高分辨率（允许切片），
+其余帧缩放到单切片分辨率走默认的低token路径
+"""
+
+import math
+from typing import List, Optional, Tuple, Dict, Any
+
+import numpy as np
+from PIL import Image
+
+
+class TokenAllocation:
+    """一次分配的结果"""
+    
+    def __init__(self, frames: List[Image.Image], max_slice_nums: int,
+                 detail_indices: List[int], estimated_tokens: int):
+        """
+        Args:
+            frames: 处理后的帧列表（关键帧保持原分辨率，其余帧已缩小）
+            max_slice_nums: 传给模型的最大切片数，只有高分辨率的关键帧会被切片
+            detail_indices: 高分辨率关键帧的索引
+            estimated_tokens: 估算的视觉token总数
+        """
+        self.frames = frames
+        self.max_slice_nums = max_slice_nums
+        self.detail_indices = detail_indices
+        self.estimated_tokens = estimated_tokens
+    
+    def summary(self) -> Dict[str, Any]:
+        """分配结果摘要"""
+        return {
+            'detail_frames': len(self.detail_indices),
+            'detail_indices': self.detail_indices,
+            'max_slice_nums': self.max_slice_nums,
+            'estimated_tokens': self.estimated_tokens,
+        }
+
+
+class FrameTokenAllocator:
+    """在全局视觉token预算内为关键帧分配高分辨率"""
+    
+    def __init__(self, token_budget: int = 8192, scale_resolution: int = 448,
+                 tokens_per_image: int = 64, max_detail_slices: int = 4,
+                 scene_threshold: float = 0.12):
+        """
+        初始化token分配器
+        
+        Args:
+            token_budget: 全局视觉token预算
+            scale_resolution: 模型单切片分辨率，面积不超过其平方的图像不会被切片
+            tokens_per_image: 每个切片（或每个3D打包组）对应的token数
+            max_detail_slices: 关键帧最多切片数
+            scene_threshold: 场景切换阈值（相邻帧缩略图的平均绝对差，0-1）
+        """
+        self.token_budget = token_budget
+        self.scale_resolution = scale_resolution
+        self.tokens_per_image = tokens_per_image
+        self.max_detail_slices = max_detail_slices
+        self.scene_threshold = scene_threshold
+    
+    def frame_scores(self, frames: List[Image.Image]) -> np.ndarray:
+        """
+        计算每帧与前一帧的差异分数
+        
+        Args:
+            frames: PIL图像帧列表
+        
+        Returns:
+            每帧的差异分数（第一帧为1.0）
+        """
+        if not frames:
+            return np.zeros(0, dtype=np.float32)
+        
+        thumbs = np.stack([
+            np.asarray(frame.convert('L').resize((32, 32), Image.Resampling.BILINEAR), dtype=np.float32)
+            for frame in frames
+        ]) / 255.0
+        
+        scores = np.ones(len(frames), dtype=np.float32)
+        scores[1:] = np.abs(thumbs[1:] - thumbs[:-1]).mean(axis=(1, 2))
+        return scores
+    
+    def detect_keyframes(self, frames: List[Image.Image]) -> List[int]:
+        """
+        检测关键帧（场景起始帧），按重要程度从高到低排序
+        
+        Args:
+            frames: PIL图像帧列表
+        
+        Returns:
+            关键帧索引列表
+        """
+        scores = self.frame_scores(frames)
+        candidates = [i for i, score in enumerate(scores) if score >= self.scene_threshold]
+        return sorted(candidates, key=lambda i: -scores[i])
+    
+    def _downscale(self, frame: Image.Image) -> Image.Image:
+        """缩小到单切片分辨率以内，避免被模型切片"""
+        width, height = frame.size
+        max_area = self.scale_resolution * self.scale_resolution
+        if width * height <= max_area:
+            return frame
+        scale = math.sqrt(max_area / (width * height))
+        size = (max(int(width * scale), 1), max(int(height * scale), 1))
+        return frame.resize(size, Image.Resampling.BICUBIC)
+    
+    def allocate(self, frames: List[Image.Image], temporal_ids: List[List[int]],
+                 token_budget: Optional[int] = None) -> TokenAllocation:
+        """
+        在token预算内分配关键帧的高分辨率
+        
+        基础开销为每个3D打包组 tokens_per_image 个token；每个高分辨率关键帧
+        额外增加 max_slice_nums 个切片的token
+        
+        Args:
+            frames: PIL图像帧列表
+            temporal_ids: 时序ID分组
+            token_budget: 本次的视觉token预算，默认使用初始化时的预算
+        
+        Returns:
+            分配结果
+        """
+        budget = token_budget if token_budget is not None else self.token_budget
+        base_tokens = len(temporal_ids) * self.tokens_per_image
+        
+        # 只有分辨率足够高、会被切片的帧才值得分配细节
+        max_area = self.scale_resolution * self.scale_resolution
+        keyframes = [i for i in self.detect_keyframes(frames)
+                     if frames[i].size[0] * frames[i].size[1] > max_area]
+        
+        detail: List[int] = []
+        slices = 1
+        spare = budget - base_tokens
+        for candidate_slices in range(self.max_detail_slices, 1, -1):
+            count = min(len(keyframes), spare // (candidate_slices * self.tokens_per_image))
+            if count > 0:
+                detail = sorted(keyframes[:count])
+                slices = candidate_slices
+                break
+        
+        detail_set = set(detail)
+        new_frames = [frame if i in detail_set else self._downscale(frame)
+                      for i, frame in enumerate(frames)]
+        estimated = base_tokens + len(detail) * slices * self.tokens_per_image
+        
+        if spare < 0:
+            print(f"⚠️ 基础视觉token ({base_tokens}) 已超出预算 ({budget})，不分配高分辨率关键帧")
+        
+        print(f"视觉token分配: {len(detail)}/{len(frames)} 帧高分辨率 (切片数 {slices}), "
+              f"估算 {estimated}/{budget} tokens")
+        
+        return TokenAllocation(
+            frames=new_frames,
+            max_slice_nums=slices,
+            detail_indices=detail,
+            estimated_tokens=estimated
+        )
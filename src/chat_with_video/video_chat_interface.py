@@ -5,11 +5,13 @@
 
 import os
 import time
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Optional, Tuple, Iterator
 from pathlib import Path
 
 from .video_encoder import VideoEncoder
 from .model_loader import MiniCPMVInference
+from .feature_cache import frame_set_fingerprint
+from .cancellation import CancellationToken
 
 
 class VideoChatInterface:
@@ -33,6 +35,9 @@ class VideoChatInterface:
         self.inference_engine = MiniCPMVInference(model_path, device)
         print("✓ 模型推理引擎初始化完成")
         
+        # 最近一次流式对话的耗时
+        self.last_timings: Dict[str, Any] = {}
+        
         # 预热模型
         self.inference_engine.warm_up()
         print("✓ 模型预热完成")
@@ -105,7 +110,8 @@ class VideoChatInterface:
     
     def chat_with_video(self, video_path: str, question: str, 
                        fps: int = 5, force_packing: Optional[int] = None,
-                       max_new_tokens: int = 2048, temperature: float = 0.7) -> str:
+                       max_new_tokens: int = 2048, temperature: float = 0.7,
+                       timeout: Optional[float] = None) -> str:
         """
         视频对话主接口
         
@@ -116,6 +122,7 @@ class VideoChatInterface:
             force_packing: 强制3D打包数量
             max_new_tokens: 最大生成token数
             temperature: 生成温度
+            timeout: 生成时限（秒），超时后返回已生成的部分
             
         Returns:
             模型的回答
@@ -154,6 +161,7 @@ class VideoChatInterface:
             msgs = [
                 {'role': 'user', 'content': frames + [question]}
             ]
+            cache_key = frame_set_fingerprint(frames, temporal_ids)
             
             # 5. 模型推理
             print("\n步骤3: 正在生成回答...")
@@ -165,14 +173,15 @@ class VideoChatInterface:
                 max_slice_nums=1,
                 temporal_ids=temporal_ids,
                 max_new_tokens=max_new_tokens,
-                temperature=temperature
+                temperature=temperature,
+                cache_key=cache_key,
+                timeout=timeout
             )
             
             inference_time = time.time() - start_time
             print(f"推理完成，耗时: {inference_time:.2f}秒")
-            
-            # 6. 清理缓存
-            self.inference_engine.clear_cache()
+            if getattr(answer, 'truncated', False):
+                print(f"⚠️ 回答被截断: {answer.stop_reason}")
             
             print(f"\n{'='*50}")
             print("对话完成!")
@@ -186,8 +195,98 @@ class VideoChatInterface:
             print(f"错误: {error_msg}")
             return error_msg
     
+    def stream_chat_with_video(self, video_path: str, question: str,
+                               fps: int = 5, force_packing: Optional[int] = None,
+                               max_new_tokens: int = 2048, temperature: float = 0.7,
+                               timeout: Optional[float] = None,
+                               cancel_token: Optional[CancellationToken] = None) -> Iterator[str]:
+        """
+        视频对话流式接口，逐段返回生成的文本
+        
+        参数与chat_with_video相同，生成结束后在 last_timings 中记录
+        视频处理耗时、首token延迟、推理耗时和停止原因；提前关闭迭代器会立即停止生成
+        
+        Yields:
+            新生成的文本片段
+        """
+        self.last_timings = {}
+        
+        try:
+            if not self.validate_video_file(video_path):
+                yield "错误: 无法访问视频文件"
+                return
+            
+            start_time = time.time()
+            frames, temporal_ids = self.video_encoder.encode_video(
+                video_path, 
+                choose_fps=fps, 
+                force_packing=force_packing
+            )
+            encoding_time = time.time() - start_time
+            print(f"视频处理完成，耗时: {encoding_time:.2f}秒")
+            
+            msgs = [
+                {'role': 'user', 'content': frames + [question]}
+            ]
+            cache_key = frame_set_fingerprint(frames, temporal_ids)
+            token = CancellationToken.for_request(cancel_token, timeout) or CancellationToken()
+            
+            start_time = time.time()
+            first_token_time = None
+            for text in self.inference_engine.stream_chat(
+                msgs=msgs,
+                use_image_id=False,
+                max_slice_nums=1,
+                temporal_ids=temporal_ids,
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                cache_key=cache_key,
+                cancel_token=token
+            ):
+                if first_token_time is None:
+                    first_token_time = time.time() - start_time
+                yield text
+            
+            inference_time = time.time() - start_time
+            self.last_timings = {
+                'encoding': encoding_time,
+                'first_token': first_token_time if first_token_time is not None else inference_time,
+                'inference': inference_time,
+                'stop_reason': token.stop_reason,
+            }
+            
+        except Exception as e:
+            error_msg = f"视频对话处理失败: {str(e)}"
+            print(f"错误: {error_msg}")
+            yield error_msg
+    
+    def print_stream_answer(self, video_path: str, question: str):
+        """流式打印回答和耗时（命令行交互模式使用），生成过程中按Ctrl+C只停止当前回答"""
+        print("\n🤖 回答:")
+        print("-" * 40)
+        stream = self.stream_chat_with_video(video_path, question)
+        try:
+            for text in stream:
+                print(text, end="", flush=True)
+        except KeyboardInterrupt:
+            # 关闭迭代器即取消令牌，模型立即空闲
+            stream.close()
+            print("\n⏹️ 已停止生成")
+            return
+        print()
+        print("-" * 40)
+        
+        timings = self.last_timings
+        if timings.get('stop_reason'):
+            print(f"⚠️ 回答被截断: {timings['stop_reason']}")
+        if timings:
+            print(f"⏱️ 视频处理: {timings['encoding']:.2f}秒 | "
+                  f"首token延迟: {timings['first_token']:.2f}秒 | "
+                  f"推理耗时: {timings['inference']:.2f}秒")
+    
     def batch_chat_with_video(self, video_path: str, questions: List[str],
-                             fps: int = 5, force_packing: Optional[int] = None) -> List[Tuple[str, str]]:
+                             fps: int = 5, force_packing: Optional[int] = None,
+                             max_batch_size: int = 4) -> List[Tuple[str, str]]:
         """
         批量视频对话，复用视频编码结果
         
@@ -196,6 +295,7 @@ class VideoChatInterface:
             questions: 问题列表
             fps: 采样帧率
             force_packing: 强制3D打包数量
+            max_batch_size: 每个微批次的最大问题数，1表示逐个问题顺序推理
             
         Returns:
             (问题, 答案) 元组列表
@@ -213,33 +313,12 @@ class VideoChatInterface:
                 video_path, choose_fps=fps, force_packing=force_packing
             )
             
-            results = []
+            cache_key = frame_set_fingerprint(frames, temporal_ids)
             
-            for i, question in enumerate(questions, 1):
-                print(f"\n处理问题 {i}/{len(questions)}: {question}")
-                
-                try:
-                    # 构建消息
-                    msgs = [{'role': 'user', 'content': frames + [question]}]
-                    
-                    # 推理
-                    answer = self.inference_engine.chat(
-                        msgs=msgs,
-                        use_image_id=False,
-                        max_slice_nums=1,
-                        temporal_ids=temporal_ids
-                    )
-                    
-                    results.append((question, answer))
-                    print(f"✓ 问题 {i} 处理完成")
-                    
-                except Exception as e:
-                    error_msg = f"处理失败: {str(e)}"
-                    results.append((question, error_msg))
-                    print(f"✗ 问题 {i} 处理失败: {error_msg}")
-                
-                # 清理缓存
-                self.inference_engine.clear_cache()
+            if max_batch_size > 1 and len(questions) > 1:
+                results = self._batched_chat(frames, temporal_ids, questions, cache_key, max_batch_size)
+            else:
+                results = self._sequential_chat(frames, temporal_ids, questions, cache_key)
             
             print(f"\n批量处理完成! 成功: {len([r for r in results if not r[1].startswith('处理失败')])}/{len(questions)}")
             return results
@@ -249,6 +328,59 @@ class VideoChatInterface:
             print(f"错误: {error_msg}")
             return [(q, error_msg) for q in questions]
     
+    def _sequential_chat(self, frames: List[Any], temporal_ids: List[List[int]],
+                         questions: List[str], cache_key: str) -> List[Tuple[str, str]]:
+        """逐个问题顺序推理"""
+        results = []
+        
+        for i, question in enumerate(questions, 1):
+            print(f"\n处理问题 {i}/{len(questions)}: {question}")
+            
+            try:
+                # 构建消息
+                msgs = [{'role': 'user', 'content': frames + [question]}]
+                
+                # 推理
+                answer = self.inference_engine.chat(
+                    msgs=msgs,
+                    use_image_id=False,
+                    max_slice_nums=1,
+                    temporal_ids=temporal_ids,
+                    cache_key=cache_key
+                )
+                
+                results.append((question, answer))
+                print(f"✓ 问题 {i} 处理完成")
+                
+            except Exception as e:
+                error_msg = f"处理失败: {str(e)}"
+                results.append((question, error_msg))
+                print(f"✗ 问题 {i} 处理失败: {error_msg}")
+        
+        return results
+    
+    def _batched_chat(self, frames: List[Any], temporal_ids: List[List[int]],
+                      questions: List[str], cache_key: str,
+                      max_batch_size: int) -> List[Tuple[str, str]]:
+        """按共享视频前缀的微批次推理，失败时回退到顺序推理"""
+        msgs_list = [[{'role': 'user', 'content': frames + [question]}] for question in questions]
+        
+        try:
+            answers = self.inference_engine.batch_chat(
+                msgs_list,
+                use_image_id=False,
+                max_slice_nums=1,
+                temporal_ids=temporal_ids,
+                cache_key=cache_key,
+                max_batch_size=max_batch_size
+            )
+        except Exception as e:
+            # 失败的请求已由内存管理器释放缓存
+            print(f"✗ 批量推理失败，回退到顺序推理: {str(e)}")
+            return self._sequential_chat(frames, temporal_ids, questions, cache_key)
+        
+        return list(zip(questions, answers))
+    
     def get_system_info(self) -> Dict[str, Any]:
         """获取系统和设备信息"""
         device_info = self.inference_engine.get_device_info()
@@ -283,7 +415,7 @@ class VideoChatInterface:
         print("\n💡 使用说明:")
         print("  1. 输入视频文件路径")
         print("  2. 输入您的问题")
-        print("  3. 等待模型处理和回答")
+        print("  3. 等待模型处理和回答（生成过程中按 Ctrl+C 停止当前回答）")
         print("  4. 输入 'quit' 退出程序")
         print("-"*60)
         
@@ -320,13 +452,8 @@ class VideoChatInterface:
                     if not question:
                         continue
                     
-                    # 处理对话
-                    answer = self.chat_with_video(video_path, question)
-                    
-                    print("\n🤖 回答:")
-                    print("-" * 40)
-                    print(answer)
-                    print("-" * 40)
+                    # 处理对话（流式输出）
+                    self.print_stream_answer(video_path, question)
                 
             except KeyboardInterrupt:
                 print("\n\n👋 用户中断，退出程序")
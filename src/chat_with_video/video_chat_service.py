@@ -4,13 +4,27 @@
 专为Intel XPU优化的MiniCPM-V视频聊天服务
 """
 
+import math
 import os
 import time
-from typing import Optional, List, Dict, Any, Tuple
+from contextlib import contextmanager, nullcontext
+from typing import Optional, List, Dict, Any, Tuple, Iterator, Callable, Sequence
 from PIL import Image
 
 from .model_loader import MiniCPMVInference
-from .video_encoder import VideoEncoder
+from .video_encoder import FramePlan, VideoEncoder
+from .token_allocator import FrameTokenAllocator
+from .feature_cache import frame_set_fingerprint
+from .cancellation import CancellationToken, ChatResult
+from .degradation import (
+    DEFAULT_OOM_LADDER, DegradationStep, applicable_steps, degrade_frames, is_out_of_memory, scaled_size
+)
+from .model_router import CostWeights, ModelVariant, VariantRouter
+
+
+# 默认预热的视频组数：单组和少量组，覆盖处理器、视觉编码器和3D重采样器的整条路径，
+# 不为每个变体/副本都按最大形状（max_frames组）做一次完整推理
+DEFAULT_WARM_UP_GROUPS = (1, 8)
 
 
 class VideoChatService:
@@ -21,7 +35,21 @@ class VideoChatService:
                  device: str = 'xpu',
                  max_frames: int = 180,
                  max_packing: int = 3,
-                 time_scale: float = 0.1):
+                 time_scale: float = 0.1,
+                 readahead: Optional[str] = None,
+                 frame_cache_bytes: int = 0,
+                 visual_token_budget: int = 8192,
+                 scheduler_batch_size: int = 0,
+                 num_threads: Optional[int] = None,
+                 draft_model_path: Optional[str] = None,
+                 speculative_lookahead: int = 4,
+                 compile_model: bool = False,
+                 warm_up_frames: Optional[List[int]] = None,
+                 memory_high_water: float = 0.85,
+                 oom_ladder: Optional[Sequence[DegradationStep]] = None,
+                 precision: str = 'auto',
+                 variants: Optional[Sequence[ModelVariant]] = None,
+                 route_weights: Optional[CostWeights] = None):
         """
         初始化视频聊天服务
         
@@ -31,22 +59,71 @@ class VideoChatService:
             max_frames: 最大帧数限制
             max_packing: 最大打包数量（1-6）
             time_scale: 时间缩放因子
+            readahead: 视频解码预读策略（'auto'/'fadvise'/'thread'），视频位于网络存储时建议开启
+            frame_cache_bytes: 解码帧缓存的最大字节数，默认0（禁用）；同一视频反复调整采样参数时可开启
+            visual_token_budget: 关键帧高分辨率模式下的全局视觉token预算
+            scheduler_batch_size: 连续批处理调度器的最大批大小，多个用户的请求在token粒度上合并解码；
+                                  默认0，不启用调度器，请求直接串行调用模型
+            num_threads: CPU推理的线程数，默认为可用物理核数
+            draft_model_path: 推测解码的草稿语言模型路径，设置后非流式问答使用推测解码
+            speculative_lookahead: 推测解码每轮草稿模型提议的token数
+            compile_model: 使用torch.compile编译模型前向，启动时按形状分桶预热
+            warm_up_frames: 启动预热使用的合成视频帧数列表；默认按DEFAULT_WARM_UP_GROUPS预热少量小形状，
+                            启用编译时为每个预填充桶选择一个帧数，[]表示只做文本预热；
+                            需要预热最大形状时显式传入 [max_frames * max_packing]
+            memory_high_water: 设备保留显存超过总显存的该比例时才在请求后释放缓存
+            oom_ladder: 内存不足时依次尝试的降级设置，默认DEFAULT_OOM_LADDER
+                        （降低分辨率 -> 减少帧数 -> 提高打包数 -> CPU卸载），[]表示不重试
+            precision: 推理精度，'auto'、'fp32'、'bf16'、'fp16'、'int8-dynamic'（仅CPU）或 'int4'（需要int4检查点）
+            variants: 同时部署的模型变体（如完整模型和int4模型），设置后按请求代价路由到能处理它的
+                      最便宜的变体，model_path和precision由各变体指定
+            route_weights: 请求代价的权重（帧数、问题长度、最大生成token数），默认CostWeights()
         """
         self.model_path = model_path
         self.device = device
+        self.scheduler_batch_size = scheduler_batch_size
+        self.num_threads = num_threads
+        self.draft_model_path = draft_model_path
+        self.speculative_lookahead = speculative_lookahead
+        self.compile_model = compile_model
+        self.memory_high_water = memory_high_water
+        self.warm_up_frames = warm_up_frames
+        self.oom_ladder = tuple(DEFAULT_OOM_LADDER if oom_ladder is None else oom_ladder)
+        self.precision = precision
+        self.router = VariantRouter(variants, route_weights) if variants else None
+        if self.router is not None:
+            self.model_path = self.router.default.model_path
         
-        # 初始化组件
+        # 初始化组件，inference_engine为兜底变体（不路由时为唯一）的推理引擎
         self.inference_engine: Optional[MiniCPMVInference] = None
+        self.engines: Dict[str, MiniCPMVInference] = {}
         self.video_encoder = VideoEncoder(
             max_frames=max_frames,
             max_packing=max_packing,
-            time_scale=time_scale
+            time_scale=time_scale,
+            frame_cache_bytes=frame_cache_bytes,
+            readahead=readahead
         )
+        self.token_allocator = FrameTokenAllocator(token_budget=visual_token_budget)
+        
+        # 启动预热各步骤的耗时
+        self.warm_up_timings: Dict[str, float] = {}
+        # 最近一次问答使用的降级设置和内存不足降级的累计次数
+        self.last_degradation: Dict[str, Any] = {}
+        self.degradation_counts: Dict[str, int] = {}
+        # 最近一次路由选择的变体和请求代价
+        self.last_route: Dict[str, Any] = {}
         
         self._initialized = False
         
         print(f"视频聊天服务已配置:")
-        print(f"  - 模型: {model_path}")
+        if self.router is None:
+            print(f"  - 模型: {model_path}")
+            print(f"  - 精度: {precision}")
+        else:
+            for variant in self.router.variants:
+                limit = '不限' if variant.max_cost is None else f"{variant.max_cost:g}"
+                print(f"  - 模型变体 {variant.name}: {variant.model_path}（精度 {variant.precision}，代价上限 {limit}）")
         print(f"  - 设备: {device}")
         print(f"  - 3D重采样器参数: max_frames={max_frames}, max_packing={max_packing}")
     
@@ -60,30 +137,72 @@ class VideoChatService:
         if self._initialized:
             return True
         
+        created = []
         try:
             print("正在初始化视频聊天服务...")
             
-            # 初始化推理引擎
-            self.inference_engine = MiniCPMVInference(
-                model_path=self.model_path,
-                device=self.device
-            )
-            
-            # 初始化模型
-            self.inference_engine.initialize()
+            if self.router is None:
+                variants = [ModelVariant('default', self.model_path, precision=self.precision)]
+            else:
+                variants = self.router.variants
             
-            # 可选：预热模型
-            print("正在预热模型...")
-            self.inference_engine.warm_up()
+            for variant in variants:
+                if len(variants) > 1:
+                    print(f"加载模型变体 {variant.name}: {variant.model_path}")
+                
+                # 初始化推理引擎和模型
+                engine = self._create_engine(variant)
+                created.append(engine)
+                engine.initialize()
+                
+                # 用与真实请求形状一致的合成视频预热完整推理路径
+                timings = engine.warm_up(self._warm_up_videos(engine))
+                if len(variants) > 1:
+                    timings = {f"{variant.name}/{step}": seconds for step, seconds in timings.items()}
+                self.warm_up_timings.update(timings)
+                
+                # 启动连续批处理调度器，并发请求由工作线程统一调度
+                if self.scheduler_batch_size > 0:
+                    engine.start_scheduler(self.scheduler_batch_size)
+                self.engines[variant.name] = engine
             
+            self.inference_engine = self.engines[variants[-1].name]
             self._initialized = True
             print("视频聊天服务初始化完成!")
             return True
             
         except Exception as e:
             print(f"服务初始化失败: {str(e)}")
+            # 释放已经加载的模型变体，失败的初始化不继续占用内存
+            self._release_engines(created)
             return False
     
+    def _release_engines(self, engines: List[MiniCPMVInference]):
+        """停止推理引擎的调度器和内存管理器，清空缓存并丢弃对它们的引用"""
+        for engine in engines:
+            try:
+                engine.stop_scheduler()
+                engine.memory.shutdown()
+                engine.clear_feature_cache()
+            except Exception as e:
+                print(f"释放推理引擎时出错: {str(e)}")
+        engines.clear()
+        self.engines.clear()
+        self.inference_engine = None
+    
+    def _create_engine(self, variant: ModelVariant) -> MiniCPMVInference:
+        """创建一个模型变体的推理引擎（尚未加载模型）"""
+        return MiniCPMVInference(
+            model_path=variant.model_path,
+            device=self.device,
+            num_threads=self.num_threads,
+            draft_model_path=self.draft_model_path,
+            speculative_lookahead=self.speculative_lookahead,
+            compile_model=self.compile_model,
+            memory_high_water=self.memory_high_water,
+            precision=variant.precision
+        )
+    
     def get_system_info(self) -> Dict[str, Any]:
         """
         获取系统状态信息
@@ -99,19 +218,77 @@ class VideoChatService:
                 'max_frames': self.video_encoder.MAX_NUM_FRAMES,
                 'max_packing': self.video_encoder.MAX_NUM_PACKING,
                 'time_scale': self.video_encoder.TIME_SCALE
-            }
+            },
+            'frame_cache': self.video_encoder.frame_cache.stats(),
+            'frame_buffer_pool': self.video_encoder.buffer_pool.stats(),
+            'warm_up_seconds': self.warm_up_timings,
+            'oom_degradations': dict(self.degradation_counts)
         }
         
         if self.inference_engine:
             device_info = self.inference_engine.get_device_info()
             info.update(device_info)
+            info.update(self._engine_stats(self.inference_engine))
+        
+        if self.router is not None:
+            info['routing'] = self.router.stats()
+            # 每个模型变体各自的精度、缓存和调度器统计
+            info['variants'] = {
+                name: {**engine.get_device_info(), **self._engine_stats(engine)}
+                for name, engine in self.engines.items()
+            }
         
         return info
     
+    @staticmethod
+    def _engine_stats(engine: MiniCPMVInference) -> Dict[str, Any]:
+        """推理引擎的缓存和调度器统计"""
+        stats = {
+            'vision_cache': engine.vision_cache.stats(),
+            'pixel_cache': engine.pixel_cache.stats(),
+            'prefix_cache': engine.prefix_cache.stats(),
+        }
+        if engine.scheduler is not None:
+            stats['scheduler'] = engine.scheduler.stats()
+        return stats
+    
+    def _warm_up_videos(self, engine: Optional[MiniCPMVInference] = None) -> List[tuple]:
+        """
+        生成预热使用的合成视频（engine为要预热的推理引擎，默认为inference_engine）
+        
+        未指定warm_up_frames时使用DEFAULT_WARM_UP_GROUPS中的少量小形状（每组max_packing帧）；
+        启用编译时为每个预填充桶选择能落入该桶的最大组数，使每个桶的编译图都被预热
+        """
+        packing = self.video_encoder.MAX_NUM_PACKING
+        max_groups = self.video_encoder.MAX_NUM_FRAMES
+        
+        frame_counts = self.warm_up_frames
+        if frame_counts is None:
+            frame_counts = [min(groups, max_groups) * packing for groups in DEFAULT_WARM_UP_GROUPS]
+            frame_counts = sorted(set(frame_counts))
+            engine = engine or self.inference_engine
+            compiled = engine.compiled
+            if compiled is not None:
+                config = getattr(engine.model, 'config', None)
+                # 每组视觉token数（重采样器query数）加上图像标记，另预留问题和对话模板的token
+                group_tokens = getattr(config, 'query_num', 64) + 8
+                groups = {min(max_groups, (bucket - 128) // group_tokens)
+                          for bucket in compiled.prompt_buckets if bucket > 128 + group_tokens}
+                frame_counts = [g * packing for g in sorted(groups)] or frame_counts
+        
+        videos = []
+        for num_frames in frame_counts:
+            frames, temporal_ids = self.video_encoder.synthetic_video(num_frames, packing)
+            videos.append((f"视频 {num_frames}帧/{len(temporal_ids)}组", frames, temporal_ids))
+        return videos
+    
     def process_video(self, 
                      video_path: str, 
                      choose_fps: int = 3,
-                     force_packing: Optional[int] = None) -> Tuple[List[Image.Image], List[List[int]]]:
+                     force_packing: Optional[int] = None,
+                     decode_size: Optional[Tuple[int, int]] = None,
+                     video_info: Optional[dict] = None,
+                     plan: Optional[FramePlan] = None) -> Tuple[List[Image.Image], List[List[int]]]:
         """
         处理视频文件，提取帧和时序ID
         
@@ -119,6 +296,9 @@ class VideoChatService:
             video_path: 视频文件路径
             choose_fps: 采样帧率
             force_packing: 强制打包数量
+            decode_size: 解码分辨率 (width, height)（可选），默认为原始分辨率
+            video_info: 已读取的视频信息（可选），提供时不再重新打开视频读取
+            plan: 已计算的帧采样计划（可选），提供时编码直接使用
             
         Returns:
             Tuple[frames, temporal_ids]: PIL图像帧列表和时序ID分组
@@ -131,14 +311,17 @@ class VideoChatService:
                 raise FileNotFoundError(f"视频文件不存在: {video_path}")
             
             # 获取视频信息
-            video_info = self.video_encoder.get_video_info(video_path)
+            if video_info is None:
+                video_info = self.video_encoder.get_video_info(video_path)
             print(f"视频信息: {video_info}")
             
             # 使用3D重采样器编码视频
             frames, temporal_ids = self.video_encoder.encode_video(
                 video_path=video_path,
                 choose_fps=choose_fps,
-                force_packing=force_packing
+                force_packing=force_packing,
+                decode_size=decode_size,
+                plan=plan
             )
             
             print(f"视频处理完成: {len(frames)}帧, {len(temporal_ids)}个时序组")
@@ -155,7 +338,10 @@ class VideoChatService:
                        force_packing: Optional[int] = None,
                        max_new_tokens: int = 2048,
                        temperature: float = 0.7,
-                       top_p: float = 0.8) -> str:
+                       top_p: float = 0.8,
+                       keyframe_detail: bool = False,
+                       cancel_token: Optional[CancellationToken] = None,
+                       timeout: Optional[float] = None) -> str:
         """
         与视频进行聊天对话
         
@@ -167,9 +353,13 @@ class VideoChatService:
             max_new_tokens: 最大生成token数
             temperature: 温度参数
             top_p: Top-p采样参数
+            keyframe_detail: 是否为关键帧分配高分辨率（在视觉token预算内）
+            cancel_token: 取消令牌（可选），取消后立即停止生成
+            timeout: 墙钟超时秒数（可选），从调用开始计时，包含视频处理
             
         Returns:
-            模型回答
+            模型回答（ChatResult），被取消或超时时为已生成的部分，truncated为True；
+            内存不足降级后degradation中记录所用的降级设置
         """
         # 确保服务已初始化
         if not self._initialized:
@@ -178,41 +368,67 @@ class VideoChatService:
         
         try:
             start_time = time.time()
+            token = CancellationToken.for_request(cancel_token, timeout)
+            # 只读取一次视频信息和采样计划，路由、降级阶梯和每次尝试的编码共用
+            video_info = self.video_encoder.get_video_info(video_path)
+            plan = self._plan_video(video_info, choose_fps, force_packing)
             
-            # 处理视频
-            print(f"处理视频: {video_path}")
-            frames, temporal_ids = self.process_video(
-                video_path=video_path,
-                choose_fps=choose_fps,
-                force_packing=force_packing
-            )
+            def attempt(step: DegradationStep) -> str:
+                # 处理视频（降低分辨率时直接按缩小的分辨率解码）
+                print(f"处理视频: {video_path}")
+                frames, temporal_ids = self.process_video(
+                    video_path=video_path,
+                    choose_fps=choose_fps,
+                    force_packing=force_packing,
+                    decode_size=self._degraded_decode_size(video_info, step),
+                    video_info=video_info,
+                    plan=plan
+                )
+                frames, temporal_ids = degrade_frames(
+                    frames, temporal_ids, step, self.video_encoder.MAX_NUM_PACKING, resize=False
+                )
+                
+                process_time = time.time() - start_time
+                print(f"视频处理耗时: {process_time:.2f}秒")
+                
+                detail = keyframe_detail and step.resolution_scale >= 1.0
+                cache_key = self._frames_cache_key(frames, temporal_ids, detail)
+                frames, max_slice_nums = self._allocate_visual_tokens(frames, temporal_ids, detail)
+                
+                # 构建消息
+                msgs = [
+                    {'role': 'user', 'content': frames + [question]}
+                ]
+                
+                print(f"开始推理，问题: {question}")
+                inference_start = time.time()
+                
+                # 调用模型推理
+                answer = engine.chat(
+                    msgs=msgs,
+                    use_image_id=False,
+                    max_slice_nums=max_slice_nums,
+                    temporal_ids=temporal_ids,
+                    max_new_tokens=max_new_tokens,
+                    temperature=temperature,
+                    top_p=top_p,
+                    cache_key=cache_key,
+                    cancel_token=token
+                )
+                
+                inference_time = time.time() - inference_start
+                print(f"推理耗时: {inference_time:.2f}秒")
+                return answer
             
-            process_time = time.time() - start_time
-            print(f"视频处理耗时: {process_time:.2f}秒")
-            
-            # 构建消息
-            msgs = [
-                {'role': 'user', 'content': frames + [question]}
-            ]
-            
-            print(f"开始推理，问题: {question}")
-            inference_start = time.time()
-            
-            # 调用模型推理
-            answer = self.inference_engine.chat(
-                msgs=msgs,
-                use_image_id=False,
-                max_slice_nums=1,
-                temporal_ids=temporal_ids,
-                max_new_tokens=max_new_tokens,
-                temperature=temperature,
-                top_p=top_p
-            )
+            if plan is None:
+                num_frames, shape = self.video_encoder.MAX_NUM_FRAMES * self.video_encoder.MAX_NUM_PACKING, None
+            else:
+                num_frames = len(plan.frame_indices)
+                shape = (math.ceil(num_frames / plan.packing_nums), plan.packing_nums)
+            with self._routed_engine(num_frames, question, max_new_tokens) as engine:
+                answer = self._run_with_oom_ladder(attempt, engine, shape)
             
-            inference_time = time.time() - inference_start
             total_time = time.time() - start_time
-            
-            print(f"推理耗时: {inference_time:.2f}秒")
             print(f"总耗时: {total_time:.2f}秒")
             print(f"回答: {answer}")
             
@@ -228,7 +444,10 @@ class VideoChatService:
                         question: str,
                         max_new_tokens: int = 2048,
                         temperature: float = 0.7,
-                        top_p: float = 0.8) -> str:
+                        top_p: float = 0.8,
+                        keyframe_detail: bool = False,
+                        cancel_token: Optional[CancellationToken] = None,
+                        timeout: Optional[float] = None) -> str:
         """
         使用已处理的帧和时序ID进行聊天
         
@@ -239,9 +458,13 @@ class VideoChatService:
             max_new_tokens: 最大生成token数
             temperature: 温度参数
             top_p: Top-p采样参数
+            keyframe_detail: 是否为关键帧分配高分辨率（在视觉token预算内）
+            cancel_token: 取消令牌（可选），取消后立即停止生成
+            timeout: 墙钟超时秒数（可选）
             
         Returns:
-            模型回答
+            模型回答（ChatResult），被取消或超时时为已生成的部分，truncated为True；
+            内存不足降级后degradation中记录所用的降级设置
         """
         # 确保服务已初始化
         if not self._initialized:
@@ -249,38 +472,346 @@ class VideoChatService:
                 raise RuntimeError("服务初始化失败")
         
         try:
-            # 构建消息
-            msgs = [
-                {'role': 'user', 'content': frames + [question]}
-            ]
-            
-            print(f"使用预处理帧进行推理，问题: {question}")
-            
-            # 调用模型推理
-            answer = self.inference_engine.chat(
-                msgs=msgs,
-                use_image_id=False,
-                max_slice_nums=1,
-                temporal_ids=temporal_ids,
-                max_new_tokens=max_new_tokens,
-                temperature=temperature,
-                top_p=top_p
-            )
+            token = CancellationToken.for_request(cancel_token, timeout)
             
-            return answer
+            def attempt(step: DegradationStep) -> str:
+                step_frames, step_temporal_ids = degrade_frames(
+                    frames, temporal_ids, step, self.video_encoder.MAX_NUM_PACKING
+                )
+                detail = keyframe_detail and step.resolution_scale >= 1.0
+                cache_key = self._frames_cache_key(step_frames, step_temporal_ids, detail)
+                step_frames, max_slice_nums = self._allocate_visual_tokens(step_frames, step_temporal_ids, detail)
+                
+                # 构建消息
+                msgs = [
+                    {'role': 'user', 'content': step_frames + [question]}
+                ]
+                
+                print(f"使用预处理帧进行推理，问题: {question}")
+                
+                # 调用模型推理
+                return engine.chat(
+                    msgs=msgs,
+                    use_image_id=False,
+                    max_slice_nums=max_slice_nums,
+                    temporal_ids=step_temporal_ids,
+                    max_new_tokens=max_new_tokens,
+                    temperature=temperature,
+                    top_p=top_p,
+                    cache_key=cache_key,
+                    cancel_token=token
+                )
+            
+            with self._routed_engine(len(frames), question, max_new_tokens) as engine:
+                return self._run_with_oom_ladder(attempt, engine, self._input_shape(temporal_ids))
             
         except Exception as e:
             print(f"聊天失败: {str(e)}")
             raise
     
+    def stream_chat(self,
+                    frames: List[Image.Image],
+                    temporal_ids: List[List[int]],
+                    question: str,
+                    max_new_tokens: int = 2048,
+                    temperature: float = 0.7,
+                    top_p: float = 0.8,
+                    keyframe_detail: bool = False,
+                    cancel_token: Optional[CancellationToken] = None,
+                    timeout: Optional[float] = None,
+                    timings: Optional[Dict[str, Any]] = None) -> Iterator[str]:
+        """
+        使用已处理的帧进行流式聊天，逐段返回生成的文本
+        
+        生成结束后在调用方传入的timings中记录本次请求的首token延迟（first_token）、推理总耗时（inference）
+        和停止原因（stop_reason，被取消或超时时非空，表示回答被截断）；每个请求使用自己的字典，
+        并发的请求互不覆盖。输出第一段文本之前内存不足时按降级阶梯重试，所用的降级设置记录在degradation中
+        
+        Args:
+            frames: PIL图像帧列表
+            temporal_ids: 时序ID分组列表
+            question: 用户问题
+            max_new_tokens: 最大生成token数
+            temperature: 温度参数
+            top_p: Top-p采样参数
+            keyframe_detail: 是否为关键帧分配高分辨率（在视觉token预算内）
+            cancel_token: 取消令牌（可选），取消或提前关闭迭代器后立即停止生成
+            timeout: 墙钟超时秒数（可选）
+            timings: 接收本次请求耗时的字典（可选）
+            
+        Yields:
+            新生成的文本片段
+        """
+        # 确保服务已初始化
+        if not self._initialized:
+            if not self.initialize():
+                raise RuntimeError("服务初始化失败")
+        
+        try:
+            start_time = time.time()
+            token = CancellationToken.for_request(cancel_token, timeout) or CancellationToken()
+            
+            def attempt(step: DegradationStep) -> Iterator[str]:
+                step_frames, step_temporal_ids = degrade_frames(
+                    frames, temporal_ids, step, self.video_encoder.MAX_NUM_PACKING
+                )
+                detail = keyframe_detail and step.resolution_scale >= 1.0
+                cache_key = self._frames_cache_key(step_frames, step_temporal_ids, detail)
+                step_frames, max_slice_nums = self._allocate_visual_tokens(step_frames, step_temporal_ids, detail)
+                
+                # 构建消息
+                msgs = [
+                    {'role': 'user', 'content': step_frames + [question]}
+                ]
+                
+                print(f"使用预处理帧进行流式推理，问题: {question}")
+                
+                return engine.stream_chat(
+                    msgs=msgs,
+                    use_image_id=False,
+                    max_slice_nums=max_slice_nums,
+                    temporal_ids=step_temporal_ids,
+                    max_new_tokens=max_new_tokens,
+                    temperature=temperature,
+                    top_p=top_p,
+                    cache_key=cache_key,
+                    cancel_token=token
+                )
+            
+            first_token_time = None
+            chunks = 0
+            with self._routed_engine(len(frames), question, max_new_tokens) as engine:
+                for text in self._stream_with_oom_ladder(attempt, engine, self._input_shape(temporal_ids),
+                                                         timings):
+                    if first_token_time is None:
+                        first_token_time = time.time() - start_time
+                        print(f"首token延迟: {first_token_time:.2f}秒")
+                    chunks += 1
+                    yield text
+            
+            inference_time = time.time() - start_time
+            if timings is not None:
+                timings.update({
+                    'first_token': first_token_time if first_token_time is not None else inference_time,
+                    'inference': inference_time,
+                    'chunks': chunks,
+                    'stop_reason': token.stop_reason,
+                })
+            print(f"推理耗时: {inference_time:.2f}秒")
+            if token.stop_reason is not None:
+                print(f"回答被截断: {token.stop_reason}")
+            
+        except Exception as e:
+            print(f"流式聊天失败: {str(e)}")
+            raise
+    
+    @contextmanager
+    def _routed_engine(self, num_frames: int, question: str, max_new_tokens: int):
+        """
+        选择处理本次请求的推理引擎，并在请求结束后记录所选变体的延迟
+        
+        未配置模型变体时直接使用inference_engine
+        
+        Args:
+            num_frames: 请求的视频帧数
+            question: 用户问题
+            max_new_tokens: 请求的最大生成token数
+            
+        Yields:
+            推理引擎
+        """
+        if self.router is None:
+            yield self.inference_engine
+            return
+        
+        variant, cost = self.router.route(num_frames, question, max_new_tokens)
+        self.last_route = {'variant': variant.name, 'cost': cost}
+        print(f"路由到模型变体 {variant.name}（请求代价 {cost:.2f}）")
+        
+        start = time.time()
+        failed = False
+        try:
+            yield self.engines[variant.name]
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.router.record(variant.name, time.time() - start, failed=failed)
+    
+    def _plan_video(self, info: dict, choose_fps: int, force_packing: Optional[int]) -> Optional[FramePlan]:
+        """按视频信息计算帧采样计划，用于路由、选择降级阶梯和编码（无法读取视频信息时为None）"""
+        if not info:
+            return None
+        return self.video_encoder.plan_frames(info['total_frames'], info['fps'],
+                                              choose_fps=choose_fps, force_packing=force_packing)
+    
+    def _run_with_oom_ladder(self,
+                             attempt: Callable[[DegradationStep], str],
+                             engine: Optional[MiniCPMVInference] = None,
+                             shape: Optional[Tuple[int, int]] = None) -> str:
+        """
+        按降级阶梯执行一次问答：内存不足时释放缓存，换下一级降级设置重试
+        
+        Args:
+            attempt: 按给定降级设置完成视频处理和推理，返回回答
+            engine: 处理本次请求的推理引擎，默认为inference_engine
+            shape: 输入的（时序组数, 打包数），提供时跳过对该输入不产生变化的级
+            
+        Returns:
+            回答（ChatResult），degradation中记录实际使用的降级设置（未降级时为None）
+        """
+        engine = engine or self.inference_engine
+        steps = self._ladder_steps(shape)
+        for index, step in enumerate(steps):
+            try:
+                with engine.cpu_offload() if step.cpu_offload else nullcontext():
+                    answer = attempt(step)
+            except Exception as e:
+                if not self._retry_after_oom(e, steps, index, engine):
+                    raise
+                continue
+            
+            degradation = self._record_degradation(step, index + 1)
+            self.last_degradation = degradation or {}
+            return ChatResult(answer, getattr(answer, 'stop_reason', None), degradation)
+    
+    def _stream_with_oom_ladder(self,
+                                attempt: Callable[[DegradationStep], Iterator[str]],
+                                engine: Optional[MiniCPMVInference] = None,
+                                shape: Optional[Tuple[int, int]] = None,
+                                timings: Optional[Dict[str, Any]] = None) -> Iterator[str]:
+        """
+        流式问答的降级阶梯：在输出第一段文本之前内存不足（视觉编码、预填充）时降级重试，
+        已经输出文本后不再重试（调用方已收到部分回答），直接抛出异常
+        
+        Args:
+            attempt: 按给定降级设置返回流式输出的文本片段
+            engine: 处理本次请求的推理引擎，默认为inference_engine
+            shape: 输入的（时序组数, 打包数），提供时跳过对该输入不产生变化的级
+            timings: 调用方的耗时字典（可选），降级时写入degradation
+            
+        Yields:
+            新生成的文本片段
+        """
+        engine = engine or self.inference_engine
+        steps = self._ladder_steps(shape)
+        for index, step in enumerate(steps):
+            started = False
+            try:
+                with engine.cpu_offload() if step.cpu_offload else nullcontext():
+                    for text in attempt(step):
+                        started = True
+                        yield text
+            except Exception as e:
+                if started or not self._retry_after_oom(e, steps, index, engine):
+                    raise
+                continue
+            
+            degradation = self._record_degradation(step, index + 1)
+            if timings is not None:
+                timings['degradation'] = degradation
+            return
+    
+    def _ladder_steps(self, shape: Optional[Tuple[int, int]]) -> List[DegradationStep]:
+        """本次请求需要尝试的降级设置，跳过对输入形状不产生变化的级"""
+        steps = list(self.oom_ladder or (DegradationStep('原始设置'),))
+        if shape is None:
+            return steps
+        return applicable_steps(steps, shape[0], shape[1], self.video_encoder.MAX_NUM_PACKING)
+    
+    def _retry_after_oom(self, error: Exception, steps: List[DegradationStep], index: int,
+                         engine: MiniCPMVInference) -> bool:
+        """内存不足且还有下一级时释放缓存并返回True，否则返回False（由调用方抛出原始异常）"""
+        if not is_out_of_memory(error) or index == len(steps) - 1:
+            return False
+        print(f"⚠️ 内存不足（{steps[index].name}）: {str(error)}")
+        self._free_memory_for_retry(engine)
+        print(f"降级重试: {steps[index + 1].name}")
+        return True
+    
+    def _record_degradation(self, step: DegradationStep, attempts: int) -> Optional[Dict[str, Any]]:
+        """统计并返回实际使用的降级设置，未降级时为None"""
+        if not step.degraded:
+            return None
+        self.degradation_counts[step.name] = self.degradation_counts.get(step.name, 0) + 1
+        print(f"已使用降级设置完成回答: {step.name}")
+        return {'step': step.name, 'attempts': attempts, **step.settings()}
+    
+    @staticmethod
+    def _input_shape(temporal_ids: List[List[int]]) -> Optional[Tuple[int, int]]:
+        """输入的（时序组数, 打包数）"""
+        if not temporal_ids:
+            return None
+        return len(temporal_ids), max(len(ids) for ids in temporal_ids)
+    
+    def _free_memory_for_retry(self, engine: MiniCPMVInference):
+        """释放设备缓存、视觉特征/前缀KV缓存和解码帧缓存，为降级重试腾出内存"""
+        engine.clear_feature_cache()
+        self.video_encoder.frame_cache.clear()
+        engine.memory.trim('内存不足降级')
+    
+    def _degraded_decode_size(self, info: dict, step: DegradationStep) -> Optional[Tuple[int, int]]:
+        """降低分辨率时的解码分辨率（info为视频信息），未降低时为None（原始分辨率）"""
+        if step.resolution_scale >= 1.0 or not info:
+            return None
+        return scaled_size(info['width'], info['height'], step.resolution_scale)
+    
+    def _frames_cache_key(self,
+                          frames: List[Image.Image],
+                          temporal_ids: List[List[int]],
+                          keyframe_detail: bool) -> str:
+        """
+        计算帧集合的视觉特征缓存键
+        
+        Args:
+            frames: PIL图像帧列表（分配token之前）
+            temporal_ids: 时序ID分组列表
+            keyframe_detail: 是否启用关键帧高分辨率
+            
+        Returns:
+            缓存键
+        """
+        budget = self.token_allocator.token_budget if keyframe_detail else None
+        return frame_set_fingerprint(frames, temporal_ids, extra=(keyframe_detail, budget))
+    
+    def _allocate_visual_tokens(self,
+                                frames: List[Image.Image],
+                                temporal_ids: List[List[int]],
+                                keyframe_detail: bool) -> Tuple[List[Image.Image], int]:
+        """
+        按需为关键帧分配高分辨率
+        
+        Args:
+            frames: PIL图像帧列表
+            temporal_ids: 时序ID分组列表
+            keyframe_detail: 是否启用关键帧高分辨率
+            
+        Returns:
+            Tuple[frames, max_slice_nums]: 处理后的帧和传给模型的最大切片数
+        """
+        if not keyframe_detail:
+            return frames, 1
+        
+        allocation = self.token_allocator.allocate(frames, temporal_ids)
+        return allocation.frames, allocation.max_slice_nums
+    
+    def _all_engines(self) -> List[MiniCPMVInference]:
+        """所有模型变体的推理引擎"""
+        if self.engines:
+            return list(self.engines.values())
+        return [self.inference_engine] if self.inference_engine else []
+    
     def clear_cache(self):
         """清理缓存"""
-        if self.inference_engine:
-            self.inference_engine.clear_cache()
+        for engine in self._all_engines():
+            engine.clear_cache()
     
     def shutdown(self):
         """关闭服务"""
         try:
+            for engine in self._all_engines():
+                engine.stop_scheduler()
+                engine.memory.shutdown()
             self.clear_cache()
             print("视频聊天服务已关闭")
         except Exception as e:
@@ -6,16 +6,39 @@
 
 import math
 import numpy as np
+from dataclasses import dataclass
 from PIL import Image
 from decord import VideoReader, cpu
 from scipy.spatial import cKDTree
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, Dict, Any
+
+from .feature_cache import EncodedFrames, derive_fingerprint
+from .frame_cache import FrameCache, NATIVE_RESOLUTION, video_fingerprint
+from .frame_buffer_pool import FrameBuffer, FrameBufferPool
+from .readahead import FrameReadahead
+
+
+@dataclass
+class FramePlan:
+    """帧采样计划 - 描述需要从视频中解码哪些帧以及如何打包"""
+    
+    frame_indices: np.ndarray
+    packing_nums: int
+    fps: float
+    duration: float
+    total_frames: int
 
 
 class VideoEncoder:
     """视频帧采样和3D重采样器 - 完整实现"""
     
-    def __init__(self, max_frames: int = 180, max_packing: int = 3, time_scale: float = 0.1):
+    # 每次从decord解码的帧数，限制解码时的临时内存
+    DECODE_CHUNK_SIZE = 32
+    
+    def __init__(self, max_frames: int = 180, max_packing: int = 3, time_scale: float = 0.1,
+                 frame_cache_bytes: int = 0,
+                 synthetic_resolution: Tuple[int, int] = (1280, 720),
+                 readahead: Optional[str] = None):
         """
         初始化视频编码器
         
@@ -23,15 +46,35 @@ class VideoEncoder:
             max_frames: 打包后接收的最大帧数，实际最大有效帧数为 MAX_NUM_FRAMES * MAX_NUM_PACKING
             max_packing: 最大打包数量，有效范围1-6，用于视频帧的3D压缩
             time_scale: 时间缩放因子，用于时序ID计算
+            frame_cache_bytes: 解码帧缓存的最大字节数，默认0（禁用，不额外占用内存）；
+                               同一视频反复调整fps/打包参数时可开启，如 512 * 1024**2
+            synthetic_resolution: 合成预热视频的参考分辨率 (width, height)，只决定synthetic_video
+                                  生成帧的宽高比，不影响真实视频的解码和帧缓冲池
+            readahead: 解码前的预读策略（'auto'/'fadvise'/'thread'），None表示不预读，适用于网络存储
         """
         self.MAX_NUM_FRAMES = max_frames
         self.MAX_NUM_PACKING = max_packing
         self.TIME_SCALE = time_scale
         
+        # 解码帧缓存，调整fps/打包参数后只需解码缺失的帧
+        self.frame_cache = FrameCache(max_bytes=frame_cache_bytes)
+        self.last_cache_stats: Dict[str, Any] = {}
+        
+        # 解码帧缓冲池，复用大块缓冲区，避免每次编码重新分配（按需分配，只保留峰值大小）
+        self.buffer_pool = FrameBufferPool()
+        
+        # 慢速存储上的预读策略
+        self.readahead = readahead
+        self.last_readahead_stats: Dict[str, Any] = {}
+        
+        # 合成预热视频的参考分辨率
+        self.synthetic_resolution = tuple(synthetic_resolution)
+        
         print(f"3D重采样器已初始化:")
         print(f"  - 最大帧数: {max_frames}")
         print(f"  - 最大打包数: {max_packing}")
         print(f"  - 时间缩放: {time_scale}")
+        print(f"  - 解码帧缓存: {f'{frame_cache_bytes / 1024**2:.0f} MB' if frame_cache_bytes > 0 else '禁用'}")
     
     def uniform_sample(self, frame_list: List, target_count: int) -> List:
         """
@@ -76,8 +119,172 @@ class VideoEncoder:
         """
         return [arr[i:i+size] for i in range(0, len(arr), size)]
     
+    def plan_frames(self, total_frames: int, fps: float, choose_fps: int = 3,
+                    force_packing: Optional[int] = None) -> FramePlan:
+        """
+        根据视频时长和采样帧率计算帧采样计划
+        
+        Args:
+            total_frames: 视频总帧数
+            fps: 视频原始帧率
+            choose_fps: 采样帧率
+            force_packing: 强制打包数量（可选）
+            
+        Returns:
+            帧采样计划
+        """
+        video_duration = total_frames / fps
+        
+        # 根据视频时长和采样帧率动态计算打包参数
+        if choose_fps * int(video_duration) <= self.MAX_NUM_FRAMES:
+            # 短视频，不需要打包
+            packing_nums = 1
+            choose_frames = round(min(choose_fps, round(fps)) * min(self.MAX_NUM_FRAMES, video_duration))
+        else:
+            # 长视频，需要计算打包数量
+            packing_nums = math.ceil(video_duration * choose_fps / self.MAX_NUM_FRAMES)
+            if packing_nums <= self.MAX_NUM_PACKING:
+                choose_frames = round(video_duration * choose_fps)
+            else:
+                choose_frames = round(self.MAX_NUM_FRAMES * self.MAX_NUM_PACKING)
+                packing_nums = self.MAX_NUM_PACKING
+        
+        # 如果强制指定打包数量
+        if force_packing:
+            packing_nums = min(force_packing, self.MAX_NUM_PACKING)
+            print(f"强制打包数量: {packing_nums}")
+        
+        # 均匀采样帧索引
+        frame_idx = [i for i in range(0, total_frames)]
+        frame_idx = np.array(self.uniform_sample(frame_idx, choose_frames))
+        
+        return FramePlan(
+            frame_indices=frame_idx,
+            packing_nums=packing_nums,
+            fps=fps,
+            duration=video_duration,
+            total_frames=total_frames
+        )
+    
+    def decode_frames(self, vr: VideoReader, fingerprint: str, frame_indices: np.ndarray,
+                      resolution: Tuple[int, int] = NATIVE_RESOLUTION) -> FrameBuffer:
+        """
+        解码指定帧，优先从解码帧缓存中读取，结果直接写入缓冲池中的缓冲区
+        
+        Args:
+            vr: 视频读取器
+            fingerprint: 视频指纹
+            frame_indices: 需要的帧索引
+            resolution: 解码分辨率
+            
+        Returns:
+            帧缓冲区，array形状为 (N, H, W, 3)，使用完毕后需调用release()归还
+        """
+        indices = [int(i) for i in frame_indices]
+        cached, missing = self.frame_cache.lookup(fingerprint, indices, resolution)
+        
+        # 帧索引 -> 在输出中的位置（均匀采样可能产生重复索引）
+        positions: Dict[int, List[int]] = {}
+        for pos, idx in enumerate(indices):
+            positions.setdefault(idx, []).append(pos)
+        
+        buffer: Optional[FrameBuffer] = None
+        
+        def write(idx: int, frame: np.ndarray):
+            nonlocal buffer
+            if buffer is None:
+                buffer = self.buffer_pool.acquire(len(indices), frame.shape[0], frame.shape[1])
+            for pos in positions[idx]:
+                buffer.array[pos] = frame
+        
+        try:
+            for idx, frame in cached.items():
+                write(idx, frame)
+            
+            # 分块解码缺失的帧，临时内存只占一个块的大小
+            for start in range(0, len(missing), self.DECODE_CHUNK_SIZE):
+                chunk = missing[start:start + self.DECODE_CHUNK_SIZE]
+                chunk_frames = vr.get_batch(chunk).asnumpy()
+                self.frame_cache.store(fingerprint, chunk, chunk_frames, resolution)
+                for idx, frame in zip(chunk, chunk_frames):
+                    write(idx, frame)
+        except Exception:
+            if buffer is not None:
+                buffer.release()
+            raise
+        
+        hit_ratio = len(cached) / len(indices) if indices else 0.0
+        self.last_cache_stats = {
+            'requested': len(indices),
+            'hits': len(cached),
+            'decoded': len(missing),
+            'hit_ratio': hit_ratio,
+        }
+        print(f"解码帧缓存: 命中 {len(cached)}/{len(indices)} ({hit_ratio:.1%})，解码 {len(missing)} 帧")
+        
+        if buffer is None:
+            buffer = self.buffer_pool.acquire(0, 0, 0)
+        return buffer
+    
+    def _open_reader(self, video_path: str, resolution: Tuple[int, int]) -> VideoReader:
+        """
+        打开视频读取器；启用预读时先预读文件头尾的容器元数据和索引，
+        覆盖VideoReader初始化时同步读取它们的I/O等待
+        
+        Args:
+            video_path: 视频文件路径
+            resolution: 解码分辨率
+            
+        Returns:
+            视频读取器
+        """
+        header = None
+        if self.readahead:
+            try:
+                header = FrameReadahead.container(video_path, strategy=self.readahead).start()
+            except Exception as e:
+                print(f"启动容器预读失败，直接打开视频: {e}")
+        
+        try:
+            return VideoReader(video_path, ctx=cpu(0), width=resolution[0], height=resolution[1])
+        finally:
+            if header is not None:
+                header.stop()
+                self.last_readahead_stats = {'header_bytes_prefetched': header.stats()['bytes_prefetched']}
+    
+    def _start_readahead(self, video_path: str, fingerprint: str, plan: FramePlan,
+                         resolution: Tuple[int, int]) -> Optional[FrameReadahead]:
+        """
+        为缓存中缺失的帧启动预读
+        
+        Args:
+            video_path: 视频文件路径
+            fingerprint: 视频指纹
+            plan: 帧采样计划
+            resolution: 解码分辨率
+            
+        Returns:
+            已启动的预读器，未启用预读或无需解码时返回None
+        """
+        if not self.readahead:
+            return None
+        
+        missing = self.frame_cache.missing_indices(fingerprint, plan.frame_indices.tolist(), resolution)
+        if not missing:
+            return None
+        
+        try:
+            return FrameReadahead(
+                video_path, missing, plan.total_frames, plan.fps, strategy=self.readahead
+            ).start()
+        except Exception as e:
+            print(f"启动预读失败，直接解码: {e}")
+            return None
+    
     def encode_video(self, video_path: str, choose_fps: int = 3, 
-                    force_packing: Optional[int] = None) -> Tuple[List[Image.Image], List[List[int]]]:
+                    force_packing: Optional[int] = None,
+                    decode_size: Optional[Tuple[int, int]] = None,
+                    plan: Optional[FramePlan] = None) -> Tuple[List[Image.Image], List[List[int]]]:
         """
         将视频编码为帧序列和temporal_ids，实现3D重采样器功能
         3D重采样器通过将多帧组织为两个对应序列：
@@ -88,54 +295,35 @@ class VideoEncoder:
             video_path: 视频文件路径
             choose_fps: 采样帧率，控制从视频中提取帧的频率
             force_packing: 强制打包数量（可选），可以强制启用3D打包
+            decode_size: 解码分辨率 (width, height)（可选），默认为原始分辨率
+            plan: 已按该视频计算好的帧采样计划（可选），提供时不再重新计算
             
         Returns:
             Tuple[frames, temporal_ids]: 
-                - frames: PIL图像帧列表
+                - frames: PIL图像帧列表（EncodedFrames，附带用作缓存键的指纹）
                 - temporal_ids: 时序ID分组列表，用于3D重采样器
         """
         try:
             # 使用decord读取视频
-            vr = VideoReader(video_path, ctx=cpu(0))
+            resolution = tuple(decode_size) if decode_size else NATIVE_RESOLUTION
+            self.last_readahead_stats = {}
+            vr = self._open_reader(video_path, resolution)
             fps = vr.get_avg_fps()
-            video_duration = len(vr) / fps
+            
+            if plan is None:
+                plan = self.plan_frames(len(vr), fps, choose_fps=choose_fps, force_packing=force_packing)
+            frame_idx = plan.frame_indices
+            packing_nums = plan.packing_nums
+            video_duration = plan.duration
             
             print(f"视频路径: {video_path}")
             print(f"视频时长: {video_duration:.2f}秒")
             print(f"原始FPS: {fps:.2f}")
             print(f"总帧数: {len(vr)}")
-            
-            # 根据视频时长和采样帧率动态计算打包参数
-            if choose_fps * int(video_duration) <= self.MAX_NUM_FRAMES:
-                # 短视频，不需要打包
-                packing_nums = 1
-                choose_frames = round(min(choose_fps, round(fps)) * min(self.MAX_NUM_FRAMES, video_duration))
-            else:
-                # 长视频，需要计算打包数量
-                packing_nums = math.ceil(video_duration * choose_fps / self.MAX_NUM_FRAMES)
-                if packing_nums <= self.MAX_NUM_PACKING:
-                    choose_frames = round(video_duration * choose_fps)
-                else:
-                    choose_frames = round(self.MAX_NUM_FRAMES * self.MAX_NUM_PACKING)
-                    packing_nums = self.MAX_NUM_PACKING
-            
-            # 如果强制指定打包数量
-            if force_packing:
-                packing_nums = min(force_packing, self.MAX_NUM_PACKING)
-                print(f"强制打包数量: {packing_nums}")
-            
-            print(f"选择帧数: {choose_frames}")
+            print(f"选择帧数: {len(frame_idx)}")
             print(f"打包数量: {packing_nums}")
-            
-            # 均匀采样帧索引
-            frame_idx = [i for i in range(0, len(vr))]
-            frame_idx = np.array(self.uniform_sample(frame_idx, choose_frames))
-            
             print(f"获取视频帧={len(frame_idx)}, 打包数={packing_nums}")
             
-            # 获取视频帧数据
-            frames = vr.get_batch(frame_idx).asnumpy()
-            
             # 计算时序ID，这是3D重采样器的关键部分
             frame_idx_ts = frame_idx / fps  # 将帧索引转换为时间戳
             scale = np.arange(0, video_duration, self.TIME_SCALE)  # 创建时间刻度
@@ -144,11 +332,27 @@ class VideoEncoder:
             frame_ts_id = self.map_to_nearest_scale(frame_idx_ts, scale) / self.TIME_SCALE
             frame_ts_id = frame_ts_id.astype(np.int32)
             
-            # 验证数据一致性
-            assert len(frames) == len(frame_ts_id), f"帧数({len(frames)})与时序ID数量({len(frame_ts_id)})不匹配"
-            
-            # 转换为PIL图像格式
-            frames_pil = [Image.fromarray(v.astype('uint8')).convert('RGB') for v in frames]
+            # 获取视频帧数据（已解码过的帧直接从缓存读取，写入复用的缓冲区）
+            fingerprint = video_fingerprint(video_path)
+            readahead = self._start_readahead(video_path, fingerprint, plan, resolution)
+            try:
+                frame_buffer = self.decode_frames(vr, fingerprint, frame_idx, resolution)
+            finally:
+                if readahead is not None:
+                    readahead.stop()
+                    self.last_readahead_stats.update(readahead.stats())
+                    print(f"预读: {self.last_readahead_stats['bytes_prefetched'] / 1024**2:.1f} MB, "
+                          f"{self.last_readahead_stats['ranges']} 个范围")
+            try:
+                frames = frame_buffer.array
+                
+                # 验证数据一致性
+                assert len(frames) == len(frame_ts_id), f"帧数({len(frames)})与时序ID数量({len(frame_ts_id)})不匹配"
+                
+                # 转换为PIL图像格式（PIL会复制像素数据，转换完成后即可归还缓冲区）
+                frames_pil = [Image.fromarray(v) for v in frames]
+            finally:
+                frame_buffer.release()
             
             # 将时序ID按打包数量分组，这是3D重采样器的核心功能
             frame_ts_id_group = self.group_array(frame_ts_id.tolist(), packing_nums)
@@ -162,12 +366,49 @@ class VideoEncoder:
             if frame_ts_id_group:
                 print(f"  - 第一个时序组: {frame_ts_id_group[0]}")
             
+            # 视觉特征等缓存的键由视频文件指纹和采样参数得到，提问时不需要再哈希像素
+            frames_pil = EncodedFrames(frames_pil, derive_fingerprint(
+                fingerprint, frame_idx.tolist(), packing_nums, resolution, self.TIME_SCALE
+            ))
             return frames_pil, frame_ts_id_group
             
         except Exception as e:
             print(f"视频编码错误: {str(e)}")
             raise
     
+    def synthetic_video(self, num_frames: Optional[int] = None, packing_nums: Optional[int] = None,
+                        choose_fps: int = 3, num_distinct: int = 8) -> Tuple[List[Image.Image], List[List[int]]]:
+        """
+        生成与encode_video输出形状一致的合成视频（用于模型预热）
+        
+        帧的宽高比与synthetic_resolution相同，面积约为448x448（处理器会缩放到相同的切片尺寸）；
+        只生成num_distinct张不同的帧循环使用，避免长视频预热占用大量内存
+        
+        Args:
+            num_frames: 帧数，默认为 MAX_NUM_FRAMES * MAX_NUM_PACKING
+            packing_nums: 打包数量，默认为MAX_NUM_PACKING
+            choose_fps: 计算时序ID使用的采样帧率
+            num_distinct: 不同帧的数量
+            
+        Returns:
+            Tuple[frames, temporal_ids]
+        """
+        packing_nums = packing_nums or self.MAX_NUM_PACKING
+        num_frames = num_frames or self.MAX_NUM_FRAMES * packing_nums
+        
+        width, height = self.synthetic_resolution
+        ratio = math.sqrt(width / height)
+        size = (max(int(448 * ratio), 14), max(int(448 / ratio), 14))
+        
+        rng = np.random.default_rng(0)
+        distinct = [Image.fromarray(rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8))
+                    for _ in range(min(num_distinct, num_frames))]
+        frames = [distinct[i % len(distinct)] for i in range(num_frames)]
+        
+        # 与encode_video相同：按采样时间戳映射到时间刻度
+        frame_ts_id = (np.arange(num_frames) / choose_fps / self.TIME_SCALE).astype(np.int32)
+        return frames, self.group_array(frame_ts_id.tolist(), packing_nums)
+    
     def get_video_info(self, video_path: str) -> dict:
         """
         获取视频基本信息
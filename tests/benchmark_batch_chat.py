@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+批量问答吞吐基准测试
+对同一视频的多个问题，对比逐个顺序推理与共享视频前缀的微批次推理的吞吐
+
+运行方式: python -m tests.benchmark_batch_chat <视频路径> [--batch-size 4]
+"""
+
+import argparse
+import time
+
+from .test_utils import setup_test_environment, setup_project_path, print_separator
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+DEFAULT_QUESTIONS = [
+    "描述这个视频的主要内容",
+    "视频中有多少个人？",
+    "视频发生在什么场景？",
+    "分析视频中人物的情绪",
+    "视频中出现了哪些物体？",
+    "视频传达了什么信息？",
+    "视频的色调是怎样的？",
+    "视频最后发生了什么？",
+]
+
+
+def run_benchmark(video_path: str, questions=None, batch_size: int = 4, fps: int = 5):
+    """运行批量问答吞吐基准测试"""
+    from src.chat_with_video.video_chat_interface import VideoChatInterface
+    
+    questions = questions or DEFAULT_QUESTIONS
+    
+    print_separator("💬 批量问答吞吐基准测试")
+    print(f"视频: {video_path}")
+    print(f"问题数: {len(questions)}, 批大小: {batch_size}")
+    
+    chat_interface = VideoChatInterface()
+    
+    results = {}
+    for label, max_batch_size in (("顺序推理", 1), (f"微批次推理 (batch={batch_size})", batch_size)):
+        # 每轮都从空的解码帧/视觉特征/前缀KV缓存开始，后一轮不沾前一轮解码的帧
+        chat_interface.video_encoder.frame_cache.clear()
+        chat_interface.inference_engine.clear_feature_cache()
+        
+        start = time.time()
+        answers = chat_interface.batch_chat_with_video(
+            video_path, questions, fps=fps, max_batch_size=max_batch_size
+        )
+        elapsed = time.time() - start
+        
+        failed = len([a for _, a in answers if a.startswith('处理失败') or a.startswith('批量处理失败')])
+        results[label] = elapsed
+        print(f"  {label}: {elapsed:.2f}秒, {len(questions) / elapsed:.3f} 问题/秒, 失败 {failed} 个")
+    
+    sequential, batched = results.values()
+    print(f"\n✅ 吞吐提升: {sequential / batched:.2f}x")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量问答吞吐基准测试")
+    parser.add_argument("video", help="视频文件路径")
+    parser.add_argument("--batch-size", type=int, default=4, help="微批次大小")
+    parser.add_argument("--fps", type=int, default=5, help="采样帧率")
+    args = parser.parse_args()
+    
+    run_benchmark(args.video, batch_size=args.batch_size, fps=args.fps)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+编译执行模式基准测试
+使用CPU上随机初始化的小型视觉编码器和语言模型，按64/128/192帧视频请求的形状
+（视觉编码批次 + 视觉token与问题组成的预填充 + 解码），对比eager与分桶编译的端到端延迟
+
+运行方式: python -m tests.benchmark_compile [--frames 64 128 192] [--new-tokens 32] [--backend inductor]
+"""
+
+import argparse
+import math
+import time
+
+from .test_utils import setup_test_environment, setup_project_path, print_separator
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+PATCHES_PER_FRAME = 64
+TOKENS_PER_GROUP = 64
+QUESTION_TOKENS = 32
+
+
+def build_fake_model(hidden_size: int = 256, num_layers: int = 4, vision_batch_size: int = 16):
+    """构造包含视觉编码器（vpm）和语言模型（llm）的小模型"""
+    from types import SimpleNamespace
+    
+    import torch
+    import torch.nn as nn
+    from transformers import LlamaConfig, LlamaForCausalLM
+    
+    torch.manual_seed(0)
+    
+    class FakeVisionEncoder(nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.patch_embed = nn.Linear(3 * 14 * 14, 128)
+            layer = nn.TransformerEncoderLayer(128, nhead=4, dim_feedforward=256, batch_first=True)
+            self.encoder = nn.TransformerEncoder(layer, num_layers=2)
+        
+        def forward(self, pixel_values):
+            return self.encoder(self.patch_embed(pixel_values))
+    
+    class FakeMiniCPMV(nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.config = SimpleNamespace(vision_batch_size=vision_batch_size)
+            self.vpm = FakeVisionEncoder()
+            self.llm = LlamaForCausalLM(LlamaConfig(
+                vocab_size=4000, hidden_size=hidden_size, intermediate_size=hidden_size * 3,
+                num_hidden_layers=num_layers, num_attention_heads=8, num_key_value_heads=8,
+                max_position_embeddings=16384,
+            ))
+    
+    return FakeMiniCPMV().eval()
+
+
+def run_request(model, num_frames: int, new_tokens: int, max_packing: int = 3):
+    """
+    模拟一次视频问答：视觉编码器按批编码所有帧，打包后的视觉token与问题一起预填充，然后贪心解码
+    
+    Returns:
+        (生成的token, 耗时秒数)
+    """
+    import torch
+    
+    generator = torch.Generator().manual_seed(num_frames)
+    frames = torch.randn(num_frames, PATCHES_PER_FRAME, 3 * 14 * 14, generator=generator)
+    groups = math.ceil(num_frames / max_packing)
+    question = torch.randint(3, model.llm.config.vocab_size, (1, QUESTION_TOKENS), generator=generator)
+    
+    start = time.time()
+    with torch.inference_mode():
+        batch = model.config.vision_batch_size
+        for i in range(0, num_frames, batch):
+            model.vpm(frames[i:i + batch])
+        
+        embed = model.llm.get_input_embeddings()
+        visual = torch.randn(1, groups * TOKENS_PER_GROUP, embed.weight.shape[1], generator=generator)
+        inputs_embeds = torch.cat([visual, embed(question)], dim=1)
+        output = model.llm.generate(inputs_embeds=inputs_embeds, max_new_tokens=new_tokens,
+                                    min_new_tokens=new_tokens, do_sample=False, pad_token_id=0)
+    return output[0].tolist(), time.time() - start
+
+
+def run_benchmark(frame_counts=(64, 128, 192), new_tokens: int = 32, backend: str = 'inductor',
+                  hidden_size: int = 256, num_layers: int = 4, repeats: int = 2):
+    """运行eager与编译模式的对比"""
+    from src.chat_with_video.compiled_execution import CompiledExecution, bucket_size
+    
+    print_separator("⚡ 编译执行模式基准测试 (CPU小模型)")
+    model = build_fake_model(hidden_size, num_layers)
+    prompt_lengths = {f: math.ceil(f / 3) * TOKENS_PER_GROUP + QUESTION_TOKENS for f in frame_counts}
+    print(f"后端: {backend}, 生成token数: {new_tokens}, 隐藏层维度: {hidden_size}, 层数: {num_layers}")
+    
+    eager = {}
+    for frames in frame_counts:
+        run_request(model, frames, new_tokens)
+        timings = [run_request(model, frames, new_tokens) for _ in range(repeats)]
+        eager[frames] = (timings[0][0], min(t for _, t in timings))
+    
+    compiled_execution = CompiledExecution(model, backend=backend)
+    compiled_execution.apply()
+    buckets = sorted({bucket_size(n, compiled_execution.prompt_buckets) for n in prompt_lengths.values()})
+    start = time.time()
+    compiled_execution.warm_up(buckets)
+    for frames in frame_counts:
+        # 视觉编码器的各批大小在第一次请求时编译
+        run_request(model, frames, new_tokens)
+    warm_up_seconds = time.time() - start
+    
+    results = {}
+    for frames in frame_counts:
+        timings = [run_request(model, frames, new_tokens) for _ in range(repeats)]
+        tokens, eager_seconds = eager[frames]
+        compiled_seconds = min(t for _, t in timings)
+        results[frames] = {
+            'prompt_tokens': prompt_lengths[frames],
+            'bucket': bucket_size(prompt_lengths[frames], compiled_execution.prompt_buckets),
+            'eager_ms': eager_seconds * 1000,
+            'compiled_ms': compiled_seconds * 1000,
+            'speedup': eager_seconds / compiled_seconds,
+            'matches_eager': timings[0][0] == tokens,
+        }
+        r = results[frames]
+        print(f"  {frames}帧 (提示 {r['prompt_tokens']} → 桶 {r['bucket']}): eager {r['eager_ms']:.0f}ms, "
+              f"编译 {r['compiled_ms']:.0f}ms, 加速 {r['speedup']:.2f}x, 结果一致: {r['matches_eager']}")
+    
+    print(f"编译预热耗时: {warm_up_seconds:.1f}s, 各桶调用: {compiled_execution.stats['prefill_bucket_calls']}")
+    compiled_execution.remove()
+    return results
+
+
+def test_compiled_matches_eager():
+    """分桶编译后的生成结果与eager一致（使用eager后端只验证分桶逻辑）"""
+    results = run_benchmark(frame_counts=(8, 20), new_tokens=4, backend='eager',
+                            hidden_size=64, num_layers=2, repeats=1)
+    for result in results.values():
+        assert result['matches_eager']
+        assert result['bucket'] >= result['prompt_tokens']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="编译执行模式基准测试")
+    parser.add_argument("--frames", type=int, nargs='+', default=[64, 128, 192], help="每个请求的帧数")
+    parser.add_argument("--new-tokens", type=int, default=32, help="生成token数")
+    parser.add_argument("--backend", default='inductor', help="torch.compile后端")
+    parser.add_argument("--hidden-size", type=int, default=256, help="模型隐藏层维度")
+    parser.add_argument("--layers", type=int, default=4, help="模型层数")
+    args = parser.parse_args()
+    
+    run_benchmark(tuple(args.frames), args.new_tokens, args.backend, args.hidden_size, args.layers)
+
+
+if __name__ == "__main__":
+    main()
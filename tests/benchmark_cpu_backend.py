@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+CPU推理后端基准测试
+使用CPU上随机初始化的小型语言模型，对比fp32、bf16和fp32+动态int8量化三种配置的
+预填充延迟和解码吞吐（tokens/s）
+
+运行方式: python -m tests.benchmark_cpu_backend [--threads N] [--prompt-len 256] [--new-tokens 64]
+"""
+
+import argparse
+import copy
+import time
+
+from .test_utils import setup_test_environment, setup_project_path, print_separator
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+def build_fake_llm(hidden_size: int = 512, num_layers: int = 4, vocab_size: int = 4000):
+    """构造随机初始化的小型因果语言模型"""
+    import torch
+    from transformers import LlamaConfig, LlamaForCausalLM
+    
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=vocab_size,
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 3,
+        num_hidden_layers=num_layers,
+        num_attention_heads=8,
+        num_key_value_heads=8,
+    )
+    return LlamaForCausalLM(config).eval()
+
+
+def prepare_configurations(llm):
+    """按CPU后端支持的配置准备模型副本"""
+    import torch
+    from src.chat_with_video.cpu_backend import cpu_supports_bf16, quantize_linear_dynamic
+    
+    configurations = {'fp32': copy.deepcopy(llm).float()}
+    
+    bf16 = copy.deepcopy(llm).to(torch.bfloat16)
+    label = 'bf16' if cpu_supports_bf16() else 'bf16 (CPU无原生bf16)'
+    configurations[label] = bf16
+    
+    int8 = copy.deepcopy(llm).float()
+    quantize_linear_dynamic(int8)
+    configurations['fp32 + 动态int8'] = int8
+    return configurations
+
+
+def measure(llm, prompt_len: int, new_tokens: int, repeats: int = 3):
+    """测量预填充延迟（取中位数）和解码吞吐"""
+    import torch
+    
+    generator = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(3, llm.config.vocab_size, (1, prompt_len), generator=generator)
+    
+    with torch.inference_mode():
+        # 预热
+        llm(input_ids=input_ids[:, :16])
+        
+        prefill = []
+        for _ in range(repeats):
+            start = time.time()
+            llm(input_ids=input_ids)
+            prefill.append(time.time() - start)
+        prefill_seconds = sorted(prefill)[len(prefill) // 2]
+        
+        start = time.time()
+        output = llm.generate(input_ids=input_ids, max_new_tokens=new_tokens, min_new_tokens=new_tokens,
+                              do_sample=False, pad_token_id=0)
+        generate_seconds = time.time() - start
+    
+    # 总耗时扣除一次预填充，得到解码阶段的吞吐
+    decode_seconds = max(generate_seconds - prefill_seconds, 1e-6)
+    generated = output.shape[1] - prompt_len
+    return {
+        'prefill_ms': prefill_seconds * 1000,
+        'tokens_per_second': (generated - 1) / decode_seconds,
+        'generated_tokens': generated,
+    }
+
+
+def run_benchmark(num_threads=None, prompt_len: int = 256, new_tokens: int = 64,
+                  hidden_size: int = 512, num_layers: int = 4):
+    """运行CPU推理后端基准测试"""
+    from src.chat_with_video.cpu_backend import configure_cpu_threads
+    
+    print_separator("🖥️ CPU推理后端基准测试 (CPU小模型)")
+    
+    threads = configure_cpu_threads(num_threads)
+    print(f"线程数: {threads['num_threads']}, 算子间线程数: {threads['interop_threads']}")
+    print(f"提示长度: {prompt_len}, 生成token数: {new_tokens}, 隐藏层维度: {hidden_size}, 层数: {num_layers}")
+    
+    llm = build_fake_llm(hidden_size=hidden_size, num_layers=num_layers)
+    
+    results = {}
+    for label, model in prepare_configurations(llm).items():
+        result = measure(model, prompt_len, new_tokens)
+        results[label] = result
+        print(f"  {label}: 预填充 {result['prefill_ms']:.1f}ms, 解码 {result['tokens_per_second']:.1f} tokens/s")
+    
+    return results
+
+
+def test_cpu_backend_configurations():
+    """每种配置都应能完成预填充和解码"""
+    results = run_benchmark(prompt_len=64, new_tokens=8, hidden_size=128, num_layers=2)
+    assert len(results) == 3
+    for result in results.values():
+        assert result['generated_tokens'] == 8
+        assert result['prefill_ms'] > 0
+        assert result['tokens_per_second'] > 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU推理后端基准测试")
+    parser.add_argument("--threads", type=int, default=None, help="算子内线程数（默认为物理核数）")
+    parser.add_argument("--prompt-len", type=int, default=256, help="提示长度")
+    parser.add_argument("--new-tokens", type=int, default=64, help="生成token数")
+    parser.add_argument("--hidden-size", type=int, default=512, help="模型隐藏层维度")
+    parser.add_argument("--layers", type=int, default=4, help="模型层数")
+    args = parser.parse_args()
+    
+    run_benchmark(args.threads, args.prompt_len, args.new_tokens, args.hidden_size, args.layers)
+
+
+if __name__ == "__main__":
+    main()
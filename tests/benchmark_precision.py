@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+推理精度基准测试
+在当前机器的推理设备（XPU可用时为XPU，否则为CPU）上逐个对比 fp32 / bf16 / fp16 / int8-dynamic / int4
+的权重内存占用、预填充延迟（ms/token）和解码吞吐（tokens/s）；当前设备不支持的精度给出原因。
+默认使用随机初始化的小型语言模型，--model 指定路径时按各精度加载MiniCPM-V并测量其语言模型
+
+运行方式: python -m tests.benchmark_precision [--model PATH] [--prompt-len 256] [--new-tokens 64]
+"""
+
+import argparse
+import copy
+import gc
+import tempfile
+import time
+
+from .test_utils import setup_test_environment, setup_project_path, print_separator
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+def current_device() -> str:
+    """当前机器的推理设备"""
+    import torch
+    try:
+        return 'xpu' if torch.xpu.is_available() else 'cpu'
+    except Exception:
+        return 'cpu'
+
+
+def _synchronize(device: str):
+    import torch
+    if device == 'xpu':
+        torch.xpu.synchronize()
+
+
+def prepare_synthetic(llm, mode, device: str):
+    """按精度模式准备小型语言模型的副本"""
+    from src.chat_with_video.cpu_backend import quantize_linear_dynamic
+    
+    if mode.quantization == 'int8-dynamic':
+        model = copy.deepcopy(llm).float()
+        quantize_linear_dynamic(model)
+        return model
+    
+    if mode.quantization == 'int4':
+        # 小模型没有int4检查点，保存后用bitsandbytes按4bit加载
+        from transformers import AutoModelForCausalLM, BitsAndBytesConfig
+        
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            llm.save_pretrained(checkpoint_dir)
+            return AutoModelForCausalLM.from_pretrained(
+                checkpoint_dir,
+                torch_dtype=mode.dtype,
+                quantization_config=BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_compute_dtype=mode.dtype),
+                device_map={'': device},
+            ).eval()
+    
+    return copy.deepcopy(llm).to(device=device, dtype=mode.dtype)
+
+
+def measure(llm, device: str, prompt_len: int, new_tokens: int, repeats: int = 3):
+    """测量预填充延迟（取中位数）和解码吞吐"""
+    import torch
+    
+    generator = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(3, llm.config.vocab_size, (1, prompt_len), generator=generator).to(device)
+    
+    with torch.inference_mode():
+        # 预热
+        llm(input_ids=input_ids[:, :16])
+        _synchronize(device)
+        
+        prefill = []
+        for _ in range(repeats):
+            start = time.time()
+            llm(input_ids=input_ids)
+            _synchronize(device)
+            prefill.append(time.time() - start)
+        prefill_seconds = sorted(prefill)[len(prefill) // 2]
+        
+        start = time.time()
+        output = llm.generate(input_ids=input_ids, max_new_tokens=new_tokens, min_new_tokens=new_tokens,
+                              do_sample=False, pad_token_id=0)
+        _synchronize(device)
+        generate_seconds = time.time() - start
+    
+    # 总耗时扣除一次预填充，得到解码阶段的吞吐
+    decode_seconds = max(generate_seconds - prefill_seconds, 1e-6)
+    generated = output.shape[1] - prompt_len
+    return {
+        'prefill_ms_per_token': prefill_seconds * 1000 / prompt_len,
+        'tokens_per_second': (generated - 1) / decode_seconds,
+        'generated_tokens': generated,
+    }
+
+
+def run_benchmark(model_path=None, prompt_len: int = 256, new_tokens: int = 64,
+                  hidden_size: int = 512, num_layers: int = 4, modes=None):
+    """
+    运行推理精度基准测试
+    
+    Returns:
+        精度名称 -> 测量结果（不支持时为 {'error': 原因}）
+    """
+    from src.chat_with_video.precision import PRECISION_MODES, module_nbytes, resolve_precision
+    
+    device = current_device()
+    print_separator(f"🎯 推理精度基准测试 ({device.upper()}, {model_path or 'CPU小模型'})")
+    print(f"提示长度: {prompt_len}, 生成token数: {new_tokens}")
+    
+    llm = None
+    if model_path is None:
+        from .benchmark_cpu_backend import build_fake_llm
+        llm = build_fake_llm(hidden_size=hidden_size, num_layers=num_layers)
+        print(f"隐藏层维度: {hidden_size}, 层数: {num_layers}")
+    
+    results = {}
+    for name in modes or PRECISION_MODES:
+        engine = model = None
+        try:
+            mode = resolve_precision(name, device)
+            if model_path is None:
+                model = prepare_synthetic(llm, mode, device)
+                llm_under_test = model
+            else:
+                from src.chat_with_video.model_loader import MiniCPMVInference
+                engine = MiniCPMVInference(model_path, device=device, precision=name,
+                                           memory_idle_seconds=None)
+                engine.initialize()
+                model, llm_under_test = engine.model, engine.model.llm
+            
+            result = {'memory_mb': module_nbytes(model) / 1024**2,
+                      **measure(llm_under_test, device, prompt_len, new_tokens)}
+            print(f"  {name:<13} 内存 {result['memory_mb']:8.1f} MB, "
+                  f"预填充 {result['prefill_ms_per_token']:.3f} ms/token, "
+                  f"解码 {result['tokens_per_second']:.1f} tokens/s")
+        except Exception as e:
+            result = {'error': str(e)}
+            print(f"  {name:<13} 不支持: {e}")
+        finally:
+            if engine is not None:
+                engine.memory.shutdown()
+            del engine, model
+            gc.collect()
+        results[name] = result
+    
+    return results
+
+
+def test_precision_modes():
+    """所有精度模式都给出测量结果或不支持的原因；CPU上fp32和int8-dynamic总是可用"""
+    results = run_benchmark(prompt_len=32, new_tokens=8, hidden_size=128, num_layers=2)
+    assert set(results) == {'fp32', 'bf16', 'fp16', 'int8-dynamic', 'int4'}
+    for name, result in results.items():
+        if 'error' in result:
+            assert result['error']
+            continue
+        assert result['generated_tokens'] == 8
+        assert result['memory_mb'] > 0 and result['prefill_ms_per_token'] > 0
+        assert result['tokens_per_second'] > 0
+    
+    if current_device() == 'cpu':
+        assert 'error' not in results['fp32'] and 'error' not in results['int8-dynamic']
+        # int8权重约为fp32的1/4（嵌入层不量化）
+        assert results['int8-dynamic']['memory_mb'] < results['fp32']['memory_mb']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="推理精度基准测试")
+    parser.add_argument("--model", type=str, default=None,
+                        help="MiniCPM-V模型路径（默认使用随机初始化的小型语言模型）")
+    parser.add_argument("--modes", type=str, nargs='+', default=None,
+                        help="要测试的精度（默认全部: fp32 bf16 fp16 int8-dynamic int4）")
+    parser.add_argument("--prompt-len", type=int, default=256, help="提示长度")
+    parser.add_argument("--new-tokens", type=int, default=64, help="生成token数")
+    parser.add_argument("--hidden-size", type=int, default=512, help="小模型隐藏层维度")
+    parser.add_argument("--layers", type=int, default=4, help="小模型层数")
+    args = parser.parse_args()
+    
+    run_benchmark(args.model, args.prompt_len, args.new_tokens, args.hidden_size, args.layers, args.modes)
+
+
+if __name__ == "__main__":
+    main()
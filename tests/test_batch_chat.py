@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+批量问答测试
+用模仿MiniCPM-V chat接口的小型因果语言模型验证：同一视频上的多个问题按微批次共享视频前缀KV生成时，
+贪心解码的回答与逐个问题调用chat一致，视觉特征只计算一次
+
+运行方式: python -m pytest tests/test_batch_chat.py
+"""
+
+from .test_utils import setup_test_environment, setup_project_path
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+NUM_FRAMES = 24
+
+
+class IdTokenizer:
+    """把token ID解码为以空格分隔的数字"""
+    
+    eos_token_id = 2
+    
+    def decode(self, ids, skip_special_tokens=True):
+        return ' '.join(str(int(i)) for i in ids)
+
+
+class TinyVideoModel:
+    """
+    模仿MiniCPM-V chat接口的模型：帧经过“视觉编码”成为视频前缀嵌入，问题逐字符映射为token；
+    批量输入左填充后交给语言模型的generate
+    """
+    
+    def __init__(self, llm):
+        self.llm = llm
+        self.vision_calls = 0
+    
+    def get_vllm_embedding(self, data):
+        import torch
+        
+        vision_hidden_states = data.get('vision_hidden_states')
+        if vision_hidden_states is None:
+            self.vision_calls += 1
+            vision_hidden_states = [self.llm.get_input_embeddings()(torch.tensor(frames))
+                                    for frames in data['frames']]
+        embeddings = []
+        for states, question in zip(vision_hidden_states, data['questions']):
+            ids = torch.tensor([3 + ord(c) % 250 for c in question])
+            embeddings.append(torch.cat([states, self.llm.get_input_embeddings()(ids)]))
+        return embeddings, vision_hidden_states
+    
+    def chat(self, msgs, tokenizer, vision_hidden_states=None, max_new_tokens=16, do_sample=False, **kwargs):
+        import torch
+        
+        batched = isinstance(msgs[0], list)
+        samples = msgs if batched else [msgs]
+        contents = [sample[0]['content'] for sample in samples]
+        embeddings, _ = self.get_vllm_embedding({
+            'frames': [content[:-1] for content in contents],
+            'questions': [content[-1] for content in contents],
+            'vision_hidden_states': vision_hidden_states,
+        })
+        
+        # 左填充为批量输入
+        total = max(e.shape[0] for e in embeddings)
+        hidden = embeddings[0].shape[-1]
+        inputs_embeds = torch.zeros(len(embeddings), total, hidden)
+        attention_mask = torch.zeros(len(embeddings), total, dtype=torch.long)
+        for b, embedding in enumerate(embeddings):
+            inputs_embeds[b, total - embedding.shape[0]:] = embedding
+            attention_mask[b, total - embedding.shape[0]:] = 1
+        
+        output = self.llm.generate(inputs_embeds=inputs_embeds, attention_mask=attention_mask,
+                                   max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens,
+                                   do_sample=do_sample, pad_token_id=0)
+        answers = [tokenizer.decode(row) for row in output]
+        return answers if batched else answers[0]
+
+
+def _engine():
+    from .test_cancellation import build_llama
+    from src.chat_with_video.model_loader import MiniCPMVInference
+    
+    engine = MiniCPMVInference(device='cpu')
+    engine.model, engine.tokenizer, engine._initialized = TinyVideoModel(build_llama()), IdTokenizer(), True
+    return engine
+
+
+def test_batch_chat_matches_sequential_chat():
+    """共享视频前缀的微批次回答与逐个问题的贪心chat相同；视觉特征只编码一次，前缀KV被复用"""
+    frames = list(range(10, 10 + NUM_FRAMES))
+    questions = ["有几个人？", "视频发生在什么场景，天气怎么样？", "最后发生了什么", "颜色"]
+    msgs_list = [[{'role': 'user', 'content': frames + [q]}] for q in questions]
+    
+    expected = [_engine().chat(msgs, max_new_tokens=8, do_sample=False) for msgs in msgs_list]
+    
+    engine = _engine()
+    shared_prefix_batches = []
+    generate_shared_prefix = engine._generate_shared_prefix
+    
+    def record(original, key, kwargs):
+        shared_prefix_batches.append(kwargs['inputs_embeds'].shape[0])
+        return generate_shared_prefix(original, key, kwargs)
+    
+    engine._generate_shared_prefix = record
+    answers = engine.batch_chat(msgs_list, max_new_tokens=8, do_sample=False,
+                                cache_key='video', max_batch_size=3)
+    
+    assert answers == expected
+    assert all(not answer.truncated for answer in answers)
+    # 第一个问题单独推理并填充视觉特征缓存，其余三个问题组成一个共享前缀的微批次
+    assert shared_prefix_batches == [3]
+    assert engine.model.vision_calls == 1
+    assert engine.prefix_cache.stats()['hits'] >= 1
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+生成取消与截止时间测试
+验证取消令牌的父子传递和超时、HuggingFace generate在取消后的下一步停止，
+连续批处理调度器中被取消的请求返回截断结果而不影响同批的其他请求，
+直接流式推理在生成结束或被取消前一直持有模型锁，以及服务的流式请求各自记录耗时
+
+运行方式: python -m pytest tests/test_cancellation.py
+"""
+
+import threading
+import time
+
+from .test_utils import setup_test_environment, setup_project_path
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+class ByteTokenizer:
+    """把token ID映射为单个字符的简易分词器"""
+    
+    eos_token_id = 2
+    
+    def decode(self, ids, skip_special_tokens=True):
+        return ''.join(chr(97 + i % 26) for i in ids if i > 2)
+
+
+def build_llama():
+    """构造小型Llama因果语言模型"""
+    import torch
+    from transformers import LlamaConfig, LlamaForCausalLM
+    
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=300, hidden_size=64, intermediate_size=128,
+                         num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=4)
+    return LlamaForCausalLM(config).eval()
+
+
+def test_token_parent_and_deadline():
+    """父令牌取消传递给子令牌；超时后停止原因为'超时'，正常结束时停止原因为空"""
+    from src.chat_with_video.cancellation import CancellationToken, ChatResult
+    
+    parent = CancellationToken()
+    child = CancellationToken.for_request(parent, timeout=60)
+    assert CancellationToken.for_request(parent, None) is parent
+    assert child.check() is None and child.stop_reason is None
+    assert 0 < child.remaining() <= 60
+    
+    parent.cancel('用户停止')
+    assert child.cancelled
+    assert child.check() == '用户停止' and child.stop_reason == '用户停止'
+    
+    expired = CancellationToken(timeout=0.05)
+    assert expired.check() is None
+    time.sleep(0.1)
+    assert expired.check() == '超时'
+    assert not expired.cancelled
+    
+    result = ChatResult("部分回答", expired.stop_reason)
+    assert result == "部分回答" and result.truncated
+    assert not ChatResult("完整回答").truncated
+
+
+def test_generate_stops_on_cancel():
+    """生成过程中取消后，generate在下一个解码步停止"""
+    import torch
+    from transformers import StoppingCriteriaList
+    from src.chat_with_video.cancellation import CancellationToken, StopOnCancel
+    
+    llm = build_llama()
+    token = CancellationToken()
+    forward = llm.forward
+    calls = []
+    
+    def counting_forward(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 5:
+            token.cancel()
+        return forward(*args, **kwargs)
+    
+    llm.forward = counting_forward
+    inputs_embeds = torch.randn(1, 8, 64)
+    with torch.no_grad():
+        output = llm.generate(inputs_embeds=inputs_embeds, max_new_tokens=50, min_new_tokens=50,
+                              do_sample=False, pad_token_id=0,
+                              stopping_criteria=StoppingCriteriaList([StopOnCancel(token)]))
+    
+    assert output.shape[1] == 5
+    assert token.stop_reason == '已取消'
+
+
+def test_scheduler_drops_cancelled_request():
+    """调度器中被取消的请求以截断结果结束，同批其他请求正常生成到最大长度"""
+    import torch
+    from src.chat_with_video.cancellation import CancellationToken
+    from src.chat_with_video.inference_scheduler import (
+        ContinuousBatchScheduler, GenerationRequest, PreparedPrompt
+    )
+    
+    llm = build_llama()
+    scheduler = ContinuousBatchScheduler(llm, ByteTokenizer(), max_batch_size=4).start()
+    
+    def prepare(seed):
+        def fn():
+            generator = torch.Generator().manual_seed(seed)
+            return PreparedPrompt(torch.randn(1, 10, 64, generator=generator), eos_token_ids=[],
+                                  max_new_tokens=300, do_sample=False, repetition_penalty=1.0)
+        return fn
+    
+    try:
+        token = CancellationToken()
+        cancelled = scheduler.submit(GenerationRequest(prepare(0), token))
+        complete = scheduler.submit(GenerationRequest(prepare(1)))
+        
+        while cancelled.num_tokens < 3:
+            time.sleep(0.01)
+        token.cancel()
+        
+        partial = cancelled.result(timeout=30)
+        assert partial.truncated and partial.stop_reason == '已取消'
+        assert cancelled.num_tokens < 300
+        
+        full = complete.result(timeout=60)
+        assert not full.truncated and complete.num_tokens == 300
+        
+        # 排队期间已超时的请求不再预填充
+        expired = scheduler.submit(GenerationRequest(prepare(2), CancellationToken(timeout=0)))
+        assert expired.result(timeout=30) == "" and expired.result().stop_reason == '超时'
+        assert scheduler.stats()['cancelled'] == 2
+    finally:
+        scheduler.stop()
+
+
+class StreamingStub:
+    """stream=True时返回生成器的模型替身，第一段之后等待release再继续"""
+    
+    def __init__(self):
+        self.release = threading.Event()
+    
+    def get_vllm_embedding(self, data):
+        raise NotImplementedError
+    
+    def chat(self, msgs, tokenizer, stream=False, **kwargs):
+        def generate():
+            yield 'a'
+            self.release.wait(10)
+            yield 'b'
+        return generate()
+
+
+def _lock_is_free(lock) -> bool:
+    """在另一个线程中尝试获取可重入锁（当前线程可能已经持有）"""
+    result = []
+    
+    def probe():
+        acquired = lock.acquire(blocking=False)
+        if acquired:
+            lock.release()
+        result.append(acquired)
+    
+    thread = threading.Thread(target=probe)
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+def _wait_until(condition, timeout: float = 10) -> bool:
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_direct_stream_holds_model_lock():
+    """直接流式推理在生成线程结束前持有模型锁；在其他线程中继续读取或提前关闭都能正确释放"""
+    from src.chat_with_video.model_loader import MiniCPMVInference
+    
+    engine = MiniCPMVInference(device='cpu')
+    engine.model, engine.tokenizer, engine._initialized = StreamingStub(), object(), True
+    msgs = [{'role': 'user', 'content': ['hi']}]
+    
+    stream = engine.stream_chat(msgs, max_new_tokens=4)
+    assert next(stream) == 'a'
+    assert not _lock_is_free(engine._model_lock)
+    
+    # 像gradio一样在另一个线程中读取剩余部分
+    rest = []
+    reader = threading.Thread(target=lambda: rest.extend(stream))
+    reader.start()
+    engine.model.release.set()
+    reader.join(timeout=10)
+    assert rest == ['b']
+    assert _wait_until(lambda: _lock_is_free(engine._model_lock))
+    
+    # 调用方提前关闭时令牌被取消，生成线程结束后释放锁
+    engine.model = StreamingStub()
+    stream = engine.stream_chat(msgs, max_new_tokens=4)
+    assert next(stream) == 'a'
+    stream.close()
+    assert not _lock_is_free(engine._model_lock)
+    engine.model.release.set()
+    assert _wait_until(lambda: _lock_is_free(engine._model_lock))
+
+
+def test_service_stream_timings_per_request():
+    """交错进行的两个流式请求各自记录耗时和停止原因，互不覆盖"""
+    from PIL import Image
+    from src.chat_with_video.cancellation import CancellationToken
+    from src.chat_with_video.video_chat_service import VideoChatService
+    
+    class ChunkEngine:
+        def stream_chat(self, msgs, cancel_token=None, **kwargs):
+            for text in ('a', 'b', 'c'):
+                if cancel_token.check():
+                    return
+                yield text
+    
+    service = VideoChatService(device='cpu', oom_ladder=[])
+    service.inference_engine, service._initialized = ChunkEngine(), True
+    frames = [Image.new('RGB', (32, 32)) for _ in range(2)]
+    
+    first_timings, second_timings = {}, {}
+    token = CancellationToken()
+    first = service.stream_chat(frames, [[0], [1]], "第一个问题", cancel_token=token, timings=first_timings)
+    second = service.stream_chat(frames, [[0], [1]], "第二个问题", timings=second_timings)
+    
+    assert next(first) == 'a'
+    assert list(second) == ['a', 'b', 'c']
+    token.cancel('用户停止')
+    assert list(first) == []
+    
+    assert second_timings['chunks'] == 3 and second_timings['stop_reason'] is None
+    assert first_timings['chunks'] == 1 and first_timings['stop_reason'] == '用户停止'
+    assert not hasattr(service, 'last_timings')
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+编译执行模式测试
+用记录编译次数的后端验证：预热后预填充按桶只编译一次，复用前缀KV时前缀长度和问题长度变化
+不触发重新编译，编译后的输出与eager执行一致
+
+运行方式: python -m pytest tests/test_compiled_execution.py
+"""
+
+from .test_utils import setup_test_environment, setup_project_path
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+def _build_llm():
+    import torch
+    from transformers import LlamaConfig, LlamaForCausalLM
+    
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=100, hidden_size=32, intermediate_size=64,
+                         num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=4)
+    return LlamaForCausalLM(config).eval()
+
+
+def _request(llm, prefix, question):
+    """先预填充前缀并像前缀缓存复用时一样复制出前缀KV，再预填充问题并解码一步，返回各步的logits"""
+    import torch
+    from transformers import DynamicCache
+    from src.chat_with_video.prefix_cache import copy_prefix
+    
+    cache = DynamicCache()
+    outputs = []
+    with torch.no_grad():
+        if prefix is not None:
+            outputs.append(llm(inputs_embeds=prefix, past_key_values=cache, use_cache=True).logits)
+            cache = copy_prefix(cache, prefix.shape[1])
+        outputs.append(llm(inputs_embeds=question, past_key_values=cache, use_cache=True).logits)
+        next_token = outputs[-1][:, -1:].argmax(dim=-1)
+        outputs.append(llm(input_ids=next_token, past_key_values=cache, use_cache=True).logits)
+    return outputs
+
+
+def test_prefix_length_does_not_recompile():
+    """预热生成全部的图，之后不同的前缀长度不再编译；结果与eager一致"""
+    import torch
+    from src.chat_with_video.compiled_execution import CompiledExecution
+    
+    torch._dynamo.reset()
+    llm = _build_llm()
+    graphs = []
+    
+    def counting_backend(gm, example_inputs):
+        graphs.append(gm)
+        return gm.forward
+    
+    generator = torch.Generator().manual_seed(0)
+    requests = [(None, 6), (None, 9), (5, 6), (9, 4), (13, 7), (7, 6)]
+    inputs = [(torch.randn(1, prefix, 32, generator=generator) if prefix else None,
+               torch.randn(1, question, 32, generator=generator)) for prefix, question in requests]
+    expected = [_request(llm, *request) for request in inputs]
+    
+    compiled = CompiledExecution(llm, prompt_buckets=(16, 32), backend=counting_backend).apply()
+    try:
+        compiled.warm_up(buckets=[16])
+        warmed_up = len(graphs)
+        calls = compiled.stats['prefix_prefill_calls']
+        actual = [_request(llm, *request) for request in inputs]
+    finally:
+        compiled.remove()
+    
+    # 桶16的静态预填充图，以及单token解码（裁剪后和拼接后的KV布局各一个）和前缀之后预填充的动态图
+    assert warmed_up == 4
+    assert len(graphs) == warmed_up
+    assert compiled.stats['prefix_prefill_calls'] - calls == 4
+    for outputs, reference in zip(actual, expected):
+        for output, target in zip(outputs, reference):
+            assert torch.allclose(output, target, atol=1e-5)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+快速模型加载测试
+用一个保存为safetensors分片的小型Llama模型验证：分片列表、并行读取和内存映射读取的权重与原模型一致、
+在meta设备上构建并装配出的模型与原模型输出相同，以及检查点缺少或多出参数时加载失败
+
+运行方式: python -m pytest tests/test_fast_loader.py
+"""
+
+from .test_utils import setup_test_environment, setup_project_path
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+def _save_checkpoint(path, max_shard_size='40KB'):
+    """保存一个小型LlamaModel检查点（分成多个分片），返回原模型"""
+    import torch
+    from transformers import LlamaConfig, LlamaModel
+    
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=64, hidden_size=32, intermediate_size=64,
+                         num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=4)
+    model = LlamaModel(config).eval()
+    model.save_pretrained(str(path), safe_serialization=True, max_shard_size=max_shard_size)
+    return model
+
+
+def _rewrite_shard(path, edit):
+    """读出最后一个分片，修改其中的张量后写回"""
+    from safetensors.torch import load_file, save_file
+    from src.chat_with_video.fast_loader import checkpoint_shards
+    
+    shard = checkpoint_shards(str(path))[-1]
+    tensors = load_file(shard)
+    edit(tensors)
+    save_file(tensors, shard, metadata={'format': 'pt'})
+
+
+def test_shards_load_identically(tmp_path):
+    """并行读取和内存映射读取得到的state_dict与原模型相同，dtype按要求转换"""
+    import torch
+    from src.chat_with_video.fast_loader import (
+        checkpoint_shards, load_shards_mapped, load_shards_parallel, map_safetensors
+    )
+    
+    model = _save_checkpoint(tmp_path)
+    shards = checkpoint_shards(str(tmp_path))
+    assert len(shards) > 1
+    assert checkpoint_shards(str(tmp_path / 'missing')) == []
+    
+    expected = model.state_dict()
+    parallel = load_shards_parallel(shards, 'cpu', torch.float32, num_workers=2)
+    mapped = load_shards_mapped(shards, 'cpu', torch.float32)
+    for state_dict in (parallel, mapped):
+        assert set(state_dict) == set(expected)
+        assert all(torch.equal(state_dict[name], expected[name]) for name in expected)
+    
+    half = load_shards_parallel(shards, 'cpu', torch.float16)
+    assert all(tensor.dtype == torch.float16 for tensor in half.values())
+    
+    # 映射的张量与文件共享存储，不复制数据
+    tensors = map_safetensors(shards[0])
+    storages = {tensor.untyped_storage().data_ptr() for tensor in tensors.values()}
+    assert len(storages) == 1
+
+
+def test_fast_load_model_matches_original(tmp_path):
+    """在meta设备上构建并装配权重后，模型输出与原模型一致，没有参数留在meta设备上"""
+    import torch
+    from src.chat_with_video.fast_loader import LoadTimer, fast_load_model
+    
+    model = _save_checkpoint(tmp_path)
+    input_ids = torch.arange(10).unsqueeze(0)
+    
+    for mmap in (False, True):
+        timer = LoadTimer()
+        loaded = fast_load_model(str(tmp_path), 'cpu', torch.float32, timer=timer, mmap=mmap)
+        assert all(param.device.type == 'cpu' for param in loaded.parameters())
+        with torch.no_grad():
+            assert torch.allclose(loaded(input_ids).last_hidden_state,
+                                  model(input_ids).last_hidden_state, atol=1e-6)
+        assert '装配权重' in timer.phases
+
+
+def test_fast_load_model_rejects_mismatched_checkpoint(tmp_path):
+    """检查点多出模型中不存在的参数或缺少参数时加载失败，而不是静默忽略"""
+    import pytest
+    import torch
+    from src.chat_with_video.fast_loader import fast_load_model
+    
+    _save_checkpoint(tmp_path)
+    _rewrite_shard(tmp_path, lambda tensors: tensors.update({'layers.9.extra.weight': torch.zeros(4)}))
+    with pytest.raises(RuntimeError, match='不存在'):
+        fast_load_model(str(tmp_path), 'cpu', torch.float32)
+    
+    _save_checkpoint(tmp_path / 'missing')
+    _rewrite_shard(tmp_path / 'missing', lambda tensors: tensors.pop(sorted(tensors)[0]))
+    with pytest.raises(RuntimeError, match='缺少'):
+        fast_load_model(str(tmp_path / 'missing'), 'cpu', torch.float32)
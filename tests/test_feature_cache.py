@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+视觉特征缓存测试
+验证帧集合指纹覆盖每帧的完整像素（只差一个像素的视频不会共用缓存）、
+时序ID和额外参数参与指纹、视频编码得到的帧直接使用编码时的指纹（提问时不哈希像素），
+以及按字节数淘汰的LRU缓存
+
+运行方式: python -m pytest tests/test_feature_cache.py
+"""
+
+from .test_utils import setup_test_environment, setup_project_path
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+def _frames(count: int = 4, size=(64, 48)):
+    import numpy as np
+    from PIL import Image
+    
+    rng = np.random.default_rng(0)
+    return [Image.fromarray(rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)) for _ in range(count)]
+
+
+def test_fingerprint_covers_every_pixel():
+    """内容相同的帧集合指纹相同；任意一个像素、时序ID或额外参数不同时指纹不同"""
+    from src.chat_with_video.feature_cache import frame_set_fingerprint
+    
+    frames = _frames()
+    temporal_ids = [[0, 1], [2, 3]]
+    key = frame_set_fingerprint(frames, temporal_ids)
+    assert frame_set_fingerprint([frame.copy() for frame in frames], temporal_ids) == key
+    
+    # 修改一个不在16x16缩略采样点上的像素
+    edited = [frame.copy() for frame in frames]
+    x, y = 1, 1
+    edited[2].putpixel((x, y), tuple(255 - c for c in edited[2].getpixel((x, y))))
+    assert frame_set_fingerprint(edited, temporal_ids) != key
+    
+    assert frame_set_fingerprint(frames, [[0], [1], [2], [3]]) != key
+    assert frame_set_fingerprint(frames, temporal_ids, extra=(True,)) != key
+    assert frame_set_fingerprint([frame.convert('L') for frame in frames], temporal_ids) != key
+
+
+def test_encoded_frames_use_encode_time_fingerprint(tmp_path, monkeypatch):
+    """编码得到的帧按编码参数计算指纹，提问时不读取像素；降级后的帧派生出不同的指纹"""
+    from .test_frame_cache import write_test_video
+    from src.chat_with_video import feature_cache
+    from src.chat_with_video.degradation import DegradationStep, degrade_frames
+    from src.chat_with_video.video_encoder import VideoEncoder
+    
+    path = write_test_video(tmp_path / 'video.mp4')
+    encoder = VideoEncoder(max_frames=64, max_packing=2)
+    frames, temporal_ids = encoder.encode_video(path, choose_fps=5)
+    again, _ = encoder.encode_video(path, choose_fps=5)
+    other_fps, other_ids = encoder.encode_video(path, choose_fps=2)
+    assert frames.fingerprint == again.fingerprint != other_fps.fingerprint
+    
+    def no_pixel_hashing(frame):
+        raise AssertionError("不应哈希像素")
+    
+    monkeypatch.setattr(feature_cache, '_frame_digest', no_pixel_hashing)
+    key = feature_cache.frame_set_fingerprint(frames, temporal_ids)
+    assert feature_cache.frame_set_fingerprint(again, temporal_ids) == key
+    assert feature_cache.frame_set_fingerprint(other_fps, other_ids) != key
+    assert feature_cache.frame_set_fingerprint(frames, temporal_ids, extra=(True,)) != key
+    
+    halved, halved_ids = degrade_frames(frames, temporal_ids, DegradationStep('减半', frame_fraction=0.5), 2)
+    assert feature_cache.frame_set_fingerprint(halved, halved_ids) not in (key, None)
+    assert degrade_frames(frames, temporal_ids, DegradationStep('原始设置'), 2)[0] is frames
+
+
+def test_vision_cache_lru_by_bytes():
+    """超过字节预算时淘汰最久未使用的条目，超过整个预算的值不缓存"""
+    import torch
+    from src.chat_with_video.feature_cache import VisionFeatureCache
+    
+    entry = [torch.zeros(16, dtype=torch.float32)]
+    cache = VisionFeatureCache(max_bytes=2 * 64)
+    cache.put('a', entry)
+    cache.put('b', entry)
+    assert cache.get('a') is entry
+    cache.put('c', entry)
+    assert 'b' not in cache and 'a' in cache and 'c' in cache
+    
+    cache.put('big', [torch.zeros(64)])
+    assert 'big' not in cache
+    assert cache.get('missing') is None
+    
+    stats = cache.stats()
+    assert stats['entries'] == 2 and stats['evictions'] == 1
+    assert stats['hits'] == 1 and stats['misses'] == 1
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+帧缓冲池测试
+验证缓冲区按实际请求大小分配（不按最坏情况预留）、归还后复用、更大的请求替换较小的空闲缓冲区、
+池满时的临时分配，以及编码视频后缓冲区全部归还
+
+运行方式: python -m pytest tests/test_frame_buffer_pool.py
+"""
+
+from .test_utils import setup_test_environment, setup_project_path
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+def test_acquire_release_and_counters():
+    """按需分配、复用、增长和池满时的临时分配都反映在计数器中"""
+    from src.chat_with_video.frame_buffer_pool import FrameBufferPool
+    
+    pool = FrameBufferPool(num_buffers=2)
+    assert pool.stats()['pooled_size_mb'] == 0
+    
+    first = pool.acquire(4, 8, 8)
+    assert first.array.shape == (4, 8, 8, 3)
+    first.array[:] = 1
+    assert pool.stats()['pooled_size_mb'] * 1024**2 == 4 * 8 * 8 * 3
+    first.release()
+    first.release()
+    assert first.array is None
+    
+    # 更小的请求复用已有缓冲区
+    with pool.acquire(2, 8, 8) as buffer:
+        assert buffer.array.shape == (2, 8, 8, 3)
+    stats = pool.stats()
+    assert stats['reuses'] == 1 and stats['allocations'] == 1 and stats['in_use'] == 0
+    
+    # 更大的请求替换空闲缓冲区，池保留的内存随峰值增长
+    with pool.acquire(8, 8, 8):
+        pass
+    stats = pool.stats()
+    assert stats['grows'] == 1 and stats['pooled_buffers'] == 1
+    assert stats['pooled_size_mb'] * 1024**2 == 8 * 8 * 8 * 3
+    
+    # 池满且全部借出时临时分配，归还后不回到池中
+    a, b = pool.acquire(1, 8, 8), pool.acquire(1, 8, 8)
+    overflow = pool.acquire(1, 8, 8)
+    stats = pool.stats()
+    assert stats['overflow_allocations'] == 1 and stats['peak_in_use'] == 3
+    for buffer in (a, b, overflow):
+        buffer.release()
+    stats = pool.stats()
+    assert stats['in_use'] == 0 and stats['free_buffers'] == 2 and stats['pooled_buffers'] == 2
+
+
+def test_preallocate():
+    """显式预分配时按 max_frames x resolution 分配全部缓冲区"""
+    from src.chat_with_video.frame_buffer_pool import FrameBufferPool
+    
+    pool = FrameBufferPool(max_frames=3, resolution=(8, 4), num_buffers=2, preallocate=True)
+    stats = pool.stats()
+    assert stats['free_buffers'] == 2 and stats['pooled_size_mb'] * 1024**2 == 2 * 3 * 8 * 4 * 3
+    with pool.acquire(3, 4, 8):
+        pass
+    assert pool.stats()['reuses'] == 1
+
+
+def test_encoder_returns_buffers(tmp_path):
+    """编码视频后缓冲区全部归还，池只保留本次解码需要的大小"""
+    from .test_frame_cache import write_test_video
+    from src.chat_with_video.video_encoder import VideoEncoder
+    
+    path = write_test_video(tmp_path / 'video.mp4', size=(64, 48))
+    encoder = VideoEncoder(max_frames=180, max_packing=3)
+    frames, _ = encoder.encode_video(path, choose_fps=5)
+    
+    stats = encoder.buffer_pool.stats()
+    assert stats['in_use'] == 0 and stats['pooled_buffers'] == 1
+    assert stats['pooled_size_mb'] * 1024**2 == len(frames) * 64 * 48 * 3
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+解码帧缓存测试
+验证按 (视频指纹, 帧索引, 分辨率) 缓存的LRU淘汰和字节预算、视频文件被改写后指纹失效，
+以及调整采样帧率后编码器只解码缓存中缺失的帧
+
+运行方式: python -m pytest tests/test_frame_cache.py
+"""
+
+from .test_utils import setup_test_environment, setup_project_path
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+def write_test_video(path, num_frames: int = 30, fps: int = 10, size=(64, 48), offset: int = 0) -> str:
+    """用OpenCV写一个每帧亮度不同的测试视频"""
+    import cv2
+    import numpy as np
+    
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+    for i in range(num_frames):
+        writer.write(np.full((size[1], size[0], 3), (i * 8 + offset) % 256, dtype=np.uint8))
+    writer.release()
+    return str(path)
+
+
+def _frame(value: int):
+    import numpy as np
+    return np.full((4, 4, 3), value, dtype=np.uint8)
+
+
+def test_lru_eviction_and_stats():
+    """超过字节预算时淘汰最久未使用的帧，命中会刷新LRU顺序"""
+    import numpy as np
+    from src.chat_with_video.frame_cache import FrameCache
+    
+    frame_bytes = _frame(0).nbytes
+    cache = FrameCache(max_bytes=3 * frame_bytes)
+    cache.store('video', [0, 1, 2], np.stack([_frame(i) for i in range(3)]))
+    
+    cached, missing = cache.lookup('video', [0, 5])
+    assert list(cached) == [0] and missing == [5]
+    assert cached[0][0, 0, 0] == 0
+    
+    # 帧0刚被访问，淘汰的是帧1
+    cache.store('video', [3], np.stack([_frame(3)]))
+    assert cache.missing_indices('video', [0, 1, 2, 3]) == [1]
+    
+    # 分辨率和视频指纹都是缓存键的一部分
+    assert cache.missing_indices('video', [0], resolution=(32, 24)) == [0]
+    assert cache.missing_indices('other', [0]) == [0]
+    
+    stats = cache.stats()
+    assert stats['entries'] == 3 and stats['evictions'] == 1
+    assert stats['hits'] == 1 and stats['misses'] == 1
+    assert stats['size_mb'] * 1024**2 == 3 * frame_bytes
+    
+    cache.clear()
+    assert cache.stats()['entries'] == 0
+
+
+def test_stored_frames_are_copies_and_disabled_cache():
+    """缓存保存帧的副本；max_bytes为0时不缓存"""
+    import numpy as np
+    from src.chat_with_video.frame_cache import FrameCache
+    
+    batch = np.stack([_frame(7)])
+    cache = FrameCache(max_bytes=1024)
+    cache.store('video', [0], batch)
+    batch[:] = 0
+    assert cache.lookup('video', [0])[0][0][0, 0, 0] == 7
+    
+    disabled = FrameCache(max_bytes=0)
+    disabled.store('video', [0], np.stack([_frame(1)]))
+    assert not disabled.enabled and disabled.stats()['entries'] == 0
+
+
+def test_fingerprint_changes_when_video_is_rewritten(tmp_path):
+    """同一路径的视频被改写后指纹改变，旧的缓存帧不会被命中"""
+    import os
+    from src.chat_with_video.frame_cache import video_fingerprint
+    
+    path = write_test_video(tmp_path / 'video.mp4')
+    before = video_fingerprint(path)
+    assert video_fingerprint(path) == before
+    
+    write_test_video(path, num_frames=20, offset=100)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    assert video_fingerprint(path) != before
+
+
+def test_encoder_decodes_only_missing_frames(tmp_path):
+    """提高采样帧率后已解码的帧从缓存读取，结果与不使用缓存时一致"""
+    import numpy as np
+    from src.chat_with_video.video_encoder import VideoEncoder
+    
+    path = write_test_video(tmp_path / 'video.mp4')
+    encoder = VideoEncoder(max_frames=64, max_packing=1, frame_cache_bytes=64 * 1024**2)
+    
+    encoder.encode_video(path, choose_fps=2)
+    assert encoder.last_cache_stats['hits'] == 0
+    first_decoded = encoder.last_cache_stats['decoded']
+    
+    frames, temporal_ids = encoder.encode_video(path, choose_fps=5)
+    stats = encoder.last_cache_stats
+    assert stats['hits'] > 0 and stats['decoded'] == stats['requested'] - stats['hits']
+    assert first_decoded > 0
+    
+    uncached = VideoEncoder(max_frames=64, max_packing=1)
+    expected, expected_ids = uncached.encode_video(path, choose_fps=5)
+    assert temporal_ids == expected_ids
+    assert all(np.array_equal(np.asarray(a), np.asarray(b)) for a, b in zip(frames, expected))
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+连续批处理调度器测试
+不启动工作线程，直接驱动接纳/解码/移除各步骤：验证不同长度的提示合并成批次后贪心解码的结果
+与逐条单独生成一致，完成或被取消的序列让出批次位置并裁掉不再需要的填充，前缀缓存的复用，
+解码步骤之间沿用同一个KV缓存，以及暂停期间不占用模型
+
+运行方式: python -m pytest tests/test_inference_scheduler.py
+"""
+
+from .test_utils import setup_test_environment, setup_project_path
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+class IdTokenizer:
+    """把token ID解码为以空格分隔的数字，便于从文本还原生成的token"""
+    
+    def decode(self, ids, skip_special_tokens=True):
+        return ''.join(f'{i} ' for i in ids)
+
+
+def _prompt(length: int, seed: int, max_new_tokens: int, cache_key=None):
+    import torch
+    from src.chat_with_video.inference_scheduler import PreparedPrompt
+    
+    generator = torch.Generator().manual_seed(seed)
+    return PreparedPrompt(torch.randn(1, length, 64, generator=generator), eos_token_ids=[],
+                          max_new_tokens=max_new_tokens, do_sample=False, repetition_penalty=1.0,
+                          cache_key=cache_key)
+
+
+def _greedy(llm, prompt) -> list:
+    """不经过调度器，单条序列的贪心解码结果"""
+    import torch
+    
+    with torch.no_grad():
+        output = llm.generate(inputs_embeds=prompt.inputs_embeds, max_new_tokens=prompt.max_new_tokens,
+                              min_new_tokens=prompt.max_new_tokens, do_sample=False, pad_token_id=0)
+    return output[0].tolist()
+
+
+def _tokens(request) -> list:
+    return [int(t) for t in request.result(timeout=0).split()]
+
+
+def _run_to_completion(scheduler):
+    while scheduler._sequences:
+        scheduler._decode_step()
+
+
+def test_merged_batch_matches_greedy():
+    """不同长度、不同时间加入批次的序列与单独贪心解码的token相同"""
+    from .test_cancellation import build_llama
+    from src.chat_with_video.inference_scheduler import ContinuousBatchScheduler, GenerationRequest
+    
+    llm = build_llama()
+    scheduler = ContinuousBatchScheduler(llm, IdTokenizer(), max_batch_size=4)
+    prompts = [_prompt(6, 0, 12), _prompt(11, 1, 5), _prompt(3, 2, 9)]
+    requests = [GenerationRequest(lambda p=p: p) for p in prompts]
+    
+    scheduler._admit(requests[0])
+    scheduler._decode_step()
+    scheduler._decode_step()
+    # 运行中的批次接纳更长和更短的提示，KV左侧填充对齐
+    scheduler._admit(requests[1])
+    scheduler._admit(requests[2])
+    assert len(scheduler._sequences) == 3
+    assert scheduler._attention_mask.shape[0] == 3
+    # 掩码覆盖已在KV中的位置：提示加上已输入模型的生成token
+    assert scheduler._attention_mask.sum(dim=1).tolist() == [6 + 2, 11, 3]
+    
+    _run_to_completion(scheduler)
+    
+    for request, prompt in zip(requests, prompts):
+        assert _tokens(request) == _greedy(llm, prompt)
+        assert not request.result().truncated
+    stats = scheduler.stats()
+    assert stats['completed'] == 3 and stats['running'] == 0 and stats['max_batch_size_seen'] == 3
+    assert scheduler._past_key_values is None and scheduler._attention_mask is None
+
+
+def test_retired_and_cancelled_sequences_free_slots():
+    """完成或被取消的序列离开批次，剩余序列的KV和掩码只保留还需要的列"""
+    from .test_cancellation import build_llama
+    from src.chat_with_video.cancellation import CancellationToken
+    from src.chat_with_video.inference_scheduler import ContinuousBatchScheduler, GenerationRequest
+    
+    llm = build_llama()
+    scheduler = ContinuousBatchScheduler(llm, IdTokenizer(), max_batch_size=2)
+    token = CancellationToken()
+    short = GenerationRequest(lambda: _prompt(12, 0, 2))
+    cancelled = GenerationRequest(lambda: _prompt(10, 1, 50), token)
+    survivor_prompt = _prompt(4, 2, 8)
+    survivor = GenerationRequest(lambda: survivor_prompt)
+    
+    scheduler._admit(short)
+    scheduler._admit(survivor)
+    scheduler._decode_step()
+    # 较长的提示完成后移除，只剩较短的序列时左侧填充被裁掉
+    assert short.future.done() and len(_tokens(short)) == 2
+    assert len(scheduler._sequences) == 1
+    assert bool(scheduler._attention_mask.all())
+    assert scheduler._past_key_values[0][0].shape[0] == 1
+    assert scheduler._past_key_values[0][0].shape[-2] == scheduler._attention_mask.shape[1]
+    
+    scheduler._admit(cancelled)
+    scheduler._decode_step()
+    token.cancel()
+    scheduler._drop_cancelled()
+    partial = cancelled.result(timeout=0)
+    assert partial.truncated and partial.stop_reason == '已取消' and cancelled.num_tokens == 2
+    assert [seq.request for seq in scheduler._sequences] == [survivor]
+    assert scheduler._past_key_values[0][0].shape[0] == 1
+    
+    _run_to_completion(scheduler)
+    assert _tokens(survivor) == _greedy(llm, survivor_prompt)
+    stats = scheduler.stats()
+    assert stats['completed'] == 3 and stats['cancelled'] == 1 and stats['running'] == 0
+
+
+def test_prefill_reuses_prefix_cache():
+    """同一缓存键的第二个请求只预填充新增部分，生成结果与单独解码一致"""
+    import torch
+    from .test_cancellation import build_llama
+    from src.chat_with_video.inference_scheduler import ContinuousBatchScheduler, GenerationRequest
+    from src.chat_with_video.prefix_cache import PrefixKVCache
+    
+    llm = build_llama()
+    prefix_cache = PrefixKVCache(max_bytes=64 * 1024**2, min_prefix_tokens=4)
+    scheduler = ContinuousBatchScheduler(llm, IdTokenizer(), prefix_cache=prefix_cache)
+    
+    first = _prompt(16, 0, 6, cache_key='video')
+    tail = torch.randn(1, 5, 64, generator=torch.Generator().manual_seed(9))
+    second = _prompt(16, 0, 6, cache_key='video')
+    second.inputs_embeds = torch.cat([first.inputs_embeds[:, :12], tail], dim=1)
+    
+    requests = [GenerationRequest(lambda p=p: p) for p in (first, second)]
+    for request in requests:
+        scheduler._admit(request)
+    _run_to_completion(scheduler)
+    
+    stats = prefix_cache.stats()
+    assert stats['hits'] == 1 and stats['reused_tokens'] == 12
+    for request, prompt in zip(requests, (first, second)):
+        assert _tokens(request) == _greedy(llm, prompt)
+
+
+def test_paused_scheduler_waits_for_resume():
+    """暂停期间解码步骤不占用模型锁，恢复后继续，结果与单独解码一致"""
+    import threading
+    from .test_cancellation import build_llama, _lock_is_free
+    from src.chat_with_video.inference_scheduler import ContinuousBatchScheduler, GenerationRequest
+    
+    llm = build_llama()
+    scheduler = ContinuousBatchScheduler(llm, IdTokenizer())
+    prompt = _prompt(6, 0, 4)
+    request = GenerationRequest(lambda: prompt)
+    scheduler._admit(request)
+    
+    scheduler.pause()
+    worker = threading.Thread(target=_run_to_completion, args=(scheduler,), daemon=True)
+    worker.start()
+    worker.join(timeout=0.3)
+    assert worker.is_alive() and not request.future.done()
+    assert _lock_is_free(scheduler.lock)
+    
+    scheduler.resume()
+    worker.join(timeout=10)
+    assert not worker.is_alive()
+    assert _tokens(request) == _greedy(llm, prompt)
+
+
+def test_batch_kv_is_reused_across_steps():
+    """解码步骤之间沿用同一个KV缓存对象，只在序列加入或离开时重建；预填充只计算最后一个位置的logits"""
+    from .test_cancellation import build_llama
+    from src.chat_with_video.inference_scheduler import ContinuousBatchScheduler, GenerationRequest
+    
+    llm = build_llama()
+    logits_lengths = []
+    llm.lm_head.register_forward_hook(lambda module, args, output: logits_lengths.append(output.shape[1]))
+    scheduler = ContinuousBatchScheduler(llm, IdTokenizer(), max_batch_size=2)
+    
+    scheduler._admit(GenerationRequest(lambda: _prompt(9, 0, 4)))
+    assert logits_lengths == [1]
+    cache = scheduler._past_key_values
+    scheduler._decode_step()
+    assert scheduler._past_key_values is cache and cache.get_seq_length() == 10
+    
+    scheduler._admit(GenerationRequest(lambda: _prompt(4, 1, 8)))
+    merged = scheduler._past_key_values
+    assert merged is not cache and merged.get_seq_length() == 10
+    scheduler._decode_step()
+    assert scheduler._past_key_values is merged
+    
+    # 第一条序列完成后批次只剩一条，重建为裁掉填充的缓存
+    scheduler._decode_step()
+    assert len(scheduler._sequences) == 1
+    assert scheduler._past_key_values is not merged
+    assert scheduler._past_key_values.get_seq_length() == scheduler._attention_mask.shape[1] == 4 + 2
+    _run_to_completion(scheduler)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+隔离的模型加载作用域测试
+验证多个线程同时进入加载作用域时显存查询只在加载线程中被屏蔽、环境变量在最后一个加载结束后恢复、
+全局替换全部还原、加载线程的工作线程继承作用域，以及副本池中的多个副本并行加载
+
+运行方式: python -m pytest tests/test_loading_scope.py
+"""
+
+import os
+import threading
+import time
+
+from .test_utils import setup_test_environment, setup_project_path
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+def test_concurrent_scopes_are_isolated():
+    """并发加载线程看到被屏蔽的显存查询，其他线程不受影响，全部退出后恢复原状"""
+    import torch
+    import transformers.modeling_utils
+    from src.chat_with_video.loading_scope import in_loading_scope, model_loading_scope
+    
+    original_mem_get_info = torch.cuda.mem_get_info
+    original_warmup = getattr(transformers.modeling_utils, 'caching_allocator_warmup', None)
+    env = {'CWV_TEST_LOADING_SCOPE': '1'}
+    os.environ.pop('CWV_TEST_LOADING_SCOPE', None)
+    
+    num_loaders = 4
+    entered = threading.Barrier(num_loaders + 1)
+    release = threading.Event()
+    observed, errors = [], []
+    
+    def loader():
+        try:
+            with model_loading_scope(env=env):
+                entered.wait(timeout=10)
+                observed.append((torch.cuda.mem_get_info(), os.environ.get('CWV_TEST_LOADING_SCOPE')))
+                release.wait(timeout=10)
+        except Exception as e:
+            errors.append(e)
+    
+    threads = [threading.Thread(target=loader) for _ in range(num_loaders)]
+    for thread in threads:
+        thread.start()
+    entered.wait(timeout=10)
+    
+    # 主线程不在加载作用域内，调用的仍是原始函数
+    assert not in_loading_scope()
+    assert torch.cuda.mem_get_info is not original_mem_get_info
+    assert torch.cuda.mem_get_info.__wrapped__ is original_mem_get_info
+    
+    release.set()
+    for thread in threads:
+        thread.join(timeout=10)
+    
+    assert not errors
+    assert observed == [((0, 0), '1')] * num_loaders
+    assert torch.cuda.mem_get_info is original_mem_get_info
+    assert getattr(transformers.modeling_utils, 'caching_allocator_warmup', None) is original_warmup
+    assert 'CWV_TEST_LOADING_SCOPE' not in os.environ
+
+
+def test_nested_scope_and_env_restore():
+    """同一线程嵌套进入时内层退出不提前恢复；已有的环境变量恢复为原值"""
+    import torch
+    from src.chat_with_video.loading_scope import in_loading_scope, model_loading_scope
+    
+    original_mem_get_info = torch.cuda.mem_get_info
+    os.environ['CWV_TEST_LOADING_SCOPE'] = 'before'
+    try:
+        with model_loading_scope(env={'CWV_TEST_LOADING_SCOPE': 'loading'}):
+            with model_loading_scope(env={'CWV_TEST_LOADING_SCOPE': 'loading'}):
+                assert torch.cuda.mem_get_info() == (0, 0)
+            assert in_loading_scope()
+            assert torch.cuda.mem_get_info() == (0, 0)
+            assert os.environ['CWV_TEST_LOADING_SCOPE'] == 'loading'
+        
+        assert not in_loading_scope()
+        assert torch.cuda.mem_get_info is original_mem_get_info
+        assert os.environ['CWV_TEST_LOADING_SCOPE'] == 'before'
+    finally:
+        os.environ.pop('CWV_TEST_LOADING_SCOPE', None)
+
+
+def test_worker_threads_inherit_scope(monkeypatch):
+    """并行读取分片的工作线程处于调用线程的加载作用域内，作用域外调用时不受影响"""
+    import torch
+    from concurrent.futures import ThreadPoolExecutor
+    from src.chat_with_video import fast_loader
+    from src.chat_with_video.loading_scope import inherit_loading_scope, in_loading_scope, model_loading_scope
+    
+    def probe():
+        return threading.current_thread().name, in_loading_scope(), torch.cuda.mem_get_info()
+    
+    with model_loading_scope():
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            name, scoped, memory = executor.submit(inherit_loading_scope(probe)).result()
+            # 工作线程执行完后不再处于作用域内
+            assert not executor.submit(in_loading_scope).result()
+    assert name != threading.current_thread().name
+    assert scoped and memory == (0, 0)
+    assert inherit_loading_scope(probe) is probe
+    
+    observed = []
+    
+    def load_shard(path, device, dtype):
+        observed.append((threading.current_thread().name, in_loading_scope(), torch.cuda.mem_get_info()))
+        return {path: torch.zeros(1)}
+    
+    monkeypatch.setattr(fast_loader, '_load_shard', load_shard)
+    with model_loading_scope():
+        state_dict = fast_loader.load_shards_parallel(['a', 'b', 'c'], 'cpu', torch.float32, num_workers=3)
+    assert set(state_dict) == {'a', 'b', 'c'}
+    assert all(name != threading.current_thread().name for name, _, _ in observed)
+    assert [(scoped, memory) for _, scoped, memory in observed] == [(True, (0, 0))] * 3
+
+
+def test_replica_pool_loads_in_parallel():
+    """副本池的多个副本同时处于加载阶段"""
+    from src.chat_with_video.loading_scope import model_loading_scope
+    from src.chat_with_video.replica_pool import ReplicaPool, ReplicaSpec
+    
+    lock = threading.Lock()
+    loading = {'current': 0, 'peak': 0}
+    
+    class LoadingService:
+        def __init__(self, spec):
+            self.spec = spec
+            self._initialized = False
+        
+        def initialize(self) -> bool:
+            with model_loading_scope():
+                with lock:
+                    loading['current'] += 1
+                    loading['peak'] = max(loading['peak'], loading['current'])
+                time.sleep(0.3)
+                with lock:
+                    loading['current'] -= 1
+            self._initialized = True
+            return True
+    
+    pool = ReplicaPool([ReplicaSpec('cpu') for _ in range(3)], service_factory=LoadingService)
+    pool.start()
+    try:
+        assert loading['peak'] == 3
+    finally:
+        pool.stop()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+自适应内存管理测试
+使用模拟的设备分配器，验证低于高水位时保留缓存、超过高水位或请求失败时释放、
+空闲一段时间后释放，以及推理引擎在请求结束后交给内存管理器决策而不是每次都清理
+
+运行方式: python -m pytest tests/test_memory_manager.py
+"""
+
+import time
+
+from .test_utils import setup_test_environment, setup_project_path
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+MB = 1024 ** 2
+
+
+def _simulated_manager(**kwargs):
+    """设备统计来自模拟分配器的内存管理器"""
+    from src.chat_with_video.memory_manager import DeviceMemoryManager
+    
+    class SimulatedManager(DeviceMemoryManager):
+        def __init__(self, **kwargs):
+            super().__init__(device='xpu', **kwargs)
+            self.allocated = 0
+            self.reserved = 0
+            self.total = 1000 * MB
+            self.empty_calls = 0
+        
+        def device_stats(self):
+            return self.allocated, self.reserved, self.total
+        
+        def _empty_device_cache(self):
+            self.empty_calls += 1
+            self.reserved = self.allocated
+    
+    return SimulatedManager(**kwargs)
+
+
+def test_keeps_cache_below_high_water():
+    """保留显存低于高水位时不释放缓存，超过后释放并记录释放量"""
+    manager = _simulated_manager(high_water=0.8, host_high_water=1.0, idle_seconds=None)
+    manager.allocated, manager.reserved = 300 * MB, 600 * MB
+    
+    for _ in range(3):
+        manager.begin_request()
+        decision = manager.end_request()
+        assert decision['action'] == '保留缓存'
+    assert manager.empty_calls == 0
+    
+    manager.reserved = 900 * MB
+    manager.begin_request()
+    decision = manager.end_request()
+    assert decision['action'] == '释放缓存'
+    assert decision['freed_mb'] == 600
+    assert manager.empty_calls == 1
+    
+    stats = manager.stats()
+    assert stats['requests'] == 4 and stats['kept'] == 3 and stats['trims'] == 1
+    assert stats['peak_reserved_mb'] == 900
+    assert [d['action'] for d in stats['recent_decisions']] == ['保留缓存'] * 3 + ['释放缓存']
+
+
+def test_failed_request_always_trims():
+    """请求失败时（可能是内存不足）即使低于高水位也释放"""
+    manager = _simulated_manager(high_water=0.8, host_high_water=1.0, idle_seconds=None)
+    manager.allocated, manager.reserved = 100 * MB, 200 * MB
+    
+    manager.begin_request()
+    decision = manager.end_request(failed=True)
+    assert decision['action'] == '释放缓存' and decision['reason'] == '请求失败'
+    assert manager.reserved == 100 * MB
+
+
+def test_idle_trim():
+    """所有请求结束并空闲超过设定时间后释放，新请求到来时取消待执行的释放"""
+    manager = _simulated_manager(high_water=0.8, host_high_water=1.0, idle_seconds=0.2)
+    manager.allocated, manager.reserved = 100 * MB, 500 * MB
+    
+    manager.begin_request()
+    manager.end_request()
+    manager.begin_request()
+    time.sleep(0.4)
+    # 有活跃请求时不做空闲释放
+    assert manager.empty_calls == 0
+    
+    manager.end_request()
+    time.sleep(0.6)
+    assert manager.empty_calls == 1
+    assert manager.decisions[-1]['reason'].startswith('空闲')
+    manager.shutdown()
+
+
+def test_engine_defers_to_memory_manager():
+    """推理引擎每次请求结束后由内存管理器决策，失败的请求触发释放"""
+    from src.chat_with_video.model_loader import MiniCPMVInference
+    
+    class StubModel:
+        def __init__(self):
+            self.fail = False
+        
+        def get_vllm_embedding(self, data):
+            return None, None
+        
+        def chat(self, msgs, tokenizer, **kwargs):
+            if self.fail:
+                raise RuntimeError("out of memory")
+            return "ok"
+    
+    engine = MiniCPMVInference(device='cpu', memory_idle_seconds=None)
+    engine.memory = _simulated_manager(high_water=0.8, host_high_water=1.0, idle_seconds=None)
+    engine.memory.allocated, engine.memory.reserved = 100 * MB, 300 * MB
+    engine.model = StubModel()
+    engine.tokenizer = object()
+    engine._initialized = True
+    
+    msgs = [{'role': 'user', 'content': ["问题"]}]
+    assert engine.chat(msgs) == "ok"
+    assert engine.chat(msgs) == "ok"
+    assert engine.memory.empty_calls == 0
+    
+    engine.model.fail = True
+    try:
+        engine.chat(msgs)
+    except RuntimeError:
+        pass
+    assert engine.memory.empty_calls == 1
+    assert engine.get_device_info()['memory']['kept'] == 2
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+模型变体路由测试
+验证按帧数、问题长度和最大生成token数估算的请求代价把请求路由到能处理它的最便宜的变体，
+以及服务为每个变体创建推理引擎、把问答发送到所选变体并按变体统计延迟和缓存，
+加载失败时释放已加载的变体，视频问答只读取一次视频信息
+
+运行方式: python -m pytest tests/test_model_router.py
+"""
+
+from contextlib import contextmanager
+
+from .test_utils import setup_test_environment, setup_project_path
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+def _variants():
+    from src.chat_with_video.model_router import ModelVariant
+    
+    return [
+        ModelVariant('large', 'openbmb/MiniCPM-V-4_5'),
+        ModelVariant('int4', 'openbmb/MiniCPM-V-4_5-int4', max_cost=1.0, precision='int4'),
+    ]
+
+
+class StubEngine:
+    """记录收到的请求的推理引擎桩"""
+    
+    def __init__(self, variant, fail_on=None, fail_to_load=False):
+        self.variant = variant
+        self.fail_on = fail_on
+        self.fail_to_load = fail_to_load
+        self.initialized = False
+        self.stopped = False
+        self.scheduler_batch_size = None
+        self.scheduler = None
+        self.compiled = None
+        self.calls = []
+        self.memory = self
+        self.vision_cache = self.pixel_cache = self.prefix_cache = self
+    
+    def initialize(self):
+        if self.fail_to_load:
+            raise RuntimeError("加载失败")
+        self.initialized = True
+    
+    def stats(self):
+        return {'variant': self.variant.name, 'calls': len(self.calls)}
+    
+    def get_device_info(self):
+        return {'device': 'cpu', 'precision': self.variant.precision}
+    
+    def stop_scheduler(self):
+        self.stopped = True
+    
+    def shutdown(self):
+        pass
+    
+    def warm_up(self, videos):
+        return {'text': 0.01}
+    
+    def start_scheduler(self, batch_size):
+        self.scheduler_batch_size = batch_size
+    
+    def chat(self, msgs, max_new_tokens=2048, **kwargs):
+        question = msgs[0]['content'][-1]
+        if question == self.fail_on:
+            raise RuntimeError("推理失败")
+        self.calls.append((len(msgs[0]['content']) - 1, max_new_tokens))
+        return f"{self.variant.name}: {question}"
+    
+    def stream_chat(self, msgs, **kwargs):
+        yield self.chat(msgs, **kwargs)
+    
+    @contextmanager
+    def cpu_offload(self):
+        yield
+    
+    def clear_feature_cache(self):
+        pass
+    
+    def trim(self, reason):
+        pass
+
+
+def _frames(count: int):
+    from PIL import Image
+    
+    frames = [Image.new('RGB', (32, 32), (i % 255, 0, 0)) for i in range(count)]
+    return frames, [[i] for i in range(count)]
+
+
+def test_route_by_cost():
+    """简短问题、短视频和较少的生成token走便宜的变体，超过其代价上限的请求走兜底的大模型"""
+    import pytest
+    from src.chat_with_video.model_router import CostWeights, ModelVariant, VariantRouter
+    
+    router = VariantRouter(_variants())
+    assert [v.name for v in router.variants] == ['int4', 'large']
+    assert router.default.name == 'large'
+    
+    variant, cost = router.route(16, "视频里有什么？", 256)
+    assert variant.name == 'int4'
+    assert cost == pytest.approx(16 / 64 + 7 / 200 + 256 / 2048)
+    assert router.route(180, "视频里有什么？", 256)[0].name == 'large'
+    assert router.route(16, "请详细解释" * 40, 256)[0].name == 'large'
+    assert router.route(16, "视频里有什么？", 2048)[0].name == 'large'
+    
+    # 自定义权重：只看帧数
+    router = VariantRouter(_variants(), CostWeights(per_frame=0.01, per_question_char=0, per_output_token=0))
+    assert router.route(100, "很长的问题" * 100, 4096)[0].name == 'int4'
+    
+    # 没有不限代价的变体时，超过所有上限的请求交给上限最大的变体
+    router = VariantRouter([ModelVariant('tiny', 'a', max_cost=0.5), ModelVariant('small', 'b', max_cost=1.0)])
+    assert router.route(1000, "", 0)[0].name == 'small'
+    
+    router.record('small', 0.2)
+    router.record('small', 0.4, failed=True)
+    stats = router.stats()
+    assert stats['tiny']['requests'] == 0 and stats['tiny']['p50_ms'] is None
+    assert stats['small']['requests'] == 2 and stats['small']['failures'] == 1
+    assert stats['small']['mean_ms'] == pytest.approx(300)
+    assert stats['small']['last_ms'] == pytest.approx(400)
+    
+    with pytest.raises(ValueError):
+        VariantRouter([])
+    with pytest.raises(ValueError):
+        VariantRouter([ModelVariant('a', 'x'), ModelVariant('a', 'y')])
+
+
+def test_service_routes_requests_to_variants():
+    """服务为每个变体加载推理引擎，问答发送到所选变体并记录该变体的延迟"""
+    import pytest
+    from src.chat_with_video.video_chat_service import VideoChatService
+    
+    class StubbedService(VideoChatService):
+        def _create_engine(self, variant):
+            return StubEngine(variant, fail_on="失败的问题")
+    
+    service = StubbedService(variants=_variants(), device='cpu', warm_up_frames=[],
+                             scheduler_batch_size=2, oom_ladder=[])
+    assert service.model_path == 'openbmb/MiniCPM-V-4_5'
+    assert service.initialize()
+    assert set(service.engines) == {'int4', 'large'}
+    assert all(engine.initialized and engine.scheduler_batch_size == 2 for engine in service.engines.values())
+    assert service.inference_engine is service.engines['large']
+    assert set(service.warm_up_timings) == {'int4/text', 'large/text'}
+    
+    frames, temporal_ids = _frames(8)
+    assert service.chat_with_frames(frames, temporal_ids, "有几个人？", max_new_tokens=128) == "int4: 有几个人？"
+    assert service.last_route['variant'] == 'int4'
+    
+    frames, temporal_ids = _frames(96)
+    answer = service.chat_with_frames(frames, temporal_ids, "按时间顺序总结视频", max_new_tokens=1024)
+    assert answer == "large: 按时间顺序总结视频"
+    
+    frames, temporal_ids = _frames(4)
+    assert list(service.stream_chat(frames, temporal_ids, "是白天吗？", max_new_tokens=64)) == ["int4: 是白天吗？"]
+    with pytest.raises(RuntimeError):
+        service.chat_with_frames(frames, temporal_ids, "失败的问题", max_new_tokens=64)
+    
+    assert service.engines['int4'].calls == [(8, 128), (4, 64)]
+    assert service.engines['large'].calls == [(96, 1024)]
+    
+    routing = service.router.stats()
+    assert routing['int4']['requests'] == 3 and routing['int4']['failures'] == 1
+    assert routing['large']['requests'] == 1 and routing['large']['failures'] == 0
+    assert routing['large']['p95_ms'] is not None
+    
+    info = service.get_system_info()
+    assert info['routing'] == routing
+    assert info['variants']['int4']['precision'] == 'int4'
+    assert info['variants']['int4']['prefix_cache'] == {'variant': 'int4', 'calls': 2}
+    assert info['variants']['large']['vision_cache'] == {'variant': 'large', 'calls': 1}
+
+
+def test_failed_initialize_releases_loaded_variants():
+    """后面的变体加载失败时，已加载的变体被停止并释放"""
+    from src.chat_with_video.video_chat_service import VideoChatService
+    
+    created = []
+    
+    class StubbedService(VideoChatService):
+        def _create_engine(self, variant):
+            created.append(StubEngine(variant, fail_to_load=variant.name == 'large'))
+            return created[-1]
+    
+    service = StubbedService(variants=_variants(), device='cpu', warm_up_frames=[])
+    assert not service.initialize()
+    assert [engine.variant.name for engine in created] == ['int4', 'large']
+    assert all(engine.stopped for engine in created)
+    assert service.engines == {} and service.inference_engine is None
+    assert not service.get_system_info()['initialized']
+
+
+def test_video_request_reads_video_info_once(tmp_path):
+    """路由、降级重试和编码共用同一份视频信息和采样计划"""
+    from .test_frame_cache import write_test_video
+    from src.chat_with_video.video_chat_service import VideoChatService
+    
+    class OomOnceEngine(StubEngine):
+        def chat(self, msgs, **kwargs):
+            if not self.calls:
+                self.calls.append(None)
+                raise RuntimeError("XPU out of memory. Tried to allocate 2.00 GiB")
+            return super().chat(msgs, **kwargs)
+        
+        def clear_feature_cache(self):
+            pass
+    
+    class StubbedService(VideoChatService):
+        def _create_engine(self, variant):
+            return OomOnceEngine(variant)
+    
+    service = StubbedService(variants=_variants(), device='cpu', warm_up_frames=[], max_frames=8)
+    assert service.initialize()
+    
+    encoder = service.video_encoder
+    counts = {'get_video_info': 0, 'plan_frames': 0}
+    for name in counts:
+        def counted(*args, _name=name, _method=getattr(encoder, name), **kwargs):
+            counts[_name] += 1
+            return _method(*args, **kwargs)
+        setattr(encoder, name, counted)
+    
+    path = write_test_video(tmp_path / 'video.mp4', num_frames=30, fps=10)
+    answer = service.chat_with_video(path, "视频里有什么？", choose_fps=2, max_new_tokens=64)
+    
+    assert answer == "int4: 视频里有什么？"
+    assert answer.degradation['step'] == '降低分辨率'
+    assert service.engines['int4'].calls == [None, (6, 64)]
+    assert counts == {'get_video_info': 1, 'plan_frames': 1}
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+模型快照测试
+验证快照目录只复制源目录中的配置和代码（权重由快照重新写入）、描述信息记录dtype和设备、
+恢复的模型与原模型输出一致且权重以内存映射方式挂载，以及不支持的快照版本和与快照不一致的精度被拒绝
+
+运行方式: python -m pytest tests/test_model_snapshot.py
+"""
+
+import json
+import os
+
+from .test_utils import setup_test_environment, setup_project_path
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+class StubTokenizer:
+    """只写出一个文件的分词器替身"""
+    
+    def save_pretrained(self, output_dir):
+        with open(os.path.join(output_dir, 'tokenizer_config.json'), 'w', encoding='utf-8') as f:
+            json.dump({'stub': True}, f)
+
+
+def _source_dir(path):
+    """带有权重、处理器配置和远程代码的源模型目录，返回加载好的模型"""
+    import torch
+    from transformers import LlamaConfig, LlamaModel
+    
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=64, hidden_size=32, intermediate_size=64,
+                         num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=4)
+    model = LlamaModel(config).eval()
+    model.save_pretrained(str(path), safe_serialization=True)
+    (path / 'preprocessor_config.json').write_text('{}')
+    (path / 'modeling_stub.py').write_text('# remote code\n')
+    (path / 'pytorch_model.bin').write_bytes(b'old weights')
+    return model
+
+
+def test_write_and_restore_snapshot(tmp_path):
+    """写入快照后恢复的模型与原模型输出一致，权重直接映射快照文件"""
+    import torch
+    from src.chat_with_video.model_snapshot import (
+        SNAPSHOT_MANIFEST, is_snapshot, read_manifest, restore_snapshot, write_snapshot
+    )
+    
+    source = tmp_path / 'source'
+    output = tmp_path / 'snapshot'
+    model = _source_dir(source)
+    assert not is_snapshot(str(source))
+    
+    manifest = write_snapshot(model, StubTokenizer(), str(source), str(output), 'cpu', source='tiny-llama')
+    assert is_snapshot(str(output))
+    assert read_manifest(str(output)) == manifest
+    assert manifest['source'] == 'tiny-llama' and manifest['dtype'] == 'float32'
+    assert manifest['device'] == 'cpu' and not manifest['quantized']
+    assert manifest['num_parameters'] == sum(p.numel() for p in model.parameters())
+    
+    files = set(os.listdir(output))
+    assert {'preprocessor_config.json', 'modeling_stub.py', 'tokenizer_config.json', SNAPSHOT_MANIFEST} <= files
+    # 源目录中的旧权重不复制，快照中的权重由save_pretrained写入
+    assert 'pytorch_model.bin' not in files and 'model.safetensors' in files
+    
+    restored = restore_snapshot(str(output), 'cpu')
+    input_ids = torch.arange(10).unsqueeze(0)
+    with torch.no_grad():
+        assert torch.allclose(restored(input_ids).last_hidden_state,
+                              model(input_ids).last_hidden_state, atol=1e-6)
+    
+    # 所有权重共享同一个文件映射，而不是逐个复制到新分配的内存
+    storages = {param.untyped_storage().data_ptr() for param in restored.parameters()}
+    assert len(storages) == 1
+
+
+def test_restore_rejects_unknown_version(tmp_path):
+    """快照版本与当前格式不一致时拒绝恢复"""
+    import pytest
+    from src.chat_with_video.model_snapshot import SNAPSHOT_MANIFEST, restore_snapshot, write_snapshot
+    
+    source = tmp_path / 'source'
+    output = tmp_path / 'snapshot'
+    write_snapshot(_source_dir(source), None, str(source), str(output), 'cpu')
+    
+    manifest_path = output / SNAPSHOT_MANIFEST
+    manifest = json.loads(manifest_path.read_text(encoding='utf-8'))
+    manifest['format_version'] = 0
+    manifest_path.write_text(json.dumps(manifest), encoding='utf-8')
+    
+    with pytest.raises(ValueError):
+        restore_snapshot(str(output), 'cpu')
+
+
+def test_restore_rejects_mismatched_precision(tmp_path):
+    """请求的精度与快照dtype或量化状态不一致时拒绝恢复，而不是静默使用快照的dtype"""
+    import pytest
+    import torch
+    from src.chat_with_video.model_snapshot import restore_snapshot, write_snapshot
+    from src.chat_with_video.precision import PrecisionMode
+    
+    source = tmp_path / 'source'
+    output = tmp_path / 'snapshot'
+    write_snapshot(_source_dir(source), None, str(source), str(output), 'cpu')
+    
+    with pytest.raises(ValueError, match='float32'):
+        restore_snapshot(str(output), 'cpu', precision=PrecisionMode('bf16', torch.bfloat16))
+    with pytest.raises(ValueError, match='未量化'):
+        restore_snapshot(str(output), 'cpu', precision=PrecisionMode('int4', torch.float32, 'int4'))
+    
+    # 动态int8量化在恢复后进行，需要fp32快照
+    for precision in (PrecisionMode('fp32', torch.float32), PrecisionMode('int8-dynamic', torch.float32, 'int8-dynamic')):
+        assert restore_snapshot(str(output), 'cpu', precision=precision).dtype == torch.float32
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+内存不足降级阶梯测试
+验证内存不足错误的识别、按降级设置处理帧（减少时序组、合并打包、缩小分辨率），
+跳过对当前输入不产生变化的级，以及服务在内存不足时释放缓存并沿阶梯重试、在回答中记录所用的降级设置，
+流式输出在第一段文本之前内存不足时同样降级重试，以及真实引擎在CPU卸载期间的流式推理不会死锁
+
+运行方式: python -m pytest tests/test_oom_degradation.py
+"""
+
+from contextlib import contextmanager
+
+from .test_utils import setup_test_environment, setup_project_path
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+def _video(num_groups: int = 8, packing: int = 2, size=(64, 48)):
+    from PIL import Image
+    
+    frames = [Image.new('RGB', size, (i * 10 % 255, 0, 0)) for i in range(num_groups * packing)]
+    flat = list(range(len(frames)))
+    temporal_ids = [flat[i:i + packing] for i in range(0, len(flat), packing)]
+    return frames, temporal_ids
+
+
+class StubEngine:
+    """帧数超过上限时报内存不足的推理引擎桩"""
+    
+    def __init__(self, max_frames: int, offload_only: bool = False):
+        self.max_frames = max_frames
+        self.offload_only = offload_only
+        self.offloaded = False
+        self.calls = []
+        self.freed = 0
+        self.fail_after = None
+        self.memory = self
+    
+    def chat(self, msgs, temporal_ids=None, **kwargs):
+        frames = msgs[0]['content'][:-1]
+        self.calls.append((len(frames), [len(ids) for ids in temporal_ids], frames[0].size))
+        if len(frames) > self.max_frames or (self.offload_only and not self.offloaded):
+            raise RuntimeError("XPU out of memory. Tried to allocate 2.00 GiB")
+        return "回答"
+    
+    def stream_chat(self, msgs, temporal_ids=None, **kwargs):
+        answer = self.chat(msgs, temporal_ids=temporal_ids)
+        for index, text in enumerate(answer):
+            if index == self.fail_after:
+                raise RuntimeError("XPU out of memory. Tried to allocate 2.00 GiB")
+            yield text
+    
+    @contextmanager
+    def cpu_offload(self):
+        self.offloaded = True
+        try:
+            yield
+        finally:
+            self.offloaded = False
+    
+    def clear_feature_cache(self):
+        self.freed += 1
+    
+    def trim(self, reason):
+        pass
+
+
+def _service(engine, **kwargs):
+    from src.chat_with_video.video_chat_service import VideoChatService
+    
+    service = VideoChatService(max_frames=60, max_packing=4, **kwargs)
+    service.inference_engine = engine
+    service._initialized = True
+    return service
+
+
+def test_is_out_of_memory():
+    """识别各后端的内存不足错误（包括被包装的），其他错误不重试"""
+    import torch
+    from src.chat_with_video.degradation import is_out_of_memory
+    
+    assert is_out_of_memory(MemoryError())
+    assert is_out_of_memory(torch.OutOfMemoryError("CUDA out of memory"))
+    assert is_out_of_memory(RuntimeError("UR_RESULT_ERROR_OUT_OF_DEVICE_MEMORY"))
+    assert is_out_of_memory(RuntimeError("[enforce fail at alloc_cpu.cpp] DefaultCPUAllocator: "
+                                         "not enough memory: you tried to allocate 1GB"))
+    try:
+        try:
+            raise MemoryError()
+        except MemoryError as e:
+            raise RuntimeError("视频处理失败") from e
+    except RuntimeError as wrapped:
+        assert is_out_of_memory(wrapped)
+    
+    assert not is_out_of_memory(ValueError("shape mismatch"))
+    assert not is_out_of_memory(FileNotFoundError("视频文件不存在"))
+
+
+def test_degrade_frames():
+    """减少帧数按时序组整组保留，提高打包数合并相邻组（不超过最大打包数），分辨率按比例缩小"""
+    from src.chat_with_video.degradation import DegradationStep, degrade_frames
+    
+    frames, temporal_ids = _video(num_groups=8, packing=2)
+    step = DegradationStep('测试', resolution_scale=0.5, frame_fraction=0.5, packing_factor=3)
+    new_frames, new_ids = degrade_frames(frames, temporal_ids, step, max_packing=4)
+    
+    # 保留4组（8帧），打包数 2*3 受最大打包数限制为4
+    assert len(new_frames) == 8
+    assert [len(ids) for ids in new_ids] == [4, 4]
+    flat = [t for ids in new_ids for t in ids]
+    assert flat == sorted(flat)
+    assert new_frames[0].size == (32, 24)
+    
+    unchanged_frames, unchanged_ids = degrade_frames(frames, temporal_ids, DegradationStep('原始设置'), 4)
+    assert unchanged_frames == frames and unchanged_ids == temporal_ids
+
+
+def test_service_walks_ladder_on_oom():
+    """内存不足时释放缓存并沿阶梯降级，回答中记录实际使用的降级设置"""
+    frames, temporal_ids = _video(num_groups=8, packing=2)
+    engine = StubEngine(max_frames=8)
+    service = _service(engine)
+    
+    answer = service.chat_with_frames(frames, temporal_ids, "发生了什么？")
+    
+    assert answer == "回答"
+    assert answer.degradation['step'] == '减少帧数'
+    assert answer.degradation['attempts'] == 3
+    assert service.last_degradation['frame_fraction'] == 0.5
+    assert service.degradation_counts == {'减少帧数': 1}
+    # 原始设置、降低分辨率各失败一次，每次失败后释放缓存
+    assert [c[0] for c in engine.calls] == [16, 16, 8]
+    assert engine.calls[1][2] == (32, 24)
+    assert engine.freed == 2
+
+
+def test_service_cpu_offload_and_limits():
+    """最后一级在CPU卸载下执行；非内存错误和阶梯用尽时抛出原始异常"""
+    import pytest
+    from src.chat_with_video.degradation import DegradationStep
+    
+    frames, temporal_ids = _video()
+    engine = StubEngine(max_frames=100, offload_only=True)
+    answer = _service(engine).chat_with_frames(frames, temporal_ids, "问题")
+    assert answer.degradation['step'] == 'CPU卸载' and answer.degradation['cpu_offload']
+    assert len(engine.calls) == 5
+    
+    # 未降级时不记录
+    answer = _service(StubEngine(max_frames=100)).chat_with_frames(frames, temporal_ids, "问题")
+    assert answer.degradation is None
+    
+    engine = StubEngine(max_frames=0)
+    service = _service(engine, oom_ladder=[DegradationStep('原始设置'), DegradationStep('减半', frame_fraction=0.5)])
+    with pytest.raises(RuntimeError, match="out of memory"):
+        service.chat_with_frames(frames, temporal_ids, "问题")
+    assert len(engine.calls) == 2
+    
+    engine = StubEngine(max_frames=100)
+    engine.chat = lambda *args, **kwargs: (_ for _ in ()).throw(ValueError("参数错误"))
+    with pytest.raises(ValueError):
+        _service(engine).chat_with_frames(frames, temporal_ids, "问题")
+
+
+def test_applicable_steps_skip_no_ops():
+    """已达到最大打包数时跳过提高打包数，只有一个时序组时跳过减少帧数和提高打包数"""
+    from src.chat_with_video.degradation import DEFAULT_OOM_LADDER, applicable_steps
+    
+    def names(num_groups, packing):
+        return [step.name for step in applicable_steps(DEFAULT_OOM_LADDER, num_groups, packing, 4)]
+    
+    assert names(8, 2) == [step.name for step in DEFAULT_OOM_LADDER]
+    assert names(8, 4) == ['原始设置', '降低分辨率', '减少帧数', 'CPU卸载']
+    assert names(1, 2) == ['原始设置', '降低分辨率', 'CPU卸载']
+
+
+def test_service_skips_no_op_steps():
+    """打包数已达上限时不重复尝试与前一级相同的输入"""
+    frames, temporal_ids = _video(num_groups=8, packing=4)
+    engine = StubEngine(max_frames=100, offload_only=True)
+    answer = _service(engine).chat_with_frames(frames, temporal_ids, "问题")
+    
+    assert answer.degradation['step'] == 'CPU卸载' and answer.degradation['attempts'] == 4
+    assert [c[0] for c in engine.calls] == [32, 32, 16, 16]
+    assert engine.freed == 3
+
+
+def test_stream_retries_before_first_chunk():
+    """流式输出第一段文本之前内存不足时降级重试，已经输出文本后直接抛出"""
+    import pytest
+    
+    frames, temporal_ids = _video(num_groups=8, packing=2)
+    engine = StubEngine(max_frames=8)
+    service = _service(engine)
+    timings = {}
+    
+    chunks = list(service.stream_chat(frames, temporal_ids, "发生了什么？", timings=timings))
+    assert ''.join(chunks) == "回答"
+    assert [c[0] for c in engine.calls] == [16, 16, 8]
+    assert timings['degradation']['step'] == '减少帧数' and timings['degradation']['attempts'] == 3
+    assert service.degradation_counts == {'减少帧数': 1}
+    
+    engine = StubEngine(max_frames=100)
+    engine.fail_after = 1
+    stream = _service(engine).stream_chat(frames, temporal_ids, "问题")
+    assert next(stream) == "回"
+    with pytest.raises(RuntimeError, match="out of memory"):
+        next(stream)
+    assert len(engine.calls) == 1 and engine.freed == 0
+
+
+def test_stream_under_real_cpu_offload():
+    """CPU卸载期间流式推理的生成线程能获取模型锁，调度器暂停且不接收请求，退出后模型移回"""
+    import threading
+    from .test_cancellation import StreamingStub
+    from src.chat_with_video.inference_scheduler import ContinuousBatchScheduler
+    from src.chat_with_video.model_loader import MiniCPMVInference
+    
+    class MovableStub(StreamingStub):
+        def __init__(self):
+            super().__init__()
+            self.release.set()
+            self.moves = []
+        
+        def to(self, device):
+            self.moves.append(device)
+            return self
+    
+    class PausedScheduler(ContinuousBatchScheduler):
+        running = True
+        
+        def submit(self, request):
+            raise AssertionError("卸载期间不应提交到调度器")
+    
+    engine = MiniCPMVInference(device='cpu')
+    # 按设备上的引擎处理卸载（模型桩记录移动）
+    engine.device = 'xpu'
+    engine.model, engine.tokenizer, engine._initialized = MovableStub(), object(), True
+    engine.scheduler = PausedScheduler(engine.model, engine.tokenizer, lock=engine._model_lock)
+    msgs = [{'role': 'user', 'content': ['hi']}]
+    
+    chunks = []
+    
+    def consume():
+        with engine.cpu_offload():
+            assert engine.offloaded and not engine.scheduler._resumed.is_set()
+            chunks.extend(engine.stream_chat(msgs, max_new_tokens=4))
+    
+    consumer = threading.Thread(target=consume, daemon=True)
+    consumer.start()
+    consumer.join(timeout=10)
+    
+    assert not consumer.is_alive()
+    assert chunks == ['a', 'b']
+    assert engine.model.moves == ['cpu', 'xpu']
+    assert not engine.offloaded and engine.scheduler._resumed.is_set()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+批量图像预处理测试
+使用按MiniCPM-V图像处理器逐帧实现的参考处理器，验证向量化预处理与逐帧结果一致、
+需要切片的帧回退到原始实现，以及推理引擎按帧集合指纹缓存像素值
+
+运行方式: python -m pytest tests/test_pixel_preprocessing.py
+"""
+
+import math
+
+from .test_utils import setup_test_environment, setup_project_path
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+def _reference_processor():
+    """按MiniCPM-V图像处理器实现的逐帧参考处理器（切片时简化为重复的源图像）"""
+    import numpy as np
+    import torch
+    from PIL import Image
+    from transformers import BatchFeature
+    
+    class NestedBatchFeature(BatchFeature):
+        """与MiniCPMVBatchFeature一样逐个转换嵌套列表中的数组"""
+        
+        def convert_to_tensors(self, tensor_type=None):
+            if tensor_type is None:
+                return self
+            
+            def convert(value):
+                if isinstance(value, list):
+                    return [convert(v) for v in value]
+                if isinstance(value, np.ndarray):
+                    return torch.from_numpy(value)
+                return value
+            
+            for key, value in self.items():
+                self[key] = convert(value)
+            return self
+    
+    class ReferenceImageProcessor:
+        patch_size = 14
+        scale_resolution = 448
+        max_slice_nums = 1
+        slice_mode = True
+        mean = np.array([0.5, 0.5, 0.5])
+        std = np.array([0.5, 0.5, 0.5])
+        
+        def __init__(self):
+            self.sliced_calls = 0
+        
+        def find_best_resize(self, original_size, scale_resolution, patch_size, allow_upscale=False):
+            width, height = original_size
+            if width * height > scale_resolution * scale_resolution or allow_upscale:
+                r = width / height
+                height = int(scale_resolution / math.sqrt(r))
+                width = int(height * r)
+            return (max(round(width / patch_size) * patch_size, patch_size),
+                    max(round(height / patch_size) * patch_size, patch_size))
+        
+        def get_sliced_grid(self, image_size, max_slice_nums, nerver_split=False):
+            ratio = image_size[0] * image_size[1] / (self.scale_resolution * self.scale_resolution)
+            multiple = min(math.ceil(ratio), max_slice_nums)
+            return None if multiple <= 1 else [1, multiple]
+        
+        def get_sliced_images(self, image, max_slice_nums=None):
+            self.sliced_calls += 1
+            best_size = self.find_best_resize(image.size, self.scale_resolution, self.patch_size,
+                                              allow_upscale=True)
+            source = image.resize(best_size, resample=Image.Resampling.BICUBIC)
+            grid = self.get_sliced_grid(image.size, max_slice_nums or self.max_slice_nums)
+            return [source] if grid is None else [source] * (grid[1] + 1)
+        
+        def reshape_by_patch(self, image):
+            image = torch.from_numpy(image)
+            patch = self.patch_size
+            patches = torch.nn.functional.unfold(image, (patch, patch), stride=(patch, patch))
+            patches = patches.reshape(image.size(0), patch, patch, -1)
+            patches = patches.permute(0, 1, 3, 2).reshape(image.size(0), patch, -1)
+            return patches.numpy()
+        
+        def preprocess(self, images, do_pad=True, max_slice_nums=None, temporal_ids=None,
+                       return_tensors=None, **kwargs):
+            if isinstance(images[0], Image.Image):
+                images = [images]
+            
+            pixel_values, image_sizes, tgt_sizes = [], [], []
+            for sample in images:
+                sample_pixels, sample_sizes, sample_tgt = [], [], []
+                for image in sample:
+                    for patch_image in self.get_sliced_images(image, max_slice_nums):
+                        array = np.asarray(patch_image).astype(np.float32) / 255
+                        array = (array - self.mean.astype(np.float32)) / self.std.astype(np.float32)
+                        array = array.transpose(2, 0, 1)
+                        sample_pixels.append(self.reshape_by_patch(array))
+                        sample_tgt.append(np.array((array.shape[1] // self.patch_size,
+                                                    array.shape[2] // self.patch_size)))
+                    sample_sizes.append(image.size)
+                pixel_values.append(sample_pixels)
+                image_sizes.append(sample_sizes)
+                tgt_sizes.append(sample_tgt)
+            
+            return NestedBatchFeature(data={
+                'pixel_values': pixel_values,
+                'image_sizes': image_sizes,
+                'tgt_sizes': tgt_sizes,
+                'temporal_ids': [temporal_ids],
+            }, tensor_type=return_tensors)
+    
+    return ReferenceImageProcessor()
+
+
+def _frames(sizes):
+    """按给定分辨率生成随机RGB帧"""
+    import numpy as np
+    from PIL import Image
+    
+    rng = np.random.default_rng(0)
+    return [Image.fromarray(rng.integers(0, 256, (h, w, 3), dtype=np.uint8)) for w, h in sizes]
+
+
+def _assert_same(a, b):
+    from src.chat_with_video.pixel_preprocessing import _same
+    assert _same(a, b)
+
+
+def test_vectorized_matches_per_frame_processor():
+    """不同分辨率混合的帧经向量化预处理后与逐帧结果一致，校验后不再逐帧处理"""
+    from src.chat_with_video.pixel_preprocessing import BatchImagePreprocessor
+    
+    processor = _reference_processor()
+    frames = _frames([(640, 360)] * 5 + [(320, 240)] * 2)
+    kwargs = {'max_slice_nums': 1, 'temporal_ids': [[0, 1], [2, 3], [4, 5, 6]]}
+    reference = dict(processor.preprocess([frames], **kwargs))
+    
+    batch = BatchImagePreprocessor(processor, num_threads=4)
+    first = batch.preprocess_sample(processor.preprocess, frames, kwargs)
+    assert batch.validated is True
+    for key in reference:
+        _assert_same(first[key], reference[key])
+    
+    calls = processor.sliced_calls
+    second = batch.preprocess_sample(processor.preprocess, frames, kwargs)
+    assert processor.sliced_calls == calls
+    for key in reference:
+        _assert_same(second[key], reference[key])
+    assert batch.stats['batches'] == 2 and batch.stats['frames'] == 14
+    
+    output = batch.build_output(second, 2, 'pt')
+    assert len(output['pixel_values']) == 2 and len(output['pixel_values'][1]) == 7
+    assert tuple(output['pixel_values'][0][0].shape) == (3, 14, reference['pixel_values'][0][0].shape[2])
+
+
+def test_sliced_frames_fall_back():
+    """需要切片的帧使用原始实现"""
+    from src.chat_with_video.pixel_preprocessing import BatchImagePreprocessor
+    
+    processor = _reference_processor()
+    frames = _frames([(1280, 720)] * 2)
+    kwargs = {'max_slice_nums': 4}
+    
+    batch = BatchImagePreprocessor(processor)
+    data = batch.preprocess_sample(processor.preprocess, frames, kwargs)
+    assert batch.validated is None and batch.stats['fallbacks'] == 1
+    assert len(data['pixel_values'][0]) == len(frames) * 5
+    _assert_same(data['pixel_values'], dict(processor.preprocess([frames], **kwargs))['pixel_values'])
+
+
+def test_engine_caches_pixel_values():
+    """同一帧集合的后续提问命中像素缓存；批量推理的每条样本复用同一份像素值"""
+    from types import SimpleNamespace
+    from src.chat_with_video.model_loader import MiniCPMVInference
+    
+    class StubModel:
+        def __init__(self, processor):
+            self.processor = SimpleNamespace(image_processor=processor)
+        
+        def get_vllm_embedding(self, data):
+            return None, None
+        
+        def chat(self, msgs, tokenizer, max_slice_nums=None, **kwargs):
+            images = [item for item in msgs[0]['content'] if not isinstance(item, str)]
+            inputs = self.processor.image_processor.preprocess(
+                [images], max_slice_nums=max_slice_nums, return_tensors='pt'
+            )
+            return str(sum(int(p.shape[-1]) for p in inputs['pixel_values'][0]))
+    
+    processor = _reference_processor()
+    engine = MiniCPMVInference(device='cpu', memory_idle_seconds=None)
+    engine.model = StubModel(processor)
+    engine.tokenizer = object()
+    engine._initialized = True
+    
+    frames = _frames([(640, 360)] * 4)
+    msgs = [{'role': 'user', 'content': frames + ["问题"]}]
+    first = engine.chat(msgs, cache_key='video')
+    calls = processor.sliced_calls
+    assert engine.chat(msgs, cache_key='video') == first
+    assert processor.sliced_calls == calls
+    assert engine.pixel_cache.stats()['hits'] == 1
+    assert engine.get_device_info()['preprocessing']['vectorized'] is True
+    
+    with engine._batched_preprocessing('video', 1):
+        output = processor.preprocess([frames, frames, frames], max_slice_nums=1, return_tensors='pt')
+    assert len(output['pixel_values']) == 3
+    _assert_same(output['pixel_values'][2], output['pixel_values'][0])
+    assert processor.sliced_calls == calls
+    assert 'preprocess' not in vars(processor)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+设备放置规划测试
+使用CPU上随机初始化的小型MiniCPM-V结构（视觉编码器、重采样器、语言模型），
+以CPU模拟XPU的内存预算，验证放置方案和跨设备前向
+
+运行方式: python -m pytest tests/test_placement_planner.py
+"""
+
+from types import SimpleNamespace
+
+from .test_utils import setup_test_environment, setup_project_path
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+def build_fake_minicpmv(hidden_size: int = 128, num_layers: int = 6):
+    """构造与MiniCPM-V模块结构相同的小模型"""
+    import torch
+    import torch.nn as nn
+    from transformers import LlamaConfig, LlamaForCausalLM
+    
+    torch.manual_seed(0)
+    
+    class FakeMiniCPMV(nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.config = SimpleNamespace(
+                vision_config=SimpleNamespace(hidden_size=64, intermediate_size=128, num_attention_heads=2,
+                                              image_size=56, patch_size=14),
+                vision_batch_size=2,
+            )
+            self.vpm = nn.Sequential(nn.Linear(64, 64), nn.GELU(), nn.Linear(64, 64))
+            self.resampler = nn.Linear(64, hidden_size)
+            self.llm = LlamaForCausalLM(LlamaConfig(
+                vocab_size=500, hidden_size=hidden_size, intermediate_size=hidden_size * 2,
+                num_hidden_layers=num_layers, num_attention_heads=4, num_key_value_heads=4,
+            ))
+        
+        def forward(self, pixels, input_ids):
+            vision = self.resampler(self.vpm(pixels))
+            embeds = self.llm.model.embed_tokens(input_ids)
+            embeds = torch.cat([vision, embeds], dim=1)
+            return self.llm(inputs_embeds=embeds).logits
+    
+    return FakeMiniCPMV().eval()
+
+
+def _total_bytes(units):
+    return sum(u.param_bytes + u.persistent_bytes for u in units) + max(u.transient_bytes for u in units)
+
+
+def test_plan_fills_devices_in_order():
+    """先放满第一个设备，之后的单元按执行顺序放到下一个设备"""
+    from src.chat_with_video.placement_planner import estimate_units, plan_placement
+    
+    model = build_fake_minicpmv()
+    units = estimate_units(model, max_context_tokens=256)
+    budget = _total_bytes(units) // 2
+    plan = plan_placement(units, {'xpu': budget, 'cpu': None})
+    
+    devices = list(plan.assignments.values())
+    assert devices[0] == 'xpu' and devices[-1] == 'cpu'
+    assert devices == sorted(devices, key=lambda d: d == 'cpu'), "设备只应切换一次"
+    assert plan.usage['xpu'] <= budget
+    
+    # 每个参数都有对应的放置
+    for name, _ in model.named_parameters():
+        assert any(name == key or name.startswith(key + '.') for key in plan.device_map), name
+
+
+def test_plan_rejects_insufficient_budget():
+    """所有设备都放不下时报错"""
+    import pytest
+    from src.chat_with_video.placement_planner import estimate_units, plan_placement
+    
+    units = estimate_units(build_fake_minicpmv(), max_context_tokens=256)
+    with pytest.raises(ValueError):
+        plan_placement(units, {'xpu': 1024, 'cpu': 2048})
+
+
+def test_apply_placement_on_fake_device():
+    """以CPU模拟XPU应用放置方案后，前向结果不变"""
+    import torch
+    from src.chat_with_video.placement_planner import estimate_units, plan_placement, apply_placement
+    
+    model = build_fake_minicpmv()
+    pixels = torch.randn(1, 4, 64)
+    input_ids = torch.randint(0, 500, (1, 8))
+    with torch.no_grad():
+        expected = model(pixels, input_ids)
+    
+    units = estimate_units(model, max_context_tokens=256)
+    plan = plan_placement(units, {'xpu': _total_bytes(units) // 2, 'cpu': None})
+    apply_placement(model, plan, device_alias={'xpu': 'cpu'})
+    
+    with torch.no_grad():
+        actual = model(pixels, input_ids)
+        generated = model.llm.generate(input_ids=input_ids, max_new_tokens=4, do_sample=False, pad_token_id=0)
+    assert torch.equal(expected, actual)
+    assert generated.shape[1] == 12
+
+
+def test_engine_applies_device_budgets():
+    """推理引擎按预算规划放置，并在设备信息中报告"""
+    from src.chat_with_video.fast_loader import LoadTimer
+    from src.chat_with_video.model_loader import MiniCPMVInference
+    from src.chat_with_video.placement_planner import estimate_units
+    
+    model = build_fake_minicpmv()
+    budget_gb = _total_bytes(estimate_units(model, max_context_tokens=256)) / 2 / 1024**3
+    
+    engine = MiniCPMVInference(device='cpu', device_budgets={'xpu': budget_gb, 'cpu': None},
+                               max_context_tokens=256)
+    engine.model = model
+    engine._apply_device_budgets(LoadTimer())
+    
+    placement = engine.get_device_info()['placement']
+    assert list(placement) == ['xpu', 'cpu']
+    assert placement['xpu']['units'][0] == '视觉编码器'
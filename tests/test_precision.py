@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+推理精度模式测试
+验证精度名称解析、设备不支持时的报错，以及int4精度要求量化检查点
+
+运行方式: python -m pytest tests/test_precision.py
+"""
+
+from .test_utils import setup_test_environment, setup_project_path
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+def test_resolve_precision():
+    """各精度解析为对应的dtype和量化方式，不支持的组合报错"""
+    import pytest
+    import torch
+    from src.chat_with_video.precision import resolve_precision
+    
+    assert resolve_precision('fp32', 'cpu').dtype == torch.float32
+    assert resolve_precision('auto', 'xpu').dtype == torch.float16
+    assert resolve_precision('auto', 'cpu', cpu_dtype='float32').dtype == torch.float32
+    
+    int8 = resolve_precision('int8-dynamic', 'cpu')
+    assert int8.quantization == 'int8-dynamic' and int8.dtype == torch.float32
+    assert resolve_precision('int4', 'xpu').quantization == 'int4'
+    
+    with pytest.raises(ValueError):
+        resolve_precision('int8-dynamic', 'xpu')
+    with pytest.raises(ValueError):
+        resolve_precision('fp8', 'cpu')
+
+
+def test_engine_precision_validation():
+    """引擎构造时拒绝未知精度，cpu_int8等同于int8-dynamic；int4精度要求量化检查点"""
+    from types import SimpleNamespace
+    import pytest
+    from src.chat_with_video.model_loader import MiniCPMVInference
+    
+    with pytest.raises(ValueError):
+        MiniCPMVInference(device='cpu', precision='int2', memory_idle_seconds=None)
+    
+    legacy = MiniCPMVInference(device='cpu', cpu_int8=True, memory_idle_seconds=None)
+    legacy._resolve_precision()
+    assert legacy.cpu_int8 and legacy.precision.name == 'int8-dynamic'
+    
+    engine = MiniCPMVInference(device='cpu', precision='int4', memory_idle_seconds=None)
+    engine._resolve_precision()
+    engine.model = SimpleNamespace(config=SimpleNamespace(quantization_config=None))
+    with pytest.raises(ValueError):
+        engine._check_checkpoint_precision()
+    
+    engine.model.config.quantization_config = {'load_in_4bit': True}
+    engine._check_checkpoint_precision()
+    assert engine.get_device_info()['quantized_checkpoint'] is True
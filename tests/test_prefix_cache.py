@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+前缀KV缓存测试
+验证保存时只保留紧凑的前缀副本（不修改调用方的KV、字节统计准确）、复用时只复制公共前缀且
+后续生成不改变缓存内容、公共前缀过短时不复用、按字节数淘汰，以及批量输入的公共前缀对齐
+
+运行方式: python -m pytest tests/test_prefix_cache.py
+"""
+
+from .test_utils import setup_test_environment, setup_project_path
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+NUM_LAYERS, HEADS, HEAD_DIM, HIDDEN = 2, 2, 4, 8
+
+
+def _kv(length: int, seed: int = 0):
+    """随机的DynamicCache，每层 [1, heads, length, head_dim]"""
+    import torch
+    from transformers import DynamicCache
+    
+    generator = torch.Generator().manual_seed(seed)
+    cache = DynamicCache()
+    for layer in range(NUM_LAYERS):
+        cache.update(torch.randn(1, HEADS, length, HEAD_DIM, generator=generator),
+                     torch.randn(1, HEADS, length, HEAD_DIM, generator=generator), layer)
+    return cache
+
+
+def _embeds(length: int, seed: int = 0):
+    import torch
+    return torch.randn(1, length, HIDDEN, generator=torch.Generator().manual_seed(seed))
+
+
+def test_store_keeps_compact_prefix():
+    """保存时复制提示长度的前缀，不引用也不修改调用方的KV，字节统计只计前缀"""
+    import torch
+    from src.chat_with_video.prefix_cache import PrefixKVCache, layer_tensors, cache_nbytes
+    
+    cache = PrefixKVCache(max_bytes=1024**2, min_prefix_tokens=4)
+    embeds = _embeds(32)
+    generated = _kv(40)  # 32个提示token + 8个回答token
+    cache.store('video', embeds, generated)
+    
+    assert generated.get_seq_length() == 40
+    entry = cache._entries['video']
+    assert entry.past_key_values.get_seq_length() == 32
+    for (keys, values), (src_keys, src_values) in zip(layer_tensors(entry.past_key_values),
+                                                      layer_tensors(generated)):
+        assert keys.untyped_storage().data_ptr() != src_keys.untyped_storage().data_ptr()
+        assert keys.untyped_storage().nbytes() == keys.numel() * keys.element_size()
+        assert torch.equal(keys, src_keys[..., :32, :]) and torch.equal(values, src_values[..., :32, :])
+    
+    expected = cache_nbytes(entry.past_key_values) + embeds.numel() * embeds.element_size()
+    assert cache.stats()['size_mb'] * 1024**2 == expected
+
+
+def test_fork_copies_only_prefix():
+    """复用时得到只含公共前缀的独立副本，在副本上继续生成不改变缓存内容"""
+    import torch
+    from src.chat_with_video.prefix_cache import PrefixKVCache, layer_tensors
+    
+    cache = PrefixKVCache(max_bytes=1024**2, min_prefix_tokens=4)
+    embeds = _embeds(32)
+    cache.store('video', embeds, _kv(32))
+    stored = [keys.clone() for keys, _ in layer_tensors(cache._entries['video'].past_key_values)]
+    
+    # 新问题与缓存共享前24个token
+    question = torch.cat([embeds[:, :24], _embeds(10, seed=1)], dim=1)
+    forked, prefix_len = cache.fork('video', question)
+    assert prefix_len == 24 and forked.get_seq_length() == 24
+    
+    forked.update(torch.ones(1, HEADS, 10, HEAD_DIM), torch.ones(1, HEADS, 10, HEAD_DIM), 0)
+    for (keys, _), before in zip(layer_tensors(cache._entries['video'].past_key_values), stored):
+        assert torch.equal(keys, before)
+    
+    # 完全相同的提示至少保留最后一个token做预填充
+    assert cache.fork('video', embeds)[1] == 31
+    
+    # 公共前缀过短或键不存在时不复用
+    assert cache.fork('video', _embeds(32, seed=2)) == (None, 0)
+    assert cache.fork('other', embeds) == (None, 0)
+    
+    stats = cache.stats()
+    assert stats['hits'] == 2 and stats['misses'] == 2 and stats['reused_tokens'] == 24 + 31
+
+
+def test_lru_eviction_by_bytes():
+    """超过字节预算时淘汰最久未使用的前缀，单条超过预算的前缀不保存"""
+    from src.chat_with_video.prefix_cache import PrefixKVCache
+    
+    entry_bytes = 2 * NUM_LAYERS * HEADS * 16 * HEAD_DIM * 4 + 16 * HIDDEN * 4
+    cache = PrefixKVCache(max_bytes=2 * entry_bytes, min_prefix_tokens=4)
+    for key in ('a', 'b'):
+        cache.store(key, _embeds(16), _kv(16))
+    cache.fork('a', _embeds(16))
+    cache.store('c', _embeds(16), _kv(16))
+    assert set(cache._entries) == {'a', 'c'} and cache.stats()['evictions'] == 1
+    
+    cache.store('big', _embeds(64), _kv(64))
+    assert 'big' not in cache._entries
+
+
+def test_align_shared_prefix():
+    """左填充的批量输入重排为“公共前缀 + 填充 + 各自问题”"""
+    import torch
+    from src.chat_with_video.prefix_cache import align_shared_prefix
+    
+    prefix = _embeds(6)
+    questions = [_embeds(2, seed=1), _embeds(4, seed=2)]
+    rows = [torch.cat([prefix, q], dim=1) for q in questions]
+    total = max(row.shape[1] for row in rows)
+    
+    inputs_embeds = torch.zeros(2, total, HIDDEN)
+    attention_mask = torch.zeros(2, total, dtype=torch.long)
+    for b, row in enumerate(rows):
+        inputs_embeds[b, total - row.shape[1]:] = row[0]
+        attention_mask[b, total - row.shape[1]:] = 1
+    
+    aligned, mask, prefix_len = align_shared_prefix(inputs_embeds, attention_mask)
+    assert prefix_len == 6
+    assert torch.equal(aligned[:, :6], prefix.expand(2, -1, -1))
+    assert mask[0].tolist() == [1] * 6 + [0, 0] + [1, 1]
+    assert mask[1].tolist() == [1] * 10
+    assert torch.equal(aligned[0, 8:], questions[0][0]) and torch.equal(aligned[1, 6:], questions[1][0])
+    
+    # 右填充的输入不处理
+    right_padded = attention_mask.flip(dims=[1])
+    assert align_shared_prefix(inputs_embeds, right_padded) is None
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+预fork工作进程池测试
+使用持有大权重张量的桩服务，验证工作进程的结果、错误传递，
+以及工作进程通过写时复制共享权重（私有内存远小于权重大小）
+
+运行方式: python -m pytest tests/test_prefork_pool.py
+"""
+
+from .test_utils import setup_test_environment, setup_project_path
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+WEIGHT_MB = 256
+
+
+class StubEngine:
+    """只有设备和调度器属性的推理引擎桩"""
+    
+    device = 'cpu'
+    scheduler = None
+
+
+class StubService:
+    """持有大权重张量的服务桩，chat_with_frames对问题做一次矩阵运算"""
+    
+    def __init__(self):
+        self.num_threads = None
+        self.inference_engine = None
+        self._initialized = False
+        self.weight = None
+    
+    def initialize(self) -> bool:
+        import torch
+        
+        torch.manual_seed(0)
+        self.weight = torch.randn(WEIGHT_MB * 1024**2 // 4 // 1024, 1024)
+        self.inference_engine = StubEngine()
+        self._initialized = True
+        return True
+    
+    def chat_with_frames(self, frames, temporal_ids, question, **kwargs):
+        import torch
+        
+        if question == 'fail':
+            raise ValueError("bad question")
+        x = torch.full((1, 1024), float(len(question)))
+        return f"{question}:{float((self.weight[:4096] @ x.T).sum()):.3f}"
+
+
+def test_workers_share_weights():
+    """工作进程返回与父进程一致的结果，且权重不被复制"""
+    import pytest
+    from src.chat_with_video.prefork_pool import PreforkWorkerPool
+    
+    service = StubService()
+    pool = PreforkWorkerPool(service, num_workers=2).start()
+    try:
+        questions = [f"问题{i}" * (i + 1) for i in range(8)]
+        futures = [pool.submit('chat_with_frames', [], [], q) for q in questions]
+        answers = [f.result(timeout=60) for f in futures]
+        assert answers == [service.chat_with_frames([], [], q) for q in questions]
+        
+        with pytest.raises(RuntimeError, match="bad question"):
+            pool.chat_with_frames([], [], 'fail')
+        
+        stats = pool.stats()
+        assert sum(w['completed'] for w in stats['workers']) == 8
+        assert sum(w['failed'] for w in stats['workers']) == 1
+        for worker in stats['workers']:
+            memory = worker['memory_mb']
+            if memory:
+                # 权重页面与父进程共享，工作进程独占内存远小于权重
+                assert memory['private'] < WEIGHT_MB / 2, memory
+    finally:
+        pool.stop()
+
+
+def test_split_cores():
+    """CPU核按连续分组，核数不足时共享"""
+    from src.chat_with_video.prefork_pool import split_cores
+    
+    assert split_cores(list(range(8)), 3) == [[0, 1, 2], [3, 4, 5], [6, 7]]
+    assert split_cores([0], 2) == [[0], [0]]
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+视频预读测试
+验证按帧采样计划估算的字节范围、只覆盖文件头尾的容器预读，
+以及编码器在打开VideoReader之前就开始预读容器元数据和索引
+
+运行方式: python -m pytest tests/test_readahead.py
+"""
+
+from .test_utils import setup_test_environment, setup_project_path
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+def test_byte_ranges(tmp_path):
+    """帧范围按比例映射到文件偏移并合并；容器预读只包含文件头尾"""
+    from src.chat_with_video.readahead import FrameReadahead
+    
+    path = tmp_path / 'video.bin'
+    path.write_bytes(b'\0' * (8 * 1024 * 1024))
+    size = 8 * 1024 * 1024
+    
+    class SmallHeader(FrameReadahead):
+        HEADER_BYTES = 1024
+    
+    ranges = SmallHeader(str(path), [100, 101, 700], total_frames=800, fps=10, gop_seconds=1.0).byte_ranges()
+    assert ranges[0] == (0, 1024) and ranges[-1] == (size - 1024, 1024)
+    # 相邻的帧100和101合并为一个范围
+    assert len(ranges) == 4
+    assert all(a[0] + a[1] <= b[0] for a, b in zip(ranges, ranges[1:]))
+    
+    container = SmallHeader.container(str(path)).byte_ranges()
+    assert container == [(0, 1024), (size - 1024, 1024)]
+
+
+def test_prefetch_thread_reads_planned_bytes(tmp_path):
+    """后台线程按计划读取各范围"""
+    from src.chat_with_video.readahead import FrameReadahead
+    
+    path = tmp_path / 'video.bin'
+    path.write_bytes(b'\0' * (4 * 1024 * 1024))
+    
+    readahead = FrameReadahead.container(str(path), strategy='thread').start()
+    readahead._thread.join(timeout=10)
+    readahead.stop()
+    stats = readahead.stats()
+    assert stats['bytes_prefetched'] == stats['bytes_planned'] > 0
+
+
+def test_container_readahead_starts_before_reader_opens(tmp_path, monkeypatch):
+    """启用预读时容器预读在VideoReader初始化之前启动，帧预读在之后"""
+    from .test_frame_cache import write_test_video
+    from src.chat_with_video import video_encoder
+    from src.chat_with_video.readahead import FrameReadahead
+    
+    events = []
+    
+    class RecordingReadahead(FrameReadahead):
+        def start(self):
+            events.append('container' if not self.frame_indices else 'frames')
+            return super().start()
+    
+    original_reader = video_encoder.VideoReader
+    
+    def recording_reader(*args, **kwargs):
+        events.append('open')
+        return original_reader(*args, **kwargs)
+    
+    monkeypatch.setattr(video_encoder, 'FrameReadahead', RecordingReadahead)
+    monkeypatch.setattr(video_encoder, 'VideoReader', recording_reader)
+    
+    path = write_test_video(tmp_path / 'video.mp4')
+    encoder = video_encoder.VideoEncoder(max_frames=64, max_packing=1, readahead='thread')
+    encoder.encode_video(path, choose_fps=2)
+    
+    assert events == ['container', 'open', 'frames']
+    # 预读在解码结束后停止，读取的字节数取决于时序，只检查两段预读都有统计
+    assert {'header_bytes_prefetched', 'bytes_prefetched'} <= set(encoder.last_readahead_stats)
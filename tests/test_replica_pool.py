@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+多副本模型池测试
+使用按生成token数耗时的桩服务，验证负载路由、错误传递、副本指标和吞吐随副本数增长
+
+运行方式: python -m pytest tests/test_replica_pool.py
+"""
+
+import time
+
+from .test_utils import setup_test_environment, setup_project_path
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+SECONDS_PER_TOKEN = 0.001
+
+
+class StubService:
+    """桩服务：chat_with_frames按max_new_tokens休眠，模拟解码耗时"""
+    
+    def __init__(self, spec):
+        self.spec = spec
+        self._initialized = False
+    
+    def initialize(self) -> bool:
+        self._initialized = True
+        return True
+    
+    def chat_with_frames(self, frames, temporal_ids, question, max_new_tokens=2048, **kwargs):
+        if question == 'fail':
+            raise ValueError("bad question")
+        time.sleep(max_new_tokens * SECONDS_PER_TOKEN)
+        return f"{question}@{self.spec.device}"
+
+
+def _pool(num_replicas):
+    from src.chat_with_video.replica_pool import ReplicaPool, ReplicaSpec
+    
+    specs = [ReplicaSpec(f'stub:{i}') for i in range(num_replicas)]
+    return ReplicaPool(specs, service_factory=StubService).start()
+
+
+def test_routes_to_least_loaded_replica():
+    """长请求占用的副本不再接收新请求，直到其他副本的在途token更多"""
+    pool = _pool(2)
+    try:
+        long_request = pool.submit('chat_with_frames', [], [], 'long', max_new_tokens=300)
+        short = [pool.submit('chat_with_frames', [], [], f'short{i}', max_new_tokens=20) for i in range(4)]
+        
+        stats = pool.stats()['replicas']
+        assert stats[0]['in_flight_tokens'] == 300
+        assert stats[1]['queue_depth'] == 4 and stats[1]['in_flight_tokens'] == 80
+        
+        assert long_request.result(timeout=10) == 'long@stub:0'
+        assert [f.result(timeout=10) for f in short] == [f'short{i}@stub:1' for i in range(4)]
+        
+        stats = pool.stats()
+        assert stats['completed'] == 5 and stats['queue_depth'] == 0
+        assert all(r['in_flight_tokens'] == 0 for r in stats['replicas'])
+        assert stats['replicas'][1]['avg_latency'] > 0
+    finally:
+        pool.stop()
+
+
+def test_errors_propagate():
+    """副本上的异常通过Future返回给调用方，并计入失败数"""
+    import pytest
+    
+    pool = _pool(2)
+    try:
+        with pytest.raises(ValueError, match="bad question"):
+            pool.chat_with_frames([], [], 'fail')
+        assert pool.chat_with_frames([], [], 'ok', max_new_tokens=1) == 'ok@stub:0'
+        assert sum(r['failed'] for r in pool.stats()['replicas']) == 1
+        
+        with pytest.raises(ValueError):
+            pool.submit('shutdown')
+    finally:
+        pool.stop()
+
+
+def test_throughput_scales_with_replicas():
+    """相同负载下，4个副本的吞吐接近单副本的4倍"""
+    def run(num_replicas):
+        pool = _pool(num_replicas)
+        try:
+            start = time.time()
+            futures = [pool.submit('chat_with_frames', [], [], str(i), max_new_tokens=50) for i in range(16)]
+            for future in futures:
+                future.result(timeout=30)
+            return time.time() - start
+        finally:
+            pool.stop()
+    
+    assert run(1) / run(4) > 3.0
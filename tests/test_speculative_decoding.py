@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+推测解码测试
+使用CPU上随机初始化的小型Llama作为主模型和草稿模型，验证贪心解码结果与主模型逐token解码一致、
+提示预填充只计算最后一个位置的logits，以及接受率统计
+
+运行方式: python -m pytest tests/test_speculative_decoding.py
+"""
+
+from .test_utils import setup_test_environment, setup_project_path
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+VOCAB_SIZE = 300
+EOS_TOKEN_ID = 2
+
+
+def build_llama(seed: int, num_layers: int):
+    """构造小型Llama因果语言模型"""
+    import torch
+    from transformers import LlamaConfig, LlamaForCausalLM
+    
+    torch.manual_seed(seed)
+    config = LlamaConfig(vocab_size=VOCAB_SIZE, hidden_size=64, intermediate_size=128,
+                         num_hidden_layers=num_layers, num_attention_heads=4, num_key_value_heads=4)
+    return LlamaForCausalLM(config).eval()
+
+
+def _prompt(max_new_tokens: int, do_sample: bool = False):
+    import torch
+    from src.chat_with_video.inference_scheduler import PreparedPrompt
+    
+    torch.manual_seed(1)
+    input_ids = torch.randint(3, VOCAB_SIZE, (1, 12))
+    return input_ids, PreparedPrompt(
+        inputs_embeds=None, eos_token_ids=[EOS_TOKEN_ID], max_new_tokens=max_new_tokens,
+        do_sample=do_sample, temperature=0.7, top_p=0.8, top_k=100, repetition_penalty=1.0
+    )
+
+
+def test_greedy_matches_target_decoding():
+    """草稿模型与主模型不同时，贪心推测解码的输出仍与主模型逐token解码完全一致"""
+    import torch
+    from src.chat_with_video.speculative_decoding import SpeculativeDecoder
+    
+    target = build_llama(seed=0, num_layers=4)
+    draft = build_llama(seed=1, num_layers=1)
+    input_ids, prompt = _prompt(max_new_tokens=24)
+    
+    with torch.no_grad():
+        inputs_embeds = target.model.embed_tokens(input_ids)
+        expected = target.generate(inputs_embeds=inputs_embeds, max_new_tokens=24, do_sample=False,
+                                   eos_token_id=EOS_TOKEN_ID, pad_token_id=0)[0].tolist()
+    
+    logits_lengths = []
+    target.lm_head.register_forward_hook(lambda module, args, output: logits_lengths.append(output.shape[1]))
+    decoder = SpeculativeDecoder(draft, lookahead=4)
+    assert decoder.generate(target, inputs_embeds, input_ids, prompt) == expected
+    
+    # 提示预填充只计算最后一个位置的logits，验证前向计算全部提议位置
+    assert logits_lengths[0] == 1 and max(logits_lengths[1:]) == 4 + 1
+    
+    stats = decoder.stats()
+    assert stats['calls'] == 1 and stats['generated_tokens'] == len(expected)
+    assert stats['proposed_tokens'] > 0
+
+
+def test_identical_draft_accepts_all_tokens():
+    """草稿模型与主模型相同时全部接受，每次主模型前向生成lookahead+1个token"""
+    import torch
+    from src.chat_with_video.speculative_decoding import SpeculativeDecoder
+    
+    target = build_llama(seed=0, num_layers=2)
+    input_ids, prompt = _prompt(max_new_tokens=21)
+    with torch.no_grad():
+        inputs_embeds = target.model.embed_tokens(input_ids)
+    
+    decoder = SpeculativeDecoder(target, lookahead=4)
+    tokens = decoder.generate(target, inputs_embeds, input_ids, prompt)
+    
+    stats = decoder.stats()
+    assert len(tokens) == 21
+    assert stats['acceptance_rate'] == 1.0
+    # 预填充1次 + 每轮验证生成5个token
+    assert stats['target_forwards'] == 1 + 4
+
+
+def test_sampling_respects_limits():
+    """采样模式下遵守最大长度，且结束token之后不再输出"""
+    import torch
+    from src.chat_with_video.speculative_decoding import SpeculativeDecoder
+    
+    target = build_llama(seed=0, num_layers=2)
+    draft = build_llama(seed=1, num_layers=1)
+    input_ids, prompt = _prompt(max_new_tokens=30, do_sample=True)
+    prompt.eos_token_ids = {EOS_TOKEN_ID, 7}
+    with torch.no_grad():
+        inputs_embeds = target.model.embed_tokens(input_ids)
+    
+    decoder = SpeculativeDecoder(draft, lookahead=3)
+    for _ in range(3):
+        tokens = decoder.generate(target, inputs_embeds, input_ids, prompt)
+        assert 1 <= len(tokens) <= 30
+        assert not any(t in prompt.eos_token_ids for t in tokens[:-1])
+    
+    assert 0.0 <= decoder.stats()['acceptance_rate'] <= 1.0
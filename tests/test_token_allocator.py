@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+视觉token分配测试
+验证场景切换帧的检测、在全局预算内为高分辨率关键帧分配切片、预算不足时减少切片数或不分配，
+以及非关键帧缩小到单切片分辨率
+
+运行方式: python -m pytest tests/test_token_allocator.py
+"""
+
+from .test_utils import setup_test_environment, setup_project_path
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+def _scenes(colors, repeat: int = 4, size=(896, 896)):
+    """每个颜色一个场景，每个场景repeat帧"""
+    from PIL import Image
+    
+    frames = [Image.new('RGB', size, color) for color in colors for _ in range(repeat)]
+    temporal_ids = [[i] for i in range(len(frames))]
+    return frames, temporal_ids
+
+
+def test_detect_keyframes():
+    """场景起始帧被检测为关键帧，差异越大越靠前"""
+    from src.chat_with_video.token_allocator import FrameTokenAllocator
+    
+    frames, _ = _scenes([(0, 0, 0), (255, 255, 255), (128, 128, 128)], size=(64, 64))
+    allocator = FrameTokenAllocator()
+    scores = allocator.frame_scores(frames)
+    assert scores[0] == 1.0 and scores[1] == 0.0
+    
+    assert allocator.detect_keyframes(frames) == [0, 4, 8]
+    assert allocator.detect_keyframes([]) == []
+
+
+def test_allocate_within_budget():
+    """预算充足时关键帧使用最大切片数，预算减少时降低切片数，估算token不超过预算"""
+    from src.chat_with_video.token_allocator import FrameTokenAllocator
+    
+    frames, temporal_ids = _scenes([(0, 0, 0), (255, 255, 255), (128, 128, 128)])
+    allocator = FrameTokenAllocator(token_budget=8192, tokens_per_image=64, max_detail_slices=4)
+    base = len(temporal_ids) * 64
+    
+    allocation = allocator.allocate(frames, temporal_ids)
+    assert allocation.detail_indices == [0, 4, 8] and allocation.max_slice_nums == 4
+    assert allocation.estimated_tokens == base + 3 * 4 * 64
+    
+    # 只够两个关键帧各4个切片
+    allocation = allocator.allocate(frames, temporal_ids, token_budget=base + 2 * 4 * 64)
+    assert len(allocation.detail_indices) == 2 and allocation.max_slice_nums == 4
+    
+    # 只够一个关键帧2个切片
+    allocation = allocator.allocate(frames, temporal_ids, token_budget=base + 2 * 64)
+    assert len(allocation.detail_indices) == 1 and allocation.max_slice_nums == 2
+    assert allocation.estimated_tokens <= base + 2 * 64
+    
+    # 基础开销已超出预算
+    allocation = allocator.allocate(frames, temporal_ids, token_budget=base - 1)
+    assert allocation.detail_indices == [] and allocation.max_slice_nums == 1
+
+
+def test_non_keyframes_are_downscaled():
+    """非关键帧缩小到单切片面积以内，关键帧保持原分辨率；低分辨率帧不分配细节"""
+    from src.chat_with_video.token_allocator import FrameTokenAllocator
+    
+    frames, temporal_ids = _scenes([(0, 0, 0), (255, 255, 255)])
+    allocator = FrameTokenAllocator(token_budget=8192, scale_resolution=448)
+    allocation = allocator.allocate(frames, temporal_ids)
+    
+    for i, frame in enumerate(allocation.frames):
+        if i in allocation.detail_indices:
+            assert frame.size == (896, 896)
+        else:
+            assert frame.size[0] * frame.size[1] <= 448 * 448
+    
+    small, small_ids = _scenes([(0, 0, 0), (255, 255, 255)], size=(320, 240))
+    allocation = allocator.allocate(small, small_ids)
+    assert allocation.detail_indices == [] and allocation.max_slice_nums == 1
+    assert all(a is b for a, b in zip(allocation.frames, small))
+    assert allocation.summary()['detail_frames'] == 0
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+视频形状预热测试
+验证合成视频与encode_video输出形状一致、服务默认只预热少量小形状、按配置/编译桶选择预热形状，
+以及推理引擎对每个视频形状走完整的chat路径并报告各步骤耗时
+
+运行方式: python -m pytest tests/test_video_warm_up.py
+"""
+
+from types import SimpleNamespace
+
+from .test_utils import setup_test_environment, setup_project_path
+
+# 设置测试环境
+setup_test_environment()
+setup_project_path()
+
+
+class StubModel:
+    """记录chat调用的模型桩"""
+    
+    def __init__(self):
+        self.config = SimpleNamespace(query_num=64)
+        self.calls = []
+    
+    def get_vllm_embedding(self, data):
+        return None, None
+    
+    def chat(self, msgs, tokenizer, **kwargs):
+        self.calls.append((msgs, kwargs))
+        return "ok"
+
+
+def test_synthetic_video_shape():
+    """合成视频按打包数分组，时序ID单调递增，宽高比与缓冲池分辨率一致"""
+    from src.chat_with_video.video_encoder import VideoEncoder
+    
+    encoder = VideoEncoder(max_frames=10, max_packing=3, frame_cache_bytes=0)
+    frames, temporal_ids = encoder.synthetic_video()
+    
+    assert len(frames) == 30
+    assert [len(group) for group in temporal_ids] == [3] * 10
+    flat = [t for group in temporal_ids for t in group]
+    assert flat == sorted(flat) and len(set(flat)) == len(flat)
+    
+    width, height = frames[0].size
+    assert abs(width / height - 1280 / 720) < 0.02
+    # 只生成少量不同的帧
+    assert len({id(frame) for frame in frames}) == 8
+    
+    frames, temporal_ids = encoder.synthetic_video(7, packing_nums=2)
+    assert len(frames) == 7 and [len(g) for g in temporal_ids] == [2, 2, 2, 1]
+
+
+def test_service_warm_up_shapes():
+    """默认预热少量小形状，最大形状需显式指定；启用编译时每个预填充桶一个形状"""
+    from src.chat_with_video.video_chat_service import VideoChatService
+    
+    service = VideoChatService(max_frames=60, max_packing=3)
+    service.inference_engine = SimpleNamespace(model=StubModel(), compiled=None)
+    labels = [label for label, _, _ in service._warm_up_videos()]
+    assert labels == ["视频 3帧/1组", "视频 24帧/8组"]
+    
+    # 组数不超过max_frames
+    small = VideoChatService(max_frames=4, max_packing=2)
+    small.inference_engine = service.inference_engine
+    assert [label for label, _, _ in small._warm_up_videos()] == ["视频 2帧/1组", "视频 8帧/4组"]
+    
+    service.warm_up_frames = [60 * 3]
+    assert [label for label, _, _ in service._warm_up_videos()] == ["视频 180帧/60组"]
+    service.warm_up_frames = None
+    
+    service.inference_engine.compiled = SimpleNamespace(prompt_buckets=(64, 256, 1024, 2048, 8192))
+    videos = service._warm_up_videos()
+    groups = [len(temporal_ids) for _, _, temporal_ids in videos]
+    # 256 -> 1组, 1024 -> 12组, 2048 -> 26组, 8192 -> 受max_frames限制为60组
+    assert groups == [1, 12, 26, 60]
+    
+    service.warm_up_frames = []
+    assert service._warm_up_videos() == []
+
+
+def test_engine_warm_up_runs_video_path():
+    """引擎预热先做文本预热，再对每个视频形状调用带temporal_ids的chat"""
+    from src.chat_with_video.model_loader import MiniCPMVInference
+    from src.chat_with_video.video_encoder import VideoEncoder
+    
+    engine = MiniCPMVInference(device='cpu')
+    engine.model = StubModel()
+    engine.tokenizer = object()
+    engine._initialized = True
+    
+    encoder = VideoEncoder(max_frames=4, max_packing=2, frame_cache_bytes=0)
+    frames, temporal_ids = encoder.synthetic_video()
+    timings = engine.warm_up([("视频 8帧/4组", frames, temporal_ids)], max_new_tokens=4)
+    
+    assert list(timings) == ['文本', "视频 8帧/4组"]
+    text_call, video_call = engine.model.calls
+    assert text_call[1]['max_new_tokens'] == 10
+    assert len(video_call[0][0]['content']) == 9
+    assert video_call[1]['temporal_ids'] == temporal_ids
+    assert video_call[1]['max_new_tokens'] == 4
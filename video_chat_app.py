@@ -81,6 +81,7 @@ class LazyVideoChatApp:
             
             self.current_video_data = (frames, temporal_ids)
             process_time = time.time() - start_time
+            cache_stats = self.service.video_encoder.last_cache_stats
             
             return f"""✅ 视频处理完成！
 
@@ -88,6 +89,7 @@ class LazyVideoChatApp:
 - 提取帧数: {len(frames)}
 - 时序组数: {len(temporal_ids)} 
 - 处理耗时: {process_time:.2f}秒
+- 解码帧缓存命中: {cache_stats.get('hits', 0)}/{cache_stats.get('requested', 0)} ({cache_stats.get('hit_ratio', 0.0):.1%})
 
 💬 现在可以开始聊天了！"""
             